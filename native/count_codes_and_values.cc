@@ -11,6 +11,7 @@
 #include "parse_utils.hh"
 #include "picosha2.h"
 #include "readerwritercircularbuffer.h"
+#include "row_groups.hh"
 #include "thread_utils.hh"
 
 using CodeCounter = absl::flat_hash_map<int64_t, size_t>;
@@ -45,28 +46,29 @@ convert_to_vector(const T& container) {
 void clean_thread(const boost::filesystem::path& in_path,
                   CodeCounter& code_counts,
                   const boost::filesystem::path& out_path) {
-    CSVReader<ZstdReader> reader(in_path, {"value", "concept_id"}, ',');
     CSVWriter<ZstdWriter> writer(out_path, {"value"}, ',');
 
-    while (reader.next_row()) {
-        int64_t code;
-        attempt_parse_or_die(reader.get_row()[1], code);
-        code_counts[code] += 1;
+    read_text_rows(
+        in_path, {"value", "concept_id"}, ',',
+        [&](std::vector<std::string>& row) {
+            int64_t code;
+            attempt_parse_or_die(row[1], code);
+            code_counts[code] += 1;
 
-        auto& text_value = reader.get_row()[0];
+            auto& text_value = row[0];
 
-        if (text_value.empty()) {
-            continue;
-        }
+            if (text_value.empty()) {
+                return;
+            }
 
-        double value;
-        if (absl::SimpleAtod(text_value, &value)) {
-            continue;
-        }
+            double value;
+            if (absl::SimpleAtod(text_value, &value)) {
+                return;
+            }
 
-        reader.get_row().resize(1);
-        writer.add_row(reader.get_row());
-    }
+            row.resize(1);
+            writer.add_row(row);
+        });
 }
 
 void process_thread(
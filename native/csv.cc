@@ -79,8 +79,9 @@ void TextWriter::add_data(std::string_view data) {
 
 void ZSTDDFree::operator()(ZSTD_DStream* ptr) { ZSTD_freeDStream(ptr); }
 
-ZstdReader::ZstdReader(const boost::filesystem::path& filename)
-    : fname(filename), reader(filename) {
+ZstdReader::ZstdReader(const boost::filesystem::path& filename,
+                       size_t offset)
+    : fname(filename), reader(filename, offset) {
     stream.reset(ZSTD_createDStream());
     ZSTD_initDStream(stream.get());
 
@@ -122,7 +123,8 @@ void ZstdReader::seek(size_t seek_amount) {
 
 bool ZstdReader::eof() const { return reader.eof() && out_buffer_end == 0; }
 
-TextReader::TextReader(const boost::filesystem::path& filename)
+TextReader::TextReader(const boost::filesystem::path& filename,
+                       size_t offset)
     : fname(filename) {
     if (!boost::filesystem::is_regular_file(filename)) {
         throw std::runtime_error(
@@ -131,6 +133,7 @@ TextReader::TextReader(const boost::filesystem::path& filename)
 
     f.rdbuf()->pubsetbuf(nullptr, 0);
     f.open(fname.c_str());
+    f.seekg(offset);
 
     buffer_data.resize(BUFFER_SIZE);
     buffer_end = 0;
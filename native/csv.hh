@@ -54,7 +54,8 @@ class ZSTDDFree {
 
 class TextReader {
    public:
-    explicit TextReader(const boost::filesystem::path& filename);
+    explicit TextReader(const boost::filesystem::path& filename,
+                        size_t offset = 0);
 
     std::string_view get_data() const;
 
@@ -71,7 +72,9 @@ class TextReader {
 
 class ZstdReader {
    public:
-    explicit ZstdReader(const boost::filesystem::path& filename);
+    // The offset must be at the start of a zstd frame
+    explicit ZstdReader(const boost::filesystem::path& filename,
+                        size_t offset = 0);
 
     std::string_view get_data() const;
 
@@ -207,8 +210,8 @@ inline size_t line_iter(std::string_view line, char delimiter, F f) {
 }
 
 template <typename Reader>
-std::vector<std::string> get_csv_columns_from_reader(Reader& reader,
-                                                     char delimiter) {
+std::vector<std::string> get_csv_columns_from_reader(
+    Reader& reader, char delimiter, size_t* header_size = nullptr) {
     std::string_view line = reader.get_data();
     std::vector<std::string> result;
 
@@ -221,6 +224,9 @@ std::vector<std::string> get_csv_columns_from_reader(Reader& reader,
                                  reader.fname.string());
     }
     reader.seek(increment);
+    if (header_size != nullptr) {
+        *header_size = increment;
+    }
 
     return result;
 }
@@ -242,7 +248,7 @@ class CSVReader {
     CSVReader(const boost::filesystem::path& filename, char _delimiter)
         : reader(filename), delimiter(_delimiter) {
         std::vector<std::string> file_columns =
-            get_csv_columns_from_reader(reader, delimiter);
+            get_csv_columns_from_reader(reader, delimiter, &consumed);
         columns = file_columns;
         init_helper(file_columns);
     }
@@ -251,10 +257,53 @@ class CSVReader {
               const std::vector<std::string>& _columns, char _delimiter)
         : columns(_columns), reader(filename), delimiter(_delimiter) {
         std::vector<std::string> file_columns =
-            get_csv_columns_from_reader(reader, delimiter);
+            get_csv_columns_from_reader(reader, delimiter, &consumed);
+        init_helper(file_columns);
+    }
+
+    // Read a file starting at the given offset, which must be after the
+    // header. Positions are then relative to the offset.
+    CSVReader(const boost::filesystem::path& filename,
+              const std::vector<std::string>& file_columns,
+              const std::vector<std::string>& _columns, char _delimiter,
+              size_t offset)
+        : columns(_columns), reader(filename, offset), delimiter(_delimiter) {
         init_helper(file_columns);
     }
 
+    // The position of the next row, in bytes of decompressed data
+    size_t get_position() const { return consumed + current_offset; }
+
+    void skip(size_t num_bytes) {
+        while (true) {
+            size_t available = reader.get_data().size() - current_offset;
+            if (num_bytes <= available) {
+                current_offset += num_bytes;
+                return;
+            }
+            if (reader.eof()) {
+                throw std::runtime_error(absl::StrCat(
+                    "Cannot skip past the end of ", reader.fname.string()));
+            }
+            num_bytes -= available;
+            consume_buffer();
+        }
+    }
+
+    // Skip past the next newline, or to the end of the file if there is none
+    void skip_line() {
+        while (!reader.eof()) {
+            std::string_view data = reader.get_data().substr(current_offset);
+            size_t newline = data.find('\n');
+            if (newline != std::string_view::npos) {
+                current_offset += newline + 1;
+                return;
+            }
+            current_offset += data.size();
+            consume_buffer();
+        }
+    }
+
     std::vector<std::string>& get_row() {
         for (const auto& item : current_row_set) {
             if (!item) {
@@ -293,8 +342,13 @@ class CSVReader {
             if (reader.eof()) {
                 return false;
             } else {
-                reader.seek(current_offset);
-                current_offset = 0;
+                size_t remaining = line.size();
+                consume_buffer();
+                if (remaining != 0 && reader.get_data().size() == remaining) {
+                    throw std::runtime_error(
+                        absl::StrCat("Incomplete or too long row in ",
+                                     reader.fname.string()));
+                }
                 return next_row();
             }
         } else {
@@ -314,6 +368,12 @@ class CSVReader {
     std::vector<std::string> columns;
 
    private:
+    void consume_buffer() {
+        consumed += current_offset;
+        reader.seek(current_offset);
+        current_offset = 0;
+    }
+
     void init_helper(const std::vector<std::string>& file_columns) {
         current_row.resize(columns.size());
         current_row_set.resize(columns.size());
@@ -351,6 +411,7 @@ class CSVReader {
     }
 
     size_t current_offset;
+    size_t consumed = 0;
     Reader reader;
     std::vector<ssize_t> column_map;
     std::vector<std::string> current_row;
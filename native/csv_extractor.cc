@@ -0,0 +1,445 @@
+#include "csv_extractor.hh"
+
+#include <algorithm>
+#include <cctype>
+#include <cstring>
+#include <memory>
+#include <vector>
+
+#include "absl/strings/numbers.h"
+#include "absl/strings/str_cat.h"
+#include "absl/time/civil_time.h"
+#include "csv.hh"
+#include "parse_utils.hh"
+#include "row_groups.hh"
+
+namespace {
+
+// This must match _EVENT_COLUMNS in femr/datasets/fileio.py
+const RowGroupSchema EVENT_SCHEMA = {
+    {"patient_id", RowGroupColumnType::INT64},
+    {"start", RowGroupColumnType::DATETIME},
+    {"concept_id", RowGroupColumnType::INT64},
+    {"value", RowGroupColumnType::VALUE},
+    {"visit_id", RowGroupColumnType::INT64},
+    {"end", RowGroupColumnType::DATETIME},
+    {"omop_table", RowGroupColumnType::STRING},
+    {"unit", RowGroupColumnType::STRING},
+    {"metadata", RowGroupColumnType::BYTES},
+};
+
+const std::string EMPTY;
+
+template <typename T>
+std::string encode_cell(T value) {
+    return std::string(reinterpret_cast<const char*>(&value), sizeof(value));
+}
+
+bool parse_digits(std::string_view text, size_t start, size_t length,
+                  int& value) {
+    if (start + length > text.size()) {
+        return false;
+    }
+    value = 0;
+    for (size_t i = start; i < start + length; i++) {
+        if (text[i] < '0' || text[i] > '9') {
+            return false;
+        }
+        value = value * 10 + (text[i] - '0');
+    }
+    return true;
+}
+
+// Parse the formats accepted by Python's datetime.fromisoformat, except for
+// time zones, as microseconds since 1970.
+bool parse_iso_datetime(std::string_view text, int64_t& microseconds) {
+    int year, month, day;
+    int hour = 0, minute = 0, second = 0, fraction = 0;
+
+    if (!parse_digits(text, 0, 4, year) || text.size() < 10 ||
+        text[4] != '-' || !parse_digits(text, 5, 2, month) || text[7] != '-' ||
+        !parse_digits(text, 8, 2, day)) {
+        return false;
+    }
+
+    size_t pos = 10;
+    if (text.size() > pos) {
+        // Any single character can separate the date and the time
+        if (!parse_digits(text, pos + 1, 2, hour)) {
+            return false;
+        }
+        pos += 3;
+        if (text.size() > pos && text[pos] == ':') {
+            if (!parse_digits(text, pos + 1, 2, minute)) {
+                return false;
+            }
+            pos += 3;
+            if (text.size() > pos && text[pos] == ':') {
+                if (!parse_digits(text, pos + 1, 2, second)) {
+                    return false;
+                }
+                pos += 3;
+                if (text.size() > pos && text[pos] == '.') {
+                    size_t num_digits = text.size() - pos - 1;
+                    if ((num_digits != 3 && num_digits != 6) ||
+                        !parse_digits(text, pos + 1, num_digits, fraction)) {
+                        return false;
+                    }
+                    if (num_digits == 3) {
+                        fraction *= 1000;
+                    }
+                    pos = text.size();
+                }
+            }
+        }
+    }
+
+    if (pos != text.size()) {
+        return false;
+    }
+
+    absl::CivilSecond time(year, month, day, hour, minute, second);
+    if (time.year() != year || time.month() != month || time.day() != day ||
+        time.hour() != hour || time.minute() != minute ||
+        time.second() != second) {
+        // absl normalizes out of range fields instead of failing
+        return false;
+    }
+
+    microseconds =
+        (time - absl::CivilSecond(1970, 1, 1, 0, 0, 0)) * 1000000 + fraction;
+    return true;
+}
+
+// Pickle a dictionary of strings, which is what the Python extractor stores
+// as the non standard metadata of an event.
+std::string pickle_string_dict(
+    const std::vector<std::pair<std::string_view, std::string_view>>& items) {
+    std::string result = "}(";
+    for (const auto& entry : items) {
+        for (std::string_view text : {entry.first, entry.second}) {
+            result.push_back('X');
+            result.append(encode_cell<uint32_t>(text.size()));
+            result.append(text);
+        }
+    }
+    result.append("u.");
+    return result;
+}
+
+class DebugWriter {
+   public:
+    DebugWriter(const boost::filesystem::path& _filename,
+                const std::vector<std::string>& _columns)
+        : filename(_filename), columns(_columns) {
+        columns.push_back("extractor");
+    }
+
+    void add_row(const std::vector<std::string>& row,
+                 const std::string& debug_name) {
+        if (!zstd_writer && !text_writer) {
+            boost::filesystem::create_directories(filename.parent_path());
+            if (filename.extension() == ".zst") {
+                zstd_writer = std::make_unique<CSVWriter<ZstdWriter>>(
+                    filename, columns, ',');
+            } else {
+                text_writer = std::make_unique<CSVWriter<TextWriter>>(
+                    filename, columns, ',');
+            }
+        }
+
+        debug_row = row;
+        debug_row.push_back(debug_name);
+        if (zstd_writer) {
+            zstd_writer->add_row(debug_row);
+        } else {
+            text_writer->add_row(debug_row);
+        }
+    }
+
+   private:
+    boost::filesystem::path filename;
+    std::vector<std::string> columns;
+    std::vector<std::string> debug_row;
+    std::unique_ptr<CSVWriter<ZstdWriter>> zstd_writer;
+    std::unique_ptr<CSVWriter<TextWriter>> text_writer;
+};
+
+template <typename Reader>
+ExtractorResult extract_concept_table_helper(
+    const boost::filesystem::path& source,
+    const boost::filesystem::path& target, const ConceptTableSpec& spec,
+    char delimiter, const boost::optional<boost::filesystem::path>& debug_file,
+    const std::string& debug_name, const SourceChunk& chunk) {
+    std::vector<std::string> file_columns = get_csv_columns(source, delimiter);
+    std::vector<std::string> lower_columns;
+    for (const auto& column : file_columns) {
+        std::string lower = column;
+        std::transform(std::begin(lower), std::end(lower), std::begin(lower),
+                       [](unsigned char c) { return std::tolower(c); });
+        lower_columns.push_back(std::move(lower));
+    }
+
+    // Only read the columns the spec uses, unless every column is needed for
+    // the debug file
+    bool read_all = debug_file != boost::none;
+    std::vector<std::string> read_columns;
+    if (read_all) {
+        read_columns = file_columns;
+    }
+
+    // Get the index of a column in the rows we read, or -1 if it is missing
+    auto get_index = [&](const std::string& name) -> ssize_t {
+        if (name.empty()) {
+            return -1;
+        }
+        // Later columns take precedence, as with the lowercased Python dict
+        auto iter = std::find(std::rbegin(lower_columns),
+                              std::rend(lower_columns), name);
+        if (iter == std::rend(lower_columns)) {
+            return -1;
+        }
+        ssize_t file_index = std::rend(lower_columns) - iter - 1;
+        if (read_all) {
+            return file_index;
+        }
+        auto read_iter = std::find(std::begin(read_columns),
+                                   std::end(read_columns),
+                                   file_columns[file_index]);
+        if (read_iter == std::end(read_columns)) {
+            read_columns.push_back(file_columns[file_index]);
+            return read_columns.size() - 1;
+        } else {
+            return read_iter - std::begin(read_columns);
+        }
+    };
+
+    ssize_t patient_id_index = get_index(spec.patient_id_field);
+    ssize_t concept_id_index = get_index(spec.concept_id_field);
+    ssize_t source_concept_id_index = get_index(spec.source_concept_id_field);
+    ssize_t string_value_index = get_index(spec.string_value_field);
+    ssize_t numeric_value_index = get_index(spec.numeric_value_field);
+    ssize_t concept_id_value_index = get_index(spec.concept_id_value_field);
+    ssize_t value_source_concept_id_index =
+        get_index(spec.value_source_concept_id_field);
+    ssize_t value_source_code_index = get_index(spec.value_source_code_field);
+
+    std::string start_field;
+    std::string end_field;
+    if (get_index(spec.prefix + "_start_date") != -1 ||
+        get_index(spec.prefix + "_start_datetime") != -1) {
+        start_field = spec.prefix + "_start_date";
+        end_field = spec.prefix + "_end_date";
+    } else {
+        start_field = spec.prefix + "_date";
+    }
+    ssize_t start_datetime_index = get_index(start_field + "time");
+    ssize_t start_date_index = get_index(start_field);
+    ssize_t end_datetime_index =
+        end_field.empty() ? -1 : get_index(end_field + "time");
+    ssize_t end_date_index = get_index(end_field);
+
+    ssize_t visit_id_index = get_index("visit_occurrence_id");
+    ssize_t unit_index = get_index("unit_source_value");
+    ssize_t load_table_id_index = get_index("load_table_id");
+    ssize_t note_id_index = get_index("note_id");
+
+    bool use_concept_id_value = !spec.string_value_field.empty() &&
+                                !spec.numeric_value_field.empty() &&
+                                !spec.concept_id_value_field.empty();
+
+    boost::optional<CSVReader<Reader>> reader;
+    if (chunk.file_offset == 0) {
+        reader.emplace(source, read_columns, delimiter);
+    } else {
+        reader.emplace(source, file_columns, read_columns, delimiter,
+                       chunk.file_offset);
+        if (chunk.start) {
+            reader->skip(*chunk.start);
+        } else {
+            reader->skip_line();
+        }
+    }
+
+    RowGroupWriter writer(target, EVENT_SCHEMA);
+    boost::optional<DebugWriter> debug_writer;
+    if (debug_file) {
+        debug_writer.emplace(*debug_file, file_columns);
+    }
+
+    ExtractorResult result;
+    ExtractorStats& stats = result.stats;
+    result.start = reader->get_position();
+
+    std::vector<std::string> cells(EVENT_SCHEMA.size());
+    std::vector<std::pair<std::string_view, std::string_view>> other_metadata;
+
+    while ((!chunk.length || reader->get_position() <= *chunk.length) &&
+           reader->next_row()) {
+        const std::vector<std::string>& row = reader->get_row();
+        stats.input_rows++;
+
+        auto get_required = [&](ssize_t index,
+                                const std::string& name) -> const std::string& {
+            if (index == -1) {
+                throw std::runtime_error(absl::StrCat(
+                    "Unable to find column '", name, "' in ", source.string()));
+            }
+            return row[index];
+        };
+
+        auto get_date = [&](ssize_t datetime_index,
+                            ssize_t date_index) -> boost::optional<int64_t> {
+            for (ssize_t index : {datetime_index, date_index}) {
+                if (index != -1 && !row[index].empty()) {
+                    int64_t result;
+                    if (!parse_iso_datetime(row[index], result)) {
+                        throw std::runtime_error(
+                            absl::StrCat("Could not parse date \"", row[index],
+                                         "\" in ", source.string()));
+                    }
+                    return result;
+                }
+            }
+            return boost::none;
+        };
+
+        std::string& value = cells[3];
+        value.clear();
+        for (ssize_t index : {string_value_index, numeric_value_index}) {
+            if (index != -1 && !row[index].empty()) {
+                double numeric_value;
+                if (absl::SimpleAtod(row[index], &numeric_value)) {
+                    value = "f" + encode_cell(numeric_value);
+                } else {
+                    value = "s" + row[index];
+                }
+            }
+        }
+
+        bool has_concept_id_value = false;
+        if (use_concept_id_value && value.empty()) {
+            const std::string& concept_id_value = get_required(
+                concept_id_value_index, spec.concept_id_value_field);
+            double numeric_value;
+            has_concept_id_value =
+                !concept_id_value.empty() &&
+                !(absl::SimpleAtod(concept_id_value, &numeric_value) &&
+                  numeric_value == 0);
+        }
+
+        int64_t concept_id;
+        if (spec.force_concept_id) {
+            concept_id = *spec.force_concept_id;
+        } else if (source_concept_id_index != -1 &&
+                   row[source_concept_id_index] != "" &&
+                   row[source_concept_id_index] != "0") {
+            attempt_parse_or_die(row[source_concept_id_index], concept_id);
+        } else {
+            attempt_parse_or_die(
+                get_required(concept_id_index, spec.concept_id_field),
+                concept_id);
+        }
+
+        if (has_concept_id_value) {
+            // See _ConceptTableConverter.get_events for the details of this
+            // special case
+            const std::string& source_concept_id =
+                value_source_concept_id_index == -1
+                    ? EMPTY
+                    : row[value_source_concept_id_index];
+            const std::string& source_code = value_source_code_index == -1
+                                                 ? EMPTY
+                                                 : row[value_source_code_index];
+            if ((source_concept_id.empty() || source_concept_id == "0") &&
+                !source_code.empty()) {
+                attempt_parse_or_die(
+                    get_required(concept_id_index, spec.concept_id_field),
+                    concept_id);
+                value = absl::StrCat("sSOURCE_CODE/", source_code);
+            } else {
+                value.clear();
+            }
+        }
+
+        if (concept_id == 0) {
+            if (spec.fallback_concept_id) {
+                concept_id = *spec.fallback_concept_id;
+            } else {
+                stats.invalid_rows++;
+                if (debug_writer) {
+                    debug_writer->add_row(row, debug_name);
+                }
+                continue;
+            }
+        }
+
+        boost::optional<int64_t> start =
+            get_date(start_datetime_index, start_date_index);
+        if (!start) {
+            throw std::runtime_error(
+                absl::StrCat("Could not find a date field for ",
+                             spec.file_prefix, " in ", source.string()));
+        }
+        boost::optional<int64_t> end =
+            get_date(end_datetime_index, end_date_index);
+
+        int64_t patient_id;
+        attempt_parse_or_die(
+            get_required(patient_id_index, spec.patient_id_field), patient_id);
+
+        cells[0] = encode_cell(patient_id);
+        cells[1] = encode_cell(*start);
+        cells[2] = encode_cell(concept_id);
+
+        cells[4].clear();
+        if (visit_id_index != -1 && !row[visit_id_index].empty()) {
+            int64_t visit_id;
+            attempt_parse_or_die(row[visit_id_index], visit_id);
+            cells[4] = encode_cell(visit_id);
+        }
+
+        cells[5] = end ? encode_cell(*end) : "";
+        cells[6] = spec.file_prefix;
+        cells[7] = unit_index == -1 ? "" : row[unit_index];
+
+        // Present columns are kept even when empty, as the Python extractor
+        // only drops missing metadata
+        other_metadata.clear();
+        if (load_table_id_index != -1) {
+            other_metadata.emplace_back("clarity_table",
+                                        row[load_table_id_index]);
+        }
+        if (note_id_index != -1) {
+            other_metadata.emplace_back("note_id", row[note_id_index]);
+        }
+        cells[8] =
+            other_metadata.empty() ? "" : pickle_string_dict(other_metadata);
+
+        writer.add_row(cells);
+        stats.valid_rows++;
+        stats.valid_events++;
+    }
+
+    if (chunk.length && reader->get_position() > *chunk.length) {
+        result.next_start = reader->get_position() - *chunk.length;
+    }
+
+    return result;
+}
+
+}  // namespace
+
+ExtractorResult extract_concept_table(
+    const boost::filesystem::path& source,
+    const boost::filesystem::path& target, const ConceptTableSpec& spec,
+    char delimiter, const boost::optional<boost::filesystem::path>& debug_file,
+    const std::string& debug_name, const SourceChunk& chunk) {
+    if (source.extension() == ".zst") {
+        return extract_concept_table_helper<ZstdReader>(
+            source, target, spec, delimiter, debug_file, debug_name, chunk);
+    } else {
+        return extract_concept_table_helper<TextReader>(
+            source, target, spec, delimiter, debug_file, debug_name, chunk);
+    }
+}
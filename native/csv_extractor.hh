@@ -0,0 +1,84 @@
+#pragma once
+
+#include <boost/filesystem.hpp>
+#include <boost/optional.hpp>
+#include <string>
+
+// A declarative description of an OMOP style table with one event per row,
+// mirroring femr.extractors.csv.ConceptTableSpec.
+//
+// Field names are lowercase, as the columns of the source are lowercased
+// before they are matched. An empty field name means that the field is unset.
+struct ConceptTableSpec {
+    // Stored as the omop_table of every event
+    std::string file_prefix;
+    std::string patient_id_field;
+
+    // Used to find the date fields, <prefix>_start_date[time] and
+    // <prefix>_end_date[time] if present, otherwise <prefix>_date[time]
+    std::string prefix;
+
+    std::string concept_id_field;
+    // Takes precedence over concept_id_field when it is set and not "0"
+    std::string source_concept_id_field;
+    boost::optional<int64_t> force_concept_id;
+
+    std::string string_value_field;
+    std::string numeric_value_field;
+    std::string concept_id_value_field;
+
+    // Used for rows with only a concept_id_value, see _ConceptTableConverter
+    std::string value_source_concept_id_field;
+    std::string value_source_code_field;
+
+    // Used instead of dropping rows with a concept id of 0
+    boost::optional<int64_t> fallback_concept_id;
+};
+
+// A part of a source file, so that large files can be extracted in parallel.
+//
+// Offsets other than the file offset are in bytes of decompressed data,
+// relative to the start of the chunk.
+struct SourceChunk {
+    // The offset of the chunk in the file, which must be the start of a zstd
+    // frame for compressed files
+    size_t file_offset = 0;
+
+    // Rows that start at or before this offset are extracted. Unset for the
+    // last chunk of a file.
+    boost::optional<size_t> length;
+
+    // The offset of the first row. If unset, the first row is assumed to start
+    // after the first newline, or after the header for the first chunk.
+    boost::optional<size_t> start;
+};
+
+struct ExtractorStats {
+    size_t input_rows = 0;
+    size_t valid_rows = 0;
+    size_t valid_events = 0;
+    size_t invalid_rows = 0;
+};
+
+struct ExtractorResult {
+    ExtractorStats stats;
+
+    // The offset of the first row of the chunk
+    size_t start = 0;
+
+    // The offset of the first row after the chunk, relative to the end of the
+    // chunk. If this does not match the start of the next chunk, the next
+    // chunk guessed wrong because of a newline within a quoted field.
+    size_t next_start = 0;
+};
+
+// Convert a chunk of a CSV (or zstd compressed CSV) file into a row group
+// event file, producing the same events as _ConceptTableConverter.get_events.
+//
+// Rows without a valid concept are written to debug_file if it is set, along
+// with an "extractor" column containing debug_name.
+ExtractorResult extract_concept_table(
+    const boost::filesystem::path& source,
+    const boost::filesystem::path& target, const ConceptTableSpec& spec,
+    char delimiter, const boost::optional<boost::filesystem::path>& debug_file,
+    const std::string& debug_name, const SourceChunk& chunk = SourceChunk());
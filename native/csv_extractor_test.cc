@@ -0,0 +1,181 @@
+#include "csv_extractor.hh"
+
+#include "absl/strings/str_cat.h"
+#include "csv.hh"
+#include "gmock/gmock.h"
+#include "gtest/gtest.h"
+#include "row_groups.hh"
+
+TEST(CSVExtractorTest, TestExtractConceptTable) {
+    boost::filesystem::path root = boost::filesystem::temp_directory_path() /
+                                   boost::filesystem::unique_path();
+    boost::filesystem::create_directories(root);
+
+    boost::filesystem::path source = root / "measurement.csv.zst";
+    {
+        CSVWriter<ZstdWriter> writer(
+            source,
+            {"PERSON_ID", "measurement_concept_id",
+             "measurement_source_concept_id", "measurement_date",
+             "measurement_datetime", "value_source_value", "value_as_number",
+             "value_as_concept_id", "measurement_source_value",
+             "visit_occurrence_id", "unit_source_value", "load_table_id"},
+            ',');
+        writer.add_row({"1", "5", "0", "2010-01-03", "", "foo", "", "", "", "",
+                        "", "lab"});
+        writer.add_row({"1", "5", "7", "2010-01-03", "2010-01-03 04:05:06",
+                        "", "2.5", "", "", "3", "mg", ""});
+        writer.add_row({"2", "0", "0", "2011-02-01", "", "", "", "", "", "",
+                        "", ""});
+        writer.add_row({"2", "6", "0", "2011-02-01", "", "", "", "9", "code",
+                        "", "", ""});
+    }
+
+    ConceptTableSpec spec;
+    spec.file_prefix = "measurement";
+    spec.patient_id_field = "person_id";
+    spec.prefix = "measurement";
+    spec.concept_id_field = "measurement_concept_id";
+    spec.source_concept_id_field = "measurement_source_concept_id";
+    spec.string_value_field = "value_source_value";
+    spec.numeric_value_field = "value_as_number";
+    spec.concept_id_value_field = "value_as_concept_id";
+    spec.value_source_concept_id_field = "measurement_source_concept_id";
+    spec.value_source_code_field = "measurement_source_value";
+
+    boost::filesystem::path target =
+        root / absl::StrCat("events", ROW_GROUP_EXTENSION);
+    boost::filesystem::path debug_file = root / "debug" / "measurement.csv";
+
+    ExtractorStats stats = extract_concept_table(source, target, spec, ',',
+                                                 debug_file, "extractor")
+                               .stats;
+    EXPECT_EQ(4, stats.input_rows);
+    EXPECT_EQ(3, stats.valid_rows);
+    EXPECT_EQ(3, stats.valid_events);
+    EXPECT_EQ(1, stats.invalid_rows);
+
+    std::vector<std::vector<std::string>> expected = {
+        {"1", "2010-01-03T00:00:00", "5", "foo", "", "", "measurement", ""},
+        {"1", "2010-01-03T04:05:06", "7", "2.5", "3", "", "measurement", "mg"},
+        {"2", "2011-02-01T00:00:00", "6", "SOURCE_CODE/code", "", "",
+         "measurement", ""},
+    };
+
+    RowGroupReader reader(target,
+                          {"patient_id", "start", "concept_id", "value",
+                           "visit_id", "end", "omop_table", "unit"},
+                          true);
+    for (const auto& row : expected) {
+        EXPECT_EQ(true, reader.next_row());
+        EXPECT_EQ(row, reader.get_row());
+    }
+    EXPECT_EQ(false, reader.next_row());
+
+    CSVReader<TextReader> debug_reader(
+        debug_file, {"PERSON_ID", "measurement_concept_id", "extractor"}, ',');
+    EXPECT_EQ(true, debug_reader.next_row());
+    EXPECT_EQ(std::vector<std::string>({"2", "0", "extractor"}),
+              debug_reader.get_row());
+    EXPECT_EQ(false, debug_reader.next_row());
+
+    boost::filesystem::remove_all(root);
+}
+
+TEST(CSVExtractorTest, TestFallbackConceptId) {
+    boost::filesystem::path root = boost::filesystem::temp_directory_path() /
+                                   boost::filesystem::unique_path();
+    boost::filesystem::create_directories(root);
+
+    boost::filesystem::path source = root / "visit_occurrence.csv";
+    {
+        CSVWriter<TextWriter> writer(
+            source,
+            {"person_id", "visit_concept_id", "visit_start_date",
+             "visit_start_datetime", "visit_end_date", "visit_end_datetime"},
+            ',');
+        writer.add_row({"3", "0", "2012-05-06", "", "2012-05-08",
+                        "2012-05-08T10:00:00.250"});
+    }
+
+    ConceptTableSpec spec;
+    spec.file_prefix = "visit_occurrence";
+    spec.patient_id_field = "person_id";
+    spec.prefix = "visit";
+    spec.concept_id_field = "visit_concept_id";
+    spec.source_concept_id_field = "visit_source_concept_id";
+    spec.fallback_concept_id = 8;
+
+    boost::filesystem::path target =
+        root / absl::StrCat("events", ROW_GROUP_EXTENSION);
+    ExtractorStats stats =
+        extract_concept_table(source, target, spec, ',', boost::none, "").stats;
+    EXPECT_EQ(1, stats.valid_rows);
+
+    RowGroupReader reader(target, {"start", "concept_id", "end", "metadata"},
+                          true);
+    EXPECT_EQ(true, reader.next_row());
+    EXPECT_EQ(std::vector<std::string>({"2012-05-06T00:00:00", "8",
+                                        "2012-05-08T10:00:00.250000", ""}),
+              reader.get_row());
+    EXPECT_EQ(false, reader.next_row());
+
+    boost::filesystem::remove_all(root);
+}
+
+TEST(CSVExtractorTest, TestChunks) {
+    boost::filesystem::path root = boost::filesystem::temp_directory_path() /
+                                   boost::filesystem::unique_path();
+    boost::filesystem::create_directories(root);
+
+    boost::filesystem::path source = root / "note.csv";
+    {
+        CSVWriter<TextWriter> writer(
+            source, {"person_id", "note_date", "note_concept_id", "note_text"},
+            ',');
+        for (int i = 0; i < 100; i++) {
+            writer.add_row({std::to_string(i), "2012-05-06", "5",
+                            i == 50 ? "first\nsecond" : "text"});
+        }
+    }
+
+    ConceptTableSpec spec;
+    spec.file_prefix = "note";
+    spec.patient_id_field = "person_id";
+    spec.prefix = "note";
+    spec.concept_id_field = "note_concept_id";
+    spec.string_value_field = "note_text";
+
+    // Split the file within the quoted newline, so the second chunk guesses
+    // the wrong start
+    std::ifstream f(source.c_str());
+    std::string data((std::istreambuf_iterator<char>(f)),
+                     std::istreambuf_iterator<char>());
+    SourceChunk first;
+    first.length = data.find("first") + 2;
+    SourceChunk second;
+    second.file_offset = *first.length;
+
+    ExtractorResult first_result = extract_concept_table(
+        source, root / "first.rowgroups", spec, ',', boost::none, "", first);
+    EXPECT_EQ(51, first_result.stats.valid_rows);
+    EXPECT_EQ(data.find("second") + 8 - *first.length,
+              first_result.next_start);
+
+    // The closing quote of the split field opens a quote that never ends
+    EXPECT_THROW(extract_concept_table(source, root / "second.rowgroups", spec,
+                                       ',', boost::none, "", second),
+                 std::runtime_error);
+
+    second.start = first_result.next_start;
+    ExtractorResult second_result = extract_concept_table(
+        source, root / "second.rowgroups", spec, ',', boost::none, "", second);
+    EXPECT_EQ(first_result.next_start, second_result.start);
+    EXPECT_EQ(49, second_result.stats.valid_rows);
+
+    RowGroupReader reader(root / "second.rowgroups", {"patient_id"}, true);
+    EXPECT_EQ(true, reader.next_row());
+    EXPECT_EQ(std::vector<std::string>({"51"}), reader.get_row());
+
+    boost::filesystem::remove_all(root);
+}
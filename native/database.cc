@@ -1,5 +1,6 @@
 #include "database.hh"
 
+#include <algorithm>
 #include <boost/filesystem.hpp>
 #include <boost/optional.hpp>
 #include <boost/range/iterator_range.hpp>
@@ -9,6 +10,7 @@
 
 #include "absl/container/flat_hash_map.h"
 #include "absl/container/flat_hash_set.h"
+#include "absl/strings/numbers.h"
 #include "absl/strings/str_cat.h"
 #include "base64.h"
 #include "blockingconcurrentqueue.h"
@@ -16,6 +18,7 @@
 #include "csv.hh"
 #include "parse_utils.hh"
 #include "readerwritercircularbuffer.h"
+#include "row_groups.hh"
 #include "streamvbyte.h"
 #include "thread_utils.hh"
 
@@ -62,6 +65,16 @@ struct Entry {
     uint32_t num_unique;
     uint32_t num_metadata;
 
+    // Sorted, deduplicated codes and shared text values used by this patient
+    std::vector<uint32_t> codes;
+    std::vector<uint32_t> shared_text_values;
+
+    // The standard metadata, with one entry per event if available
+    std::vector<int64_t> visit_ids;
+    std::vector<int32_t> end_offsets;
+    std::vector<std::string> omop_tables;
+    std::vector<std::string> units;
+
     std::vector<std::string>
         data;  // of size 1 + num_unique + num_event
                // stores data, then unique values, then event metadata
@@ -71,6 +84,12 @@ struct Entry {
     }
 };
 
+void sort_and_unique(std::vector<uint32_t>& values) {
+    std::sort(std::begin(values), std::end(values));
+    auto last = std::unique(std::begin(values), std::end(values));
+    values.erase(last, std::end(values));
+}
+
 void write_patient_to_buffer(uint32_t start_unique, int64_t patient_id,
                              const Patient& current_patient,
                              std::vector<uint32_t>& buffer) {
@@ -411,15 +430,33 @@ void reader_thread(
     std::atomic<uint64_t>& offset_and_unique_counter,
     const absl::flat_hash_map<int64_t, uint32_t>& code_to_index,
     const absl::flat_hash_map<std::string, uint32_t>& text_value_to_index) {
-    CSVReader<ZstdReader> reader(
-        patient_file,
-        {"patient_id", "concept_id", "start", "value", "metadata"}, ',');
+    std::vector<std::string> columns = {"patient_id", "concept_id", "start",
+                                        "value", "metadata"};
+
+    // Older patient collections store all metadata in the pickle
+    std::vector<std::string> file_columns =
+        get_file_columns(patient_file, ',');
+    bool has_standard_metadata =
+        std::find(std::begin(file_columns), std::end(file_columns),
+                  "visit_id") != std::end(file_columns);
+    if (has_standard_metadata) {
+        columns.insert(std::end(columns),
+                       {"visit_id", "end", "omop_table", "unit"});
+    }
+
+    // CSV patient collections base64 encode the pickled metadata
+    bool is_row_group = is_row_group_file(patient_file);
 
     int64_t patient_id = 0;
     Patient current_patient;
     std::vector<std::string> current_unique;
     std::vector<std::string> current_metadata;
 
+    std::vector<int64_t> current_visit_ids;
+    std::vector<int32_t> current_end_offsets;
+    std::vector<std::string> current_omop_tables;
+    std::vector<std::string> current_units;
+
     absl::CivilSecond birth_date;
 
     std::vector<uint32_t> buffer;
@@ -468,6 +505,20 @@ void reader_thread(
         next_entry.num_unique = current_unique.size();
         next_entry.num_metadata = current_metadata.size();
 
+        for (const Event& event : current_patient.events) {
+            next_entry.codes.push_back(event.code);
+            if (event.value_type == ValueType::SHARED_TEXT) {
+                next_entry.shared_text_values.push_back(event.text_value);
+            }
+        }
+        sort_and_unique(next_entry.codes);
+        sort_and_unique(next_entry.shared_text_values);
+
+        next_entry.visit_ids = std::move(current_visit_ids);
+        next_entry.end_offsets = std::move(current_end_offsets);
+        next_entry.omop_tables = std::move(current_omop_tables);
+        next_entry.units = std::move(current_units);
+
         next_entry.data.reserve(1 + current_unique.size() +
                                 current_metadata.size());
 
@@ -480,13 +531,13 @@ void reader_thread(
         queue.wait_enqueue({std::move(next_entry)});
     };
 
-    while (reader.next_row()) {
+    auto process_row = [&](std::vector<std::string>& row) {
         int64_t next_patient_id;
-        attempt_parse_or_die(reader.get_row()[0], next_patient_id);
+        attempt_parse_or_die(row[0], next_patient_id);
         int64_t code;
-        attempt_parse_or_die(reader.get_row()[1], code);
+        attempt_parse_or_die(row[1], code);
         absl::CivilSecond start;
-        attempt_parse_time_or_die(reader.get_row()[2], start);
+        attempt_parse_time_or_die(row[2], start);
 
         if (next_patient_id != patient_id) {
             output_patient();
@@ -498,6 +549,11 @@ void reader_thread(
             patient_id = next_patient_id;
             current_unique.clear();
             current_metadata.clear();
+
+            current_visit_ids.clear();
+            current_end_offsets.clear();
+            current_omop_tables.clear();
+            current_units.clear();
         }
 
         Event next_event;
@@ -507,35 +563,108 @@ void reader_thread(
 
         next_event.code = code_to_index.find(code)->second;
 
-        if (reader.get_row()[3].empty()) {
+        if (row[3].empty()) {
             next_event.value_type = ValueType::NONE;
         } else {
-            bool parse_number = absl::SimpleAtof(reader.get_row()[3],
-                                                 &next_event.numeric_value);
+            bool parse_number =
+                absl::SimpleAtof(row[3], &next_event.numeric_value);
             if (parse_number) {
                 next_event.value_type = ValueType::NUMERIC;
             } else {
-                auto iter = text_value_to_index.find(reader.get_row()[3]);
+                auto iter = text_value_to_index.find(row[3]);
                 if (iter != std::end(text_value_to_index)) {
                     next_event.value_type = ValueType::SHARED_TEXT;
                     next_event.text_value = iter->second;
                 } else {
                     next_event.value_type = ValueType::UNIQUE_TEXT;
-                    current_unique.emplace_back(std::move(reader.get_row()[3]));
+                    current_unique.emplace_back(std::move(row[3]));
                 }
             }
         }
 
-        current_metadata.emplace_back(base64_decode(reader.get_row()[4]));
+        if (is_row_group) {
+            current_metadata.emplace_back(std::move(row[4]));
+        } else {
+            current_metadata.emplace_back(base64_decode(row[4]));
+        }
+
+        if (has_standard_metadata) {
+            int64_t visit_id = MISSING_VISIT_ID;
+            if (!row[5].empty()) {
+                attempt_parse_or_die(row[5], visit_id);
+            }
+            current_visit_ids.push_back(visit_id);
+
+            int32_t end_offset = MISSING_END_OFFSET;
+            if (!row[6].empty()) {
+                absl::CivilSecond end;
+                attempt_parse_time_or_die(row[6], end);
+                int64_t offset = (end - birth_date) / seconds_per_minute -
+                                 next_event.start_age_in_minutes;
+                if (offset <= std::numeric_limits<int32_t>::min() ||
+                    offset > std::numeric_limits<int32_t>::max()) {
+                    throw std::runtime_error(
+                        absl::StrCat("End time ", row[6], " is out of range ",
+                                     "for patient ", patient_id));
+                }
+                end_offset = offset;
+            }
+            current_end_offsets.push_back(end_offset);
+
+            current_omop_tables.emplace_back(std::move(row[7]));
+            current_units.emplace_back(std::move(row[8]));
+        }
 
         current_patient.events.push_back(next_event);
-    }
+    };
+
+    read_text_rows(patient_file, columns, ',', process_row);
 
     output_patient();
 
     queue.wait_enqueue(boost::none);
 }
 
+void write_index(const boost::filesystem::path& path,
+                 std::vector<std::vector<uint32_t>>& index) {
+    DictionaryWriter writer(path);
+    for (auto& offsets : index) {
+        writer.add_value(container_to_view(offsets));
+        std::vector<uint32_t>().swap(offsets);
+    }
+}
+
+void write_meta(const boost::filesystem::path& path,
+                const std::vector<int64_t>& patient_ids,
+                const std::vector<uint32_t>& code_counts,
+                const std::vector<uint32_t>& text_counts,
+                absl::Span<const int64_t> codes, uint32_t version) {
+    DictionaryWriter meta(path);
+
+    meta.add_value(container_to_view(patient_ids));
+
+    std::vector<uint32_t> sorted_indices;
+    for (size_t i = 0; i < patient_ids.size(); i++) {
+        sorted_indices.push_back(i);
+    }
+    std::sort(std::begin(sorted_indices), std::end(sorted_indices),
+              [&](uint32_t a, uint32_t b) {
+                  return patient_ids[a] < patient_ids[b];
+              });
+
+    meta.add_value(container_to_view(sorted_indices));
+
+    meta.add_value(container_to_view(code_counts));
+    meta.add_value(container_to_view(text_counts));
+    meta.add_value(container_to_view(codes));
+
+    meta.add_value(element_to_view(&version));
+
+    std::random_device device;
+    uint32_t extract_id = device();
+    meta.add_value(element_to_view(&extract_id));
+}
+
 void convert_patient_collection_to_patient_database(
     const boost::filesystem::path& patient_root,
     const boost::filesystem::path& concept_root,
@@ -573,6 +702,10 @@ void convert_patient_collection_to_patient_database(
     }
 
     std::vector<int64_t> patient_ids;
+
+    // Inverted indices from codes / shared text values to patient offsets
+    std::vector<std::vector<uint32_t>> code_index;
+    std::vector<std::vector<uint32_t>> value_index;
     {
         DictionaryWriter patients(target / "patients");
         DictionaryWriter event_metadata(target / "event_metadata");
@@ -603,13 +736,58 @@ void convert_patient_collection_to_patient_database(
             });
         }
 
+        DictionaryWriter event_metadata_columns(target /
+                                                "event_metadata_columns");
+        DictionaryWriter event_metadata_text(target / "event_metadata_text");
+        absl::flat_hash_map<std::string, uint32_t> metadata_text_to_index;
+
+        auto add_metadata_column = [&](const auto& column, auto missing) {
+            bool any_present =
+                std::any_of(std::begin(column), std::end(column),
+                            [&](auto value) { return value != missing; });
+            if (any_present) {
+                event_metadata_columns.add_value(container_to_view(column));
+            } else {
+                event_metadata_columns.add_value("");
+            }
+        };
+
+        auto add_metadata_text_column =
+            [&](const std::vector<std::string>& texts) {
+                std::vector<uint32_t> column;
+                column.reserve(texts.size());
+                for (const auto& text : texts) {
+                    if (text.empty()) {
+                        column.push_back(MISSING_METADATA_TEXT);
+                    } else {
+                        auto [iter, inserted] = metadata_text_to_index.emplace(
+                            text, metadata_text_to_index.size());
+                        if (inserted) {
+                            event_metadata_text.add_value(text);
+                        }
+                        column.push_back(iter->second);
+                    }
+                }
+                add_metadata_column(column, MISSING_METADATA_TEXT);
+            };
+
         uint32_t next_write_patient = 0;
         DictionaryWriter unique_text(target / "unique_text");
         std::priority_queue<Entry> entry_heap;
 
+        code_index.resize(codes.size());
+        value_index.resize(codes_and_values.second.size());
+
         auto write_patient = [&](const Entry& entry) {
             patient_ids.push_back(entry.patient_id);
 
+            for (uint32_t code : entry.codes) {
+                code_index[code].push_back(next_write_patient);
+            }
+            for (uint32_t text_value : entry.shared_text_values) {
+                value_index[text_value].push_back(next_write_patient);
+            }
+
             patients.add_value(entry.data[0]);
 
             for (uint32_t i = 0; i < entry.num_unique; i++) {
@@ -636,6 +814,11 @@ void convert_patient_collection_to_patient_database(
             event_metadata.add_value(container_to_view(event_metadata_offsets));
             event_metadata.add_value(event_metadata_value);
 
+            add_metadata_column(entry.visit_ids, MISSING_VISIT_ID);
+            add_metadata_column(entry.end_offsets, MISSING_END_OFFSET);
+            add_metadata_text_column(entry.omop_tables);
+            add_metadata_text_column(entry.units);
+
             next_write_patient++;
         };
 
@@ -665,51 +848,51 @@ void convert_patient_collection_to_patient_database(
 
     std::cout << "Done with main " << absl::Now() << std::endl;
 
-    {
-        DictionaryWriter meta(target / "meta");
-
-        meta.add_value(container_to_view(patient_ids));
-
-        std::vector<uint32_t> sorted_indices;
-        for (size_t i = 0; i < patient_ids.size(); i++) {
-            sorted_indices.push_back(i);
-        }
-        std::sort(std::begin(sorted_indices), std::end(sorted_indices),
-                  [&](uint32_t a, uint32_t b) {
-                      return patient_ids[a] < patient_ids[b];
-                  });
+    write_index(target / "code_index", code_index);
+    write_index(target / "value_index", value_index);
 
-        meta.add_value(container_to_view(sorted_indices));
+    std::cout << "Done with index " << absl::Now() << std::endl;
 
-        auto add_counts = [&meta](const auto& a) {
+    {
+        auto get_counts = [](const auto& a) {
             std::vector<uint32_t> result;
             result.reserve(a.size());
             for (auto& entry : a) {
                 result.push_back(entry.second);
             }
-
-            meta.add_value(container_to_view(result));
+            return result;
         };
 
-        add_counts(codes_and_values.first);
-        add_counts(codes_and_values.second);
-        meta.add_value(container_to_view(codes));
-
-        meta.add_value(element_to_view(&current_version));
-
-        std::random_device device;
-        uint32_t extract_id = device();
-        meta.add_value(element_to_view(&extract_id));
+        write_meta(target / "meta", patient_ids,
+                   get_counts(codes_and_values.first),
+                   get_counts(codes_and_values.second), codes,
+                   current_version);
     }
     std::cout << "Done with meta " << absl::Now() << std::endl;
 }
 
+// The number of patients to prefetch ahead of a sequential scan
+constexpr uint32_t SEQUENTIAL_READ_AHEAD = 4096;
+
 PatientDatabaseIterator::PatientDatabaseIterator(PatientDatabase* d)
-    : parent_database(d) {
+    : parent_database(d), read_ahead_start(0), read_ahead_end(0) {
     (void)parent_database->patients->size();
 }
 
 Patient& PatientDatabaseIterator::get_patient(uint32_t patient_offset) {
+    if (parent_database->access_pattern == AccessPattern::SEQUENTIAL &&
+        (patient_offset < read_ahead_start ||
+         patient_offset + SEQUENTIAL_READ_AHEAD / 2 >= read_ahead_end)) {
+        read_ahead_start = patient_offset;
+        read_ahead_end = patient_offset + SEQUENTIAL_READ_AHEAD;
+        parent_database->patients->prefetch(read_ahead_start, read_ahead_end);
+        if (parent_database->has_event_metadata_columns) {
+            parent_database->event_metadata_columns_dictionary->prefetch(
+                read_ahead_start * NUM_METADATA_COLUMNS,
+                read_ahead_end * NUM_METADATA_COLUMNS);
+        }
+    }
+
     std::string_view data = (*(parent_database->patients))[patient_offset];
 
     uint32_t count;
@@ -736,16 +919,48 @@ Patient& PatientDatabaseIterator::get_patient(uint32_t patient_offset) {
 }
 
 PatientDatabase::PatientDatabase(boost::filesystem::path const& path,
-                                 bool read_all, bool read_all_unique_text)
-    : patients(path / "patients", read_all),
+                                 bool read_all, bool read_all_unique_text,
+                                 AccessPattern access)
+    : database_path(path),
+      access_pattern(access),
+      patients(path / "patients", read_all, access),
       ontology(path / "ontology"),
       shared_text_dictionary(path / "shared_text", read_all),
-      unique_text_dictionary(path / "unique_text", read_all_unique_text),
+      unique_text_dictionary(path / "unique_text", read_all_unique_text,
+                             access),
       code_index_dictionary(path / "code_index", read_all),
       value_index_dictionary(path / "value_index", read_all),
-      event_metadata_dictionary(path / "event_metadata", read_all),
+      event_metadata_dictionary(path / "event_metadata", read_all, access),
+      event_metadata_columns_dictionary(path / "event_metadata_columns",
+                                        read_all, access),
+      event_metadata_text_dictionary(path / "event_metadata_text", true),
       meta_dictionary(path / "meta", read_all) {
     (void)version_id();
+    has_event_metadata = event_metadata_dictionary;
+
+    // Overlays are only resolved by femr.datasets.OverlayPatientDatabase, so
+    // track the newest one to at least report a different database_id
+    overlay_generation = 0;
+    boost::filesystem::path overlay_root = path / "overlays";
+    if (boost::filesystem::is_directory(overlay_root)) {
+        for (auto& entry : boost::make_iterator_range(
+                 boost::filesystem::directory_iterator(overlay_root), {})) {
+            uint32_t generation;
+            if (absl::SimpleAtoi(entry.path().filename().string(),
+                                 &generation)) {
+                overlay_generation =
+                    std::max(overlay_generation, generation + 1);
+            }
+        }
+    }
+    has_event_metadata_columns = event_metadata_columns_dictionary;
+
+    if (access_pattern == AccessPattern::SEQUENTIAL) {
+        // Iterators prefetch these from whatever thread they run on, so
+        // they can't be loaded lazily
+        (void)patients->size();
+        load_event_metadata();
+    }
 }
 
 uint32_t PatientDatabase::size() { return patients->size(); }
@@ -762,9 +977,30 @@ uint32_t PatientDatabase::version_id() {
 uint32_t PatientDatabase::database_id() {
     if (version_id() == 0) {
         return 0;
-    } else {
-        return read_element<uint32_t>(meta_dictionary, 6);
     }
+
+    uint32_t id = read_element<uint32_t>(meta_dictionary, 6);
+    if (overlay_generation != 0) {
+        id ^= overlay_generation * 0x9E3779B9u;
+        if (id == 0) {
+            // 0 is reserved for databases without an id
+            id = 1;
+        }
+    }
+    return id;
+}
+
+void PatientDatabase::close() {
+    patients.close();
+    ontology.close();
+    shared_text_dictionary.close();
+    unique_text_dictionary.close();
+    code_index_dictionary.close();
+    value_index_dictionary.close();
+    event_metadata_dictionary.close();
+    event_metadata_columns_dictionary.close();
+    event_metadata_text_dictionary.close();
+    meta_dictionary.close();
 }
 
 PatientDatabaseIterator PatientDatabase::iterator() {
@@ -826,9 +1062,293 @@ Dictionary* PatientDatabase::get_unique_text_dictionary() {
     }
 }
 
+namespace {
+
+absl::Span<const uint32_t> read_index(LazyDictionary& index, uint32_t entry,
+                                      std::string_view name) {
+    if (!index) {
+        throw std::runtime_error(absl::StrCat(
+            "This database does not have a ", name,
+            ", it must be recreated with a newer version of femr"));
+    }
+
+    if (entry >= index->size()) {
+        // Codes that only appear in the ontology are never used by patients
+        return {};
+    }
+
+    return read_span<uint32_t>(*index, entry);
+}
+
+std::vector<uint32_t> merge_index(
+    LazyDictionary& index, absl::Span<const uint32_t> entries,
+    std::string_view name) {
+    std::vector<uint32_t> result;
+    for (uint32_t entry : entries) {
+        absl::Span<const uint32_t> offsets = read_index(index, entry, name);
+        result.insert(std::end(result), std::begin(offsets), std::end(offsets));
+    }
+    sort_and_unique(result);
+    return result;
+}
+
+}  // namespace
+
+absl::Span<const uint32_t> PatientDatabase::get_patient_offsets_with_code(
+    uint32_t code) {
+    return read_index(code_index_dictionary, code, "code_index");
+}
+
+std::vector<uint32_t> PatientDatabase::get_patient_offsets_with_codes(
+    absl::Span<const uint32_t> codes) {
+    return merge_index(code_index_dictionary, codes, "code_index");
+}
+
+absl::Span<const uint32_t>
+PatientDatabase::get_patient_offsets_with_shared_text(uint32_t text_value) {
+    return read_index(value_index_dictionary, text_value, "value_index");
+}
+
+std::vector<uint32_t> PatientDatabase::get_patient_offsets_with_shared_text(
+    absl::Span<const uint32_t> text_values) {
+    return merge_index(value_index_dictionary, text_values, "value_index");
+}
+
+EventStandardMetadata PatientDatabase::get_event_standard_metadata(
+    uint32_t patient_offset, uint32_t event_index) {
+    EventStandardMetadata result;
+    if (!has_event_metadata_columns) {
+        return result;
+    }
+
+    auto get_column = [&](uint32_t column, auto missing)
+        -> boost::optional<decltype(missing)> {
+        std::string_view raw =
+            get_event_metadata_column(patient_offset, column);
+        const auto* values =
+            reinterpret_cast<const decltype(missing)*>(raw.data());
+        if (raw.empty() || values[event_index] == missing) {
+            return boost::none;
+        } else {
+            return values[event_index];
+        }
+    };
+
+    result.visit_id = get_column(0, MISSING_VISIT_ID);
+    result.end_offset_in_minutes = get_column(1, MISSING_END_OFFSET);
+    if (auto omop_table = get_column(2, MISSING_METADATA_TEXT)) {
+        result.omop_table = (*event_metadata_text_dictionary)[*omop_table];
+    }
+    if (auto unit = get_column(3, MISSING_METADATA_TEXT)) {
+        result.unit = (*event_metadata_text_dictionary)[*unit];
+    }
+
+    return result;
+}
+
+namespace {
+
+// Replace the first value of a streamvbyte encoded patient record without
+// decoding the rest of it. Values are stored little endian in 1 to 4 bytes,
+// with the length of the first value in the low bits of the first control
+// byte.
+std::string replace_first_encoded_value(std::string_view record,
+                                        uint32_t value) {
+    uint32_t count;
+    std::memcpy(&count, record.data(), sizeof(count));
+    size_t control_start = sizeof(count);
+    size_t data_start = control_start + (count + 3) / 4;
+
+    uint8_t control = record[control_start];
+    size_t old_length = (control & 3) + 1;
+    size_t new_length = 1;
+    while (new_length < sizeof(value) && (value >> (8 * new_length)) != 0) {
+        new_length++;
+    }
+
+    std::string result;
+    result.reserve(record.size() - old_length + new_length);
+    result.append(record.substr(0, data_start));
+    result[control_start] = (control & ~3) | (new_length - 1);
+    result.append(reinterpret_cast<const char*>(&value), new_length);
+    result.append(record.substr(data_start + old_length));
+    return result;
+}
+
+// Dictionaries are never modified after being written, so they can be shared
+// with a hard link, falling back to a copy across filesystems.
+void link_or_copy_file(const boost::filesystem::path& source,
+                       const boost::filesystem::path& target) {
+    boost::system::error_code error;
+    boost::filesystem::create_hard_link(source, target, error);
+    if (error) {
+        boost::filesystem::copy_file(source, target);
+    }
+}
+
+}  // namespace
+
+void PatientDatabase::subset(std::vector<uint32_t> patient_offsets,
+                             const boost::filesystem::path& target) {
+    uint32_t version = version_id();
+    if (version < 2) {
+        throw std::runtime_error(absl::StrCat(
+            "Cannot subset a database of version ", version,
+            ", it must be recreated with a newer version of femr"));
+    }
+
+    sort_and_unique(patient_offsets);
+    for (uint32_t patient_offset : patient_offsets) {
+        if (patient_offset >= size()) {
+            throw std::out_of_range(
+                absl::StrCat("Invalid patient offset ", patient_offset));
+        }
+    }
+
+    boost::filesystem::create_directories(target / "ontology");
+    for (auto& entry : boost::make_iterator_range(
+             boost::filesystem::directory_iterator(database_path / "ontology"),
+             {})) {
+        link_or_copy_file(entry.path(),
+                          target / "ontology" / entry.path().filename());
+    }
+    link_or_copy_file(database_path / "shared_text", target / "shared_text");
+    if (has_event_metadata_columns) {
+        link_or_copy_file(database_path / "event_metadata_text",
+                          target / "event_metadata_text");
+    }
+
+    std::vector<int64_t> patient_ids;
+    patient_ids.reserve(patient_offsets.size());
+
+    std::vector<uint32_t> code_counts(
+        read_span<uint32_t>(meta_dictionary, 2).size());
+    std::vector<uint32_t> text_counts(
+        read_span<uint32_t>(meta_dictionary, 3).size());
+
+    std::vector<std::vector<uint32_t>> code_index(code_counts.size());
+    std::vector<std::vector<uint32_t>> value_index(text_counts.size());
+
+    {
+        DictionaryWriter patients_writer(target / "patients");
+
+        Dictionary* unique_text = get_unique_text_dictionary();
+        boost::optional<DictionaryWriter> unique_text_writer;
+        if (unique_text != nullptr) {
+            unique_text_writer.emplace(target / "unique_text");
+        }
+
+        boost::optional<DictionaryWriter> event_metadata_writer;
+        if (has_event_metadata) {
+            event_metadata_writer.emplace(target / "event_metadata");
+        }
+
+        boost::optional<DictionaryWriter> event_metadata_columns_writer;
+        if (has_event_metadata_columns) {
+            event_metadata_columns_writer.emplace(target /
+                                                  "event_metadata_columns");
+        }
+
+        PatientDatabaseIterator iter = iterator();
+        uint32_t next_unique = 0;
+        std::vector<uint32_t> codes;
+        std::vector<uint32_t> text_values;
+
+        for (uint32_t i = 0; i < patient_offsets.size(); i++) {
+            uint32_t patient_offset = patient_offsets[i];
+            patient_ids.push_back(get_patient_id(patient_offset));
+
+            // Only decode the patient to rebuild the indices and counts,
+            // the compressed record itself is copied as is
+            const Patient& patient = iter.get_patient(patient_offset);
+            codes.clear();
+            text_values.clear();
+            uint32_t num_unique = 0;
+            for (const Event& event : patient.events) {
+                code_counts[event.code]++;
+                codes.push_back(event.code);
+                if (event.value_type == ValueType::SHARED_TEXT) {
+                    text_counts[event.text_value]++;
+                    text_values.push_back(event.text_value);
+                } else if (event.value_type == ValueType::UNIQUE_TEXT) {
+                    if (unique_text_writer) {
+                        unique_text_writer->add_value(
+                            (*unique_text)[event.text_value]);
+                    }
+                    num_unique++;
+                }
+            }
+
+            sort_and_unique(codes);
+            for (uint32_t code : codes) {
+                code_index[code].push_back(i);
+            }
+            sort_and_unique(text_values);
+            for (uint32_t text_value : text_values) {
+                value_index[text_value].push_back(i);
+            }
+
+            // Unique text values are numbered from the start of the
+            // patient record, so that is the only value that changes
+            patients_writer.add_value(replace_first_encoded_value(
+                (*patients)[patient_offset], next_unique));
+            next_unique += num_unique;
+
+            if (event_metadata_writer) {
+                for (uint32_t j = 0; j < 2; j++) {
+                    event_metadata_writer->add_value(
+                        (*event_metadata_dictionary)[patient_offset * 2 + j]);
+                }
+            }
+
+            if (event_metadata_columns_writer) {
+                for (uint32_t j = 0; j < NUM_METADATA_COLUMNS; j++) {
+                    event_metadata_columns_writer->add_value(
+                        (*event_metadata_columns_dictionary)
+                            [patient_offset * NUM_METADATA_COLUMNS + j]);
+                }
+            }
+        }
+    }
+
+    write_index(target / "code_index", code_index);
+    write_index(target / "value_index", value_index);
+
+    write_meta(target / "meta", patient_ids, code_counts, text_counts,
+               read_span<int64_t>(meta_dictionary, 4), version);
+}
+
+std::string_view PatientDatabase::get_event_metadata_column(
+    uint32_t patient_offset, uint32_t column) {
+    if (!has_event_metadata_columns) {
+        return std::string_view(nullptr, 0);
+    }
+    return (*event_metadata_columns_dictionary)[patient_offset *
+                                                    NUM_METADATA_COLUMNS +
+                                                column];
+}
+
+Dictionary* PatientDatabase::get_event_metadata_text_dictionary() {
+    if (has_event_metadata_columns) {
+        return &(*event_metadata_text_dictionary);
+    } else {
+        return nullptr;
+    }
+}
+
+void PatientDatabase::load_event_metadata() {
+    if (has_event_metadata) {
+        (void)event_metadata_dictionary->size();
+    }
+    if (has_event_metadata_columns) {
+        (void)event_metadata_columns_dictionary->size();
+        (void)event_metadata_text_dictionary->size();
+    }
+}
+
 std::string_view PatientDatabase::get_event_metadata(uint32_t patient_offset,
                                                      uint32_t event_index) {
-    if (!event_metadata_dictionary) {
+    if (!has_event_metadata) {
         return std::string_view(nullptr, 0);
     }
 
@@ -1301,8 +1821,37 @@ absl::Span<const uint32_t> Ontology::get_children(uint32_t code) {
 absl::Span<const uint32_t> Ontology::get_all_parents(uint32_t code) {
     return read_span<uint32_t>(*all_parents_dict, code);
 }
+std::vector<uint32_t> Ontology::get_all_children(
+    absl::Span<const uint32_t> codes) {
+    absl::flat_hash_set<uint32_t> seen(std::begin(codes), std::end(codes));
+    std::vector<uint32_t> to_process(std::begin(seen), std::end(seen));
+
+    while (!to_process.empty()) {
+        uint32_t next = to_process.back();
+        to_process.pop_back();
+
+        for (uint32_t child : get_children(next)) {
+            if (seen.insert(child).second) {
+                to_process.push_back(child);
+            }
+        }
+    }
+
+    std::vector<uint32_t> result(std::begin(seen), std::end(seen));
+    std::sort(std::begin(result), std::end(result));
+    return result;
+}
 Dictionary& Ontology::get_dictionary() { return *main_dictionary; }
 
+void Ontology::close() {
+    main_dictionary.close();
+    parent_dict.close();
+    children_dict.close();
+    all_parents_dict.close();
+    text_description.close();
+    concept_ids.close();
+}
+
 std::string_view Ontology::get_text_description(uint32_t code) {
     if (!text_description) {
         return std::string_view(nullptr, 0);
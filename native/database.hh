@@ -5,6 +5,7 @@
 #include <boost/filesystem.hpp>
 #include <boost/optional.hpp>
 #include <cstdint>
+#include <limits>
 #include <string_view>
 #include <thread>
 #include <vector>
@@ -16,8 +17,13 @@
 
 class LazyDictionary {
    public:
-    LazyDictionary(const boost::filesystem::path& _path, bool _read_all)
-        : path(_path), read_all(_read_all), value(boost::none) {}
+    LazyDictionary(const boost::filesystem::path& _path, bool _read_all,
+                   AccessPattern _access = AccessPattern::NORMAL)
+        : path(_path),
+          read_all(_read_all),
+          access(_access),
+          closed(false),
+          value(boost::none) {}
 
     Dictionary* operator->() {
         init();
@@ -31,15 +37,33 @@ class LazyDictionary {
 
     operator bool() const { return boost::filesystem::exists(path); }
 
+    void close() {
+        closed = true;
+        if (value) {
+            // Keep the (now empty) Dictionary alive as Python might still
+            // hold a reference to it
+            value->close();
+        }
+    }
+
    private:
     void init() {
+        if (closed) {
+            throw std::runtime_error(
+                "Cannot access " + path.string() + " after it was closed");
+        }
         if (!value) {
             value.emplace(path, read_all);
+            if (access != AccessPattern::NORMAL) {
+                value->advise(access);
+            }
         }
     }
 
     boost::filesystem::path path;
     bool read_all;
+    AccessPattern access;
+    bool closed;
     boost::optional<Dictionary> value;
 };
 
@@ -51,6 +75,10 @@ class Ontology {
     absl::Span<const uint32_t> get_parents(uint32_t code);
     absl::Span<const uint32_t> get_children(uint32_t code);
     absl::Span<const uint32_t> get_all_parents(uint32_t code);
+
+    // All descendants of the given codes, including the codes themselves
+    std::vector<uint32_t> get_all_children(absl::Span<const uint32_t> codes);
+
     Dictionary& get_dictionary();
 
     std::string_view get_text_description(uint32_t code);
@@ -58,6 +86,8 @@ class Ontology {
     boost::optional<uint32_t> get_code_from_concept_id(int64_t concept_id);
     int64_t get_concept_id_from_code(uint32_t code);
 
+    void close();
+
    private:
     LazyDictionary main_dictionary;
     LazyDictionary parent_dict;
@@ -92,6 +122,22 @@ struct Event {
     }
 };
 
+// The standard metadata fields that are stored as typed columns.
+// Everything else is stored as a pickled dictionary.
+constexpr int64_t MISSING_VISIT_ID = std::numeric_limits<int64_t>::min();
+constexpr int32_t MISSING_END_OFFSET = std::numeric_limits<int32_t>::min();
+constexpr uint32_t MISSING_METADATA_TEXT =
+    std::numeric_limits<uint32_t>::max();
+constexpr uint32_t NUM_METADATA_COLUMNS = 4;
+
+struct EventStandardMetadata {
+    boost::optional<int64_t> visit_id;
+    // The end time, as an offset in minutes from the start of the event
+    boost::optional<int32_t> end_offset_in_minutes;
+    boost::optional<std::string_view> omop_table;
+    boost::optional<std::string_view> unit;
+};
+
 struct Patient {
     uint32_t patient_offset;
     absl::CivilDay birth_date;
@@ -112,12 +158,20 @@ class PatientDatabaseIterator {
 
     Patient current_patient;
     std::vector<uint32_t> buffer;
+
+    // The patient offsets last prefetched for sequential access
+    uint32_t read_ahead_start;
+    uint32_t read_ahead_end;
 };
 
 class PatientDatabase {
    public:
+    // access is a hint for how patients will be read. Sequential access
+    // prefetches upcoming patients in the background while iterating in
+    // offset order.
     PatientDatabase(const boost::filesystem::path& path, bool read_all,
-                    bool read_all_unique_text = false);
+                    bool read_all_unique_text = false,
+                    AccessPattern access = AccessPattern::NORMAL);
     PatientDatabase(PatientDatabase&&) = default;
 
     PatientDatabaseIterator iterator();
@@ -135,13 +189,15 @@ class PatientDatabase {
     Ontology& get_ontology();
 
     // Indexing
+    // Sorted patient offsets of every patient with at least one event
+    // with the given code(s) / shared text value(s)
     absl::Span<const uint32_t> get_patient_offsets_with_code(uint32_t code);
-    absl::Span<const uint32_t> get_patient_offsets_with_codes(
+    std::vector<uint32_t> get_patient_offsets_with_codes(
         absl::Span<const uint32_t> codes);
 
     absl::Span<const uint32_t> get_patient_offsets_with_shared_text(
         uint32_t text_value);
-    absl::Span<const uint32_t> get_patient_offsets_with_shared_text(
+    std::vector<uint32_t> get_patient_offsets_with_shared_text(
         absl::Span<const uint32_t> text_values);
 
     // Map back to original patient ids
@@ -176,14 +232,42 @@ class PatientDatabase {
     }
 
     // Event metadata
+    // Pickled dictionary of the non-standard metadata fields
     std::string_view get_event_metadata(uint32_t patient_offset,
                                         uint32_t event_index);
+    EventStandardMetadata get_event_standard_metadata(uint32_t patient_offset,
+                                                      uint32_t event_index);
+    // The raw values of one of the NUM_METADATA_COLUMNS typed columns for a
+    // patient, with one value per event. Empty if the field is missing for
+    // every event of the patient.
+    std::string_view get_event_metadata_column(uint32_t patient_offset,
+                                               uint32_t column);
+    // The strings referenced by the omop_table and unit columns
+    Dictionary* get_event_metadata_text_dictionary();
+    // Map the event metadata files now instead of on first use, as lazy
+    // loading is not thread safe
+    void load_event_metadata();
+
+    // Write the given patients to a new database at target, in database
+    // order. Patient records and metadata are copied without re-encoding
+    // them and the ontology and shared text are reused as is.
+    void subset(std::vector<uint32_t> patient_offsets,
+                const boost::filesystem::path& target);
 
     // Metadata information
     uint32_t version_id();
+    // Changes whenever an overlay is added to the database, even though
+    // overlays are not resolved by this class
     uint32_t database_id();
 
+    // Unmap every file and release every file descriptor.
+    // Any further access to the database will throw.
+    void close();
+
    private:
+    boost::filesystem::path database_path;
+    AccessPattern access_pattern;
+
     LazyDictionary patients;
 
     Ontology ontology;
@@ -198,6 +282,12 @@ class PatientDatabase {
     LazyDictionary event_metadata_dictionary;
     bool has_event_metadata;
 
+    // NUM_METADATA_COLUMNS entries per patient, one for each standard field.
+    // Empty entries mean that field is missing for every event.
+    LazyDictionary event_metadata_columns_dictionary;
+    LazyDictionary event_metadata_text_dictionary;
+    bool has_event_metadata_columns;
+
     // 0 patient_ids
     // 1 sorted_patient_offsets
     // 2 code counts
@@ -206,6 +296,9 @@ class PatientDatabase {
     // 5 version_id
     // 6 database_id
     Dictionary meta_dictionary;
+
+    // One past the newest overlay in the overlays directory, or 0 if none
+    uint32_t overlay_generation;
 };
 
 void convert_patient_collection_to_patient_database(
@@ -1394,7 +1394,7 @@ class BatchLoader {
    public:
     BatchLoader(std::string path_to_data, std::string batch_info_path,
                 double _token_dropout = 0)
-        : data(path_to_data, false),
+        : data(path_to_data, false, false, AccessPattern::RANDOM),
           batch_info(read_file(batch_info_path)),
           batch_creator(data, (*batch_info)["config"], _token_dropout),
           batches((*batch_info)["batches"]) {
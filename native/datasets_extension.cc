@@ -4,16 +4,25 @@
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
 
+#include <algorithm>
+#include <atomic>
+#include <exception>
 #include <iostream>
+#include <limits>
+#include <memory>
+#include <thread>
 
 #include "absl/strings/str_cat.h"
 #include "absl/time/civil_time.h"
 #include "civil_day_caster.hh"
+#include "csv_extractor.hh"
 #include "database.hh"
 #include "database_test_helper.hh"
 #include "filesystem_caster.hh"
 #include "join_csvs.hh"
+#include "patient_cache.hh"
 #include "register_iterable.hh"
+#include "transforms.hh"
 
 namespace py = pybind11;
 
@@ -34,9 +43,24 @@ void keep_alive(py::handle nurse, py::handle patient) {
 
 namespace {
 
+constexpr absl::CivilDay unix_epoch_day(1970);
+
+template <typename T>
+py::array_t<T> vector_to_array(std::vector<T>&& data) {
+    // Hand the vector's storage over to numpy without copying
+    auto* owned = new std::vector<T>(std::move(data));
+    py::capsule free_when_done(owned, [](void* ptr) {
+        delete reinterpret_cast<std::vector<T>*>(ptr);
+    });
+    return py::array_t<T>(owned->size(), owned->data(), free_when_done);
+}
+
 class OntologyWrapper {
    public:
-    OntologyWrapper(Ontology& _ontology) : ontology(_ontology) {}
+    OntologyWrapper(Ontology& _ontology, uint32_t _database_id)
+        : ontology(_ontology), database_id(_database_id) {}
+
+    uint32_t get_database_id() { return database_id; }
 
     Dictionary& get_dictionary() { return ontology.get_dictionary(); }
 
@@ -85,6 +109,81 @@ class OntologyWrapper {
         });
     }
 
+    uint32_t get_code_index(std::string_view code_str) {
+        auto possible_entry = ontology.get_dictionary().find(code_str);
+        if (!possible_entry) {
+            throw py::index_error();
+        }
+        return *possible_entry;
+    }
+
+    template <typename F>
+    py::array_t<uint32_t> get_generic_indices(uint32_t code_index, F f) {
+        if (code_index >= ontology.get_dictionary().size()) {
+            throw py::index_error();
+        }
+        absl::Span<const uint32_t> result = f(code_index);
+        return py::array_t<uint32_t>(result.size(), result.data());
+    }
+
+    py::array_t<uint32_t> get_parent_indices(uint32_t code_index) {
+        return get_generic_indices(code_index, [this](uint32_t code) {
+            return ontology.get_parents(code);
+        });
+    }
+
+    py::array_t<uint32_t> get_children_indices(uint32_t code_index) {
+        return get_generic_indices(code_index, [this](uint32_t code) {
+            return ontology.get_children(code);
+        });
+    }
+
+    py::array_t<uint32_t> get_all_parent_indices(uint32_t code_index) {
+        return get_generic_indices(code_index, [this](uint32_t code) {
+            return ontology.get_all_parents(code);
+        });
+    }
+
+    // Export a relation for every code as a CSR matrix (indptr, indices),
+    // so that the relation of code i is indices[indptr[i]:indptr[i + 1]]
+    template <typename F>
+    py::tuple get_generic_csr(F f) {
+        uint32_t num_codes = ontology.get_dictionary().size();
+
+        std::vector<uint64_t> indptr;
+        std::vector<uint32_t> indices;
+        {
+            py::gil_scoped_release release;
+
+            indptr.reserve(num_codes + 1);
+            indptr.push_back(0);
+            for (uint32_t code = 0; code < num_codes; code++) {
+                absl::Span<const uint32_t> result = f(code);
+                indices.insert(std::end(indices), std::begin(result),
+                               std::end(result));
+                indptr.push_back(indices.size());
+            }
+        }
+
+        return py::make_tuple(vector_to_array(std::move(indptr)),
+                              vector_to_array(std::move(indices)));
+    }
+
+    py::tuple get_parents_csr() {
+        return get_generic_csr(
+            [this](uint32_t code) { return ontology.get_parents(code); });
+    }
+
+    py::tuple get_children_csr() {
+        return get_generic_csr(
+            [this](uint32_t code) { return ontology.get_children(code); });
+    }
+
+    py::tuple get_all_parents_csr() {
+        return get_generic_csr(
+            [this](uint32_t code) { return ontology.get_all_parents(code); });
+    }
+
     std::string_view get_text_description(std::string_view code_str) {
         auto possible_entry = ontology.get_dictionary().find(code_str);
         if (!possible_entry) {
@@ -112,18 +211,577 @@ class OntologyWrapper {
    private:
     std::vector<boost::optional<py::str>> main_dictionary;
     Ontology& ontology;
+    uint32_t database_id;
 };
 
+struct PatientColumns {
+    std::vector<uint32_t> code;
+    std::vector<uint32_t> start_age_in_minutes;
+    std::vector<uint8_t> value_type;
+    std::vector<float> numeric_value;
+    std::vector<uint32_t> text_value;
+
+    // The standard metadata, only filled in by add_metadata. Missing values
+    // use the same sentinels as the database.
+    std::vector<int64_t> visit_id;
+    std::vector<int32_t> end_offset_in_minutes;
+    std::vector<uint32_t> omop_table;
+    std::vector<uint32_t> unit;
+
+    void reserve(size_t num_events) {
+        code.reserve(num_events);
+        start_age_in_minutes.reserve(num_events);
+        value_type.reserve(num_events);
+        numeric_value.reserve(num_events);
+        text_value.reserve(num_events);
+    }
+
+    size_t size() const { return code.size(); }
+
+    void clear() {
+        code.clear();
+        start_age_in_minutes.clear();
+        value_type.clear();
+        numeric_value.clear();
+        text_value.clear();
+        visit_id.clear();
+        end_offset_in_minutes.clear();
+        omop_table.clear();
+        unit.clear();
+    }
+
+    void add_patient(const Patient& patient) {
+        reserve(size() + patient.events.size());
+        for (const Event& event : patient.events) {
+            code.push_back(event.code);
+            start_age_in_minutes.push_back(event.start_age_in_minutes);
+            value_type.push_back(static_cast<uint8_t>(event.value_type));
+
+            switch (event.value_type) {
+                case ValueType::NUMERIC:
+                    numeric_value.push_back(event.numeric_value);
+                    text_value.push_back(
+                        std::numeric_limits<uint32_t>::max());
+                    break;
+
+                case ValueType::SHARED_TEXT:
+                case ValueType::UNIQUE_TEXT:
+                    numeric_value.push_back(
+                        std::numeric_limits<float>::quiet_NaN());
+                    text_value.push_back(event.text_value);
+                    break;
+
+                default:
+                    numeric_value.push_back(
+                        std::numeric_limits<float>::quiet_NaN());
+                    text_value.push_back(
+                        std::numeric_limits<uint32_t>::max());
+                    break;
+            }
+        }
+    }
+
+    void add_metadata(PatientDatabase& database, const Patient& patient) {
+        size_t num_events = patient.events.size();
+        auto helper = [&](auto& target, uint32_t column, auto missing) {
+            std::string_view raw = database.get_event_metadata_column(
+                patient.patient_offset, column);
+            if (raw.empty()) {
+                target.insert(std::end(target), num_events, missing);
+            } else {
+                const auto* values =
+                    reinterpret_cast<const decltype(missing)*>(raw.data());
+                target.insert(std::end(target), values, values + num_events);
+            }
+        };
+        helper(visit_id, 0, MISSING_VISIT_ID);
+        helper(end_offset_in_minutes, 1, MISSING_END_OFFSET);
+        helper(omop_table, 2, MISSING_METADATA_TEXT);
+        helper(unit, 3, MISSING_METADATA_TEXT);
+    }
+
+    void append(PatientColumns&& other) {
+        auto helper = [](auto& target, auto& source) {
+            target.insert(std::end(target), std::begin(source),
+                          std::end(source));
+            std::decay_t<decltype(source)>().swap(source);
+        };
+        helper(code, other.code);
+        helper(start_age_in_minutes, other.start_age_in_minutes);
+        helper(value_type, other.value_type);
+        helper(numeric_value, other.numeric_value);
+        helper(text_value, other.text_value);
+        helper(visit_id, other.visit_id);
+        helper(end_offset_in_minutes, other.end_offset_in_minutes);
+        helper(omop_table, other.omop_table);
+        helper(unit, other.unit);
+    }
+
+    void add_to_dict(py::dict& result, bool include_metadata = false) && {
+        result["code"] = vector_to_array(std::move(code));
+        result["start_age_in_minutes"] =
+            vector_to_array(std::move(start_age_in_minutes));
+        result["value_type"] = vector_to_array(std::move(value_type));
+        result["numeric_value"] = vector_to_array(std::move(numeric_value));
+        result["text_value"] = vector_to_array(std::move(text_value));
+        if (include_metadata) {
+            result["visit_id"] = vector_to_array(std::move(visit_id));
+            result["end_offset_in_minutes"] =
+                vector_to_array(std::move(end_offset_in_minutes));
+            result["omop_table"] = vector_to_array(std::move(omop_table));
+            result["unit"] = vector_to_array(std::move(unit));
+        }
+    }
+};
+
+// Events are sorted by start, so time windows can be found with a binary
+// search. Returns the index of the first event starting at or after the given
+// time, or strictly after it if right is set, mirroring numpy.searchsorted.
+size_t search_events(const Patient& patient, absl::CivilSecond time,
+                     bool right) {
+    int64_t seconds = time - absl::CivilSecond(patient.birth_date);
+    auto event_seconds = [](const Event& event) {
+        return (int64_t)event.start_age_in_minutes * 60;
+    };
+
+    auto iter =
+        right ? std::upper_bound(std::begin(patient.events),
+                                 std::end(patient.events), seconds,
+                                 [&](int64_t value, const Event& event) {
+                                     return value < event_seconds(event);
+                                 })
+              : std::lower_bound(std::begin(patient.events),
+                                 std::end(patient.events), seconds,
+                                 [&](const Event& event, int64_t value) {
+                                     return event_seconds(event) < value;
+                                 });
+    return iter - std::begin(patient.events);
+}
+
+bool parse_side(const std::string& side) {
+    if (side == "left") {
+        return false;
+    } else if (side == "right") {
+        return true;
+    } else {
+        throw py::value_error(
+            absl::StrCat("side must be 'left' or 'right', not '", side, "'"));
+    }
+}
+
+AccessPattern parse_access(const std::string& access) {
+    if (access == "normal") {
+        return AccessPattern::NORMAL;
+    } else if (access == "sequential") {
+        return AccessPattern::SEQUENTIAL;
+    } else if (access == "random") {
+        return AccessPattern::RANDOM;
+    } else {
+        throw py::value_error(absl::StrCat(
+            "access must be 'normal', 'sequential' or 'random', not '", access,
+            "'"));
+    }
+}
+
+// The signature of native map_reduce callbacks, which are called without the
+// GIL. state points to the data of the thread's state array, which is a copy
+// of the initial array for the first thread and zeros for the others.
+// birth_date is in days since the unix epoch.
+using NativePatientCallback = void (*)(
+    void* state, int64_t patient_id, int32_t birth_date, uint64_t num_events,
+    const uint32_t* code, const uint32_t* start_age_in_minutes,
+    const uint8_t* value_type, const float* numeric_value,
+    const uint32_t* text_value);
+
+// Get the address of a native callback, which can be a raw address,
+// a numba cfunc or a ctypes function pointer
+boost::optional<uintptr_t> get_native_callback(py::handle func) {
+    if (py::isinstance<py::int_>(func)) {
+        return func.cast<uintptr_t>();
+    }
+
+    if (py::hasattr(func, "address")) {
+        return func.attr("address").cast<uintptr_t>();
+    }
+
+    py::module ctypes = py::module::import("ctypes");
+    if (py::isinstance(func, ctypes.attr("_CFuncPtr"))) {
+        return ctypes.attr("cast")(func, ctypes.attr("c_void_p"))
+            .attr("value")
+            .cast<uintptr_t>();
+    }
+
+    return boost::none;
+}
+
 class PatientDatabaseWrapper : public PatientDatabase {
    public:
     PatientDatabaseWrapper(const boost::filesystem::path& path, bool read_all,
-                           bool read_all_unique_text = false)
-        : PatientDatabase(path, read_all, read_all_unique_text),
-          ontology_wrapper(get_ontology()) {}
+                           bool read_all_unique_text = false,
+                           AccessPattern access = AccessPattern::NORMAL)
+        : PatientDatabase(path, read_all, read_all_unique_text, access),
+          ontology_wrapper(get_ontology(), database_id()) {}
 
     OntologyWrapper& get_ontology_wrapper() { return ontology_wrapper; }
 
+    py::array_t<int64_t> get_patient_ids_with_codes(
+        const std::vector<std::string>& code_strs, bool include_descendants) {
+        std::vector<uint32_t> codes;
+        for (const auto& code_str : code_strs) {
+            // Codes that are not in this database cannot match any patient
+            auto possible_code = get_code_dictionary().find(code_str);
+            if (possible_code) {
+                codes.push_back(*possible_code);
+            }
+        }
+
+        py::gil_scoped_release release;
+        if (include_descendants) {
+            codes = get_ontology().get_all_children(codes);
+        }
+        return offsets_to_patient_ids(get_patient_offsets_with_codes(codes));
+    }
+
+    py::array_t<int64_t> get_patient_ids_with_shared_text(
+        const std::vector<std::string>& text_strs) {
+        std::vector<uint32_t> text_values;
+        for (const auto& text_str : text_strs) {
+            auto possible_value = get_shared_text_dictionary().find(text_str);
+            if (possible_value) {
+                text_values.push_back(*possible_value);
+            }
+        }
+
+        py::gil_scoped_release release;
+        return offsets_to_patient_ids(
+            get_patient_offsets_with_shared_text(text_values));
+    }
+
+    std::unique_ptr<PatientDatabaseWrapper> subset(
+        const std::vector<int64_t>& patient_ids,
+        const boost::filesystem::path& target) {
+        std::vector<uint32_t> patient_offsets;
+        patient_offsets.reserve(patient_ids.size());
+        for (int64_t patient_id : patient_ids) {
+            boost::optional<uint32_t> patient_offset =
+                get_patient_offset(patient_id);
+            if (!patient_offset) {
+                throw py::index_error(
+                    absl::StrCat("Could not find patient ", patient_id));
+            }
+            patient_offsets.push_back(*patient_offset);
+        }
+
+        {
+            py::gil_scoped_release release;
+            PatientDatabase::subset(std::move(patient_offsets), target);
+        }
+        return std::make_unique<PatientDatabaseWrapper>(target, false);
+    }
+
+    py::dict get_patients(const std::vector<int64_t>& patient_ids,
+                          size_t num_threads, bool include_metadata) {
+        std::vector<uint32_t> patient_offsets;
+        patient_offsets.reserve(patient_ids.size());
+        for (int64_t patient_id : patient_ids) {
+            boost::optional<uint32_t> patient_offset =
+                get_patient_offset(patient_id);
+            if (!patient_offset) {
+                throw py::index_error(
+                    absl::StrCat("Could not find patient ", patient_id));
+            }
+            patient_offsets.push_back(*patient_offset);
+        }
+
+        num_threads = std::max<size_t>(
+            1, std::min(num_threads, patient_offsets.size()));
+
+        std::vector<PatientColumns> thread_columns(num_threads);
+        std::vector<std::vector<int64_t>> thread_event_counts(num_threads);
+        std::vector<int64_t> birth_dates(patient_offsets.size());
+
+        // Got to prime the pump by triggering lazy loading, before releasing
+        // the GIL so that concurrent callers don't race on it either
+        (void)iterator();
+        if (include_metadata) {
+            load_event_metadata();
+        }
+
+        {
+            py::gil_scoped_release release;
+
+            size_t patients_per_thread =
+                (patient_offsets.size() + num_threads - 1) / num_threads;
+
+            std::vector<std::thread> threads;
+            for (size_t i = 0; i < num_threads; i++) {
+                threads.emplace_back([&, i]() {
+                    PatientDatabaseIterator iter = iterator();
+                    size_t start = patients_per_thread * i;
+                    size_t end = std::min(patient_offsets.size(),
+                                          patients_per_thread * (i + 1));
+                    for (size_t j = start; j < end; j++) {
+                        with_patient(
+                            iter, patient_offsets[j], [&](const Patient& p) {
+                                birth_dates[j] = p.birth_date - unix_epoch_day;
+                                thread_columns[i].add_patient(p);
+                                if (include_metadata) {
+                                    thread_columns[i].add_metadata(*this, p);
+                                }
+                                thread_event_counts[i].push_back(
+                                    p.events.size());
+                            });
+                    }
+                });
+            }
+
+            for (auto& thread : threads) {
+                thread.join();
+            }
+        }
+
+        size_t total_events = 0;
+        for (const auto& columns : thread_columns) {
+            total_events += columns.size();
+        }
+
+        PatientColumns columns;
+        columns.reserve(total_events);
+
+        std::vector<uint64_t> event_offsets;
+        event_offsets.reserve(patient_offsets.size() + 1);
+        event_offsets.push_back(0);
+
+        for (size_t i = 0; i < num_threads; i++) {
+            for (int64_t count : thread_event_counts[i]) {
+                event_offsets.push_back(event_offsets.back() + count);
+            }
+            columns.append(std::move(thread_columns[i]));
+        }
+
+        py::dict result;
+        result["patient_id"] =
+            vector_to_array(std::vector<int64_t>(patient_ids));
+        result["birth_date"] = vector_to_array(std::move(birth_dates))
+                                   .attr("view")("datetime64[D]");
+        result["offsets"] = vector_to_array(std::move(event_offsets));
+        std::move(columns).add_to_dict(result, include_metadata);
+        return result;
+    }
+
+    // Decode a patient and pass it to f, going through the cache if enabled
+    template <typename F>
+    void with_patient(PatientDatabaseIterator& iter, uint32_t patient_offset,
+                      F f) {
+        if (!cache) {
+            f(iter.get_patient(patient_offset));
+            return;
+        }
+
+        std::shared_ptr<const Patient> patient = cache->get(patient_offset);
+        if (!patient) {
+            patient = std::make_shared<const Patient>(
+                iter.get_patient(patient_offset));
+            cache->put(patient);
+        }
+        f(*patient);
+    }
+
+    void enable_cache(boost::optional<size_t> max_patients,
+                      boost::optional<size_t> max_bytes) {
+        if (!max_patients && !max_bytes) {
+            throw py::value_error(
+                "Must specify at least one of max_patients or max_bytes");
+        }
+        if (max_patients.value_or(1) == 0 || max_bytes.value_or(1) == 0) {
+            throw py::value_error("Cache limits must be positive");
+        }
+        cache = std::make_unique<PatientCache>(max_patients.value_or(0),
+                                               max_bytes.value_or(0));
+    }
+
+    void disable_cache() { cache.reset(); }
+
+    py::array_t<int64_t> searchsorted_events(
+        int64_t patient_id, const std::vector<absl::CivilSecond>& times,
+        const std::string& side) {
+        bool right = parse_side(side);
+        boost::optional<uint32_t> patient_offset =
+            get_patient_offset(patient_id);
+        if (!patient_offset) {
+            throw py::index_error();
+        }
+
+        std::vector<int64_t> result(times.size());
+        {
+            py::gil_scoped_release release;
+            PatientDatabaseIterator iter = iterator();
+            with_patient(iter, *patient_offset, [&](const Patient& p) {
+                for (size_t i = 0; i < times.size(); i++) {
+                    result[i] = search_events(p, times[i], right);
+                }
+            });
+        }
+
+        return vector_to_array(std::move(result));
+    }
+
+    py::object map_reduce(py::object func, py::object reducer,
+                          size_t num_threads, py::object initial) {
+        boost::optional<uintptr_t> native_callback = get_native_callback(func);
+
+        num_threads =
+            std::max<size_t>(1, std::min<size_t>(num_threads, size()));
+        uint32_t pids_per_thread = (size() + num_threads - 1) / num_threads;
+
+        // Only the first thread starts from initial so that it is reduced
+        // exactly once, even when the reducer updates it in place
+        std::vector<py::object> results(num_threads, py::none());
+        results[0] = initial;
+        std::vector<void*> states(num_threads, nullptr);
+        if (native_callback) {
+            if (initial.is_none()) {
+                throw py::value_error(
+                    "Native callbacks require an initial numpy array");
+            }
+            py::array initial_array = py::array::ensure(initial);
+            for (size_t i = 0; i < num_threads; i++) {
+                py::array state =
+                    initial_array.attr("copy")().cast<py::array>();
+                if (i != 0) {
+                    state.attr("fill")(0);
+                }
+                states[i] = state.mutable_data();
+                results[i] = state;
+            }
+        }
+
+        std::atomic<bool> failed(false);
+        std::vector<std::exception_ptr> errors(num_threads);
+
+        auto process_patients = [&](size_t i) {
+            PatientDatabaseIterator iter = iterator();
+            uint32_t start_pid = pids_per_thread * i;
+            uint32_t end_pid =
+                std::min(size(), (uint32_t)(pids_per_thread * (i + 1)));
+
+            PatientColumns columns;
+            for (uint32_t pat_offset = start_pid;
+                 pat_offset < end_pid && !failed; pat_offset++) {
+                const Patient& p = iter.get_patient(pat_offset);
+                int64_t patient_id = get_patient_id(pat_offset);
+                int32_t birth_date = p.birth_date - unix_epoch_day;
+
+                columns.clear();
+                columns.add_patient(p);
+
+                if (native_callback) {
+                    auto callback = reinterpret_cast<NativePatientCallback>(
+                        *native_callback);
+                    callback(states[i], patient_id, birth_date, columns.size(),
+                             columns.code.data(),
+                             columns.start_age_in_minutes.data(),
+                             columns.value_type.data(),
+                             columns.numeric_value.data(),
+                             columns.text_value.data());
+                } else {
+                    py::gil_scoped_acquire acquire;
+
+                    py::dict patient;
+                    patient["patient_id"] = patient_id;
+                    patient["birth_date"] =
+                        absl::CivilSecond(p.birth_date);
+                    std::move(columns).add_to_dict(patient);
+                    columns = PatientColumns();
+
+                    py::object value = func(patient);
+                    if (results[i].is_none()) {
+                        results[i] = value;
+                    } else {
+                        results[i] = reducer(results[i], value);
+                    }
+                }
+            }
+        };
+
+        {
+            py::gil_scoped_release release;
+
+            // Got to prime the pump by triggering lazy loading
+            if (size() > 0) {
+                iterator().get_patient(0);
+            }
+
+            std::vector<std::thread> threads;
+            for (size_t i = 0; i < num_threads; i++) {
+                threads.emplace_back([&, i]() {
+                    try {
+                        process_patients(i);
+                    } catch (...) {
+                        errors[i] = std::current_exception();
+                        failed = true;
+                    }
+                });
+            }
+
+            for (auto& thread : threads) {
+                thread.join();
+            }
+        }
+
+        for (const auto& error : errors) {
+            if (error) {
+                std::rethrow_exception(error);
+            }
+        }
+
+        py::object result = results[0];
+        for (size_t i = 1; i < num_threads; i++) {
+            if (result.is_none()) {
+                result = results[i];
+            } else if (!results[i].is_none()) {
+                result = reducer(result, results[i]);
+            }
+        }
+        return result;
+    }
+
+    py::dict get_cache_stats() {
+        PatientCacheStats stats;
+        if (cache) {
+            stats = cache->get_stats();
+        }
+
+        py::dict result;
+        result["hits"] = stats.hits;
+        result["misses"] = stats.misses;
+        result["evictions"] = stats.evictions;
+        result["num_patients"] = stats.num_patients;
+        result["num_bytes"] = stats.num_bytes;
+        return result;
+    }
+
+    void close() {
+        disable_cache();
+        PatientDatabase::close();
+    }
+
    private:
+    std::unique_ptr<PatientCache> cache;
+
+    py::array_t<int64_t> offsets_to_patient_ids(
+        const std::vector<uint32_t>& offsets) {
+        std::vector<int64_t> patient_ids;
+        patient_ids.reserve(offsets.size());
+        for (uint32_t offset : offsets) {
+            patient_ids.push_back(get_patient_id(offset));
+        }
+        std::sort(std::begin(patient_ids), std::end(patient_ids));
+
+        py::gil_scoped_acquire acquire;
+        return vector_to_array(std::move(patient_ids));
+    }
+
     OntologyWrapper ontology_wrapper;
 };
 
@@ -149,6 +807,8 @@ class EventWrapper {
         return *m_code;
     }
 
+    uint32_t code_index() const { return m_event.code; }
+
     py::object start() {
         if (!m_start) {
             absl::CivilSecond start_time =
@@ -209,10 +869,31 @@ class EventWrapper {
             } else {
                 m_metadata.emplace(py::dict());
             }
+
+            EventStandardMetadata standard = standard_metadata();
+            for (const char* name : {"visit_id", "end", "omop_table", "unit"}) {
+                py::object value = standard_metadata_value(standard, name);
+                if (!value.is_none()) {
+                    (*m_metadata)[name] = value;
+                }
+            }
         }
         return *m_metadata;
     }
 
+    py::object get_metadata(const std::string& name) {
+        // Standard fields are stored as typed columns, so they can be read
+        // without unpickling the rest of the metadata.
+        if (!m_metadata) {
+            py::object value =
+                standard_metadata_value(standard_metadata(), name);
+            if (!value.is_none()) {
+                return value;
+            }
+        }
+        return metadata().attr("get")(name, py::none());
+    }
+
     py::object to_python_event() {
         using namespace pybind11::literals;
         return m_python_event("code"_a = code(), "start"_a = start(),
@@ -220,6 +901,30 @@ class EventWrapper {
     }
 
    private:
+    EventStandardMetadata standard_metadata() {
+        return m_database->get_event_standard_metadata(m_patient_offset,
+                                                       m_event_index);
+    }
+
+    py::object standard_metadata_value(const EventStandardMetadata& standard,
+                                       const std::string& name) {
+        if (name == "visit_id" && standard.visit_id) {
+            return py::cast(*standard.visit_id);
+        } else if (name == "end" && standard.end_offset_in_minutes) {
+            absl::CivilSecond end_time =
+                m_birth_date + 60 * ((int64_t)m_event.start_age_in_minutes +
+                                     *standard.end_offset_in_minutes);
+            return py::cast(end_time);
+        } else if (name == "omop_table" && standard.omop_table) {
+            return py::str(standard.omop_table->data(),
+                           standard.omop_table->size());
+        } else if (name == "unit" && standard.unit) {
+            return py::str(standard.unit->data(), standard.unit->size());
+        } else {
+            return py::none();
+        }
+    }
+
     py::module m_pickle;
     py::object m_python_event;
 
@@ -235,6 +940,54 @@ class EventWrapper {
     boost::optional<py::object> m_metadata;
 };
 
+// Get the sort keys of a list of string fields or of a numpy struct dtype
+std::vector<std::pair<std::string, ColumnValueType>> get_column_types(
+    py::object fields) {
+    std::vector<std::pair<std::string, ColumnValueType>> column_types;
+
+    if (py::isinstance<py::list>(fields)) {
+        // Assume all string fields
+        py::list list = py::reinterpret_borrow<py::list>(fields);
+        for (auto item : list) {
+            column_types.emplace_back(item.cast<std::string>(),
+                                      ColumnValueType::STRING);
+        }
+    } else if (py::isinstance<py::dtype>(fields)) {
+        py::dict fields_dict = fields.attr("fields");
+        for (const auto& entry : fields_dict) {
+            std::string name = entry.first.cast<std::string>();
+            py::tuple type_and_offset = entry.second.cast<py::tuple>();
+            py::dtype type = type_and_offset[0].cast<py::dtype>();
+            ColumnValueType our_type;
+            switch (type.kind()) {
+                case 'M':
+                    our_type = ColumnValueType::DATETIME;
+                    break;
+
+                case 'S':
+                    our_type = ColumnValueType::STRING;
+                    break;
+
+                case 'u':
+                    our_type = ColumnValueType::UINT64_T;
+                    break;
+
+                case 'i':
+                    our_type = ColumnValueType::INT64_T;
+                    break;
+
+                default:
+                    throw std::runtime_error(absl::StrCat(
+                        "Invalid kind ", std::to_string(type.kind())));
+            }
+            column_types.emplace_back(name, our_type);
+        }
+    } else {
+        throw std::runtime_error("Invalid type passed as fields");
+    }
+    return column_types;
+}
+
 }  // namespace
 
 void register_datasets_extension(py::module& root) {
@@ -266,65 +1019,171 @@ void register_datasets_extension(py::module& root) {
         test_module.def("create_database_files", create_database_files);
     }
 
-    m.def("sort_and_join_csvs", [](std::string source_path,
-                                   std::string target_path, py::object fields,
-                                   char delimiter, int num_threads) {
-        std::vector<std::pair<std::string, ColumnValueType>> column_types;
-
-        if (py::isinstance<py::list>(fields)) {
-            // Assume all string fields
-            py::list list = py::reinterpret_borrow<py::list>(fields);
-            for (auto item : list) {
-                column_types.emplace_back(item.cast<std::string>(),
-                                          ColumnValueType::STRING);
+    m.def(
+        "sort_and_join_csvs",
+        [](std::string source_path, std::string target_path, py::object fields,
+           char delimiter, int num_threads, size_t max_memory_bytes,
+           boost::optional<std::vector<size_t>> shards) {
+            sort_and_join_csvs(source_path, target_path,
+                               get_column_types(fields), delimiter,
+                               num_threads, max_memory_bytes, shards);
+        },
+        py::arg("source_path"), py::arg("target_path"), py::arg("fields"),
+        py::arg("delimiter"), py::arg("num_threads"),
+        py::arg("max_memory_bytes") = DEFAULT_SORT_MEMORY_BYTES,
+        py::arg("shards") = py::none());
+
+    m.def(
+        "partition_csvs",
+        [](std::string source_path, std::string target_path, py::object fields,
+           char delimiter, int num_partitions, size_t max_memory_bytes) {
+            partition_csvs(source_path, target_path, get_column_types(fields),
+                           delimiter, num_partitions, max_memory_bytes);
+        },
+        py::arg("source_path"), py::arg("target_path"), py::arg("fields"),
+        py::arg("delimiter"), py::arg("num_partitions"),
+        py::arg("max_memory_bytes") = DEFAULT_SORT_MEMORY_BYTES);
+
+    m.def(
+        "join_csvs",
+        [](std::string source_path, std::string target_file, py::object fields,
+           char delimiter, size_t max_memory_bytes) {
+            join_csvs(source_path, target_file, get_column_types(fields),
+                      delimiter, max_memory_bytes);
+        },
+        py::arg("source_path"), py::arg("target_file"), py::arg("fields"),
+        py::arg("delimiter"),
+        py::arg("max_memory_bytes") = DEFAULT_SORT_MEMORY_BYTES);
+
+    m.def(
+        "extract_concept_table",
+        [](const boost::filesystem::path& source,
+           const boost::filesystem::path& target, py::dict spec_dict,
+           char delimiter,
+           boost::optional<boost::filesystem::path> debug_file,
+           const std::string& debug_name, size_t file_offset,
+           boost::optional<size_t> length, boost::optional<size_t> start) {
+            // Unset fields are None on the Python side and empty here
+            auto get_field = [&](const char* name) -> std::string {
+                py::object value = spec_dict[name];
+                return value.is_none() ? "" : value.cast<std::string>();
+            };
+
+            ConceptTableSpec spec;
+            spec.file_prefix = get_field("file_prefix");
+            spec.patient_id_field = get_field("patient_id_field");
+            spec.prefix = get_field("prefix");
+            spec.concept_id_field = get_field("concept_id_field");
+            spec.source_concept_id_field =
+                get_field("source_concept_id_field");
+            spec.force_concept_id =
+                spec_dict["force_concept_id"]
+                    .cast<boost::optional<int64_t>>();
+            spec.string_value_field = get_field("string_value_field");
+            spec.numeric_value_field = get_field("numeric_value_field");
+            spec.concept_id_value_field = get_field("concept_id_value_field");
+            spec.value_source_concept_id_field =
+                get_field("value_source_concept_id_field");
+            spec.value_source_code_field =
+                get_field("value_source_code_field");
+            spec.fallback_concept_id =
+                spec_dict["fallback_concept_id"]
+                    .cast<boost::optional<int64_t>>();
+
+            SourceChunk chunk;
+            chunk.file_offset = file_offset;
+            chunk.length = length;
+            chunk.start = start;
+
+            ExtractorResult result;
+            {
+                py::gil_scoped_release release;
+                result = extract_concept_table(source, target, spec, delimiter,
+                                               debug_file, debug_name, chunk);
             }
-        } else if (py::isinstance<py::dtype>(fields)) {
-            py::dict fields_dict = fields.attr("fields");
-            for (const auto& entry : fields_dict) {
-                std::string name = entry.first.cast<std::string>();
-                py::tuple type_and_offset = entry.second.cast<py::tuple>();
-                py::dtype type = type_and_offset[0].cast<py::dtype>();
-                ColumnValueType our_type;
-                switch (type.kind()) {
-                    case 'M':
-                        our_type = ColumnValueType::DATETIME;
-                        break;
-
-                    case 'S':
-                        our_type = ColumnValueType::STRING;
-                        break;
-
-                    case 'u':
-                        our_type = ColumnValueType::UINT64_T;
-                        break;
-
-                    case 'i':
-                        our_type = ColumnValueType::INT64_T;
-                        break;
-
-                    default:
-                        throw std::runtime_error(absl::StrCat(
-                            "Invalid kind ", std::to_string(type.kind())));
+
+            py::dict stats;
+            stats["input_rows"] = result.stats.input_rows;
+            stats["valid_rows"] = result.stats.valid_rows;
+            stats["valid_events"] = result.stats.valid_events;
+            stats["invalid_rows"] = result.stats.invalid_rows;
+            return py::make_tuple(stats, result.start, result.next_start);
+        },
+        py::arg("source"), py::arg("target"), py::arg("spec"),
+        py::arg("delimiter"), py::arg("debug_file"), py::arg("debug_name"),
+        py::arg("file_offset") = 0, py::arg("length") = py::none(),
+        py::arg("start") = py::none());
+
+    m.def(
+        "transform_patients",
+        [](const boost::filesystem::path& source,
+           const boost::filesystem::path& target, py::list transform_list) {
+            // Every transform is a tuple of a name and a dict of parameters
+            std::vector<PatientTransform> transforms;
+            for (py::handle item : transform_list) {
+                auto [name, parameters] =
+                    item.cast<std::pair<std::string, py::dict>>();
+
+                PatientTransform transform;
+                transform.type = get_patient_transform_type(name);
+                if (parameters.contains("concept_map")) {
+                    py::dict concept_map = parameters["concept_map"];
+                    for (auto entry : concept_map) {
+                        transform.concept_map[entry.first.cast<int64_t>()] =
+                            entry.second.cast<int64_t>();
+                    }
+                }
+                if (parameters.contains("birth_concept_id")) {
+                    transform.birth_concept_id =
+                        parameters["birth_concept_id"].cast<int64_t>();
+                }
+                if (parameters.contains("skip_omop_table")) {
+                    transform.skip_omop_table =
+                        parameters["skip_omop_table"]
+                            .cast<boost::optional<std::string>>();
                 }
-                column_types.emplace_back(name, our_type);
+                transforms.emplace_back(std::move(transform));
             }
-        } else {
-            throw std::runtime_error(
-                "Invalid type passed as fields to sort_and_join_csvs");
-        }
-        sort_and_join_csvs(source_path, target_path, column_types, delimiter,
-                           num_threads);
-    });
+
+            PatientTransformResult result;
+            {
+                py::gil_scoped_release release;
+                result = transform_patients(source, target, transforms);
+            }
+
+            py::list stats;
+            for (const auto& entry : result.stats) {
+                py::dict transform_stats;
+                transform_stats["lost_patients"] = entry.lost_patients;
+                transform_stats["lost_events"] = entry.lost_events;
+                transform_stats["seconds"] = entry.seconds;
+                stats.append(transform_stats);
+            }
+            return py::make_tuple(result.num_patients, stats);
+        },
+        py::arg("source"), py::arg("target"), py::arg("transforms"));
 
     m.def("convert_patient_collection_to_patient_database",
           convert_patient_collection_to_patient_database);
 
+    py::enum_<ValueType>(m, "ValueType")
+        .value("NONE", ValueType::NONE)
+        .value("NUMERIC", ValueType::NUMERIC)
+        .value("SHARED_TEXT", ValueType::SHARED_TEXT)
+        .value("UNIQUE_TEXT", ValueType::UNIQUE_TEXT);
+
     py::class_<PatientDatabaseWrapper> database_binding(m, "PatientDatabase");
 
     database_binding
-        .def(py::init<std::string, bool, bool>(), py::arg("filename"),
-             py::arg("read_all") = false,
-             py::arg("read_all_unique_text") = false)
+        .def(py::init([](const std::string& filename, bool read_all,
+                         bool read_all_unique_text, const std::string& access) {
+                 return std::make_unique<PatientDatabaseWrapper>(
+                     filename, read_all, read_all_unique_text,
+                     parse_access(access));
+             }),
+             py::arg("filename"), py::arg("read_all") = false,
+             py::arg("read_all_unique_text") = false,
+             py::arg("access") = "normal")
         .def("__len__",
              [](PatientDatabaseWrapper& self) { return self.size(); })
         .def(
@@ -339,22 +1198,97 @@ void register_datasets_extension(py::module& root) {
                 if (!patient_offset) {
                     throw py::index_error();
                 }
-                Patient p = self.get_patient(*patient_offset);
-                py::tuple events(p.events.size());
+                PatientDatabaseIterator iter = self.iterator();
+                py::tuple events;
 
-                absl::CivilSecond birth_date = p.birth_date;
+                self.with_patient(iter, *patient_offset, [&](const Patient& p) {
+                    events = py::tuple(p.events.size());
 
-                for (size_t i = 0; i < p.events.size(); i++) {
-                    const Event& event = p.events[i];
-                    events[i] =
-                        EventWrapper(pickle, python_event, &self,
-                                     *patient_offset, birth_date, i, event);
-                }
+                    absl::CivilSecond birth_date = p.birth_date;
+
+                    for (size_t i = 0; i < p.events.size(); i++) {
+                        const Event& event = p.events[i];
+                        events[i] =
+                            EventWrapper(pickle, python_event, &self,
+                                         *patient_offset, birth_date, i, event);
+                    }
+                });
 
                 return python_patient("patient_id"_a = patient_id,
                                       "events"_a = events);
             },
             py::return_value_policy::reference_internal)
+        .def(
+            "get_events_in_range",
+            [python_event, pickle](PatientDatabaseWrapper& self,
+                                   int64_t patient_id,
+                                   boost::optional<absl::CivilSecond> start,
+                                   boost::optional<absl::CivilSecond> end) {
+                boost::optional<uint32_t> patient_offset =
+                    self.get_patient_offset(patient_id);
+
+                if (!patient_offset) {
+                    throw py::index_error();
+                }
+                PatientDatabaseIterator iter = self.iterator();
+                py::tuple events;
+
+                self.with_patient(iter, *patient_offset, [&](const Patient& p) {
+                    size_t first = start ? search_events(p, *start, false) : 0;
+                    size_t last =
+                        end ? search_events(p, *end, false) : p.events.size();
+                    last = std::max(first, last);
+
+                    events = py::tuple(last - first);
+
+                    absl::CivilSecond birth_date = p.birth_date;
+
+                    for (size_t i = first; i < last; i++) {
+                        events[i - first] =
+                            EventWrapper(pickle, python_event, &self,
+                                         *patient_offset, birth_date, i,
+                                         p.events[i]);
+                    }
+                });
+
+                return events;
+            },
+            py::arg("patient_id"), py::arg("start") = py::none(),
+            py::arg("end") = py::none(),
+            py::return_value_policy::reference_internal)
+        .def("map_reduce", &PatientDatabaseWrapper::map_reduce,
+             py::arg("func"), py::arg("reducer"), py::arg("num_threads") = 1,
+             py::arg("initial") = py::none())
+        .def("searchsorted_events",
+             &PatientDatabaseWrapper::searchsorted_events,
+             py::arg("patient_id"), py::arg("times"), py::arg("side") = "left")
+        .def("get_patient_arrays",
+             [](PatientDatabaseWrapper& self, int64_t patient_id) {
+                 boost::optional<uint32_t> patient_offset =
+                     self.get_patient_offset(patient_id);
+
+                 if (!patient_offset) {
+                     throw py::index_error();
+                 }
+
+                 PatientColumns columns;
+                 absl::CivilDay birth_date;
+                 {
+                     py::gil_scoped_release release;
+                     PatientDatabaseIterator iter = self.iterator();
+                     self.with_patient(iter, *patient_offset,
+                                       [&](const Patient& p) {
+                                           birth_date = p.birth_date;
+                                           columns.add_patient(p);
+                                       });
+                 }
+
+                 py::dict result;
+                 result["patient_id"] = patient_id;
+                 result["birth_date"] = absl::CivilSecond(birth_date);
+                 std::move(columns).add_to_dict(result);
+                 return result;
+             })
         .def(
             "__iter__",
             [](PatientDatabaseWrapper& self) {
@@ -370,6 +1304,29 @@ void register_datasets_extension(py::module& root) {
              })
         .def("get_ontology", &PatientDatabaseWrapper::get_ontology_wrapper,
              py::return_value_policy::reference_internal)
+        .def("enable_cache", &PatientDatabaseWrapper::enable_cache,
+             py::arg("max_patients") = py::none(),
+             py::arg("max_bytes") = py::none())
+        .def("disable_cache", &PatientDatabaseWrapper::disable_cache)
+        .def("get_cache_stats", &PatientDatabaseWrapper::get_cache_stats)
+        .def("get_patients", &PatientDatabaseWrapper::get_patients,
+             py::arg("patient_ids"), py::arg("num_threads") = 1,
+             py::arg("include_metadata") = false)
+        .def("get_patient_ids_with_codes",
+             &PatientDatabaseWrapper::get_patient_ids_with_codes,
+             py::arg("codes"), py::arg("include_descendants") = false)
+        .def("get_patient_ids_with_shared_text",
+             &PatientDatabaseWrapper::get_patient_ids_with_shared_text,
+             py::arg("values"))
+        .def("get_shared_text_dictionary",
+             &PatientDatabaseWrapper::get_shared_text_dictionary,
+             py::return_value_policy::reference_internal)
+        .def("get_unique_text_dictionary",
+             &PatientDatabaseWrapper::get_unique_text_dictionary,
+             py::return_value_policy::reference_internal)
+        .def("get_event_metadata_text_dictionary",
+             &PatientDatabaseWrapper::get_event_metadata_text_dictionary,
+             py::return_value_policy::reference_internal)
         .def("compute_split",
              [](PatientDatabaseWrapper& self, uint32_t seed,
                 int64_t patient_id) {
@@ -382,10 +1339,17 @@ void register_datasets_extension(py::module& root) {
              })
         .def("version_id", &PatientDatabaseWrapper::version_id)
         .def("database_id", &PatientDatabaseWrapper::database_id)
-        .def("close",
-             [](const PatientDatabaseWrapper& self) {
-                 // TODO: Implement this to save memory and file pointers
-             })
+        .def("subset", &PatientDatabaseWrapper::subset,
+             py::arg("patient_ids"), py::arg("target_path"))
+        .def("close", &PatientDatabaseWrapper::close)
+        .def("__enter__",
+             [](PatientDatabaseWrapper& self) -> PatientDatabaseWrapper& {
+                 return self;
+             },
+             py::return_value_policy::reference)
+        .def("__exit__",
+             [](PatientDatabaseWrapper& self, py::object, py::object,
+                py::object) { self.close(); })
         .attr("__bases__") =
         py::make_tuple(abc_mapping) + database_binding.attr("__bases__");
 
@@ -395,19 +1359,34 @@ void register_datasets_extension(py::module& root) {
         .def("get_parents", &OntologyWrapper::get_parents)
         .def("get_children", &OntologyWrapper::get_children)
         .def("get_all_parents", &OntologyWrapper::get_all_parents)
+        .def("get_code_index", &OntologyWrapper::get_code_index)
+        .def("get_parent_indices", &OntologyWrapper::get_parent_indices)
+        .def("get_children_indices", &OntologyWrapper::get_children_indices)
+        .def("get_all_parent_indices",
+             &OntologyWrapper::get_all_parent_indices)
+        .def("get_parents_csr", &OntologyWrapper::get_parents_csr)
+        .def("get_children_csr", &OntologyWrapper::get_children_csr)
+        .def("get_all_parents_csr", &OntologyWrapper::get_all_parents_csr)
         .def("get_text_description", &OntologyWrapper::get_text_description)
         .def("get_code_from_concept_id",
              &OntologyWrapper::get_code_from_concept_id)
         .def("get_concept_id_from_code",
-             &OntologyWrapper::get_concept_id_from_code);
+             &OntologyWrapper::get_concept_id_from_code)
+        .def("get_database_id", &OntologyWrapper::get_database_id);
 
     py::class_<EventWrapper>(m, "EventWrapper")
         .def_property_readonly("code", &EventWrapper::code)
+        .def_property_readonly("code_index", &EventWrapper::code_index)
         .def_property_readonly("start", &EventWrapper::start)
         .def_property_readonly("value", &EventWrapper::value)
+        .def_property_readonly(
+            "metadata",
+            [](EventWrapper& wrapper) {
+                return wrapper.metadata().attr("copy")();
+            })
         .def("__getattr__",
              [](EventWrapper& wrapper, const std::string& attr) {
-                 return wrapper.metadata().attr("get")(attr, py::none());
+                 return wrapper.get_metadata(attr);
              })
         .def("__repr__", [python_event](EventWrapper& wrapper) {
             return py::str(wrapper.to_python_event());
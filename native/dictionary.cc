@@ -4,6 +4,8 @@
 #include <sys/mman.h>
 #include <unistd.h>
 
+#include <algorithm>
+
 #include "absl/strings/str_cat.h"
 #include "streamvbyte.h"
 
@@ -91,16 +93,24 @@ Dictionary::Dictionary(Dictionary&& other)
     other.fd = -1;
 }
 
-Dictionary::~Dictionary() noexcept(false) {
+Dictionary::~Dictionary() noexcept(false) { close(); }
+
+void Dictionary::close() {
+    values_.clear();
+    values_.shrink_to_fit();
+    possib_sorted_values.reset();
+
     if (mmap_data != nullptr) {
-        int ret = munmap(mmap_data, length);
+        int ret = munmap(mmap_data, length + STREAMVBYTE_PADDING);
+        mmap_data = nullptr;
         if (ret < 0) {
             throw std::runtime_error(absl::StrCat(
                 "Got error trying to unmap Dictionary", std::strerror(errno)));
         }
     }
     if (fd != -1) {
-        int ret = close(fd);
+        int ret = ::close(fd);
+        fd = -1;
         if (ret < 0) {
             throw std::runtime_error(absl::StrCat(
                 "Got error trying to close Dictionary", std::strerror(errno)));
@@ -108,6 +118,50 @@ Dictionary::~Dictionary() noexcept(false) {
     }
 }
 
+void Dictionary::advise(AccessPattern access) {
+    if (mmap_data == nullptr) {
+        return;
+    }
+
+    int advice;
+    switch (access) {
+        case AccessPattern::SEQUENTIAL:
+            advice = MADV_SEQUENTIAL;
+            break;
+
+        case AccessPattern::RANDOM:
+            advice = MADV_RANDOM;
+            break;
+
+        default:
+            advice = MADV_NORMAL;
+            break;
+    }
+
+    if (madvise(mmap_data, length, advice) < 0) {
+        throw std::runtime_error(absl::StrCat(
+            "Got error trying to set options for ", std::strerror(errno)));
+    }
+}
+
+void Dictionary::prefetch(uint32_t start_idx, uint32_t end_idx) {
+    end_idx = std::min(end_idx, size());
+    if (start_idx >= end_idx) {
+        return;
+    }
+
+    // madvise requires a page aligned start
+    uintptr_t page_size = sysconf(_SC_PAGESIZE);
+    uintptr_t start =
+        reinterpret_cast<uintptr_t>(values_[start_idx].data()) &
+        ~(page_size - 1);
+    uintptr_t end = reinterpret_cast<uintptr_t>(values_[end_idx - 1].data() +
+                                                values_[end_idx - 1].size());
+
+    // This is only a hint, so failures are ignored
+    (void)madvise(reinterpret_cast<void*>(start), end - start, MADV_WILLNEED);
+}
+
 uint32_t Dictionary::size() const { return values_.size(); }
 
 std::string_view Dictionary::operator[](uint32_t idx) const {
@@ -4,6 +4,14 @@
 #include <boost/optional.hpp>
 #include <fstream>
 
+// How a mapped file is expected to be read, passed on to the kernel with
+// madvise to tune read-ahead
+enum class AccessPattern {
+    NORMAL,
+    SEQUENTIAL,
+    RANDOM,
+};
+
 class Dictionary {
    public:
     Dictionary(const boost::filesystem::path& path, bool read_all);
@@ -20,6 +28,13 @@ class Dictionary {
 
     void init_sorted_values();
 
+    void advise(AccessPattern access);
+    // Ask the kernel to start reading the given entries in the background
+    void prefetch(uint32_t start_idx, uint32_t end_idx);
+
+    // Unmap the file and release the descriptor, leaving an empty dictionary
+    void close();
+
    private:
     int fd;
     char* mmap_data;
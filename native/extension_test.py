@@ -1,6 +1,8 @@
 from __future__ import annotations
 
+import ctypes
 import datetime
+import operator
 
 import extension.datasets as m
 import numpy as np
@@ -82,5 +84,329 @@ def test_helper(tmp_path, capsys):
         assert total == 9
 
 
+def create_database(tmp_path):
+    concept_root = tmp_path / "concepts"
+    m.test.create_ontology_files(str(concept_root), True)
+
+    patients = tmp_path / "patients"
+    m.test.create_database_files(str(patients))
+
+    target = tmp_path / "database"
+
+    m.convert_patient_collection_to_patient_database(str(patients), str(concept_root), str(target), ",", 1)
+
+    return m.PatientDatabase(str(target), False)
+
+
+def test_patient_arrays(tmp_path):
+    database = create_database(tmp_path)
+    codes = database.get_ontology().get_codes()
+
+    arrays = database.get_patient_arrays(30)
+
+    assert arrays["patient_id"] == 30
+    assert arrays["birth_date"] == datetime.datetime(1990, 3, 8)
+
+    assert arrays["code"].dtype == np.uint32
+    assert [codes[c] for c in arrays["code"]] == [
+        "bar/foo",
+        "bar/foo",
+        "bar/parent of foo",
+        "lol/lmao",
+        "lol/lmao",
+        "lol/lmao",
+    ]
+
+    day = 24 * 60
+    assert list(arrays["start_age_in_minutes"]) == [
+        9 * 60 + 30,
+        10 * 60 + 30,
+        3 * day + 14 * 60 + 30,
+        3 * day + 14 * 60 + 30,
+        6 * day + 14 * 60 + 30,
+        7 * day + 14 * 60 + 30,
+    ]
+
+    assert list(arrays["value_type"]) == [
+        int(m.ValueType.NONE),
+        int(m.ValueType.NONE),
+        int(m.ValueType.UNIQUE_TEXT),
+        int(m.ValueType.SHARED_TEXT),
+        int(m.ValueType.NUMERIC),
+        int(m.ValueType.NUMERIC),
+    ]
+
+    assert np.isnan(arrays["numeric_value"][:4]).all()
+    assert list(arrays["numeric_value"][4:]) == [34, 34.5]
+
+    assert database.get_unique_text_dictionary()[arrays["text_value"][2]] == "Long Text"
+    assert database.get_shared_text_dictionary()[arrays["text_value"][3]] == "Short Text"
+
+    with pytest.raises(IndexError):
+        database.get_patient_arrays(31)
+
+
+def test_patient_ids_with_codes(tmp_path):
+    database = create_database(tmp_path)
+
+    assert list(database.get_patient_ids_with_codes(["bar/foo"])) == [30, 70, 80]
+    assert list(database.get_patient_ids_with_codes(["bar/parent of foo"])) == [30, 70]
+    assert list(database.get_patient_ids_with_codes(["lol/lmao"])) == [30]
+    assert list(database.get_patient_ids_with_codes(["lol/lmao", "bar/parent of foo"])) == [30, 70]
+
+    # Ontology only codes and unknown codes match nobody
+    assert list(database.get_patient_ids_with_codes(["bar/grandparent of foo", "missing/code"])) == []
+
+    assert list(database.get_patient_ids_with_codes(["bar/grandparent of foo"], include_descendants=True)) == [
+        30,
+        70,
+        80,
+    ]
+
+    assert list(database.get_patient_ids_with_shared_text(["Short Text"])) == [30, 70]
+
+
+def test_get_patients(tmp_path):
+    database = create_database(tmp_path)
+
+    patient_ids = [80, 30, 70]
+    for num_threads in (1, 2, 8):
+        batch = database.get_patients(patient_ids, num_threads=num_threads)
+
+        assert list(batch["patient_id"]) == patient_ids
+        assert list(batch["offsets"]) == [0, 1, 7, 9]
+        assert list(batch["birth_date"]) == [np.datetime64("1990-03-08")] * 3
+
+        single = database.get_patient_arrays(30)
+        for name in ("code", "start_age_in_minutes", "value_type", "text_value"):
+            assert list(batch[name][1:7]) == list(single[name])
+
+    assert len(database.get_patients([])["offsets"]) == 1
+
+    with pytest.raises(IndexError):
+        database.get_patients([30, 31])
+
+
+def test_close(tmp_path):
+    database = create_database(tmp_path)
+    ontology = database.get_ontology()
+    codes = ontology.get_codes()
+
+    with database as same_database:
+        assert same_database is database
+        patient = database[30]
+        assert patient.events[0].code == "bar/foo"
+
+    with pytest.raises(Exception):
+        database[30]
+
+    with pytest.raises(Exception):
+        database.get_patient_arrays(30)
+
+    with pytest.raises(Exception):
+        patient.events[2].value
+
+    assert len(codes) == 0
+
+    # Closing twice is harmless
+    database.close()
+
+
+def test_access_pattern(tmp_path):
+    database = create_database(tmp_path)
+    path = tmp_path / "database"
+
+    for access in ("normal", "sequential", "random"):
+        with m.PatientDatabase(str(path), access=access) as hinted:
+            for patient_id in hinted:
+                assert hinted[patient_id].events == database[patient_id].events
+
+    with pytest.raises(ValueError):
+        m.PatientDatabase(str(path), access="backwards")
+
+
+def test_patient_cache(tmp_path):
+    database = create_database(tmp_path)
+
+    with pytest.raises(ValueError):
+        database.enable_cache()
+
+    database.enable_cache(max_patients=2)
+
+    expected = database[30].events
+    assert database[30].events == expected
+    assert len(database.get_patient_arrays(30)["code"]) == len(expected)
+
+    stats = database.get_cache_stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 2
+    assert stats["num_patients"] == 1
+
+    database.get_patients([70, 80])
+    stats = database.get_cache_stats()
+    assert stats["evictions"] == 1
+    assert stats["num_patients"] == 2
+
+    database.disable_cache()
+    assert database[30].events == expected
+    assert database.get_cache_stats()["misses"] == 0
+
+
+def test_events_in_range(tmp_path):
+    database = create_database(tmp_path)
+
+    events = database.get_events_in_range(30, datetime.datetime(1990, 3, 8, 10), datetime.datetime(1990, 3, 14, 14, 30))
+    assert [e.start for e in events] == [
+        datetime.datetime(1990, 3, 8, 10, 30),
+        datetime.datetime(1990, 3, 11, 14, 30),
+        datetime.datetime(1990, 3, 11, 14, 30),
+    ]
+    assert events[1].value == "Long Text"
+
+    assert len(database.get_events_in_range(30, start=datetime.datetime(1990, 3, 14, 14, 30))) == 2
+    assert len(database.get_events_in_range(30, end=datetime.datetime(1990, 3, 8, 9, 30))) == 0
+    assert len(database.get_events_in_range(30)) == 6
+    assert len(database.get_events_in_range(30, datetime.datetime(1991, 1, 1), datetime.datetime(1990, 1, 1))) == 0
+
+    times = [
+        datetime.datetime(1980, 1, 1),
+        datetime.datetime(1990, 3, 8, 9, 30),
+        datetime.datetime(1990, 3, 11, 14, 30),
+        datetime.datetime(2000, 1, 1),
+    ]
+    left = database.searchsorted_events(30, times)
+    assert left.dtype == np.int64
+    assert list(left) == [0, 0, 2, 6]
+    assert list(database.searchsorted_events(30, times, side="right")) == [0, 1, 4, 6]
+
+    with pytest.raises(ValueError):
+        database.searchsorted_events(30, times, side="middle")
+
+    with pytest.raises(IndexError):
+        database.get_events_in_range(31)
+
+
+def test_map_reduce(tmp_path):
+    database = create_database(tmp_path)
+
+    def count_events(patient):
+        return {patient["patient_id"]: len(patient["code"])}
+
+    def merge(a, b):
+        return {**a, **b}
+
+    for num_threads in (1, 2, 8):
+        assert database.map_reduce(count_events, merge, num_threads=num_threads) == {30: 6, 70: 2, 80: 1}
+
+    def fail(patient):
+        raise RuntimeError("Failed on purpose")
+
+    with pytest.raises(RuntimeError):
+        database.map_reduce(fail, merge, num_threads=2)
+
+    def add_codes(a, b):
+        a.extend(b)
+        return a
+
+    expected = sorted(c for patient_id in database for c in database.get_patient_arrays(patient_id)["code"])
+    for num_threads in (1, 2, 8):
+        codes = database.map_reduce(
+            lambda patient: list(patient["code"]), add_codes, num_threads=num_threads, initial=[-1]
+        )
+        assert codes[0] == -1
+        assert sorted(codes[1:]) == expected
+
+    callback_type = ctypes.CFUNCTYPE(
+        None,
+        ctypes.c_void_p,
+        ctypes.c_int64,
+        ctypes.c_int32,
+        ctypes.c_uint64,
+        ctypes.POINTER(ctypes.c_uint32),
+        ctypes.POINTER(ctypes.c_uint32),
+        ctypes.POINTER(ctypes.c_uint8),
+        ctypes.POINTER(ctypes.c_float),
+        ctypes.POINTER(ctypes.c_uint32),
+    )
+
+    @callback_type
+    def count_numeric(state, patient_id, birth_date, num_events, code, start_age, value_type, numeric_value, text):
+        counts = ctypes.cast(state, ctypes.POINTER(ctypes.c_int64))
+        counts[0] += num_events
+        for i in range(num_events):
+            if value_type[i] == int(m.ValueType.NUMERIC):
+                counts[1] += 1
+
+    counts = database.map_reduce(count_numeric, operator.add, num_threads=2, initial=np.zeros(2, dtype=np.int64))
+    assert list(counts) == [9, 2]
+
+    for num_threads in (1, 2, 8):
+        initial = np.array([100, 10], dtype=np.int64)
+        counts = database.map_reduce(count_numeric, operator.add, num_threads=num_threads, initial=initial)
+        assert list(counts) == [109, 12]
+        assert list(initial) == [100, 10]
+
+    with pytest.raises(ValueError):
+        database.map_reduce(count_numeric, operator.add)
+
+
+def test_ontology_indices(tmp_path):
+    database = create_database(tmp_path)
+    ontology = database.get_ontology()
+    codes = ontology.get_codes()
+
+    foo = ontology.get_code_index("bar/foo")
+    assert codes[foo] == "bar/foo"
+    assert {codes[i] for i in ontology.get_all_parent_indices(foo)} == {
+        "bar/foo",
+        "bar/parent of foo",
+        "bar/grandparent of foo",
+    }
+
+    with pytest.raises(IndexError):
+        ontology.get_code_index("bar/missing")
+    with pytest.raises(IndexError):
+        ontology.get_parent_indices(len(codes))
+
+    for get_strs, get_indices, get_csr in [
+        (ontology.get_parents, ontology.get_parent_indices, ontology.get_parents_csr),
+        (ontology.get_children, ontology.get_children_indices, ontology.get_children_csr),
+        (ontology.get_all_parents, ontology.get_all_parent_indices, ontology.get_all_parents_csr),
+    ]:
+        indptr, indices = get_csr()
+        assert len(indptr) == len(codes) + 1
+        assert indices.dtype == np.uint32
+
+        for i, code in enumerate(codes):
+            expected = [codes[j] for j in get_indices(i)]
+            assert list(get_strs(code)) == expected
+            assert [codes[j] for j in indices[indptr[i] : indptr[i + 1]]] == expected
+
+
+def test_subset(tmp_path):
+    database = create_database(tmp_path)
+
+    for patient_ids in ([30, 70], [80, 70], [70]):
+        target = tmp_path / ("subset_" + "_".join(str(p) for p in patient_ids))
+        subset = database.subset(patient_ids, str(target))
+
+        assert sorted(subset) == sorted(patient_ids)
+        assert subset.version_id() == database.version_id()
+        assert subset.database_id() != database.database_id()
+        assert list(subset.get_ontology().get_codes()) == list(database.get_ontology().get_codes())
+
+        for patient_id in patient_ids:
+            assert subset[patient_id].events == database[patient_id].events
+            assert subset.get_patient_birth_date(patient_id) == database.get_patient_birth_date(patient_id)
+
+        expected = [p for p in database.get_patient_ids_with_codes(["bar/parent of foo"]) if p in patient_ids]
+        assert sorted(subset.get_patient_ids_with_codes(["bar/parent of foo"])) == sorted(expected)
+        expected = [p for p in database.get_patient_ids_with_shared_text(["Short Text"]) if p in patient_ids]
+        assert sorted(subset.get_patient_ids_with_shared_text(["Short Text"])) == sorted(expected)
+
+    with pytest.raises(IndexError):
+        database.subset([30, 31], str(tmp_path / "missing"))
+
+
 if __name__ == "__main__":
     raise SystemExit(pytest.main([__file__]))
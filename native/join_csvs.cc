@@ -3,6 +3,8 @@
 #include <boost/filesystem.hpp>
 #include <boost/optional.hpp>
 #include <boost/range/iterator_range.hpp>
+#include <cstring>
+#include <deque>
 #include <iostream>
 #include <queue>
 
@@ -11,6 +13,7 @@
 #include "csv.hh"
 #include "parse_utils.hh"
 #include "readerwritercircularbuffer.h"
+#include "row_groups.hh"
 #include "thread_utils.hh"
 
 constexpr int QUEUE_SIZE = 1000;
@@ -24,13 +27,142 @@ union ColumnValue {
     ColumnValue() {}
 };
 
-constexpr size_t MAX_SIZE = 1000000000;
-// constexpr size_t MAX_SIZE = 10000000;
+// Sorted runs are written with small row groups, so that merging many runs at
+// once only needs a small buffer for each run
+constexpr size_t RUN_ROW_GROUP_BYTES = 1024 * 1024;
+
+// The memory needed to read a sorted run while merging, which is either the
+// compressed and decompressed row group or the buffers of a CSV reader
+constexpr size_t MERGE_BYTES_PER_RUN = 4 * 1024 * 1024;
 
 using Row = std::vector<std::string>;
 using QueueItem = boost::optional<std::vector<std::string>>;
 using QueueType = moodycamel::BlockingReaderWriterCircularBuffer<QueueItem>;
 
+// The layout of the files being sorted, which are either zstd compressed CSVs
+// or row group files. Rows of row group files are kept in their binary
+// encoding so that they are written back unchanged.
+struct FileLayout {
+    std::vector<std::string> columns;
+    boost::optional<RowGroupSchema> row_group_schema;
+
+    bool is_row_group() const { return row_group_schema != boost::none; }
+
+    std::string extension() const {
+        if (is_row_group()) {
+            return std::string(ROW_GROUP_EXTENSION);
+        } else {
+            return ".csv.zst";
+        }
+    }
+};
+
+FileLayout get_file_layout(const boost::filesystem::path& source,
+                           char delimiter) {
+    FileLayout layout;
+    if (is_row_group_file(source)) {
+        layout.row_group_schema = get_row_group_schema(source);
+        for (const auto& column : *layout.row_group_schema) {
+            layout.columns.push_back(column.first);
+        }
+    } else {
+        layout.columns = get_csv_columns(source, delimiter);
+    }
+    return layout;
+}
+
+class RowReader {
+   public:
+    RowReader(const boost::filesystem::path& source, const FileLayout& layout,
+              char delimiter) {
+        if (layout.is_row_group()) {
+            row_group_reader.emplace(source);
+            if (row_group_reader->schema != *layout.row_group_schema) {
+                throw std::runtime_error("Columns of input don't match " +
+                                         source.string());
+            }
+        } else {
+            csv_reader.emplace(source, delimiter);
+            if (csv_reader->columns != layout.columns) {
+                throw std::runtime_error("Columns of input don't match " +
+                                         source.string());
+            }
+        }
+    }
+
+    bool next_row() {
+        if (row_group_reader) {
+            return row_group_reader->next_row();
+        } else {
+            return csv_reader->next_row();
+        }
+    }
+
+    Row& get_row() {
+        if (row_group_reader) {
+            return row_group_reader->get_row();
+        } else {
+            return csv_reader->get_row();
+        }
+    }
+
+   private:
+    boost::optional<CSVReader<ZstdReader>> csv_reader;
+    boost::optional<RowGroupReader> row_group_reader;
+};
+
+class RowWriter {
+   public:
+    RowWriter(const boost::filesystem::path& target, const FileLayout& layout,
+              char delimiter,
+              size_t max_bytes_per_group = MAX_ROW_GROUP_BYTES) {
+        if (layout.is_row_group()) {
+            row_group_writer.emplace(target, *layout.row_group_schema,
+                                     max_bytes_per_group);
+        } else {
+            csv_writer.emplace(target, layout.columns, delimiter);
+        }
+    }
+
+    void add_row(const Row& row) {
+        if (row_group_writer) {
+            row_group_writer->add_row(row);
+        } else {
+            csv_writer->add_row(row);
+        }
+    }
+
+   private:
+    boost::optional<CSVWriter<ZstdWriter>> csv_writer;
+    boost::optional<RowGroupWriter> row_group_writer;
+};
+
+template <typename T>
+void parse_integer_cell(const std::string& val, bool is_row_group, T& value) {
+    if (!is_row_group) {
+        attempt_parse_or_die(val, value);
+    } else if (val.size() == sizeof(value)) {
+        std::memcpy(&value, val.data(), sizeof(value));
+    } else {
+        throw std::runtime_error("Missing integer sort key");
+    }
+}
+
+void parse_time_cell(const std::string& val, bool is_row_group,
+                     absl::CivilSecond& value) {
+    if (!is_row_group) {
+        attempt_parse_time_or_die(val, value);
+    } else {
+        int64_t microseconds;
+        parse_integer_cell(val, is_row_group, microseconds);
+        int64_t seconds = microseconds / 1000000;
+        if (microseconds % 1000000 < 0) {
+            seconds -= 1;
+        }
+        value = absl::CivilSecond(1970, 1, 1, 0, 0, 0) + seconds;
+    }
+}
+
 bool compare_rows_using_indices(
     const std::vector<std::pair<std::string, ColumnValueType>>& sort_keys,
     const std::vector<ColumnValue>& column_values, size_t a, size_t b) {
@@ -77,7 +209,7 @@ bool compare_rows_using_indices(
 void convert_to_column_values(
     const std::vector<std::pair<std::string, ColumnValueType>>& sort_keys,
     const std::vector<size_t>& sort_indices,
-    const std::vector<std::string>& row,
+    const std::vector<std::string>& row, bool is_row_group,
     std::vector<ColumnValue>& column_values, ssize_t start_location = -1) {
     for (size_t i = 0; i < sort_indices.size(); i++) {
         const std::string& val = row[sort_indices[i]];
@@ -88,15 +220,16 @@ void convert_to_column_values(
                 break;
 
             case ColumnValueType::UINT64_T:
-                attempt_parse_or_die(val, column_val.integer);
+                parse_integer_cell(val, is_row_group, column_val.integer);
                 break;
 
             case ColumnValueType::INT64_T:
-                attempt_parse_or_die(val, column_val.signed_integer);
+                parse_integer_cell(val, is_row_group,
+                                   column_val.signed_integer);
                 break;
 
             case ColumnValueType::DATETIME:
-                attempt_parse_time_or_die(val, column_val.time);
+                parse_time_cell(val, is_row_group, column_val.time);
                 break;
 
             default:
@@ -111,9 +244,29 @@ void convert_to_column_values(
     }
 }
 
+bool is_valid_sort_column(ColumnValueType sort_type,
+                          RowGroupColumnType column_type) {
+    switch (sort_type) {
+        case ColumnValueType::STRING:
+            return column_type == RowGroupColumnType::STRING ||
+                   column_type == RowGroupColumnType::BYTES;
+
+        case ColumnValueType::UINT64_T:
+        case ColumnValueType::INT64_T:
+            return column_type == RowGroupColumnType::INT64;
+
+        case ColumnValueType::DATETIME:
+            return column_type == RowGroupColumnType::DATETIME;
+
+        default:
+            return false;
+    }
+}
+
 std::vector<size_t> get_sort_indices(
-    const std::vector<std::string>& columns,
+    const FileLayout& layout,
     const std::vector<std::pair<std::string, ColumnValueType>>& sort_keys) {
+    const auto& columns = layout.columns;
     std::vector<size_t> indices;
     for (const auto& sort_key : sort_keys) {
         auto iter =
@@ -125,6 +278,14 @@ std::vector<size_t> get_sort_indices(
         } else {
             indices.push_back(iter - std::begin(columns));
         }
+
+        if (layout.is_row_group() &&
+            !is_valid_sort_column(
+                sort_key.second,
+                (*layout.row_group_schema)[indices.back()].second)) {
+            throw std::runtime_error("The sort key " + sort_key.first +
+                                     " does not match the column type");
+        }
     }
     return indices;
 }
@@ -136,11 +297,11 @@ void sort_reader(
     std::vector<
         std::vector<moodycamel::BlockingReaderWriterCircularBuffer<QueueItem>>>&
         all_write_queues,
-    const std::vector<std::string>& columns,
+    const FileLayout& layout,
     const std::vector<std::pair<std::string, ColumnValueType>>& sort_keys,
-    char delimiter) {
+    char delimiter, const std::vector<bool>& is_shard_needed) {
     boost::optional<boost::filesystem::path> item;
-    auto sort_indices = get_sort_indices(columns, sort_keys);
+    auto sort_indices = get_sort_indices(layout, sort_keys);
     while (true) {
         file_queue.wait_dequeue(item);
 
@@ -149,16 +310,14 @@ void sort_reader(
         } else {
             auto source = *item;
 
-            CSVReader<ZstdReader> reader(source.string(), delimiter);
-            if (reader.columns != columns) {
-                throw std::runtime_error("Columns of input don't match " +
-                                         source.string());
-            }
+            RowReader reader(source, layout, delimiter);
             while (reader.next_row()) {
                 Row r = std::move(reader.get_row());
                 size_t index =
                     std::hash<std::string>()(r[sort_indices[0]]) % (num_shards);
-                all_write_queues[index][i].wait_enqueue(std::move(r));
+                if (is_shard_needed[index]) {
+                    all_write_queues[index][i].wait_enqueue(std::move(r));
+                }
             }
         }
     }
@@ -168,28 +327,52 @@ void sort_reader(
     }
 }
 
-void sort_writer(
-    size_t j, size_t num_shards,
-    std::vector<moodycamel::BlockingReaderWriterCircularBuffer<QueueItem>>&
-        write_queues,
-    const boost::filesystem::path& target_dir,
-    const std::vector<std::string>& columns,
-    const std::vector<std::pair<std::string, ColumnValueType>>& sort_keys,
-    char delimiter) {
-    boost::filesystem::create_directory(target_dir);
-    std::vector<Row> rows;
-    std::vector<ColumnValue> row_values;
-    std::vector<size_t> row_indices;
-    size_t current_size = 0;
+// Buffers rows in memory and writes them to target_dir as sorted runs
+class SortedRunWriter {
+   public:
+    SortedRunWriter(
+        const boost::filesystem::path& _target_dir, const FileLayout& _layout,
+        const std::vector<std::pair<std::string, ColumnValueType>>& _sort_keys,
+        char _delimiter)
+        : target_dir(_target_dir),
+          layout(_layout),
+          sort_keys(_sort_keys),
+          delimiter(_delimiter),
+          sort_indices(get_sort_indices(_layout, _sort_keys)),
+          current_size(0) {
+        boost::filesystem::create_directory(target_dir);
+
+        // The memory used by every row besides the data of its cells
+        row_overhead = sizeof(Row) +
+                       layout.columns.size() * sizeof(std::string) +
+                       sort_keys.size() * sizeof(ColumnValue) +
+                       2 * sizeof(size_t);
+    }
 
-    auto sort_indices = get_sort_indices(columns, sort_keys);
+    void add_row(Row&& r) {
+        current_size += row_overhead;
+        for (const auto& column : r) {
+            current_size += column.size();
+        }
+        row_indices.emplace_back(rows.size());
+        rows.emplace_back(std::move(r));
+    }
+
+    // The approximate memory used by the buffered rows
+    size_t size() const { return current_size; }
 
-    auto flush = [&]() {
-        auto target_file = target_dir / boost::filesystem::unique_path(
-                                            "%%%%%%%%%%%%%%.csv.zst");
+    void flush() {
+        if (rows.empty()) {
+            return;
+        }
+
+        auto target_file =
+            target_dir / boost::filesystem::unique_path("%%%%%%%%%%%%%%" +
+                                                        layout.extension());
 
         for (const auto& row : rows) {
-            convert_to_column_values(sort_keys, sort_indices, row, row_values);
+            convert_to_column_values(sort_keys, sort_indices, row,
+                                     layout.is_row_group(), row_values);
         }
 
         std::sort(std::begin(row_indices), std::end(row_indices),
@@ -198,7 +381,7 @@ void sort_writer(
                                                         a, b);
                   });
 
-        CSVWriter<ZstdWriter> writer(target_file.string(), columns, delimiter);
+        RowWriter writer(target_file, layout, delimiter, RUN_ROW_GROUP_BYTES);
         for (const auto& row_index : row_indices) {
             writer.add_row(rows[row_index]);
         }
@@ -207,31 +390,59 @@ void sort_writer(
         row_values.clear();
         row_indices.clear();
         current_size = 0;
-    };
+    }
+
+   private:
+    boost::filesystem::path target_dir;
+    const FileLayout& layout;
+    const std::vector<std::pair<std::string, ColumnValueType>>& sort_keys;
+    char delimiter;
+    std::vector<size_t> sort_indices;
+    size_t row_overhead;
+
+    std::vector<Row> rows;
+    std::vector<ColumnValue> row_values;
+    std::vector<size_t> row_indices;
+    size_t current_size;
+};
+
+void sort_writer(
+    size_t j, size_t num_shards,
+    std::vector<moodycamel::BlockingReaderWriterCircularBuffer<QueueItem>>&
+        write_queues,
+    const boost::filesystem::path& target_dir, const FileLayout& layout,
+    const std::vector<std::pair<std::string, ColumnValueType>>& sort_keys,
+    char delimiter, size_t max_run_bytes) {
+    SortedRunWriter writer(target_dir, layout, sort_keys, delimiter);
 
     dequeue_many_loop(write_queues, [&](Row& r) {
-        for (const auto& column : r) {
-            current_size += column.size();
-        }
-        row_indices.emplace_back(rows.size());
-        rows.emplace_back(std::move(r));
-        if (current_size > MAX_SIZE) {
-            flush();
+        writer.add_row(std::move(r));
+        if (writer.size() > max_run_bytes) {
+            writer.flush();
         }
     });
 
-    if (current_size > 0) {
-        flush();
-    }
+    writer.flush();
 }
 
 void sort_csvs(
     const boost::filesystem::path& source_directory,
     const boost::filesystem::path& target_directory,
     const std::vector<std::pair<std::string, ColumnValueType>>& sort_keys,
-    char delimiter, size_t num_shards) {
+    char delimiter, size_t num_shards, size_t max_memory_bytes,
+    const boost::optional<std::vector<size_t>>& shards) {
     boost::filesystem::create_directory(target_directory);
 
+    std::vector<bool> is_shard_needed(num_shards, !shards);
+    if (shards) {
+        for (size_t shard : *shards) {
+            is_shard_needed.at(shard) = true;
+        }
+    }
+
+    // Every shard sorts runs of its own
+    size_t max_run_bytes = max_memory_bytes / num_shards;
+
     std::vector<boost::filesystem::path> target_shards;
 
     for (size_t i = 0; i < num_shards; i++) {
@@ -242,12 +453,12 @@ void sort_csvs(
         boost::optional<boost::filesystem::path>>
         file_queue;
 
-    std::vector<std::string> columns;
+    FileLayout layout;
     for (auto& entry : boost::make_iterator_range(
              boost::filesystem::directory_iterator(source_directory), {})) {
         boost::filesystem::path source = entry.path();
-        if (columns.empty()) {
-            columns = get_csv_columns(source, delimiter);
+        if (layout.columns.empty()) {
+            layout = get_file_layout(source, delimiter);
         }
         file_queue.enqueue(source);
     }
@@ -270,15 +481,17 @@ void sort_csvs(
 
     for (size_t i = 0; i < num_shards; i++) {
         threads.emplace_back([i, &file_queue, &write_queues, num_shards,
-                              &columns, &sort_keys, delimiter]() {
-            sort_reader(i, num_shards, file_queue, write_queues, columns,
-                        sort_keys, delimiter);
+                              &layout, &sort_keys, delimiter,
+                              &is_shard_needed]() {
+            sort_reader(i, num_shards, file_queue, write_queues, layout,
+                        sort_keys, delimiter, is_shard_needed);
         });
 
         threads.emplace_back([i, &write_queues, &target_shards, num_shards,
-                              &columns, &sort_keys, delimiter]() {
+                              &layout, &sort_keys, delimiter,
+                              max_run_bytes]() {
             sort_writer(i, num_shards, write_queues[i], target_shards[i],
-                        columns, sort_keys, delimiter);
+                        layout, sort_keys, delimiter, max_run_bytes);
         });
     }
 
@@ -287,42 +500,81 @@ void sort_csvs(
     }
 }
 
-void join_csvs(
+void partition_csvs(
     const boost::filesystem::path& source_directory,
-    const boost::filesystem::path& target_file,
+    const boost::filesystem::path& target_directory,
     const std::vector<std::pair<std::string, ColumnValueType>>& sort_keys,
-    char delimiter) {
-    std::vector<CSVReader<ZstdReader>> source_files;
-
-    std::vector<std::string> columns;
+    char delimiter, size_t num_partitions, size_t max_memory_bytes) {
+    boost::filesystem::create_directory(target_directory);
 
+    std::vector<boost::filesystem::path> sources;
     for (auto& entry : boost::make_iterator_range(
              boost::filesystem::directory_iterator(source_directory), {})) {
-        const boost::filesystem::path& source = entry.path();
-        if (columns.empty()) {
-            columns = get_csv_columns(source, delimiter);
-        }
-        source_files.emplace_back(source, delimiter);
-        if (source_files.size() == 1) {
-            columns = source_files.back().columns;
-        } else {
-            if (source_files.back().columns != columns) {
-                throw std::runtime_error("Invalid columns");
+        sources.push_back(entry.path());
+    }
+    if (sources.empty()) {
+        return;
+    }
+
+    FileLayout layout = get_file_layout(sources[0], delimiter);
+    auto sort_indices = get_sort_indices(layout, sort_keys);
+
+    std::vector<SortedRunWriter> partitions;
+    partitions.reserve(num_partitions);
+    for (size_t i = 0; i < num_partitions; i++) {
+        partitions.emplace_back(target_directory / std::to_string(i), layout,
+                                sort_keys, delimiter);
+    }
+
+    // The partitions share the budget, so spill the largest one whenever it
+    // is exceeded to keep the runs long
+    size_t current_size = 0;
+    for (const auto& source : sources) {
+        RowReader reader(source, layout, delimiter);
+        while (reader.next_row()) {
+            Row r = std::move(reader.get_row());
+            size_t index =
+                std::hash<std::string>()(r[sort_indices[0]]) % num_partitions;
+
+            SortedRunWriter& partition = partitions[index];
+            current_size -= partition.size();
+            partition.add_row(std::move(r));
+            current_size += partition.size();
+
+            if (current_size > max_memory_bytes) {
+                auto largest = std::max_element(
+                    std::begin(partitions), std::end(partitions),
+                    [](const SortedRunWriter& a, const SortedRunWriter& b) {
+                        return a.size() < b.size();
+                    });
+                current_size -= largest->size();
+                largest->flush();
             }
         }
     }
 
-    if (columns.empty()) {
-        // No data to join
-        return;
+    for (auto& partition : partitions) {
+        partition.flush();
+    }
+}
+
+void merge_files(
+    const std::vector<boost::filesystem::path>& sources,
+    const boost::filesystem::path& target_file, const FileLayout& layout,
+    const std::vector<std::pair<std::string, ColumnValueType>>& sort_keys,
+    char delimiter, size_t max_bytes_per_group) {
+    std::vector<RowReader> source_files;
+    for (const auto& source : sources) {
+        source_files.emplace_back(source, layout, delimiter);
     }
 
-    CSVWriter<ZstdWriter> target(target_file, columns, delimiter);
+    RowWriter target(target_file, layout, delimiter, max_bytes_per_group);
 
-    auto sort_indices = get_sort_indices(columns, sort_keys);
+    auto sort_indices = get_sort_indices(layout, sort_keys);
 
     std::vector<Row> rows(source_files.size());
-    std::vector<ColumnValue> column_vals;
+    std::vector<ColumnValue> column_vals(source_files.size() *
+                                         sort_keys.size());
 
     auto comp = [&](size_t a, size_t b) {
         return compare_rows_using_indices(sort_keys, column_vals, b, a);
@@ -336,7 +588,7 @@ void join_csvs(
         if (source_file.next_row()) {
             rows[i] = std::move(source_file.get_row());
             convert_to_column_values(sort_keys, sort_indices, rows[i],
-                                     column_vals);
+                                     layout.is_row_group(), column_vals, i);
             queue.push(i);
         }
     }
@@ -352,34 +604,106 @@ void join_csvs(
         if (source_file.next_row()) {
             rows[read_index] = std::move(source_file.get_row());
             convert_to_column_values(sort_keys, sort_indices, rows[read_index],
-                                     column_vals, read_index);
+                                     layout.is_row_group(), column_vals,
+                                     read_index);
             queue.push(read_index);
         }
     }
 }
 
+void join_csvs(
+    const boost::filesystem::path& source_directory,
+    const boost::filesystem::path& target_file,
+    const std::vector<std::pair<std::string, ColumnValueType>>& sort_keys,
+    char delimiter, size_t max_memory_bytes) {
+    std::deque<boost::filesystem::path> sources;
+
+    FileLayout layout;
+
+    for (auto& entry : boost::make_iterator_range(
+             boost::filesystem::directory_iterator(source_directory), {})) {
+        const boost::filesystem::path& source = entry.path();
+        if (layout.columns.empty()) {
+            layout = get_file_layout(source, delimiter);
+        }
+        sources.push_back(source);
+    }
+
+    if (layout.columns.empty()) {
+        // No data to join
+        return;
+    }
+
+    size_t max_runs = std::max(max_memory_bytes / MERGE_BYTES_PER_RUN,
+                               static_cast<size_t>(2));
+
+    // Merge the oldest runs first, so that every row is merged a similar
+    // number of times
+    while (sources.size() > max_runs) {
+        std::vector<boost::filesystem::path> runs(
+            std::begin(sources), std::begin(sources) + max_runs);
+        sources.erase(std::begin(sources), std::begin(sources) + max_runs);
+
+        auto merged_run =
+            source_directory / boost::filesystem::unique_path(
+                                   "%%%%%%%%%%%%%%" + layout.extension());
+        merge_files(runs, merged_run, layout, sort_keys, delimiter,
+                    RUN_ROW_GROUP_BYTES);
+        for (const auto& run : runs) {
+            boost::filesystem::remove(run);
+        }
+        sources.push_back(merged_run);
+    }
+
+    merge_files(std::vector<boost::filesystem::path>(std::begin(sources),
+                                                     std::end(sources)),
+                target_file, layout, sort_keys, delimiter,
+                MAX_ROW_GROUP_BYTES);
+}
+
 void sort_and_join_csvs(
     const boost::filesystem::path& source_directory,
     const boost::filesystem::path& target_directory,
     const std::vector<std::pair<std::string, ColumnValueType>>& sort_keys,
-    char delimiter, size_t num_shards) {
+    char delimiter, size_t num_shards, size_t max_memory_bytes,
+    const boost::optional<std::vector<size_t>>& shards) {
     boost::filesystem::create_directory(target_directory);
     boost::filesystem::path sorted_dir =
         target_directory / boost::filesystem::unique_path();
-    sort_csvs(source_directory, sorted_dir, sort_keys, delimiter, num_shards);
+    sort_csvs(source_directory, sorted_dir, sort_keys, delimiter, num_shards,
+              max_memory_bytes, shards);
+
+    // The joined files use the same format as the source files
+    std::string extension = ".csv.zst";
+    for (auto& entry : boost::make_iterator_range(
+             boost::filesystem::directory_iterator(source_directory), {})) {
+        extension = get_file_layout(entry.path(), delimiter).extension();
+        break;
+    }
+
+    std::vector<size_t> needed_shards;
+    if (shards) {
+        needed_shards = *shards;
+    } else {
+        for (size_t i = 0; i < num_shards; i++) {
+            needed_shards.push_back(i);
+        }
+    }
+
     std::vector<std::thread> threads;
 
-    for (size_t i = 0; i < num_shards; i++) {
-        threads.emplace_back(
-            [i, &sorted_dir, &target_directory, &sort_keys, delimiter]() {
-                join_csvs(sorted_dir / std::to_string(i),
-                          target_directory / (std::to_string(i) + ".csv.zst"),
-                          sort_keys, delimiter);
-            });
+    for (size_t i : needed_shards) {
+        threads.emplace_back([i, &sorted_dir, &target_directory, &sort_keys,
+                              &extension, delimiter, num_shards,
+                              max_memory_bytes]() {
+            join_csvs(sorted_dir / std::to_string(i),
+                      target_directory / (std::to_string(i) + extension),
+                      sort_keys, delimiter, max_memory_bytes / num_shards);
+        });
     }
 
-    for (size_t i = 0; i < num_shards; i++) {
-        threads[i].join();
+    for (auto& thread : threads) {
+        thread.join();
     }
     boost::filesystem::remove_all(sorted_dir);
 }
@@ -1,25 +1,56 @@
 #pragma once
 
 #include <boost/filesystem.hpp>
+#include <boost/optional.hpp>
 #include <string>
 #include <vector>
 
 enum class ColumnValueType { STRING, UINT64_T, INT64_T, DATETIME };
 
+// The default budget for the rows held in memory while sorting and joining,
+// shared between all shards. The estimate is approximate, so leave some
+// headroom.
+constexpr size_t DEFAULT_SORT_MEMORY_BYTES = 16ull * 1024 * 1024 * 1024;
+
+// Split the rows of the files in source_directory into num_shards shards by
+// the first sort key, writing every shard as a set of sorted runs in
+// target_directory / <shard>. If shards is given, the rows of the other shards
+// are dropped.
 void sort_csvs(
     const boost::filesystem::path& source_directory,
     const boost::filesystem::path& target_directory,
     const std::vector<std::pair<std::string, ColumnValueType>>& sort_keys,
-    char delimiter, size_t num_threads);
+    char delimiter, size_t num_threads,
+    size_t max_memory_bytes = DEFAULT_SORT_MEMORY_BYTES,
+    const boost::optional<std::vector<size_t>>& shards = boost::none);
 
-void join_csvs(
+// Split the rows of the files in source_directory into num_partitions
+// partitions like sort_csvs, but on the calling thread. The partitions share
+// max_memory_bytes, so their runs are shorter than those of sort_csvs.
+void partition_csvs(
     const boost::filesystem::path& source_directory,
     const boost::filesystem::path& target_directory,
     const std::vector<std::pair<std::string, ColumnValueType>>& sort_keys,
-    char delimiter, size_t num_shards);
+    char delimiter, size_t num_partitions,
+    size_t max_memory_bytes = DEFAULT_SORT_MEMORY_BYTES);
+
+// Merge the sorted runs in source_directory into target_file. If there are
+// too many runs to merge at once within the budget, runs are first merged
+// into larger runs in source_directory.
+void join_csvs(
+    const boost::filesystem::path& source_directory,
+    const boost::filesystem::path& target_file,
+    const std::vector<std::pair<std::string, ColumnValueType>>& sort_keys,
+    char delimiter, size_t max_memory_bytes = DEFAULT_SORT_MEMORY_BYTES);
 
+// Sort and join the files in source_directory into num_shards files named
+// target_directory / <shard><extension>. If shards is given, only those shards
+// are written, so that an interrupted run can redo just its missing shards.
+// The shard of a row only depends on its first sort key and num_shards.
 void sort_and_join_csvs(
     const boost::filesystem::path& source_directory,
     const boost::filesystem::path& target_directory,
     const std::vector<std::pair<std::string, ColumnValueType>>& sort_keys,
-    char delimiter, size_t num_shards);
+    char delimiter, size_t num_shards,
+    size_t max_memory_bytes = DEFAULT_SORT_MEMORY_BYTES,
+    const boost::optional<std::vector<size_t>>& shards = boost::none);
@@ -9,6 +9,7 @@
 #include "gmock/gmock.h"
 #include "gtest/gtest.h"
 #include "parse_utils.hh"
+#include "row_groups.hh"
 
 TEST(JoinCsvTest, TestSort) {
     boost::filesystem::path root = boost::filesystem::temp_directory_path() /
@@ -153,3 +154,292 @@ TEST(JoinCsvTest, TestSortAndJoin) {
     EXPECT_EQ(num_keys, 100);
     boost::filesystem::remove_all(root);
 }
+
+TEST(JoinCsvTest, TestSortAndJoinRowGroups) {
+    boost::filesystem::path root = boost::filesystem::temp_directory_path() /
+                                   boost::filesystem::unique_path();
+    boost::filesystem::create_directory(root);
+    boost::filesystem::path source = root / "source_dir";
+    boost::filesystem::path target = root / "target_dir";
+    boost::filesystem::create_directory(source);
+    RowGroupSchema schema = {{"col1", RowGroupColumnType::INT64},
+                             {"col2", RowGroupColumnType::BYTES}};
+
+    auto encode = [](int64_t value) {
+        return std::string(reinterpret_cast<const char*>(&value),
+                           sizeof(value));
+    };
+
+    std::vector<std::vector<std::string>> entries;
+
+    for (int64_t i = 1; i <= 100; i++) {
+        for (int j = 1; j <= 3; j++) {
+            // Binary cells are passed through unchanged
+            entries.push_back({encode(-i), absl::StrCat(j, "\n\r,\"", i)});
+        }
+    }
+
+    std::shuffle(std::begin(entries), std::end(entries),
+                 std::default_random_engine(1235423));
+
+    size_t num_chunks = 7;
+
+    size_t entries_per_chunk = (entries.size() + num_chunks - 1) / num_chunks;
+
+    size_t num_shards = 5;
+
+    for (size_t i = 0; i < num_chunks; i++) {
+        RowGroupWriter writer(
+            source / absl::StrCat(i, ROW_GROUP_EXTENSION), schema);
+        for (size_t j = 0; j < entries_per_chunk; j++) {
+            size_t index = i * entries_per_chunk + j;
+            if (index < entries.size()) {
+                writer.add_row(entries[index]);
+            }
+        }
+    }
+
+    sort_and_join_csvs(source.string(), target.string(),
+                       {{"col1", ColumnValueType::INT64_T},
+                        {"col2", ColumnValueType::STRING}},
+                       ',', num_shards);
+
+    std::vector<std::vector<std::string>> found_entries;
+    for (size_t i = 0; i < num_shards; i++) {
+        RowGroupReader reader(target / absl::StrCat(i, ROW_GROUP_EXTENSION));
+        EXPECT_EQ(reader.schema, schema);
+        while (reader.next_row()) {
+            if (!found_entries.empty() &&
+                found_entries.back()[0] == reader.get_row()[0]) {
+                EXPECT_LT(found_entries.back()[1], reader.get_row()[1]);
+            }
+            found_entries.push_back(reader.get_row());
+        }
+    }
+
+    EXPECT_EQ(found_entries.size(), entries.size());
+    std::sort(std::begin(entries), std::end(entries));
+    std::sort(std::begin(found_entries), std::end(found_entries));
+    EXPECT_EQ(found_entries, entries);
+
+    boost::filesystem::remove_all(root);
+}
+
+TEST(JoinCsvTest, TestSortAndJoinWithMemoryBudget) {
+    boost::filesystem::path root = boost::filesystem::temp_directory_path() /
+                                   boost::filesystem::unique_path();
+    boost::filesystem::create_directory(root);
+    boost::filesystem::path source = root / "source_dir";
+    boost::filesystem::path target = root / "target_dir";
+    boost::filesystem::create_directory(source);
+    RowGroupSchema schema = {{"col1", RowGroupColumnType::INT64},
+                             {"col2", RowGroupColumnType::STRING}};
+
+    auto encode = [](int64_t value) {
+        return std::string(reinterpret_cast<const char*>(&value),
+                           sizeof(value));
+    };
+
+    std::vector<std::vector<std::string>> entries;
+
+    for (int64_t i = 1; i <= 100; i++) {
+        for (int j = 1; j <= 3; j++) {
+            entries.push_back({encode(i), absl::StrCat(j * 100)});
+        }
+    }
+
+    std::shuffle(std::begin(entries), std::end(entries),
+                 std::default_random_engine(1235423));
+
+    size_t num_chunks = 7;
+
+    size_t entries_per_chunk = (entries.size() + num_chunks - 1) / num_chunks;
+
+    size_t num_shards = 3;
+
+    for (size_t i = 0; i < num_chunks; i++) {
+        RowGroupWriter writer(
+            source / absl::StrCat(i, ROW_GROUP_EXTENSION), schema);
+        for (size_t j = 0; j < entries_per_chunk; j++) {
+            size_t index = i * entries_per_chunk + j;
+            if (index < entries.size()) {
+                writer.add_row(entries[index]);
+            }
+        }
+    }
+
+    // Every row becomes a sorted run of its own, which are then merged two at
+    // a time
+    sort_and_join_csvs(source.string(), target.string(),
+                       {{"col1", ColumnValueType::INT64_T},
+                        {"col2", ColumnValueType::STRING}},
+                       ',', num_shards, 1);
+
+    std::vector<std::vector<std::string>> found_entries;
+    size_t num_files = 0;
+    for (auto& entry : boost::make_iterator_range(
+             boost::filesystem::directory_iterator(target), {})) {
+        num_files++;
+        RowGroupReader reader(entry.path());
+        std::vector<std::string> last_row;
+        while (reader.next_row()) {
+            if (!last_row.empty()) {
+                EXPECT_LT(last_row, reader.get_row());
+            }
+            last_row = reader.get_row();
+            found_entries.push_back(last_row);
+        }
+    }
+
+    EXPECT_EQ(num_files, num_shards);
+    std::sort(std::begin(entries), std::end(entries));
+    std::sort(std::begin(found_entries), std::end(found_entries));
+    EXPECT_EQ(found_entries, entries);
+
+    boost::filesystem::remove_all(root);
+}
+
+TEST(JoinCsvTest, TestSortAndJoinSomeShards) {
+    boost::filesystem::path root = boost::filesystem::temp_directory_path() /
+                                   boost::filesystem::unique_path();
+    boost::filesystem::create_directory(root);
+    boost::filesystem::path source = root / "source_dir";
+    boost::filesystem::path all_target = root / "all_target_dir";
+    boost::filesystem::path some_target = root / "some_target_dir";
+    boost::filesystem::create_directory(source);
+    std::vector<std::string> columns = {"col1", "col2"};
+
+    std::vector<std::vector<std::string>> entries;
+
+    for (int i = 1; i <= 100; i++) {
+        for (int j = 1; j <= 3; j++) {
+            entries.push_back({std::to_string(i), std::to_string(j * 100)});
+        }
+    }
+
+    std::shuffle(std::begin(entries), std::end(entries),
+                 std::default_random_engine(1235423));
+
+    size_t num_chunks = 7;
+
+    size_t entries_per_chunk = (entries.size() + num_chunks - 1) / num_chunks;
+
+    size_t num_shards = 5;
+
+    for (size_t i = 0; i < num_chunks; i++) {
+        CSVWriter<ZstdWriter> writer(
+            (source / absl::StrCat(i, ".csv.zst")).string(), columns, ',');
+        for (size_t j = 0; j < entries_per_chunk; j++) {
+            size_t index = i * entries_per_chunk + j;
+            if (index < entries.size()) {
+                writer.add_row(entries[index]);
+            }
+        }
+    }
+
+    std::vector<std::pair<std::string, ColumnValueType>> sort_keys = {
+        {"col1", ColumnValueType::UINT64_T}, {"col2", ColumnValueType::STRING}};
+    sort_and_join_csvs(source.string(), all_target.string(), sort_keys, ',',
+                       num_shards);
+    sort_and_join_csvs(source.string(), some_target.string(), sort_keys, ',',
+                       num_shards, DEFAULT_SORT_MEMORY_BYTES,
+                       std::vector<size_t>{1, 3});
+
+    auto read_rows = [&](const boost::filesystem::path& path) {
+        std::vector<std::vector<std::string>> rows;
+        CSVReader<ZstdReader> reader(path, columns, ',');
+        while (reader.next_row()) {
+            rows.push_back(reader.get_row());
+        }
+        return rows;
+    };
+
+    // The requested shards have exactly the rows they have in a full join
+    for (size_t i = 0; i < num_shards; i++) {
+        boost::filesystem::path name = absl::StrCat(i, ".csv.zst");
+        if (i == 1 || i == 3) {
+            EXPECT_EQ(read_rows(some_target / name),
+                      read_rows(all_target / name));
+        } else {
+            EXPECT_FALSE(boost::filesystem::exists(some_target / name));
+        }
+    }
+
+    boost::filesystem::remove_all(root);
+}
+
+TEST(JoinCsvTest, TestPartition) {
+    boost::filesystem::path root = boost::filesystem::temp_directory_path() /
+                                   boost::filesystem::unique_path();
+    boost::filesystem::create_directory(root);
+    boost::filesystem::path source = root / "source_dir";
+    boost::filesystem::path sorted = root / "sorted_dir";
+    boost::filesystem::path partitioned = root / "partitioned_dir";
+    boost::filesystem::create_directory(source);
+    std::vector<std::string> columns = {"col1", "col2"};
+
+    std::vector<std::vector<std::string>> entries;
+
+    for (int i = 1; i <= 100; i++) {
+        for (int j = 1; j <= 3; j++) {
+            entries.push_back({std::to_string(i), std::to_string(j * 100)});
+        }
+    }
+
+    std::shuffle(std::begin(entries), std::end(entries),
+                 std::default_random_engine(1235423));
+
+    size_t num_chunks = 7;
+
+    size_t entries_per_chunk = (entries.size() + num_chunks - 1) / num_chunks;
+
+    size_t num_partitions = 4;
+
+    for (size_t i = 0; i < num_chunks; i++) {
+        CSVWriter<ZstdWriter> writer(
+            (source / absl::StrCat(i, ".csv.zst")).string(), columns, ',');
+        for (size_t j = 0; j < entries_per_chunk; j++) {
+            size_t index = i * entries_per_chunk + j;
+            if (index < entries.size()) {
+                writer.add_row(entries[index]);
+            }
+        }
+    }
+
+    std::vector<std::pair<std::string, ColumnValueType>> sort_keys = {
+        {"col1", ColumnValueType::UINT64_T}, {"col2", ColumnValueType::STRING}};
+    sort_csvs(source.string(), sorted.string(), sort_keys, ',',
+              num_partitions);
+    // Small enough that every partition is spilled several times
+    partition_csvs(source.string(), partitioned.string(), sort_keys, ',',
+                   num_partitions, 4096);
+
+    auto join_rows = [&](const boost::filesystem::path& path) {
+        boost::filesystem::path joined = root / "joined.csv.zst";
+        join_csvs(path, joined, sort_keys, ',');
+        std::vector<std::vector<std::string>> rows;
+        CSVReader<ZstdReader> reader(joined, columns, ',');
+        while (reader.next_row()) {
+            rows.push_back(reader.get_row());
+        }
+        boost::filesystem::remove(joined);
+        return rows;
+    };
+
+    // Both put every row in the same partition
+    size_t num_rows = 0;
+    for (size_t i = 0; i < num_partitions; i++) {
+        boost::filesystem::path partition = partitioned / std::to_string(i);
+        size_t num_runs = std::distance(
+            boost::filesystem::directory_iterator(partition),
+            boost::filesystem::directory_iterator());
+        EXPECT_GT(num_runs, 1);
+
+        auto rows = join_rows(partition);
+        EXPECT_EQ(rows, join_rows(sorted / std::to_string(i)));
+        num_rows += rows.size();
+    }
+    EXPECT_EQ(num_rows, entries.size());
+
+    boost::filesystem::remove_all(root);
+}
@@ -0,0 +1,96 @@
+#pragma once
+
+#include <cstdint>
+#include <list>
+#include <memory>
+#include <mutex>
+
+#include "absl/container/flat_hash_map.h"
+#include "database.hh"
+
+struct PatientCacheStats {
+    uint64_t hits = 0;
+    uint64_t misses = 0;
+    uint64_t evictions = 0;
+    size_t num_patients = 0;
+    size_t num_bytes = 0;
+};
+
+// A thread safe LRU cache of decoded patients, keyed by patient offset.
+// A limit of 0 means that dimension is unbounded.
+class PatientCache {
+   public:
+    PatientCache(size_t _max_patients, size_t _max_bytes)
+        : max_patients(_max_patients), max_bytes(_max_bytes) {}
+
+    std::shared_ptr<const Patient> get(uint32_t patient_offset) {
+        std::lock_guard<std::mutex> lock(mutex);
+        auto iter = index.find(patient_offset);
+        if (iter == std::end(index)) {
+            stats.misses++;
+            return nullptr;
+        }
+        stats.hits++;
+        entries.splice(std::begin(entries), entries, iter->second);
+        return iter->second->patient;
+    }
+
+    void put(std::shared_ptr<const Patient> patient) {
+        size_t num_bytes = patient_bytes(*patient);
+        if (max_bytes != 0 && num_bytes > max_bytes) {
+            // Would immediately evict everything, including itself
+            return;
+        }
+
+        std::lock_guard<std::mutex> lock(mutex);
+        if (index.contains(patient->patient_offset)) {
+            return;
+        }
+
+        entries.push_front(Entry{std::move(patient), num_bytes});
+        index[entries.front().patient->patient_offset] = std::begin(entries);
+        stats.num_patients++;
+        stats.num_bytes += num_bytes;
+
+        while ((max_patients != 0 && stats.num_patients > max_patients) ||
+               (max_bytes != 0 && stats.num_bytes > max_bytes)) {
+            const Entry& last = entries.back();
+            index.erase(last.patient->patient_offset);
+            stats.num_patients--;
+            stats.num_bytes -= last.num_bytes;
+            stats.evictions++;
+            entries.pop_back();
+        }
+    }
+
+    void clear() {
+        std::lock_guard<std::mutex> lock(mutex);
+        entries.clear();
+        index.clear();
+        stats.num_patients = 0;
+        stats.num_bytes = 0;
+    }
+
+    PatientCacheStats get_stats() {
+        std::lock_guard<std::mutex> lock(mutex);
+        return stats;
+    }
+
+    static size_t patient_bytes(const Patient& patient) {
+        return sizeof(Patient) + patient.events.capacity() * sizeof(Event);
+    }
+
+   private:
+    struct Entry {
+        std::shared_ptr<const Patient> patient;
+        size_t num_bytes;
+    };
+
+    const size_t max_patients;
+    const size_t max_bytes;
+
+    std::mutex mutex;
+    std::list<Entry> entries;
+    absl::flat_hash_map<uint32_t, std::list<Entry>::iterator> index;
+    PatientCacheStats stats;
+};
@@ -0,0 +1,60 @@
+#include "patient_cache.hh"
+
+#include "gmock/gmock.h"
+#include "gtest/gtest.h"
+
+namespace {
+
+std::shared_ptr<const Patient> make_patient(uint32_t patient_offset,
+                                            size_t num_events) {
+    auto patient = std::make_shared<Patient>();
+    patient->patient_offset = patient_offset;
+    patient->events.resize(num_events);
+    patient->events.shrink_to_fit();
+    return patient;
+}
+
+}  // namespace
+
+TEST(PatientCache, EvictsLeastRecentlyUsedByCount) {
+    PatientCache cache(2, 0);
+
+    cache.put(make_patient(0, 1));
+    cache.put(make_patient(1, 1));
+
+    EXPECT_NE(cache.get(0), nullptr);  // 1 is now the least recently used
+
+    cache.put(make_patient(2, 1));
+
+    EXPECT_EQ(cache.get(1), nullptr);
+    EXPECT_NE(cache.get(0), nullptr);
+    EXPECT_NE(cache.get(2), nullptr);
+
+    PatientCacheStats stats = cache.get_stats();
+    EXPECT_EQ(stats.hits, 3);
+    EXPECT_EQ(stats.misses, 1);
+    EXPECT_EQ(stats.evictions, 1);
+    EXPECT_EQ(stats.num_patients, 2);
+}
+
+TEST(PatientCache, EvictsByBytes) {
+    size_t patient_size = PatientCache::patient_bytes(*make_patient(0, 10));
+    PatientCache cache(0, patient_size * 2);
+
+    cache.put(make_patient(0, 10));
+    cache.put(make_patient(1, 10));
+    cache.put(make_patient(2, 10));
+
+    EXPECT_EQ(cache.get(0), nullptr);
+    EXPECT_EQ(cache.get_stats().num_bytes, patient_size * 2);
+    EXPECT_EQ(cache.get_stats().evictions, 1);
+
+    // Patients larger than the whole cache are never stored
+    cache.put(make_patient(3, 100));
+    EXPECT_EQ(cache.get(3), nullptr);
+    EXPECT_EQ(cache.get_stats().num_patients, 2);
+
+    cache.clear();
+    EXPECT_EQ(cache.get_stats().num_patients, 0);
+    EXPECT_EQ(cache.get_stats().num_bytes, 0);
+}
@@ -0,0 +1,344 @@
+#include "row_groups.hh"
+
+#include <algorithm>
+#include <cstring>
+
+#include "absl/strings/str_cat.h"
+#include "absl/strings/str_format.h"
+#include "absl/time/civil_time.h"
+#include "zstd.h"
+
+namespace {
+
+// Row groups are also flushed once they reach this many rows
+const uint32_t MAX_ROWS_PER_GROUP = 64 * 1024;
+
+const int COMPRESSION_LEVEL = 1;
+
+template <typename T>
+void write_element(std::ostream& f, const T& value) {
+    f.write(reinterpret_cast<const char*>(&value), sizeof(value));
+}
+
+template <typename T>
+bool read_element(std::istream& f, T& value) {
+    f.read(reinterpret_cast<char*>(&value), sizeof(value));
+    return f.gcount() == sizeof(value);
+}
+
+template <typename T>
+T decode_cell(std::string_view cell) {
+    if (cell.size() != sizeof(T)) {
+        throw std::runtime_error(
+            absl::StrCat("Invalid cell of size ", cell.size()));
+    }
+    T value;
+    std::memcpy(&value, cell.data(), sizeof(T));
+    return value;
+}
+
+std::string format_double(double value) {
+    return absl::StrFormat("%.17g", value);
+}
+
+std::string format_datetime(int64_t microseconds) {
+    int64_t seconds = microseconds / 1000000;
+    int64_t remainder = microseconds % 1000000;
+    if (remainder < 0) {
+        seconds -= 1;
+        remainder += 1000000;
+    }
+
+    std::string result = absl::FormatCivilTime(
+        absl::CivilSecond(1970, 1, 1, 0, 0, 0) + seconds);
+    if (remainder != 0) {
+        absl::StrAppendFormat(&result, ".%06d", remainder);
+    }
+    return result;
+}
+
+void check_stream(const std::ios& f, const boost::filesystem::path& filename) {
+    if (!f) {
+        throw std::runtime_error(
+            absl::StrCat("Truncated row group file ", filename.string()));
+    }
+}
+
+RowGroupSchema read_schema(std::istream& f,
+                           const boost::filesystem::path& filename) {
+    std::string magic(ROW_GROUP_MAGIC.size(), '\0');
+    f.read(magic.data(), magic.size());
+    if (magic != ROW_GROUP_MAGIC) {
+        throw std::runtime_error(
+            absl::StrCat(filename.string(), " is not a row group file"));
+    }
+
+    RowGroupSchema schema;
+    uint32_t num_columns;
+    read_element(f, num_columns);
+    for (uint32_t i = 0; i < num_columns; i++) {
+        RowGroupColumnType type;
+        uint32_t name_length;
+        read_element(f, type);
+        read_element(f, name_length);
+        std::string name(name_length, '\0');
+        f.read(name.data(), name.size());
+        schema.emplace_back(std::move(name), type);
+    }
+    check_stream(f, filename);
+
+    return schema;
+}
+
+}  // namespace
+
+bool is_row_group_file(const boost::filesystem::path& filename) {
+    std::ifstream f(filename.c_str(), std::ios::binary);
+    std::string magic(ROW_GROUP_MAGIC.size(), '\0');
+    f.read(magic.data(), magic.size());
+    return f.gcount() == static_cast<std::streamsize>(magic.size()) &&
+           magic == ROW_GROUP_MAGIC;
+}
+
+RowGroupSchema get_row_group_schema(const boost::filesystem::path& filename) {
+    std::ifstream f(filename.c_str(), std::ios::binary);
+    return read_schema(f, filename);
+}
+
+std::string row_group_cell_to_text(RowGroupColumnType type,
+                                   std::string_view cell) {
+    if (cell.empty()) {
+        return "";
+    }
+
+    switch (type) {
+        case RowGroupColumnType::INT64:
+            return absl::StrCat(decode_cell<int64_t>(cell));
+
+        case RowGroupColumnType::FLOAT64:
+            return format_double(decode_cell<double>(cell));
+
+        case RowGroupColumnType::DATETIME:
+            return format_datetime(decode_cell<int64_t>(cell));
+
+        case RowGroupColumnType::STRING:
+        case RowGroupColumnType::BYTES:
+            return std::string(cell);
+
+        case RowGroupColumnType::VALUE:
+            if (cell[0] == 'f') {
+                return format_double(decode_cell<double>(cell.substr(1)));
+            } else {
+                return std::string(cell.substr(1));
+            }
+
+        default:
+            throw std::runtime_error("Unexpected row group column type?");
+    }
+}
+
+RowGroupWriter::RowGroupWriter(const boost::filesystem::path& filename,
+                               const RowGroupSchema& schema,
+                               size_t _max_bytes_per_group)
+    : fname(filename),
+      max_bytes_per_group(_max_bytes_per_group),
+      num_rows(0),
+      current_size(0),
+      lengths(schema.size()),
+      data(schema.size()) {
+    f.open(filename.c_str(), std::ios::binary);
+
+    f.write(ROW_GROUP_MAGIC.data(), ROW_GROUP_MAGIC.size());
+    write_element(f, static_cast<uint32_t>(schema.size()));
+    for (const auto& column : schema) {
+        write_element(f, column.second);
+        write_element(f, static_cast<uint32_t>(column.first.size()));
+        f.write(column.first.data(), column.first.size());
+    }
+}
+
+void RowGroupWriter::add_row(const std::vector<std::string>& row) {
+    if (row.size() != data.size()) {
+        throw std::runtime_error("Wrong number of columns? " +
+                                 std::to_string(row.size()));
+    }
+
+    for (size_t i = 0; i < row.size(); i++) {
+        lengths[i].push_back(row[i].size());
+        data[i].append(row[i]);
+        current_size += row[i].size();
+    }
+    num_rows++;
+
+    if (num_rows >= MAX_ROWS_PER_GROUP ||
+        current_size >= max_bytes_per_group) {
+        flush();
+    }
+}
+
+void RowGroupWriter::flush() {
+    if (num_rows == 0) {
+        return;
+    }
+
+    uncompressed.clear();
+    for (size_t i = 0; i < data.size(); i++) {
+        uncompressed.append(reinterpret_cast<const char*>(lengths[i].data()),
+                            lengths[i].size() * sizeof(uint32_t));
+        uncompressed.append(data[i]);
+        lengths[i].clear();
+        data[i].clear();
+    }
+
+    compressed.resize(ZSTD_compressBound(uncompressed.size()));
+    size_t compressed_size =
+        ZSTD_compress(compressed.data(), compressed.size(),
+                      uncompressed.data(), uncompressed.size(),
+                      COMPRESSION_LEVEL);
+    if (ZSTD_isError(compressed_size) != 0) {
+        throw std::runtime_error("Got error while compressing? " +
+                                 std::string(ZSTD_getErrorName(
+                                     compressed_size)));
+    }
+
+    write_element(f, num_rows);
+    write_element(f, static_cast<uint64_t>(compressed_size));
+    f.write(compressed.data(), compressed_size);
+
+    num_rows = 0;
+    current_size = 0;
+}
+
+RowGroupWriter::~RowGroupWriter() { flush(); }
+
+RowGroupReader::RowGroupReader(const boost::filesystem::path& filename)
+    : fname(filename), as_text(false), num_rows(0), current_row_index(0) {
+    f.open(filename.c_str(), std::ios::binary);
+    schema = read_schema(f, filename);
+
+    for (size_t i = 0; i < schema.size(); i++) {
+        columns.push_back(schema[i].first);
+        column_indices.push_back(i);
+    }
+    current_row.resize(columns.size());
+}
+
+RowGroupReader::RowGroupReader(const boost::filesystem::path& filename,
+                               const std::vector<std::string>& _columns,
+                               bool _as_text)
+    : columns(_columns),
+      fname(filename),
+      as_text(_as_text),
+      num_rows(0),
+      current_row_index(0) {
+    f.open(filename.c_str(), std::ios::binary);
+    schema = read_schema(f, filename);
+
+    for (const auto& column : columns) {
+        auto iter = std::find_if(
+            std::begin(schema), std::end(schema),
+            [&](const auto& entry) { return entry.first == column; });
+        if (iter == std::end(schema)) {
+            throw std::runtime_error(absl::StrCat(
+                "Unable to find column '", column, "' in ", filename.string()));
+        }
+        column_indices.push_back(iter - std::begin(schema));
+    }
+    current_row.resize(columns.size());
+}
+
+bool RowGroupReader::read_row_group() {
+    uint64_t compressed_size;
+    if (!read_element(f, num_rows)) {
+        return false;
+    }
+    read_element(f, compressed_size);
+    compressed.resize(compressed_size);
+    f.read(compressed.data(), compressed.size());
+    check_stream(f, fname);
+
+    unsigned long long uncompressed_size =
+        ZSTD_getFrameContentSize(compressed.data(), compressed.size());
+    if (uncompressed_size == ZSTD_CONTENTSIZE_UNKNOWN ||
+        uncompressed_size == ZSTD_CONTENTSIZE_ERROR) {
+        throw std::runtime_error(
+            absl::StrCat("Invalid row group in ", fname.string()));
+    }
+    uncompressed.resize(uncompressed_size);
+    size_t ret = ZSTD_decompress(uncompressed.data(), uncompressed.size(),
+                                 compressed.data(), compressed.size());
+    if (ZSTD_isError(ret) != 0) {
+        throw std::runtime_error("Got error while decompressing? " +
+                                 std::string(ZSTD_getErrorName(ret)));
+    }
+
+    cell_offsets.resize(schema.size());
+    data_starts.resize(schema.size());
+
+    size_t position = 0;
+    for (size_t i = 0; i < schema.size(); i++) {
+        auto& offsets = cell_offsets[i];
+        offsets.resize(num_rows + 1);
+        offsets[0] = 0;
+        for (uint32_t row = 0; row < num_rows; row++) {
+            uint32_t length;
+            std::memcpy(&length,
+                        uncompressed.data() + position + row * sizeof(length),
+                        sizeof(length));
+            offsets[row + 1] = offsets[row] + length;
+        }
+        position += num_rows * sizeof(uint32_t);
+        data_starts[i] = position;
+        position += offsets[num_rows];
+    }
+
+    if (position != uncompressed.size()) {
+        throw std::runtime_error(
+            absl::StrCat("Invalid row group in ", fname.string()));
+    }
+
+    current_row_index = 0;
+    return true;
+}
+
+bool RowGroupReader::next_row() {
+    while (current_row_index == num_rows) {
+        if (!read_row_group()) {
+            return false;
+        }
+    }
+
+    // Callers are allowed to move the previous row out
+    current_row.resize(column_indices.size());
+    for (size_t i = 0; i < column_indices.size(); i++) {
+        size_t index = column_indices[i];
+        const auto& offsets = cell_offsets[index];
+        std::string_view cell(uncompressed.data() + data_starts[index] +
+                                  offsets[current_row_index],
+                              offsets[current_row_index + 1] -
+                                  offsets[current_row_index]);
+        if (as_text) {
+            current_row[i] = row_group_cell_to_text(schema[index].second, cell);
+        } else {
+            current_row[i].assign(cell);
+        }
+    }
+
+    current_row_index++;
+    return true;
+}
+
+std::vector<std::string>& RowGroupReader::get_row() { return current_row; }
+
+std::vector<std::string> get_file_columns(
+    const boost::filesystem::path& filename, char delimiter) {
+    if (is_row_group_file(filename)) {
+        std::vector<std::string> result;
+        for (const auto& column : get_row_group_schema(filename)) {
+            result.push_back(column.first);
+        }
+        return result;
+    } else {
+        return get_csv_columns(filename, delimiter);
+    }
+}
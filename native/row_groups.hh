@@ -0,0 +1,135 @@
+#pragma once
+
+#include <boost/filesystem.hpp>
+#include <fstream>
+#include <string>
+#include <string_view>
+#include <vector>
+
+#include "csv.hh"
+
+// Row group files store a table as a series of zstd compressed row groups,
+// with the cells of each column of a group stored contiguously.
+//
+// A file starts with ROW_GROUP_MAGIC, the number of columns as a uint32_t
+// and the type (uint8_t), name length (uint32_t) and name of every column.
+// Every row group is then the number of rows (uint32_t), the compressed size
+// (uint64_t) and a zstd frame containing, for each column, the length of every
+// cell (uint32_t) followed by the data of every cell.
+//
+// Cells are stored in a binary encoding that depends on the type of the
+// column. An empty cell is a missing value.
+enum class RowGroupColumnType : uint8_t {
+    // A little endian int64_t
+    INT64 = 0,
+    // A little endian double
+    FLOAT64 = 1,
+    // A little endian int64_t of microseconds since 1970-01-01T00:00:00
+    DATETIME = 2,
+    // UTF-8 text
+    STRING = 3,
+    // Arbitrary bytes
+    BYTES = 4,
+    // Either 'f' followed by a FLOAT64 or 's' followed by a STRING
+    VALUE = 5,
+};
+
+using RowGroupSchema = std::vector<std::pair<std::string, RowGroupColumnType>>;
+
+constexpr std::string_view ROW_GROUP_MAGIC = "FEMRRG01";
+constexpr std::string_view ROW_GROUP_EXTENSION = ".rowgroups";
+
+// Row groups are flushed once they reach this size, unless a writer is given
+// a smaller size
+constexpr size_t MAX_ROW_GROUP_BYTES = 64 * 1024 * 1024;
+
+bool is_row_group_file(const boost::filesystem::path& filename);
+
+RowGroupSchema get_row_group_schema(const boost::filesystem::path& filename);
+
+// Convert a cell to the text that the equivalent CSV file would contain
+std::string row_group_cell_to_text(RowGroupColumnType type,
+                                   std::string_view cell);
+
+class RowGroupWriter {
+   public:
+    RowGroupWriter(const boost::filesystem::path& filename,
+                   const RowGroupSchema& schema,
+                   size_t max_bytes_per_group = MAX_ROW_GROUP_BYTES);
+
+    // Add a row of cells in the binary encoding of each column
+    void add_row(const std::vector<std::string>& row);
+
+    ~RowGroupWriter();
+
+    boost::filesystem::path fname;
+
+   private:
+    void flush();
+
+    std::ofstream f;
+    size_t max_bytes_per_group;
+    uint32_t num_rows;
+    size_t current_size;
+    std::vector<std::vector<uint32_t>> lengths;
+    std::vector<std::string> data;
+    std::string uncompressed;
+    std::string compressed;
+};
+
+class RowGroupReader {
+   public:
+    // Read every column, with cells in their binary encoding
+    explicit RowGroupReader(const boost::filesystem::path& filename);
+
+    // Read the given columns, converting cells to text if as_text is set
+    RowGroupReader(const boost::filesystem::path& filename,
+                   const std::vector<std::string>& columns, bool as_text);
+
+    bool next_row();
+
+    std::vector<std::string>& get_row();
+
+    std::vector<std::string> columns;
+    RowGroupSchema schema;
+    boost::filesystem::path fname;
+
+   private:
+    bool read_row_group();
+
+    std::ifstream f;
+    bool as_text;
+    std::vector<size_t> column_indices;
+
+    uint32_t num_rows;
+    uint32_t current_row_index;
+    std::string compressed;
+    std::string uncompressed;
+    std::vector<std::vector<uint32_t>> cell_offsets;
+    std::vector<size_t> data_starts;
+    std::vector<std::string> current_row;
+};
+
+// Get the column names of a CSV or row group file
+std::vector<std::string> get_file_columns(
+    const boost::filesystem::path& filename, char delimiter);
+
+// Call f with every row of a zstd compressed CSV or a row group file, only
+// including the given columns. Row group cells are converted to the text the
+// equivalent CSV would contain.
+template <typename F>
+void read_text_rows(const boost::filesystem::path& filename,
+                    const std::vector<std::string>& columns, char delimiter,
+                    F f) {
+    if (is_row_group_file(filename)) {
+        RowGroupReader reader(filename, columns, true);
+        while (reader.next_row()) {
+            f(reader.get_row());
+        }
+    } else {
+        CSVReader<ZstdReader> reader(filename, columns, delimiter);
+        while (reader.next_row()) {
+            f(reader.get_row());
+        }
+    }
+}
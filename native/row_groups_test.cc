@@ -0,0 +1,78 @@
+#include "row_groups.hh"
+
+#include "absl/strings/str_cat.h"
+#include "gmock/gmock.h"
+#include "gtest/gtest.h"
+
+namespace {
+
+template <typename T>
+std::string encode(T value) {
+    return std::string(reinterpret_cast<const char*>(&value), sizeof(value));
+}
+
+}  // namespace
+
+TEST(RowGroupsTest, TestRoundTrip) {
+    boost::filesystem::path root = boost::filesystem::temp_directory_path() /
+                                   boost::filesystem::unique_path();
+    boost::filesystem::create_directories(root);
+
+    RowGroupSchema schema = {{"id", RowGroupColumnType::INT64},
+                             {"text", RowGroupColumnType::STRING}};
+
+    boost::filesystem::path path =
+        root / absl::StrCat("test", ROW_GROUP_EXTENSION);
+
+    // Enough rows for several row groups
+    size_t num_rows = 200000;
+    {
+        RowGroupWriter writer(path, schema);
+        for (size_t i = 0; i < num_rows; i++) {
+            writer.add_row({encode<int64_t>(i), i % 3 == 0 ? "" : "foo"});
+        }
+    }
+
+    EXPECT_EQ(true, is_row_group_file(path));
+    EXPECT_EQ(schema, get_row_group_schema(path));
+    EXPECT_EQ(std::vector<std::string>({"id", "text"}),
+              get_file_columns(path, ','));
+
+    {
+        RowGroupReader reader(path);
+        for (size_t i = 0; i < num_rows; i++) {
+            EXPECT_EQ(true, reader.next_row());
+            EXPECT_EQ(encode<int64_t>(i), reader.get_row()[0]);
+            EXPECT_EQ(i % 3 == 0 ? "" : "foo", reader.get_row()[1]);
+        }
+        EXPECT_EQ(false, reader.next_row());
+    }
+
+    {
+        RowGroupReader reader(path, {"text", "id"}, true);
+        EXPECT_EQ(true, reader.next_row());
+        EXPECT_EQ(std::vector<std::string>({"", "0"}), reader.get_row());
+        EXPECT_EQ(true, reader.next_row());
+        EXPECT_EQ(std::vector<std::string>({"foo", "1"}), reader.get_row());
+    }
+
+    boost::filesystem::remove_all(root);
+}
+
+TEST(RowGroupsTest, TestCellToText) {
+    EXPECT_EQ("-5", row_group_cell_to_text(RowGroupColumnType::INT64,
+                                           encode<int64_t>(-5)));
+    EXPECT_EQ("1.5", row_group_cell_to_text(RowGroupColumnType::FLOAT64,
+                                            encode<double>(1.5)));
+    EXPECT_EQ("2010-01-03T04:05:06",
+              row_group_cell_to_text(RowGroupColumnType::DATETIME,
+                                     encode<int64_t>(1262491506000000)));
+    EXPECT_EQ("1969-12-31T23:59:59.500000",
+              row_group_cell_to_text(RowGroupColumnType::DATETIME,
+                                     encode<int64_t>(-500000)));
+    EXPECT_EQ("2.25", row_group_cell_to_text(RowGroupColumnType::VALUE,
+                                             "f" + encode<double>(2.25)));
+    EXPECT_EQ("text",
+              row_group_cell_to_text(RowGroupColumnType::VALUE, "stext"));
+    EXPECT_EQ("", row_group_cell_to_text(RowGroupColumnType::VALUE, ""));
+}
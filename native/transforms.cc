@@ -0,0 +1,994 @@
+#include "transforms.hh"
+
+#include <algorithm>
+#include <chrono>
+#include <cstring>
+#include <numeric>
+#include <tuple>
+
+#include "absl/container/flat_hash_set.h"
+#include "absl/strings/str_cat.h"
+#include "absl/time/civil_time.h"
+#include "row_groups.hh"
+
+namespace {
+
+constexpr int64_t MICROSECONDS_PER_MINUTE = 60ll * 1000 * 1000;
+constexpr int64_t MICROSECONDS_PER_DAY = 24 * 60 * MICROSECONDS_PER_MINUTE;
+
+const std::string VISIT_TABLE = "visit_occurrence";
+
+struct PatientTransformInfo {
+    std::string name;
+    PatientTransformType type;
+
+    // Whether the transform reads the events in order
+    bool needs_sorted_events;
+
+    // Whether the transform keeps sorted events sorted
+    bool preserves_order;
+};
+
+// These match the declarations of the Python transforms
+const std::vector<PatientTransformInfo> TRANSFORM_INFOS = {
+    {"map_concepts", PatientTransformType::MAP_CONCEPTS, false, false},
+    {"remove_nones", PatientTransformType::REMOVE_NONES, false, true},
+    {"delta_encode", PatientTransformType::DELTA_ENCODE, true, true},
+    {"move_pre_birth", PatientTransformType::MOVE_PRE_BIRTH, true, false},
+    {"move_visit_start_to_first_event_start",
+     PatientTransformType::MOVE_VISIT_START_TO_FIRST_EVENT_START, false,
+     false},
+    {"move_to_day_end", PatientTransformType::MOVE_TO_DAY_END, false, false},
+    {"move_billing_codes", PatientTransformType::MOVE_BILLING_CODES, false,
+     false},
+    {"move_mimic_billing_codes",
+     PatientTransformType::MOVE_MIMIC_BILLING_CODES, true, false},
+    {"move_early_end_date_to_start_date",
+     PatientTransformType::MOVE_EARLY_END_DATE_TO_START_DATE, false, true},
+    {"remove_very_old", PatientTransformType::REMOVE_VERY_OLD, true, true},
+    {"replace_categorical_measurement_results",
+     PatientTransformType::REPLACE_CATEGORICAL_MEASUREMENT_RESULTS, false,
+     true},
+    {"replace_default_birthdate",
+     PatientTransformType::REPLACE_DEFAULT_BIRTHDATE, false, false},
+};
+
+const PatientTransformInfo& get_info(PatientTransformType type) {
+    for (const auto& info : TRANSFORM_INFOS) {
+        if (info.type == type) {
+            return info;
+        }
+    }
+    throw std::runtime_error("Unexpected patient transform type?");
+}
+
+int64_t get_microseconds(absl::CivilDay day) {
+    return (day - absl::CivilDay(1970, 1, 1)) * MICROSECONDS_PER_DAY;
+}
+
+// The day of a time, which is what datetime.date() compares
+int64_t get_day(int64_t time) {
+    int64_t day = time / MICROSECONDS_PER_DAY;
+    if (time % MICROSECONDS_PER_DAY < 0) {
+        day -= 1;
+    }
+    return day;
+}
+
+template <typename T>
+T decode_cell(std::string_view cell) {
+    if (cell.size() != sizeof(T)) {
+        throw std::runtime_error(
+            absl::StrCat("Invalid cell of size ", cell.size()));
+    }
+    T value;
+    std::memcpy(&value, cell.data(), sizeof(T));
+    return value;
+}
+
+template <typename T>
+std::string encode_cell(T value) {
+    return std::string(reinterpret_cast<const char*>(&value), sizeof(value));
+}
+
+boost::optional<int64_t> decode_optional_cell(std::string_view cell) {
+    if (cell.empty()) {
+        return boost::none;
+    }
+    return decode_cell<int64_t>(cell);
+}
+
+std::string encode_optional_cell(const boost::optional<int64_t>& value) {
+    return value ? encode_cell(*value) : "";
+}
+
+// Compare two value cells like the decoded Python values, so that numbers are
+// compared as doubles
+bool values_equal(std::string_view a, std::string_view b) {
+    if (a.empty() || b.empty()) {
+        return a.empty() && b.empty();
+    }
+    if (a[0] == 'f' && b[0] == 'f') {
+        return decode_cell<double>(a.substr(1)) ==
+               decode_cell<double>(b.substr(1));
+    }
+    return a == b;
+}
+
+std::string visit_id_to_string(const boost::optional<int64_t>& visit_id) {
+    return visit_id ? absl::StrCat(*visit_id) : "None";
+}
+
+// Get a string field of a pickled metadata dictionary.
+//
+// This only keeps track of dictionaries and strings, which is enough to read
+// the metadata written by femr without calling Python. Other objects are
+// skipped as long as they only use the opcodes of plain pickled data.
+boost::optional<std::string> get_pickled_string(std::string_view pickle,
+                                                std::string_view key) {
+    if (pickle.empty()) {
+        return boost::none;
+    }
+
+    enum class Kind { MARK, STRING, DICT, OTHER };
+    struct Item {
+        Kind kind;
+        std::string text;
+        size_t dict_index = 0;
+    };
+
+    using Dict =
+        std::vector<std::pair<std::string, boost::optional<std::string>>>;
+    std::vector<Dict> dicts;
+    std::vector<Item> stack;
+    std::vector<Item> memo;
+    size_t position = 0;
+
+    auto read = [&](size_t length) {
+        if (length > pickle.size() - position) {
+            throw std::runtime_error("Truncated pickled metadata");
+        }
+        std::string_view result = pickle.substr(position, length);
+        position += length;
+        return result;
+    };
+    auto read_size = [&](size_t num_bytes) {
+        uint64_t result = 0;
+        std::memcpy(&result, read(num_bytes).data(), num_bytes);
+        return result;
+    };
+    auto read_line = [&]() {
+        size_t end = pickle.find('\n', position);
+        if (end == std::string_view::npos) {
+            throw std::runtime_error("Truncated pickled metadata");
+        }
+        position = end + 1;
+    };
+    auto top = [&]() -> Item& {
+        if (stack.empty()) {
+            throw std::runtime_error("Invalid pickled metadata");
+        }
+        return stack.back();
+    };
+    auto pop = [&]() {
+        Item result = std::move(top());
+        stack.pop_back();
+        return result;
+    };
+    auto pop_mark = [&]() {
+        auto is_mark = [](const Item& item) { return item.kind == Kind::MARK; };
+        auto mark = std::find_if(stack.rbegin(), stack.rend(), is_mark);
+        if (mark == stack.rend()) {
+            throw std::runtime_error("Invalid pickled metadata");
+        }
+        std::vector<Item> items(std::make_move_iterator(mark.base()),
+                                std::make_move_iterator(stack.end()));
+        stack.erase(mark.base() - 1, stack.end());
+        return items;
+    };
+    auto push = [&](Kind kind, std::string_view text = "") {
+        stack.push_back(Item{kind, std::string(text)});
+    };
+    auto set_item = [&](Item& dict, const Item& item_key,
+                        const Item& item_value) {
+        if (dict.kind == Kind::DICT && item_key.kind == Kind::STRING) {
+            boost::optional<std::string> text;
+            if (item_value.kind == Kind::STRING) {
+                text = item_value.text;
+            }
+            dicts[dict.dict_index].emplace_back(item_key.text, text);
+        }
+    };
+    auto put = [&](size_t index) {
+        if (memo.size() <= index) {
+            memo.resize(index + 1, Item{Kind::OTHER});
+        }
+        memo[index] = top();
+    };
+    auto get = [&](size_t index) {
+        if (index >= memo.size()) {
+            throw std::runtime_error("Invalid pickled metadata");
+        }
+        stack.push_back(memo[index]);
+    };
+
+    while (true) {
+        unsigned char opcode = read(1)[0];
+        switch (opcode) {
+            case 0x80:  // PROTO
+                read(1);
+                break;
+            case 0x95:  // FRAME
+                read(8);
+                break;
+
+            case '}':  // EMPTY_DICT
+                stack.push_back(Item{Kind::DICT, "", dicts.size()});
+                dicts.emplace_back();
+                break;
+            case ']':  // EMPTY_LIST
+            case ')':  // EMPTY_TUPLE
+            case 'N':  // NONE
+            case 0x88:  // NEWTRUE
+            case 0x89:  // NEWFALSE
+                push(Kind::OTHER);
+                break;
+            case '(':  // MARK
+                push(Kind::MARK);
+                break;
+
+            case 0x94:  // MEMOIZE
+                put(memo.size());
+                break;
+            case 'q':  // BINPUT
+                put(read_size(1));
+                break;
+            case 'r':  // LONG_BINPUT
+                put(read_size(4));
+                break;
+            case 'h':  // BINGET
+                get(read_size(1));
+                break;
+            case 'j':  // LONG_BINGET
+                get(read_size(4));
+                break;
+
+            case 0x8c:  // SHORT_BINUNICODE
+                push(Kind::STRING, read(read_size(1)));
+                break;
+            case 'X':  // BINUNICODE
+                push(Kind::STRING, read(read_size(4)));
+                break;
+            case 0x8d:  // BINUNICODE8
+                push(Kind::STRING, read(read_size(8)));
+                break;
+
+            case 'C':  // SHORT_BINBYTES
+                read(read_size(1));
+                push(Kind::OTHER);
+                break;
+            case 'B':  // BINBYTES
+                read(read_size(4));
+                push(Kind::OTHER);
+                break;
+            case 0x8e:  // BINBYTES8
+                read(read_size(8));
+                push(Kind::OTHER);
+                break;
+            case 'K':  // BININT1
+                read(1);
+                push(Kind::OTHER);
+                break;
+            case 'M':  // BININT2
+                read(2);
+                push(Kind::OTHER);
+                break;
+            case 'J':  // BININT
+                read(4);
+                push(Kind::OTHER);
+                break;
+            case 'G':  // BINFLOAT
+                read(8);
+                push(Kind::OTHER);
+                break;
+            case 0x8a:  // LONG1
+                read(read_size(1));
+                push(Kind::OTHER);
+                break;
+            case 0x8b:  // LONG4
+                read(read_size(4));
+                push(Kind::OTHER);
+                break;
+
+            case 'c':  // GLOBAL
+                read_line();
+                read_line();
+                push(Kind::OTHER);
+                break;
+            case 0x93:  // STACK_GLOBAL
+            case 'R':   // REDUCE
+            case 0x81:  // NEWOBJ
+            case 0x86:  // TUPLE2
+                pop();
+                pop();
+                push(Kind::OTHER);
+                break;
+            case 0x85:  // TUPLE1
+                pop();
+                push(Kind::OTHER);
+                break;
+            case 0x87:  // TUPLE3
+                pop();
+                pop();
+                pop();
+                push(Kind::OTHER);
+                break;
+            case 't':  // TUPLE
+                pop_mark();
+                push(Kind::OTHER);
+                break;
+            case 'b':  // BUILD
+            case 'a':  // APPEND
+                pop();
+                break;
+            case 'e':  // APPENDS
+                pop_mark();
+                break;
+
+            case 's': {  // SETITEM
+                Item item_value = pop();
+                Item item_key = pop();
+                set_item(top(), item_key, item_value);
+                break;
+            }
+            case 'u': {  // SETITEMS
+                std::vector<Item> items = pop_mark();
+                for (size_t i = 0; i + 1 < items.size(); i += 2) {
+                    set_item(top(), items[i], items[i + 1]);
+                }
+                break;
+            }
+
+            case '.': {  // STOP
+                Item result = pop();
+                if (result.kind != Kind::DICT) {
+                    return boost::none;
+                }
+                // Later items replace earlier ones with the same key
+                const auto& items = dicts[result.dict_index];
+                for (auto iter = items.rbegin(); iter != items.rend(); iter++) {
+                    if (iter->first == key) {
+                        return iter->second;
+                    }
+                }
+                return boost::none;
+            }
+
+            default:
+                throw std::runtime_error(absl::StrCat(
+                    "Unsupported opcode ", static_cast<int>(opcode),
+                    " in pickled metadata"));
+        }
+    }
+}
+
+// Call f with every column of the patient
+template <typename F>
+void for_each_column(PatientEvents& patient, F f) {
+    f(patient.start);
+    f(patient.concept_id);
+    f(patient.value);
+    f(patient.visit_id);
+    f(patient.end);
+    f(patient.omop_table);
+    f(patient.metadata);
+    for (auto& column : patient.other_columns) {
+        f(column);
+    }
+}
+
+// Only keep the events for which keep is set
+void filter_events(PatientEvents& patient, const std::vector<bool>& keep) {
+    for_each_column(patient, [&](auto& column) {
+        size_t num_kept = 0;
+        for (size_t i = 0; i < column.size(); i++) {
+            if (keep[i]) {
+                if (num_kept != i) {
+                    column[num_kept] = std::move(column[i]);
+                }
+                num_kept++;
+            }
+        }
+        column.resize(num_kept);
+    });
+}
+
+// Stably sort the events by start and concept id, like RawPatient.resort
+void resort(PatientEvents& patient) {
+    auto less = [&](size_t a, size_t b) {
+        return std::tie(patient.start[a], patient.concept_id[a]) <
+               std::tie(patient.start[b], patient.concept_id[b]);
+    };
+
+    std::vector<size_t> order(patient.size());
+    std::iota(std::begin(order), std::end(order), 0);
+    if (std::is_sorted(std::begin(order), std::end(order), less)) {
+        return;
+    }
+    std::stable_sort(std::begin(order), std::end(order), less);
+
+    for_each_column(patient, [&](auto& column) {
+        std::remove_reference_t<decltype(column)> sorted;
+        sorted.reserve(column.size());
+        for (size_t i : order) {
+            sorted.push_back(std::move(column[i]));
+        }
+        column = std::move(sorted);
+    });
+}
+
+bool is_skipped(const PatientTransform& transform,
+                const PatientEvents& patient, size_t i) {
+    return transform.skip_omop_table &&
+           patient.omop_table[i] == *transform.skip_omop_table;
+}
+
+void map_concepts(const PatientTransform& transform, PatientEvents& patient) {
+    for (int64_t& concept_id : patient.concept_id) {
+        auto iter = transform.concept_map.find(concept_id);
+        if (iter != std::end(transform.concept_map)) {
+            concept_id = iter->second;
+        }
+    }
+}
+
+void remove_nones(const PatientTransform& transform, PatientEvents& patient) {
+    absl::flat_hash_set<std::pair<int64_t, int64_t>> has_value;
+    for (size_t i = 0; i < patient.size(); i++) {
+        if (!patient.value[i].empty()) {
+            has_value.emplace(patient.concept_id[i], get_day(patient.start[i]));
+        }
+    }
+
+    std::vector<bool> keep(patient.size(), true);
+    for (size_t i = 0; i < patient.size(); i++) {
+        if (patient.value[i].empty() &&
+            has_value.contains(
+                {patient.concept_id[i], get_day(patient.start[i])}) &&
+            !is_skipped(transform, patient, i)) {
+            keep[i] = false;
+        }
+    }
+
+    filter_events(patient, keep);
+}
+
+void delta_encode(const PatientTransform& transform, PatientEvents& patient) {
+    absl::flat_hash_map<std::pair<int64_t, int64_t>, std::string_view>
+        last_value;
+
+    std::vector<bool> keep(patient.size(), true);
+    for (size_t i = 0; i < patient.size(); i++) {
+        std::pair<int64_t, int64_t> key(patient.concept_id[i],
+                                        get_day(patient.start[i]));
+        auto iter = last_value.find(key);
+        if (iter != std::end(last_value) &&
+            values_equal(iter->second, patient.value[i]) &&
+            !is_skipped(transform, patient, i)) {
+            keep[i] = false;
+            continue;
+        }
+        last_value[key] = patient.value[i];
+    }
+
+    filter_events(patient, keep);
+}
+
+bool move_pre_birth(const PatientTransform& transform,
+                    PatientEvents& patient) {
+    boost::optional<int64_t> birth_date;
+    for (size_t i = 0; i < patient.size(); i++) {
+        if (patient.concept_id[i] == transform.birth_concept_id) {
+            birth_date = patient.start[i];
+        }
+    }
+
+    if (!birth_date) {
+        return false;
+    }
+
+    std::vector<bool> keep(patient.size(), true);
+    for (size_t i = 0; i < patient.size(); i++) {
+        if (patient.start[i] < *birth_date) {
+            if (*birth_date - patient.start[i] > 30 * MICROSECONDS_PER_DAY) {
+                keep[i] = false;
+                continue;
+            }
+            patient.start[i] = *birth_date;
+        }
+
+        if (patient.end[i] && *patient.end[i] < *birth_date) {
+            patient.end[i] = *birth_date;
+        }
+    }
+
+    filter_events(patient, keep);
+    return true;
+}
+
+void move_visit_start_to_first_event_start(PatientEvents& patient) {
+    absl::flat_hash_map<int64_t, int64_t> visit_starts;
+    boost::optional<int64_t> missing_visit_start;
+    for (size_t i = 0; i < patient.size(); i++) {
+        if (patient.omop_table[i] != VISIT_TABLE) {
+            continue;
+        }
+
+        bool matches;
+        if (patient.visit_id[i]) {
+            auto [iter, inserted] =
+                visit_starts.emplace(*patient.visit_id[i], patient.start[i]);
+            matches = inserted || iter->second == patient.start[i];
+        } else {
+            matches = !missing_visit_start ||
+                      *missing_visit_start == patient.start[i];
+            missing_visit_start = patient.start[i];
+        }
+
+        if (!matches) {
+            throw std::runtime_error(absl::StrCat(
+                "Multiple visit events with visit ID ",
+                visit_id_to_string(patient.visit_id[i]), " for patient ID ",
+                patient.patient_id));
+        }
+    }
+
+    absl::flat_hash_map<int64_t, int64_t> first_event_starts;
+    for (size_t i = 0; i < patient.size(); i++) {
+        if (!patient.visit_id[i]) {
+            continue;
+        }
+        auto visit_start = visit_starts.find(*patient.visit_id[i]);
+        if (visit_start != std::end(visit_starts) &&
+            patient.start[i] > visit_start->second) {
+            auto [iter, inserted] = first_event_starts.emplace(
+                *patient.visit_id[i], patient.start[i]);
+            iter->second = std::min(iter->second, patient.start[i]);
+        }
+    }
+
+    for (size_t i = 0; i < patient.size(); i++) {
+        if (patient.omop_table[i] != VISIT_TABLE) {
+            continue;
+        }
+
+        if (patient.visit_id[i]) {
+            auto iter = first_event_starts.find(*patient.visit_id[i]);
+            if (iter != std::end(first_event_starts)) {
+                patient.start[i] = iter->second;
+            }
+        }
+
+        if (patient.end[i]) {
+            patient.end[i] = std::max(patient.start[i], *patient.end[i]);
+        }
+    }
+}
+
+void move_to_day_end(const PatientTransform& transform,
+                     PatientEvents& patient) {
+    auto move_date_to_end = [](int64_t time) {
+        if (time % MICROSECONDS_PER_DAY == 0) {
+            return time + MICROSECONDS_PER_DAY - MICROSECONDS_PER_MINUTE;
+        } else {
+            return time;
+        }
+    };
+
+    for (size_t i = 0; i < patient.size(); i++) {
+        if (patient.concept_id[i] == transform.birth_concept_id) {
+            continue;
+        }
+
+        patient.start[i] = move_date_to_end(patient.start[i]);
+        if (patient.end[i]) {
+            patient.end[i] =
+                std::max(move_date_to_end(*patient.end[i]), patient.start[i]);
+        }
+    }
+}
+
+void move_billing_codes(PatientEvents& patient) {
+    // The billing code tables based on the original Clarity queries used to
+    // form STRIDE
+    static const absl::flat_hash_set<std::string> billing_tables = {
+        "shc_pat_enc_dx",        "lpch_pat_enc_dx",
+        "shc_hsp_acct_dx_list",  "lpch_hsp_acct_dx_list",
+        "shc_arpb_transactions", "lpch_arpb_transactions",
+    };
+    static const absl::flat_hash_set<std::string> visit_tables = {
+        "lpch_pat_enc",
+        "shc_pat_enc",
+    };
+
+    std::vector<bool> is_billing(patient.size());
+    std::vector<bool> is_visit(patient.size());
+    for (size_t i = 0; i < patient.size(); i++) {
+        boost::optional<std::string> clarity_table =
+            get_pickled_string(patient.metadata[i], "clarity_table");
+        if (clarity_table) {
+            is_billing[i] = billing_tables.contains(*clarity_table);
+            is_visit[i] = visit_tables.contains(*clarity_table);
+        }
+    }
+
+    absl::flat_hash_map<int64_t, int64_t> end_visits;
+    absl::flat_hash_map<std::pair<int64_t, int64_t>, int64_t> lowest_visit;
+    for (size_t i = 0; i < patient.size(); i++) {
+        // For events that share the same code/start time, find the lowest
+        // visit ID
+        if (is_billing[i] && patient.visit_id[i]) {
+            auto [iter, inserted] = lowest_visit.emplace(
+                std::make_pair(patient.start[i], patient.concept_id[i]),
+                *patient.visit_id[i]);
+            iter->second = std::min(iter->second, *patient.visit_id[i]);
+        }
+
+        if (is_visit[i] && patient.end[i]) {
+            if (!patient.visit_id[i]) {
+                throw std::runtime_error(absl::StrCat(
+                    "Expected visit id for visit? ", patient.patient_id));
+            }
+            auto [iter, inserted] =
+                end_visits.emplace(*patient.visit_id[i], *patient.end[i]);
+            if (iter->second != *patient.end[i]) {
+                throw std::runtime_error(
+                    absl::StrCat("Multiple end visits? ", patient.patient_id,
+                                 " ", *patient.visit_id[i]));
+            }
+        }
+    }
+
+    std::vector<bool> keep(patient.size(), true);
+    for (size_t i = 0; i < patient.size(); i++) {
+        if (!is_billing[i]) {
+            continue;
+        }
+
+        // Only keep the copy of the event with the lowest visit id
+        boost::optional<int64_t> lowest;
+        auto iter = lowest_visit.find(
+            std::make_pair(patient.start[i], patient.concept_id[i]));
+        if (iter != std::end(lowest_visit)) {
+            lowest = iter->second;
+        }
+        if (patient.visit_id[i] != lowest) {
+            keep[i] = false;
+            continue;
+        }
+
+        // Codes without a visit are kept as they are
+        if (!patient.visit_id[i]) {
+            continue;
+        }
+
+        auto end_visit = end_visits.find(*patient.visit_id[i]);
+        if (end_visit == std::end(end_visits)) {
+            throw std::runtime_error(
+                absl::StrCat("Expected visit end for code ", patient.patient_id,
+                             " ", *patient.visit_id[i]));
+        }
+
+        patient.start[i] = std::max(patient.start[i], end_visit->second);
+        if (patient.end[i]) {
+            patient.end[i] = std::max(*patient.end[i], end_visit->second);
+        }
+    }
+
+    filter_events(patient, keep);
+}
+
+void move_mimic_billing_codes(PatientEvents& patient) {
+    static const absl::flat_hash_set<std::string> billing_tables = {
+        "condition_occurrence",
+        "procedure_occurrence",
+        "observation",
+    };
+
+    absl::flat_hash_map<int64_t, std::pair<int64_t, int64_t>> visits;
+    for (size_t i = 0; i < patient.size(); i++) {
+        if (patient.omop_table[i] == VISIT_TABLE && patient.visit_id[i]) {
+            if (!patient.end[i]) {
+                throw std::runtime_error(absl::StrCat(
+                    "Missing visit start/end time for visit_occurrence_id ",
+                    *patient.visit_id[i]));
+            }
+            visits[*patient.visit_id[i]] = {patient.start[i], *patient.end[i]};
+        }
+    }
+
+    for (size_t i = 0; i < patient.size(); i++) {
+        if (!billing_tables.contains(patient.omop_table[i]) ||
+            !patient.visit_id[i]) {
+            continue;
+        }
+
+        auto iter = visits.find(*patient.visit_id[i]);
+        if (iter != std::end(visits) &&
+            patient.start[i] == iter->second.first) {
+            patient.start[i] = iter->second.second;
+            if (patient.end[i]) {
+                patient.end[i] = std::max(*patient.end[i], iter->second.second);
+            }
+        }
+    }
+}
+
+void move_early_end_date_to_start_date(PatientEvents& patient) {
+    for (size_t i = 0; i < patient.size(); i++) {
+        if (patient.end[i] && patient.omop_table[i] == VISIT_TABLE &&
+            *patient.end[i] < patient.start[i]) {
+            patient.end[i] = patient.start[i];
+        }
+    }
+}
+
+void remove_very_old(PatientEvents& patient) {
+    if (patient.size() == 0) {
+        throw std::runtime_error(
+            absl::StrCat("Expected a birth event for ", patient.patient_id));
+    }
+
+    int64_t birth_date = patient.start[0];
+    std::vector<bool> keep(patient.size(), true);
+    for (size_t i = 0; i < patient.size(); i++) {
+        // Greater than 125 years old is not plausible
+        if (patient.start[i] - birth_date > 125 * 365 * MICROSECONDS_PER_DAY) {
+            keep[i] = false;
+        }
+    }
+
+    filter_events(patient, keep);
+}
+
+void replace_categorical_measurement_results(PatientEvents& patient) {
+    // The default Clarity value when the lab result is categorical
+    const std::string categorical_value =
+        absl::StrCat("f", encode_cell(9999999.0));
+
+    for (size_t i = 0; i < patient.size(); i++) {
+        if (patient.omop_table[i] == "measurement" &&
+            values_equal(patient.value[i], categorical_value)) {
+            patient.value[i].clear();
+        }
+    }
+}
+
+void replace_default_birthdate(const PatientTransform& transform,
+                               PatientEvents& patient) {
+    const int64_t default_birth_date =
+        get_microseconds(absl::CivilDay(1, 1, 1));
+    const int64_t replacement = get_microseconds(absl::CivilDay(1900, 1, 1));
+
+    for (size_t i = 0; i < patient.size(); i++) {
+        if (patient.concept_id[i] == transform.birth_concept_id &&
+            patient.start[i] == default_birth_date) {
+            patient.start[i] = replacement;
+        }
+    }
+}
+
+// Apply a transform without resorting the events afterwards
+bool apply_transform(const PatientTransform& transform,
+                     PatientEvents& patient) {
+    switch (transform.type) {
+        case PatientTransformType::MAP_CONCEPTS:
+            map_concepts(transform, patient);
+            return true;
+
+        case PatientTransformType::REMOVE_NONES:
+            remove_nones(transform, patient);
+            return true;
+
+        case PatientTransformType::DELTA_ENCODE:
+            delta_encode(transform, patient);
+            return true;
+
+        case PatientTransformType::MOVE_PRE_BIRTH:
+            return move_pre_birth(transform, patient);
+
+        case PatientTransformType::MOVE_VISIT_START_TO_FIRST_EVENT_START:
+            move_visit_start_to_first_event_start(patient);
+            return true;
+
+        case PatientTransformType::MOVE_TO_DAY_END:
+            move_to_day_end(transform, patient);
+            return true;
+
+        case PatientTransformType::MOVE_BILLING_CODES:
+            move_billing_codes(patient);
+            return true;
+
+        case PatientTransformType::MOVE_MIMIC_BILLING_CODES:
+            move_mimic_billing_codes(patient);
+            return true;
+
+        case PatientTransformType::MOVE_EARLY_END_DATE_TO_START_DATE:
+            move_early_end_date_to_start_date(patient);
+            return true;
+
+        case PatientTransformType::REMOVE_VERY_OLD:
+            remove_very_old(patient);
+            return true;
+
+        case PatientTransformType::REPLACE_CATEGORICAL_MEASUREMENT_RESULTS:
+            replace_categorical_measurement_results(patient);
+            return true;
+
+        case PatientTransformType::REPLACE_DEFAULT_BIRTHDATE:
+            replace_default_birthdate(transform, patient);
+            return true;
+
+        default:
+            throw std::runtime_error("Unexpected patient transform type?");
+    }
+}
+
+}  // namespace
+
+PatientTransformType get_patient_transform_type(const std::string& name) {
+    for (const auto& info : TRANSFORM_INFOS) {
+        if (info.name == name) {
+            return info.type;
+        }
+    }
+    throw std::runtime_error(absl::StrCat("Unknown patient transform ", name));
+}
+
+bool needs_sorted_events(PatientTransformType type) {
+    return get_info(type).needs_sorted_events;
+}
+
+bool preserves_order(PatientTransformType type) {
+    return get_info(type).preserves_order;
+}
+
+bool apply_patient_transform(const PatientTransform& transform,
+                             PatientEvents& patient) {
+    if (!apply_transform(transform, patient)) {
+        return false;
+    }
+    if (!preserves_order(transform.type)) {
+        resort(patient);
+    }
+    return true;
+}
+
+PatientTransformResult transform_patients(
+    const boost::filesystem::path& source,
+    const boost::filesystem::path& target,
+    const std::vector<PatientTransform>& transforms) {
+    RowGroupReader reader(source);
+    const RowGroupSchema& schema = reader.schema;
+
+    auto get_index = [&](const std::string& name) {
+        for (size_t i = 0; i < schema.size(); i++) {
+            if (schema[i].first == name) {
+                return i;
+            }
+        }
+        throw std::runtime_error(absl::StrCat("Unable to find column '", name,
+                                              "' in ", source.string()));
+    };
+
+    size_t patient_id_index = get_index("patient_id");
+    size_t start_index = get_index("start");
+    size_t concept_id_index = get_index("concept_id");
+    size_t value_index = get_index("value");
+    size_t visit_id_index = get_index("visit_id");
+    size_t end_index = get_index("end");
+    size_t omop_table_index = get_index("omop_table");
+    size_t metadata_index = get_index("metadata");
+
+    std::vector<size_t> other_indices;
+    for (size_t i = 0; i < schema.size(); i++) {
+        if (i != patient_id_index && i != start_index &&
+            i != concept_id_index && i != value_index &&
+            i != visit_id_index && i != end_index && i != omop_table_index &&
+            i != metadata_index) {
+            other_indices.push_back(i);
+        }
+    }
+
+    RowGroupWriter writer(target, schema);
+    std::vector<std::string> row(schema.size());
+
+    PatientTransformResult result;
+    result.stats.resize(transforms.size());
+
+    PatientEvents patient;
+    patient.other_columns.resize(other_indices.size());
+
+    auto write_patient = [&]() {
+        for (size_t i = 0; i < patient.size(); i++) {
+            row[patient_id_index] = encode_cell(patient.patient_id);
+            row[start_index] = encode_cell(patient.start[i]);
+            row[concept_id_index] = encode_cell(patient.concept_id[i]);
+            row[value_index] = std::move(patient.value[i]);
+            row[visit_id_index] = encode_optional_cell(patient.visit_id[i]);
+            row[end_index] = encode_optional_cell(patient.end[i]);
+            row[omop_table_index] = std::move(patient.omop_table[i]);
+            row[metadata_index] = std::move(patient.metadata[i]);
+            for (size_t j = 0; j < other_indices.size(); j++) {
+                row[other_indices[j]] = std::move(patient.other_columns[j][i]);
+            }
+            writer.add_row(row);
+        }
+    };
+
+    auto process_patient = [&]() {
+        result.num_patients++;
+        size_t num_events = patient.size();
+
+        // The events in patient files are sorted. They are only resorted
+        // before a transform that reads them in order, and once at the end.
+        bool is_sorted = true;
+        for (size_t i = 0; i < transforms.size(); i++) {
+            const PatientTransformInfo& info = get_info(transforms[i].type);
+            auto start_time = std::chrono::steady_clock::now();
+            if (info.needs_sorted_events && !is_sorted) {
+                resort(patient);
+                is_sorted = true;
+            }
+            bool kept = apply_transform(transforms[i], patient);
+            is_sorted = is_sorted && info.preserves_order;
+            result.stats[i].seconds +=
+                std::chrono::duration<double>(std::chrono::steady_clock::now() -
+                                              start_time)
+                    .count();
+
+            if (!kept) {
+                result.stats[i].lost_patients++;
+                result.stats[i].lost_events += num_events;
+                return;
+            }
+            result.stats[i].lost_events += num_events - patient.size();
+            num_events = patient.size();
+        }
+
+        if (!is_sorted) {
+            resort(patient);
+        }
+        write_patient();
+    };
+
+    while (reader.next_row()) {
+        std::vector<std::string>& cells = reader.get_row();
+        int64_t patient_id = decode_cell<int64_t>(cells[patient_id_index]);
+        if (patient.size() != 0 && patient_id != patient.patient_id) {
+            process_patient();
+            for_each_column(patient, [](auto& column) { column.clear(); });
+        }
+
+        patient.patient_id = patient_id;
+        patient.start.push_back(decode_cell<int64_t>(cells[start_index]));
+        patient.concept_id.push_back(
+            decode_cell<int64_t>(cells[concept_id_index]));
+        patient.value.push_back(std::move(cells[value_index]));
+        patient.visit_id.push_back(
+            decode_optional_cell(cells[visit_id_index]));
+        patient.end.push_back(decode_optional_cell(cells[end_index]));
+        patient.omop_table.push_back(std::move(cells[omop_table_index]));
+        patient.metadata.push_back(std::move(cells[metadata_index]));
+        for (size_t j = 0; j < other_indices.size(); j++) {
+            patient.other_columns[j].push_back(
+                std::move(cells[other_indices[j]]));
+        }
+    }
+
+    if (patient.size() != 0) {
+        process_patient();
+    }
+
+    return result;
+}
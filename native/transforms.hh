@@ -0,0 +1,113 @@
+#pragma once
+
+#include <boost/filesystem.hpp>
+#include <boost/optional.hpp>
+#include <string>
+#include <vector>
+
+#include "absl/container/flat_hash_map.h"
+
+// Native implementations of the standard patient transforms in
+// femr.transforms, which are applied to row group patient files without
+// creating Python objects. Every transform has the same semantics as the
+// Python function it is named after.
+enum class PatientTransformType {
+    // femr.transforms.MapConcepts
+    MAP_CONCEPTS,
+    // femr.transforms.remove_nones
+    REMOVE_NONES,
+    // femr.transforms.delta_encode
+    DELTA_ENCODE,
+    // femr.transforms.stanford.move_pre_birth
+    MOVE_PRE_BIRTH,
+    // femr.transforms.stanford.move_visit_start_to_first_event_start
+    MOVE_VISIT_START_TO_FIRST_EVENT_START,
+    // femr.transforms.stanford.move_to_day_end
+    MOVE_TO_DAY_END,
+    // femr.transforms.stanford.move_billing_codes
+    MOVE_BILLING_CODES,
+    // femr.transforms.mimic.move_billing_codes
+    MOVE_MIMIC_BILLING_CODES,
+    // femr.transforms.mimic.move_early_end_date_to_start_date
+    MOVE_EARLY_END_DATE_TO_START_DATE,
+    // femr.transforms.mimic.remove_very_old
+    REMOVE_VERY_OLD,
+    // femr.transforms.sickkids.replace_categorical_measurement_results
+    REPLACE_CATEGORICAL_MEASUREMENT_RESULTS,
+    // femr.transforms.sickkids.replace_default_birthdate
+    REPLACE_DEFAULT_BIRTHDATE,
+};
+
+// Get a transform type from its name, the lowercase name of the enum value
+PatientTransformType get_patient_transform_type(const std::string& name);
+
+struct PatientTransform {
+    PatientTransformType type;
+
+    // MAP_CONCEPTS
+    absl::flat_hash_map<int64_t, int64_t> concept_map;
+
+    // MOVE_PRE_BIRTH, MOVE_TO_DAY_END and REPLACE_DEFAULT_BIRTHDATE
+    int64_t birth_concept_id = 0;
+
+    // REMOVE_NONES and DELTA_ENCODE never drop events from this table
+    boost::optional<std::string> skip_omop_table;
+};
+
+// The events of a single patient, stored by column.
+//
+// Times are in microseconds since 1970-01-01T00:00:00. The other cells are in
+// the binary encoding of their row group column, with an empty cell for a
+// missing value.
+struct PatientEvents {
+    int64_t patient_id = 0;
+
+    std::vector<int64_t> start;
+    std::vector<int64_t> concept_id;
+    std::vector<std::string> value;
+    std::vector<boost::optional<int64_t>> visit_id;
+    std::vector<boost::optional<int64_t>> end;
+    std::vector<std::string> omop_table;
+    std::vector<std::string> metadata;
+
+    // The columns that the transforms do not use, such as unit
+    std::vector<std::vector<std::string>> other_columns;
+
+    size_t size() const { return start.size(); }
+};
+
+// Whether a transform reads the events of a patient in order, so that they
+// have to be sorted before it
+bool needs_sorted_events(PatientTransformType type);
+
+// Whether a transform keeps sorted events sorted, so that they do not have to
+// be resorted after it
+bool preserves_order(PatientTransformType type);
+
+// Apply a transform to a patient, resorting the events afterwards if the
+// transform does not preserve their order. Returns false if the patient was
+// removed.
+bool apply_patient_transform(const PatientTransform& transform,
+                             PatientEvents& patient);
+
+struct PatientTransformStats {
+    size_t lost_patients = 0;
+    size_t lost_events = 0;
+    double seconds = 0;
+};
+
+struct PatientTransformResult {
+    size_t num_patients = 0;
+
+    // The statistics of every transform, in order
+    std::vector<PatientTransformStats> stats;
+};
+
+// Apply the transforms in order to every patient in a row group patient file,
+// writing the remaining patients to target with the same schema. Like
+// PatientCollection.transform, the events are only resorted before the
+// transforms that need them sorted and once at the end.
+PatientTransformResult transform_patients(
+    const boost::filesystem::path& source,
+    const boost::filesystem::path& target,
+    const std::vector<PatientTransform>& transforms);
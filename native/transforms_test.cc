@@ -0,0 +1,260 @@
+#include "transforms.hh"
+
+#include <boost/filesystem.hpp>
+#include <cstring>
+
+#include "absl/time/civil_time.h"
+#include "gmock/gmock.h"
+#include "gtest/gtest.h"
+#include "row_groups.hh"
+
+namespace {
+
+const int64_t BIRTH = 4083587;
+
+int64_t get_time(int year, int month, int day, int hour = 0, int minute = 0) {
+    return (absl::CivilSecond(year, month, day, hour, minute, 0) -
+            absl::CivilSecond(1970, 1, 1, 0, 0, 0)) *
+           1000000;
+}
+
+std::string numeric_value(double value) {
+    std::string result = "f";
+    result.append(reinterpret_cast<const char*>(&value), sizeof(value));
+    return result;
+}
+
+std::string text_value(const std::string& value) { return "s" + value; }
+
+void add_event(PatientEvents& patient, int64_t start, int64_t concept_id,
+               const std::string& value = "",
+               const std::string& omop_table = "",
+               boost::optional<int64_t> visit_id = boost::none,
+               boost::optional<int64_t> end = boost::none,
+               const std::string& metadata = "") {
+    patient.start.push_back(start);
+    patient.concept_id.push_back(concept_id);
+    patient.value.push_back(value);
+    patient.visit_id.push_back(visit_id);
+    patient.end.push_back(end);
+    patient.omop_table.push_back(omop_table);
+    patient.metadata.push_back(metadata);
+}
+
+std::string encode(int64_t value) {
+    return std::string(reinterpret_cast<const char*>(&value), sizeof(value));
+}
+
+const RowGroupSchema EVENT_SCHEMA = {
+    {"patient_id", RowGroupColumnType::INT64},
+    {"start", RowGroupColumnType::DATETIME},
+    {"concept_id", RowGroupColumnType::INT64},
+    {"value", RowGroupColumnType::VALUE},
+    {"visit_id", RowGroupColumnType::INT64},
+    {"end", RowGroupColumnType::DATETIME},
+    {"omop_table", RowGroupColumnType::STRING},
+    {"unit", RowGroupColumnType::STRING},
+    {"metadata", RowGroupColumnType::BYTES},
+};
+
+PatientTransform get_transform(const std::string& name) {
+    PatientTransform transform;
+    transform.type = get_patient_transform_type(name);
+    transform.birth_concept_id = BIRTH;
+    return transform;
+}
+
+}  // namespace
+
+TEST(TransformsTest, TestRemoveNonesAndDeltaEncode) {
+    PatientEvents patient;
+    add_event(patient, get_time(2010, 1, 1), 3);
+    add_event(patient, get_time(2010, 1, 1, 5), 3, numeric_value(1));
+    add_event(patient, get_time(2010, 1, 1, 6), 3, numeric_value(1));
+    add_event(patient, get_time(2010, 1, 1, 7), 3, text_value("1"));
+    add_event(patient, get_time(2010, 1, 1, 8), 3, numeric_value(1));
+    add_event(patient, get_time(2010, 1, 2), 3);
+    add_event(patient, get_time(2010, 1, 2), 4, "", "visit_occurrence");
+    add_event(patient, get_time(2010, 1, 2, 1), 4, numeric_value(2));
+
+    PatientTransform remove_nones = get_transform("remove_nones");
+    remove_nones.skip_omop_table = "visit_occurrence";
+    EXPECT_TRUE(apply_patient_transform(remove_nones, patient));
+    EXPECT_EQ(7, patient.size());
+    EXPECT_EQ(get_time(2010, 1, 1, 5), patient.start[0]);
+
+    PatientTransform delta_encode = get_transform("delta_encode");
+    EXPECT_TRUE(apply_patient_transform(delta_encode, patient));
+    EXPECT_THAT(patient.start,
+                testing::ElementsAre(
+                    get_time(2010, 1, 1, 5), get_time(2010, 1, 1, 7),
+                    get_time(2010, 1, 1, 8), get_time(2010, 1, 2),
+                    get_time(2010, 1, 2), get_time(2010, 1, 2, 1)));
+}
+
+TEST(TransformsTest, TestMoveTimes) {
+    PatientEvents patient;
+    add_event(patient, get_time(1999, 1, 1), 5);
+    add_event(patient, get_time(2000, 1, 1), 7, "", "visit_occurrence", 1,
+              get_time(2000, 1, 1));
+    add_event(patient, get_time(1999, 12, 20), 6, "", "", 1);
+    add_event(patient, get_time(2000, 1, 1, 10), BIRTH);
+    add_event(patient, get_time(2000, 1, 1, 12), 8, "", "", 1);
+
+    PatientTransform map_concepts = get_transform("map_concepts");
+    map_concepts.concept_map[8] = 9;
+    EXPECT_TRUE(apply_patient_transform(map_concepts, patient));
+    EXPECT_EQ(9, patient.concept_id[4]);
+
+    EXPECT_TRUE(
+        apply_patient_transform(get_transform("move_pre_birth"), patient));
+    EXPECT_THAT(patient.concept_id, testing::ElementsAre(6, 7, BIRTH, 9));
+    EXPECT_EQ(get_time(2000, 1, 1, 10), patient.start[0]);
+    EXPECT_EQ(get_time(2000, 1, 1, 10), *patient.end[1]);
+
+    EXPECT_TRUE(apply_patient_transform(
+        get_transform("move_visit_start_to_first_event_start"), patient));
+    EXPECT_THAT(patient.concept_id, testing::ElementsAre(6, BIRTH, 7, 9));
+    EXPECT_EQ(get_time(2000, 1, 1, 12), patient.start[2]);
+    EXPECT_EQ(get_time(2000, 1, 1, 12), *patient.end[2]);
+
+    PatientEvents no_birth;
+    add_event(no_birth, get_time(2000, 1, 1), 5);
+    EXPECT_FALSE(
+        apply_patient_transform(get_transform("move_pre_birth"), no_birth));
+
+    PatientEvents midnight;
+    add_event(midnight, get_time(2000, 1, 1), BIRTH);
+    add_event(midnight, get_time(2000, 1, 1), 5, "", "", boost::none,
+              get_time(2000, 1, 1));
+    add_event(midnight, get_time(2000, 1, 1, 0, 1), 6);
+    EXPECT_TRUE(
+        apply_patient_transform(get_transform("move_to_day_end"), midnight));
+    EXPECT_THAT(midnight.start,
+                testing::ElementsAre(get_time(2000, 1, 1),
+                                     get_time(2000, 1, 1, 0, 1),
+                                     get_time(2000, 1, 1, 23, 59)));
+    EXPECT_EQ(get_time(2000, 1, 1, 23, 59), *midnight.end[2]);
+}
+
+TEST(TransformsTest, TestMoveBillingCodes) {
+    // The metadata as pickled by Python and by the native extractor
+    std::string visit_metadata(
+        "\x80\x04\x95\"\x00\x00\x00\x00\x00\x00\x00}\x94\x8c\rclarity_table"
+        "\x94\x8c\x0bshc_pat_enc\x94s.",
+        45);
+    std::string billing_metadata(
+        "}(X\r\x00\x00\x00"
+        "clarity_tableX\x0e\x00\x00\x00shc_pat_enc_dxu.",
+        41);
+
+    PatientEvents patient;
+    add_event(patient, get_time(2000, 1, 1), 3, "", "visit_occurrence", 2,
+              get_time(2000, 1, 3), visit_metadata);
+    add_event(patient, get_time(2000, 1, 1), 4, "", "condition_occurrence", 2,
+              boost::none, billing_metadata);
+    add_event(patient, get_time(2000, 1, 1), 4, "", "condition_occurrence", 5,
+              boost::none, billing_metadata);
+    add_event(patient, get_time(2000, 1, 2), 6, "", "condition_occurrence",
+              boost::none, boost::none, billing_metadata);
+
+    EXPECT_TRUE(
+        apply_patient_transform(get_transform("move_billing_codes"), patient));
+    EXPECT_THAT(patient.concept_id, testing::ElementsAre(3, 6, 4));
+    EXPECT_EQ(get_time(2000, 1, 3), patient.start[2]);
+    EXPECT_EQ(2, *patient.visit_id[2]);
+
+    PatientEvents bad_metadata;
+    add_event(bad_metadata, get_time(2000, 1, 1), 3, "", "", boost::none,
+              boost::none, "\x80\x04\x95");
+    EXPECT_THROW(apply_patient_transform(get_transform("move_billing_codes"),
+                                         bad_metadata),
+                 std::runtime_error);
+}
+
+TEST(TransformsTest, TestTransformPatients) {
+    boost::filesystem::path root = boost::filesystem::temp_directory_path() /
+                                   boost::filesystem::unique_path();
+    boost::filesystem::create_directories(root);
+
+    boost::filesystem::path source = root / "source.rowgroups";
+    {
+        RowGroupWriter writer(source, EVENT_SCHEMA);
+        writer.add_row({encode(1), encode(get_time(2000, 1, 1)), encode(BIRTH),
+                        "", "", "", "person", "", ""});
+        writer.add_row({encode(1), encode(get_time(2000, 1, 2)), encode(5),
+                        numeric_value(2), "", "", "", "mg", ""});
+        writer.add_row({encode(1), encode(get_time(2000, 1, 2)), encode(5),
+                        "", "", "", "", "", ""});
+        writer.add_row({encode(2), encode(get_time(2000, 1, 2)), encode(5),
+                        "", "", "", "", "", ""});
+    }
+
+    std::vector<PatientTransform> transforms = {
+        get_transform("move_pre_birth"), get_transform("move_to_day_end"),
+        get_transform("remove_nones")};
+
+    boost::filesystem::path target = root / "target.rowgroups";
+    PatientTransformResult result =
+        transform_patients(source, target, transforms);
+
+    EXPECT_EQ(2, result.num_patients);
+    EXPECT_EQ(1, result.stats[0].lost_patients);
+    EXPECT_EQ(1, result.stats[0].lost_events);
+    EXPECT_EQ(0, result.stats[1].lost_events);
+    EXPECT_EQ(1, result.stats[2].lost_events);
+
+    RowGroupReader reader(target, {"patient_id", "start", "value", "unit"},
+                          true);
+    EXPECT_TRUE(reader.next_row());
+    EXPECT_EQ(std::vector<std::string>({"1", "2000-01-01T00:00:00", "", ""}),
+              reader.get_row());
+    EXPECT_TRUE(reader.next_row());
+    EXPECT_EQ(std::vector<std::string>({"1", "2000-01-02T23:59:00", "2", "mg"}),
+              reader.get_row());
+    EXPECT_FALSE(reader.next_row());
+
+    boost::filesystem::remove_all(root);
+}
+
+TEST(TransformsTest, TestTransformPatientsSortsOnce) {
+    EXPECT_TRUE(preserves_order(PatientTransformType::REMOVE_NONES));
+    EXPECT_FALSE(preserves_order(PatientTransformType::MAP_CONCEPTS));
+    EXPECT_TRUE(needs_sorted_events(PatientTransformType::DELTA_ENCODE));
+    EXPECT_FALSE(needs_sorted_events(PatientTransformType::REMOVE_NONES));
+
+    boost::filesystem::path root = boost::filesystem::temp_directory_path() /
+                                   boost::filesystem::unique_path();
+    boost::filesystem::create_directories(root);
+
+    boost::filesystem::path source = root / "source.rowgroups";
+    {
+        RowGroupWriter writer(source, EVENT_SCHEMA);
+        for (int64_t concept_id : {5, 6, 7}) {
+            writer.add_row({encode(1), encode(get_time(2000, 1, 1)),
+                            encode(concept_id), numeric_value(1), "", "", "",
+                            "", ""});
+        }
+    }
+
+    PatientTransform map_concepts = get_transform("map_concepts");
+    map_concepts.concept_map[5] = 8;
+
+    // The events are out of order after map_concepts, so they are resorted
+    // before delta_encode and at the end after remove_nones
+    for (const auto& transforms : std::vector<std::vector<PatientTransform>>{
+             {map_concepts, get_transform("remove_nones")},
+             {map_concepts, get_transform("delta_encode")}}) {
+        boost::filesystem::path target = root / "target.rowgroups";
+        transform_patients(source, target, transforms);
+
+        RowGroupReader reader(target, {"concept_id"}, true);
+        std::vector<std::string> concept_ids;
+        while (reader.next_row()) {
+            concept_ids.push_back(reader.get_row()[0]);
+        }
+        EXPECT_THAT(concept_ids, testing::ElementsAre("6", "7", "8"));
+    }
+
+    boost::filesystem::remove_all(root);
+}
@@ -30,6 +30,8 @@ class Event:
     # - visit_id: int, the visit_id this event is tied to
     # - omop_table: str, the omop table this event was pulled from
     # - clarity_table: str, the clarity table where the event comes from
+    #
+    # Events read from a PatientDatabase also have a `code_index`, the integer index of `code` in the ontology
 
     def __init__(
         self,
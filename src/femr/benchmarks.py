@@ -0,0 +1,333 @@
+"""Throughput benchmarks for the main femr hot paths, run against a synthetic extract of a chosen size."""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import csv
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import tempfile
+import time
+from typing import Any, Dict, Iterator, Optional
+
+import msgpack
+
+import femr
+import femr.datasets
+from femr.etl_pipelines.omop import _get_generic_omop_transformations
+from femr.extractors.csv import run_csv_extractors
+from femr.extractors.omop import OMOP_BIRTH, get_omop_csv_extractors
+from femr.featurizers import AgeFeaturizer, CountFeaturizer, FeaturizerList
+from femr.labelers import TimeHorizon
+from femr.labelers.omop import CodeLabeler
+
+OBSERVATION_FIELDS = [
+    "person_id",
+    "observation_concept_id",
+    "observation_datetime",
+    "value_as_string",
+    "value_as_number",
+    "value_as_concept_id",
+    "unit_source_value",
+    "visit_occurrence_id",
+]
+
+CONCEPT_FIELDS = [
+    "concept_id",
+    "concept_name",
+    "domain_id",
+    "vocabulary_id",
+    "concept_class_id",
+    "standard_concept",
+    "concept_code",
+    "valid_start_date",
+    "valid_end_date",
+    "invalid_reason",
+]
+
+
+def generate_omop_input(
+    target_dir: str,
+    num_patients: int,
+    events_per_patient: int,
+    num_codes: int = 1000,
+    num_files: int = 4,
+    seed: int = 97,
+) -> None:
+    """Write a synthetic OMOP source, with its concept tables, to `target_dir`.
+
+    This follows `tutorials/synthetic_data_generation/generate_omop.py`, but with a configurable scale. Every
+    patient has a birth and a gender event from the person table and `events_per_patient - 2` observations
+    with codes Synthetic/0 to Synthetic/`num_codes - 1`.
+    """
+    rng = random.Random(seed)
+    observation_dir = os.path.join(target_dir, "observation")
+    os.makedirs(observation_dir, exist_ok=True)
+
+    # Concept ids of the synthetic codes are their index plus one
+    gender_concept_ids = [num_codes + 1, num_codes + 2]
+    with open(os.path.join(target_dir, "concept.csv"), "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(CONCEPT_FIELDS)
+        concepts = [(i + 1, "Synthetic", str(i)) for i in range(num_codes)]
+        concepts += [(gender_concept_ids[0], "Gender", "M"), (gender_concept_ids[1], "Gender", "F")]
+        concepts.append((OMOP_BIRTH, "SNOMED", "3950001"))
+        for concept_id, vocabulary_id, concept_code in concepts:
+            writer.writerow(
+                [concept_id, f"{vocabulary_id}/{concept_code}", "Custom", vocabulary_id, "Custom", "", concept_code]
+                + [""] * 3
+            )
+
+    with open(os.path.join(target_dir, "concept_relationship.csv"), "w") as f:
+        csv.writer(f).writerow(
+            ["concept_id_1", "concept_id_2", "relationship_id", "valid_start_date", "valid_end_date", "invalid_reason"]
+        )
+
+    birth_dates = []
+    with open(os.path.join(target_dir, "person.csv"), "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(["person_id", "birth_datetime", "gender_concept_id", "ethnicity_concept_id", "race_concept_id"])
+        for patient_id in range(num_patients):
+            birth = datetime.datetime(1950, 1, 1) + datetime.timedelta(days=rng.randint(0, 50 * 365))
+            birth_dates.append(birth)
+            writer.writerow([patient_id, birth.isoformat(), rng.choice(gender_concept_ids), 0, 0])
+
+    patients_per_file = (num_patients + num_files - 1) // num_files
+    for file_index in range(num_files):
+        with open(os.path.join(observation_dir, f"{file_index}.csv"), "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(OBSERVATION_FIELDS)
+            first_patient = file_index * patients_per_file
+            for patient_id in range(first_patient, min(num_patients, first_patient + patients_per_file)):
+                current = birth_dates[patient_id]
+                visit_id = patient_id * events_per_patient
+                for _ in range(events_per_patient - 2):
+                    if rng.random() < 0.1:
+                        current += datetime.timedelta(days=rng.randint(1, 100), minutes=rng.randint(0, 24 * 60))
+                        visit_id += 1
+
+                    # Skew the code distribution so that a few codes are very common, as in real data
+                    concept_id = int(num_codes * rng.random() ** 3) + 1
+                    if rng.random() < 0.3:
+                        value, unit = str(rng.randint(0, 200)), "mg"
+                    else:
+                        value, unit = "", ""
+                    writer.writerow([patient_id, concept_id, current.isoformat(), "", value, "", unit, visit_id])
+
+
+class BenchmarkRecorder:
+    """Collects the timings of a benchmark run."""
+
+    def __init__(self):
+        self.results: Dict[str, Dict[str, Any]] = {}
+
+    @contextlib.contextmanager
+    def time(self, name: str, unit: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """Time a block. The block can set `result["count"]` to also record a rate in `unit`s per second."""
+        result: Dict[str, Any] = {}
+        logging.info("Running %s", name)
+        start = time.perf_counter()
+        yield result
+        result["seconds"] = time.perf_counter() - start
+        if unit is not None and "count" in result:
+            result["unit"] = unit
+            result[f"{unit}_per_second"] = result["count"] / result["seconds"] if result["seconds"] > 0 else None
+        self.results[name] = result
+        logging.info("Finished %s in %.3f seconds", name, result["seconds"])
+
+
+def run_etl(recorder: BenchmarkRecorder, source_dir: str, work_dir: str, num_threads: int) -> str:
+    """Run the stages of the generic OMOP ETL, returning the path of the resulting PatientDatabase."""
+    with recorder.time("etl_run_csv_extractors"):
+        events = run_csv_extractors(
+            source_dir, os.path.join(work_dir, "events"), get_omop_csv_extractors(), num_threads=num_threads
+        )
+
+    with recorder.time("etl_to_patient_collection"):
+        patients = events.to_patient_collection(os.path.join(work_dir, "patients_raw"), num_threads=num_threads)
+
+    with recorder.time("etl_transform"):
+        patients = patients.transform(
+            os.path.join(work_dir, "patients_cleaned"), _get_generic_omop_transformations(), num_threads=num_threads
+        )
+
+    database_path = os.path.join(work_dir, "database")
+    with recorder.time("etl_to_patient_database"):
+        patients.to_patient_database(database_path, source_dir, num_threads=num_threads).close()
+
+    return database_path
+
+
+def run_database_access(recorder: BenchmarkRecorder, database_path: str, num_random_access: int, seed: int) -> None:
+    """Time random access to single patients and a full iteration over the database."""
+    with femr.datasets.PatientDatabase(database_path) as database:
+        patient_ids = list(database)
+        sample = random.Random(seed).choices(patient_ids, k=num_random_access)
+
+        with recorder.time("patient_random_access", unit="patients") as result:
+            for patient_id in sample:
+                _ = database[patient_id].events
+            result["count"] = len(sample)
+
+    with femr.datasets.PatientDatabase(database_path, access="sequential") as database:
+        with recorder.time("patient_full_iteration", unit="events") as result:
+            result["count"] = sum(len(database[patient_id].events) for patient_id in database)
+
+
+def run_labeling_and_featurization(recorder: BenchmarkRecorder, database_path: str, num_threads: int) -> None:
+    """Time Labeler.apply and FeaturizerList.featurize with a typical code labeler and count featurizer."""
+    labeler = CodeLabeler(
+        outcome_codes=["Synthetic/0"],
+        time_horizon=TimeHorizon(datetime.timedelta(days=0), datetime.timedelta(days=365)),
+        prediction_codes=[f"Synthetic/{i}" for i in range(1, 10)],
+    )
+    with recorder.time("labeler_apply", unit="patients") as result:
+        labeled_patients = labeler.apply(path_to_patient_database=database_path, num_threads=num_threads)
+        result["count"] = len(labeled_patients)
+        result["num_labels"] = labeled_patients.get_num_labels()
+
+    featurizers = FeaturizerList([AgeFeaturizer(), CountFeaturizer(is_ontology_expansion=True)])
+    with recorder.time("featurizer_preprocess"):
+        featurizers.preprocess_featurizers(database_path, labeled_patients, num_threads)
+
+    with recorder.time("featurizer_featurize", unit="labels") as result:
+        features, _, _, _ = featurizers.featurize(database_path, labeled_patients, num_threads)
+        result["count"] = features.shape[0]
+
+
+def run_batches(recorder: BenchmarkRecorder, database_path: str, work_dir: str, num_batches: int) -> None:
+    """Time CLMBR batch creation and loading."""
+    import femr.extension.dataloader
+
+    dictionary_path = os.path.join(work_dir, "dictionary.msgpack")
+    with recorder.time("create_dictionary"):
+        femr.extension.dataloader.create_dictionary(database_path, dictionary_path)
+
+    with open(dictionary_path, "rb") as f:
+        dictionary = msgpack.load(f, use_list=False)
+    vocab_size = min(len(dictionary["regular"]), 1024 * 64)
+
+    config_path = os.path.join(work_dir, "loader_config.msgpack")
+    with open(config_path, "wb") as f:
+        msgpack.dump(
+            {
+                "transformer": {
+                    "vocab_size": vocab_size,
+                    "dictionary": dictionary,
+                    "min_size": 5,
+                    "max_size": 14,
+                    "is_hierarchical": False,
+                },
+                "task": {"type": "clmbr", "vocab_size": min(vocab_size, 8 * 1024)},
+                "seed": 97,
+                "splits": [["train", 0, 80], ["dev", 80, 85], ["test", 85, 100]],
+            },
+            f,
+        )
+
+    batch_info_path = os.path.join(work_dir, "batch_info.msgpack")
+    with recorder.time("create_batches"):
+        femr.extension.dataloader.create_batches(batch_info_path, database_path, config_path)
+
+    loader = femr.extension.dataloader.BatchLoader(database_path, batch_info_path)
+    num_batches = min(num_batches, loader.get_number_of_batches("train"))
+    with recorder.time("batch_loader_get_batch", unit="batches") as result:
+        for i in range(num_batches):
+            loader.get_batch("train", i)
+        result["count"] = num_batches
+
+
+def run_benchmarks(
+    work_dir: str,
+    num_patients: int,
+    events_per_patient: int,
+    num_threads: int = 1,
+    num_random_access: int = 10_000,
+    num_batches: int = 100,
+    seed: int = 97,
+    skip_batches: bool = False,
+) -> Dict[str, Any]:
+    """Generate a synthetic extract in `work_dir` and time every benchmark, returning the results."""
+    recorder = BenchmarkRecorder()
+
+    source_dir = os.path.join(work_dir, "omop")
+    with recorder.time("generate_input"):
+        generate_omop_input(source_dir, num_patients, events_per_patient, num_files=max(num_threads, 4), seed=seed)
+
+    database_path = run_etl(recorder, source_dir, work_dir, num_threads)
+    run_database_access(recorder, database_path, num_random_access, seed)
+    run_labeling_and_featurization(recorder, database_path, num_threads)
+    if not skip_batches:
+        run_batches(recorder, database_path, work_dir, num_batches)
+
+    return {
+        "femr_version": getattr(femr, "__version__", None),
+        "timestamp": datetime.datetime.now().isoformat(),
+        "platform": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": {
+            "num_patients": num_patients,
+            "events_per_patient": events_per_patient,
+            "num_threads": num_threads,
+            "num_random_access": num_random_access,
+            "num_batches": num_batches,
+            "seed": seed,
+        },
+        "results": recorder.results,
+    }
+
+
+def femr_bench_program() -> None:
+    """Run the femr benchmarks and write the results to a JSON file."""
+    parser = argparse.ArgumentParser(description="Benchmark femr against a synthetic extract")
+    parser.add_argument("output", type=str, help="The JSON file to write the results to")
+    parser.add_argument("--num_patients", type=int, default=10_000, help="The number of synthetic patients")
+    parser.add_argument("--events_per_patient", type=int, default=100, help="The number of events per patient")
+    parser.add_argument("--num_threads", type=int, default=1, help="The number of threads to use")
+    parser.add_argument(
+        "--num_random_access", type=int, default=10_000, help="The number of patients to read in random order"
+    )
+    parser.add_argument("--num_batches", type=int, default=100, help="The number of CLMBR batches to load")
+    parser.add_argument("--seed", type=int, default=97, help="The random seed for the synthetic data")
+    parser.add_argument(
+        "--work_dir", type=str, default=None, help="Where to keep the synthetic extract, a temporary directory if unset"
+    )
+    parser.add_argument(
+        "--skip_batches", default=False, action="store_true", help="Skip the CLMBR batch creation benchmarks"
+    )
+
+    args = parser.parse_args()
+
+    if args.work_dir is not None and os.path.exists(args.work_dir) and os.listdir(args.work_dir):
+        parser.error(f"--work_dir {args.work_dir} must be empty or not exist yet")
+
+    logging.basicConfig(format="%(asctime)s [%(levelname)-5.5s]  %(message)s", level=logging.INFO)
+
+    with contextlib.ExitStack() as stack:
+        work_dir: str
+        if args.work_dir is None:
+            work_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        else:
+            work_dir = args.work_dir
+            os.makedirs(work_dir, exist_ok=True)
+
+        results = run_benchmarks(
+            work_dir,
+            num_patients=args.num_patients,
+            events_per_patient=args.events_per_patient,
+            num_threads=args.num_threads,
+            num_random_access=args.num_random_access,
+            num_batches=args.num_batches,
+            seed=args.seed,
+            skip_batches=args.skip_batches,
+        )
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
@@ -1,17 +1,50 @@
 """femr.datasets provides the main tools for doing raw data manipulation."""
 from __future__ import annotations
 
+import abc
 import collections.abc
 import contextlib
+import ctypes
 import functools
+import heapq
+import io
 import itertools
 import multiprocessing.pool
 import os
-from typing import Any, Callable, ContextManager, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+import pickle
+import tempfile
+import time
+from typing import (
+    Any,
+    Callable,
+    ClassVar,
+    ContextManager,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    cast,
+)
 
 import numpy as np
-
-from femr.datasets import fileio
+import zstandard
+
+from femr.datasets import fileio, profiling
+from femr.datasets.checkpoints import Checkpoints, get_checkpoint_key
+from femr.datasets.export import export_to_parquet  # noqa: F401
+from femr.datasets.sharded import (  # noqa: F401
+    OverlayPatientDatabase,
+    ShardedOntology,
+    ShardedPatientDatabase,
+    add_patient_overlay,
+    compact_patient_database,
+    delete_patients,
+    open_patient_database,
+    split_patient_ids,
+)
 from femr.datasets.types import RawEvent, RawPatient
 from femr.extension import datasets as extension_datasets
 
@@ -21,20 +54,88 @@ def _get_sort_key(pid_and_event: Tuple[int, RawEvent]) -> Any:
     return (pid_and_event[0], pid_and_event[1].start)
 
 
+# The default budget for the events held in memory while sorting, shared between all workers
+DEFAULT_SORT_MEMORY_BYTES = 16 * 1024 * 1024 * 1024
+
+# A rough estimate of the memory used by a (patient_id, RawEvent) tuple and its sort key, besides its strings
+_EVENT_MEMORY_BYTES = 640
+
+# Sorted runs are written and read back in batches of this many events
+_RUN_BATCH_SIZE = 1024
+
+# The order of the events in patient files
+_PATIENT_SORT_FIELDS = np.dtype(
+    [
+        ("patient_id", np.int64),
+        ("start", np.datetime64),
+        ("concept_id", np.int64),
+    ]
+)
+
+
+def _estimate_event_memory(event: RawEvent) -> int:
+    """Estimate the memory used by an event while it is sorted."""
+    size = _EVENT_MEMORY_BYTES
+    for value in event.__dict__.values():
+        if isinstance(value, (str, bytes)):
+            size += len(value)
+    return size
+
+
+def _write_sorted_run(items: List[Tuple[int, RawEvent]], path: str) -> None:
+    """Sort the items and spill them to a temporary file."""
+    items.sort(key=_get_sort_key)
+    with contextlib.closing(zstandard.ZstdCompressor(level=1).stream_writer(open(path, "wb"))) as f:
+        for i in range(0, len(items), _RUN_BATCH_SIZE):
+            pickle.dump(items[i : i + _RUN_BATCH_SIZE], f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _read_sorted_run(path: str) -> Iterator[Tuple[int, RawEvent]]:
+    """Read back a run written by _write_sorted_run."""
+    # The reader implements readinto, which is all BufferedReader needs from a raw stream
+    reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    with io.BufferedReader(cast(io.RawIOBase, reader)) as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from batch
+
+
 def _sort_readers(
     events: EventCollection,
+    max_memory_bytes: int,
     reader_funcs: Sequence[Callable[[], ContextManager[Iterable[Tuple[int, RawEvent]]]]],
 ) -> None:
-    """Sort the provided reader_funcs and write out to the provided events."""
-    items: List[Tuple[int, RawEvent]] = []
-    for reader_func in reader_funcs:
-        with reader_func() as reader:
-            items.extend(reader)
+    """Sort the provided reader_funcs and write out to the provided events.
+
+    Once the events use more than max_memory_bytes, they are sorted and spilled to a temporary file as a run.
+    The runs are then merged together with the events that are still in memory.
+    """
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(events.path))) as run_directory:
+        run_paths: List[str] = []
+        items: List[Tuple[int, RawEvent]] = []
+        current_size = 0
+        for reader_func in reader_funcs:
+            with reader_func() as reader:
+                for item in reader:
+                    items.append(item)
+                    current_size += _estimate_event_memory(item[1])
+                    if current_size > max_memory_bytes:
+                        run_paths.append(os.path.join(run_directory, f"{len(run_paths)}.pkl.zst"))
+                        _write_sorted_run(items, run_paths[-1])
+                        items = []
+                        current_size = 0
 
-    with contextlib.closing(events.create_writer()) as writer:
         items.sort(key=_get_sort_key)
-        for i, e in items:
-            writer.add_event(i, e)
+        runs = [_read_sorted_run(path) for path in run_paths]
+
+        with contextlib.closing(events.create_writer()) as writer:
+            # The merge is stable, so events with the same key keep the order in which they were read
+            merged = heapq.merge(*runs, items, key=_get_sort_key) if runs else items
+            for i, e in merged:
+                writer.add_event(i, e)
 
 
 def _create_event_reader(
@@ -47,9 +148,14 @@ def _create_event_reader(
 class EventCollection:
     """A datatype that represents an unordered collection of Events."""
 
-    def __init__(self, path: str):
-        """Create or open an EventCollection at the given path."""
+    def __init__(self, path: str, file_format: str = "rowgroups"):
+        """Create or open an EventCollection at the given path.
+
+        New files are written in `file_format`, which is either the binary "rowgroups" format or the older
+        "csv" format. Files in either format can be read.
+        """
         self.path = path
+        self.file_format = file_format
         if not os.path.exists(path):
             os.mkdir(self.path)
 
@@ -73,11 +179,17 @@ class EventCollection:
 
     def create_writer(self) -> fileio.EventWriter:
         """Create an EventWriter."""
-        return fileio.EventWriter(self.path)
+        return fileio.EventWriter(self.path, self.file_format)
 
-    def sort(self, target_path: str, num_threads: int = 1) -> EventCollection:
-        """Sort the collection and store the resulting output in the target_path."""
-        result = EventCollection(target_path)
+    def sort(
+        self, target_path: str, num_threads: int = 1, max_memory_bytes: int = DEFAULT_SORT_MEMORY_BYTES
+    ) -> EventCollection:
+        """Sort the collection and store the resulting output in the target_path.
+
+        Every worker holds at most its share of `max_memory_bytes` of events in memory, spilling the rest to
+        temporary files next to target_path.
+        """
+        result = EventCollection(target_path, self.file_format)
 
         current_shards = self.sharded_readers()
 
@@ -88,28 +200,80 @@ class EventCollection:
         chunks = [chunk for chunk in chunks if chunk]
 
         with multiprocessing.pool.Pool(num_threads) as pool:
-            for _ in pool.imap_unordered(functools.partial(_sort_readers, result), chunks):
+            sort_func = functools.partial(_sort_readers, result, max_memory_bytes // num_threads)
+            for _ in pool.imap_unordered(sort_func, chunks):
                 pass
 
         return result
 
-    def to_patient_collection(self, target_path: str, num_threads: int = 1) -> PatientCollection:
-        """Convert the EventCollection to a PatientCollection, which is stored in target_path."""
-        extension_datasets.sort_and_join_csvs(
-            self.path,
-            target_path,
-            np.dtype(
-                [
-                    ("patient_id", np.int64),
-                    ("start", np.datetime64),
-                    ("concept_id", np.int64),
-                ]
-            ),
-            ",",
-            num_threads,
+    def to_patient_collection(
+        self,
+        target_path: str,
+        num_threads: int = 1,
+        timing_dict: Optional[Dict[str, Any]] = None,
+        max_memory_bytes: int = DEFAULT_SORT_MEMORY_BYTES,
+        checkpoint: bool = False,
+    ) -> PatientCollection:
+        """Convert the EventCollection to a PatientCollection, which is stored in target_path.
+
+        The patient files use the same format as the event files. If `timing_dict` is given, it is filled with the
+        wall time, CPU time, peak RSS and I/O of the conversion.
+        The events are sorted in runs of at most `max_memory_bytes` in total, which are merged from disk.
+        If `checkpoint` is set, only the patient files that are missing or out of date are written again, see
+        femr.datasets.checkpoints.Checkpoints.
+        """
+        checkpoints = Checkpoints(target_path) if checkpoint else None
+        shards = None
+        keys: Dict[str, str] = {}
+        if checkpoints is not None:
+            # Every patient file is a shard, which depends on all of the event files
+            event_files = sorted(os.listdir(self.path))
+            digests = checkpoints.get_file_digests([os.path.join(self.path, name) for name in event_files], num_threads)
+            inputs = [(name, digests[os.path.join(self.path, name)]) for name in event_files]
+            shards = []
+            for i in range(num_threads):
+                keys[str(i)] = get_checkpoint_key(inputs, i, num_threads)
+                if checkpoints.get_marker(str(i), keys[str(i)]) is None:
+                    shards.append(i)
+            checkpoints.remove_incomplete({str(i) for i in range(num_threads)} - {str(i) for i in shards})
+
+        with profiling.ResourceTimer() as timer:
+            if shards != []:
+                extension_datasets.sort_and_join_csvs(
+                    self.path, target_path, _PATIENT_SORT_FIELDS, ",", num_threads, max_memory_bytes, shards
+                )
+
+        if checkpoints is not None:
+            assert shards is not None
+            for i in shards:
+                outputs = [name for name in os.listdir(target_path) if name.startswith(f"{i}.")]
+                checkpoints.mark_complete(str(i), keys[str(i)], outputs)
+
+        if timing_dict is not None:
+            timing_dict.update(timer.stats)
+
+        return PatientCollection(target_path, self.file_format)
+
+    def partition(
+        self, target_path: str, num_partitions: int, max_memory_bytes: int = DEFAULT_SORT_MEMORY_BYTES
+    ) -> None:
+        """Split the events into partitions by patient id, which are stored as sorted runs in target_path/<partition>.
+
+        The partition of a patient only depends on its id and `num_partitions`, so the partitions of several
+        collections can be combined and joined with `join_sorted_runs`. Partitions without events may be missing.
+        This runs on the calling thread, with `max_memory_bytes` shared between the partitions.
+        """
+        extension_datasets.partition_csvs(
+            self.path, target_path, _PATIENT_SORT_FIELDS, ",", num_partitions, max_memory_bytes
         )
 
-        return PatientCollection(target_path)
+    def join_sorted_runs(self, target_file: str, max_memory_bytes: int = DEFAULT_SORT_MEMORY_BYTES) -> bool:
+        """Merge the sorted runs in the collection, such as a partition, into a single patient file.
+
+        Returns whether the file was written, as nothing is written for a collection without events.
+        """
+        extension_datasets.join_csvs(self.path, target_file, _PATIENT_SORT_FIELDS, ",", max_memory_bytes)
+        return os.path.exists(target_file)
 
 
 def _sharded_patient_reader(path: str) -> ContextManager[Iterable[RawPatient]]:
@@ -117,50 +281,231 @@ def _sharded_patient_reader(path: str) -> ContextManager[Iterable[RawPatient]]:
     return contextlib.closing(fileio.PatientReader(path))
 
 
-def _transform_single_reader(
+class PatientTransform(abc.ABC):
+    """A patient transform that declares how it depends on and changes the order of the events of a patient.
+
+    Calling the transform applies it and resorts the events if needed. PatientCollection.transform instead only
+    resorts the events before a transform that needs them in order, and once at the end.
+    """
+
+    # Whether the transform reads the events in order, so that they have to be sorted before it
+    needs_sorted_events: ClassVar[bool] = True
+
+    # Whether the transform keeps sorted events sorted, for instance because it only removes events
+    preserves_order: ClassVar[bool] = False
+
+    def __call__(self, patient: RawPatient) -> Optional[RawPatient]:
+        """Apply the transform to a patient, resorting the events afterwards if needed."""
+        result = self.apply(patient)
+        if result is not None and not self.preserves_order:
+            result.resort()
+        return result
+
+    @abc.abstractmethod
+    def apply(self, patient: RawPatient) -> Optional[RawPatient]:
+        """Apply the transform to a patient without resorting the events afterwards."""
+
+
+class NativeTransform(PatientTransform):
+    """A patient transform that can also be applied natively, without creating RawPatient objects.
+
+    Calling the transform applies it in Python. PatientCollection.transform instead applies every run of consecutive
+    native transforms to a row group patient file in a single native pass, see native/transforms.hh.
+    """
+
+    @abc.abstractmethod
+    def get_native_transform(self) -> Tuple[str, Dict[str, Any]]:
+        """Return the name and the parameters of the native implementation."""
+
+
+def _get_transform_stages(
+    transforms: Sequence[Callable[[RawPatient], Optional[RawPatient]]], allow_native: bool
+) -> List[Tuple[bool, List[Callable[[RawPatient], Optional[RawPatient]]]]]:
+    """Split the transforms into stages of consecutive native transforms and of Python transforms."""
+    stages: List[Tuple[bool, List[Callable[[RawPatient], Optional[RawPatient]]]]] = []
+    for transform in transforms:
+        is_native = allow_native and isinstance(transform, NativeTransform)
+        if stages and stages[-1][0] == is_native:
+            stages[-1][1].append(transform)
+        else:
+            stages.append((is_native, [transform]))
+    return stages or [(False, [])]
+
+
+def _run_native_transforms(
+    source: str,
+    target_path: str,
+    transforms: Sequence[NativeTransform],
+    information: Dict[str, Dict[str, int]],
+    transform_seconds: Dict[str, float],
+) -> Tuple[str, int]:
+    """Apply native transforms to a row group patient file, writing a new file in target_path.
+
+    Returns the new file and the number of patients in the source.
+    """
+    fd, target_file = tempfile.mkstemp(dir=target_path, suffix=fileio.ROW_GROUP_EXTENSION)
+    os.close(fd)
+
+    num_patients, native_stats = extension_datasets.transform_patients(
+        source, target_file, [transform.get_native_transform() for transform in transforms]
+    )
+
+    # Match the statistics of the Python transforms, which only count the patients that reach a transform
+    remaining_patients = num_patients
+    for transform, stats in zip(transforms, native_stats):
+        if remaining_patients > 0:
+            information[str(transform)]["lost_events"] += stats["lost_events"]
+        if stats["lost_patients"] > 0:
+            information[str(transform)]["lost_patients"] += stats["lost_patients"]
+        remaining_patients -= stats["lost_patients"]
+        transform_seconds[str(transform)] += stats["seconds"]
+
+    return target_file, num_patients
+
+
+def _apply_transform(
+    transform: Callable[[RawPatient], Optional[RawPatient]], patient: RawPatient, is_sorted: bool
+) -> Tuple[Optional[RawPatient], bool]:
+    """Apply a transform to a patient, returning the result and whether its events are still sorted.
+
+    A PatientTransform is applied without resorting the events afterwards. Other transforms are always given sorted
+    events and are trusted to keep them sorted.
+    """
+    if isinstance(transform, PatientTransform):
+        if transform.needs_sorted_events and not is_sorted:
+            patient.resort()
+            is_sorted = True
+        return transform.apply(patient), is_sorted and transform.preserves_order
+    else:
+        if not is_sorted:
+            patient.resort()
+        return transform(patient), True
+
+
+def _run_python_transforms(
+    source: str,
     target_path: str,
     transforms: Sequence[Callable[[RawPatient], Optional[RawPatient]]],
-    capture_statistics: bool,
-    reader_func: Callable[[], ContextManager[Iterable[RawPatient]]],
-) -> Optional[Dict[str, Dict[str, int]]]:
-    """Transform a single PatientReader, writing to a particular target_path."""
-    if capture_statistics:
-        information: Dict[str, Dict[str, int]] = collections.defaultdict(lambda: collections.defaultdict(int))
-    with contextlib.closing(fileio.PatientWriter(target_path)) as o:
-        with reader_func() as reader:
+    file_format: str,
+    capture_timing: bool,
+    information: Dict[str, Dict[str, int]],
+    transform_seconds: Dict[str, float],
+) -> Tuple[str, int]:
+    """Apply transforms in Python to a patient file, writing a new file in target_path.
+
+    Returns the new file and the number of patients in the source.
+    """
+    num_patients = 0
+    with contextlib.closing(fileio.PatientWriter(target_path, file_format)) as o:
+        with _sharded_patient_reader(source) as reader:
             for p in reader:
-                if capture_statistics:
-                    current_event_count = len(p.events)
+                num_patients += 1
+                current_event_count = len(p.events)
                 current_patient: Optional[RawPatient] = p
+                # The events in patient files are sorted
+                is_sorted = True
                 for transform in transforms:
                     assert current_patient is not None
-                    current_patient = transform(current_patient)
+                    if capture_timing:
+                        start = time.perf_counter()
+                        current_patient, is_sorted = _apply_transform(transform, current_patient, is_sorted)
+                        transform_seconds[str(transform)] += time.perf_counter() - start
+                    else:
+                        current_patient, is_sorted = _apply_transform(transform, current_patient, is_sorted)
                     if current_patient is None:
-                        if capture_statistics:
-                            information[str(transform)]["lost_patients"] += 1
-                            information[str(transform)]["lost_events"] += current_event_count
+                        information[str(transform)]["lost_patients"] += 1
+                        information[str(transform)]["lost_events"] += current_event_count
                         break
                     else:
-                        if capture_statistics:
-                            new_events = len(current_patient.events)
-                            information[str(transform)]["lost_events"] += current_event_count - new_events
-                            current_event_count = new_events
+                        new_events = len(current_patient.events)
+                        information[str(transform)]["lost_events"] += current_event_count - new_events
+                        current_event_count = new_events
 
                 if current_patient is not None:
+                    if not is_sorted:
+                        current_patient.resort()
                     o.add_patient(current_patient)
 
+    return o.writer.file.name, num_patients
+
+
+def _transform_single_reader(
+    target_path: str,
+    transforms: Sequence[Callable[[RawPatient], Optional[RawPatient]]],
+    file_format: str,
+    capture_statistics: bool,
+    capture_timing: bool,
+    profile_dir: Optional[str],
+    task: Tuple[int, str],
+) -> Tuple[int, str, Optional[Dict[str, Dict[str, int]]], Optional[Dict[str, Any]]]:
+    """Transform a single patient file, writing to a particular target_path.
+
+    Runs of native transforms are applied natively when the files are in the row group format, with the
+    intermediate files between stages written to a temporary directory in target_path.
+    Returns the index of the task, the name of the new file, and the statistics and the timing of the file, if
+    requested.
+    """
+    task_index, source = task
+    information: Dict[str, Dict[str, int]] = collections.defaultdict(lambda: collections.defaultdict(int))
+    transform_seconds: Dict[str, float] = collections.defaultdict(float)
+    num_patients = 0
+
+    profile_path = None
+    if profile_dir is not None:
+        profile_path = os.path.join(profile_dir, f"transform_{task_index}.prof")
+
+    allow_native = file_format == "rowgroups" and fileio._is_row_group_file(source)
+    stages = _get_transform_stages(transforms, allow_native)
+
+    with profiling.ResourceTimer() as timer, profiling.profile_to(profile_path):
+        with tempfile.TemporaryDirectory(dir=target_path, prefix=".stages_") as stage_path:
+            current_file = source
+            for i, (is_native, stage_transforms) in enumerate(stages):
+                stage_target = target_path if i == len(stages) - 1 else stage_path
+                if is_native:
+                    next_file, stage_patients = _run_native_transforms(
+                        current_file,
+                        stage_target,
+                        cast(List[NativeTransform], stage_transforms),
+                        information,
+                        transform_seconds,
+                    )
+                else:
+                    next_file, stage_patients = _run_python_transforms(
+                        current_file,
+                        stage_target,
+                        stage_transforms,
+                        file_format,
+                        capture_timing,
+                        information,
+                        transform_seconds,
+                    )
+
+                if i == 0:
+                    num_patients = stage_patients
+                else:
+                    os.remove(current_file)
+                current_file = next_file
+
+    stats = None
     if capture_statistics:
-        return {k: dict(v) for k, v in information.items()}
-    else:
-        return None
+        stats = {k: dict(v) for k, v in information.items()}
+
+    timing = None
+    if capture_timing:
+        timer.set_rows(num_patients)
+        timing = {"task": task_index, "pid": os.getpid(), **timer.stats, "transform_seconds": dict(transform_seconds)}
+
+    return task_index, os.path.basename(current_file), stats, timing
 
 
 class PatientCollection:
     """A PatientCollection is an unordered sequence of Patients."""
 
-    def __init__(self, path: str):
-        """Open a PatientCollection at a particular path."""
+    def __init__(self, path: str, file_format: str = "rowgroups"):
+        """Open a PatientCollection at a particular path, writing new files in `file_format`."""
         self.path = path
+        self.file_format = file_format
 
     def sharded_readers(
         self,
@@ -185,33 +530,85 @@ class PatientCollection:
         | Sequence[Callable[[RawPatient], Optional[RawPatient]]],
         num_threads: int = 1,
         stats_dict: Optional[Dict[str, Dict[str, int]]] = None,
+        timing_dict: Optional[Dict[str, Any]] = None,
+        profile_dir: Optional[str] = None,
+        checkpoint: bool = False,
     ) -> PatientCollection:
-        """Apply a transformation to the patient files in a folder to generate a modified output folder."""
-        os.mkdir(target_path)
-
+        """Apply a transformation to the patient files in a folder to generate a modified output folder.
+
+        The events of each patient are only resorted before a `PatientTransform` that needs them in order or another
+        transform, and once at the end. Consecutive `NativeTransform`s are applied in a single native pass over each
+        file, without creating RawPatient objects. If `timing_dict` is given, it is filled with the timing of the
+        whole stage, of each worker and of each transform. If `profile_dir` is given, a cProfile dump is written there
+        for each input shard. If `checkpoint` is set, only the patient files that are new or changed since a previous
+        run are transformed again, see femr.datasets.checkpoints.Checkpoints. The transforms then have to be
+        picklable, as they are part of the key of every file.
+        """
         if not isinstance(transform, collections.abc.Sequence):
             transform = [transform]
 
         total_stats: Dict[str, Dict[str, int]] = collections.defaultdict(lambda: collections.defaultdict(int))
-
-        with multiprocessing.pool.Pool(num_threads) as pool:
-            for stats in pool.imap_unordered(
-                functools.partial(
-                    _transform_single_reader,
-                    target_path,
-                    transform,
-                    stats_dict is not None,
-                ),
-                self.sharded_readers(),
-            ):
-                if stats is not None:
-                    for k, v in stats.items():
+        task_timings: List[Dict[str, Any]] = []
+
+        sources = sorted(os.listdir(self.path))
+        checkpoints = Checkpoints(target_path) if checkpoint else None
+        keys: Dict[str, str] = {}
+        if checkpoints is not None:
+            # Every patient file is a shard, keyed by its contents and the transforms
+            digests = checkpoints.get_file_digests([os.path.join(self.path, child) for child in sources], num_threads)
+            transforms_key = get_checkpoint_key(list(transform), self.file_format)
+            complete_sources = set()
+            for child in sources:
+                key = get_checkpoint_key(digests[os.path.join(self.path, child)], transforms_key)
+                marker = checkpoints.get_marker(child, key)
+                if marker is None:
+                    keys[child] = key
+                else:
+                    complete_sources.add(child)
+                    for k, v in marker["stats"].items():
                         for sub_k, sub_v in v.items():
                             total_stats[k][sub_k] += sub_v
+            checkpoints.remove_incomplete(complete_sources)
+            sources = [child for child in sources if child in keys]
+        else:
+            os.mkdir(target_path)
+
+        with profiling.ResourceTimer(include_children=True) as timer:
+            with multiprocessing.pool.Pool(num_threads) as pool:
+                for task_index, output_file, stats, timing in pool.imap_unordered(
+                    functools.partial(
+                        _transform_single_reader,
+                        target_path,
+                        transform,
+                        self.file_format,
+                        stats_dict is not None or checkpoints is not None,
+                        timing_dict is not None,
+                        profile_dir,
+                    ),
+                    enumerate(os.path.join(self.path, child) for child in sources),
+                ):
+                    if checkpoints is not None:
+                        assert stats is not None
+                        child = sources[task_index]
+                        checkpoints.mark_complete(child, keys[child], [output_file], stats=stats)
+                    if stats is not None:
+                        for k, v in stats.items():
+                            for sub_k, sub_v in v.items():
+                                total_stats[k][sub_k] += sub_v
+                    if timing is not None:
+                        task_timings.append(timing)
         if stats_dict is not None:
             stats_dict.update(total_stats)
 
-        return PatientCollection(target_path)
+        if timing_dict is not None:
+            transform_seconds: Dict[str, float] = collections.defaultdict(float)
+            for timing in task_timings:
+                for name, seconds in timing["transform_seconds"].items():
+                    transform_seconds[name] += seconds
+            timing_dict.update(profiling.summarize_stage(timer.stats, task_timings))
+            timing_dict["transform_seconds"] = dict(transform_seconds)
+
+        return PatientCollection(target_path, self.file_format)
 
     def to_patient_database(
         self,
@@ -219,15 +616,44 @@ class PatientCollection:
         concept_path: str,
         num_threads: int = 1,
         delimiter: str = ",",
+        timing_dict: Optional[Dict[str, Any]] = None,
     ) -> PatientDatabase:
-        """Convert a PatientCollection to a PatientDatabase."""
-        extension_datasets.convert_patient_collection_to_patient_database(
-            self.path, concept_path, target_path, delimiter, num_threads
-        )
-        return PatientDatabase(target_path)
+        """Convert a PatientCollection to a PatientDatabase.
+
+        If `timing_dict` is given, it is filled with the wall time, CPU time, peak RSS and I/O of the conversion.
+        """
+        with profiling.ResourceTimer() as timer:
+            extension_datasets.convert_patient_collection_to_patient_database(
+                self.path, concept_path, target_path, delimiter, num_threads
+            )
+        database = PatientDatabase(target_path)
+
+        if timing_dict is not None:
+            timer.set_rows(len(database))
+            timing_dict.update(timer.stats)
+
+        return database
 
 
 # Import from C++ extension
 
 PatientDatabase = extension_datasets.PatientDatabase
 Ontology = extension_datasets.Ontology
+
+# The signature of native callbacks for PatientDatabase.map_reduce, which are run without the GIL.
+# Arguments are (state, patient_id, birth_date, num_events, code, start_age_in_minutes, value_type,
+# numeric_value, text_value), where state points to the calling thread's state array and birth_date is
+# in days since the unix epoch. The state of the first thread starts as a copy of the initial array and
+# the others start as zeros, so that the initial array is only reduced once.
+MapReduceCallback = ctypes.CFUNCTYPE(
+    None,
+    ctypes.c_void_p,
+    ctypes.c_int64,
+    ctypes.c_int32,
+    ctypes.c_uint64,
+    ctypes.POINTER(ctypes.c_uint32),
+    ctypes.POINTER(ctypes.c_uint32),
+    ctypes.POINTER(ctypes.c_uint8),
+    ctypes.POINTER(ctypes.c_float),
+    ctypes.POINTER(ctypes.c_uint32),
+)
@@ -0,0 +1,148 @@
+"""Completion markers that let the ETL stages resume, only redoing the shards that are missing or invalidated."""
+from __future__ import annotations
+
+import hashlib
+import json
+import multiprocessing.pool
+import os
+import pickle
+import shutil
+import tempfile
+from typing import Any, Collection, Dict, List, Optional, Sequence, Tuple
+
+import femr
+
+# Files are hashed in blocks of this many bytes
+_HASH_BLOCK_BYTES = 16 * 1024 * 1024
+
+_DIGESTS_FILE = "digests.json"
+
+
+def _hash_bytes(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _write_json(path: str, data: Any) -> None:
+    """Write a json file atomically, so that it is never seen half written."""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+def get_file_digest(path: str) -> str:
+    """Hash the contents of a file."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(_HASH_BLOCK_BYTES)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_checkpoint_key(*parts: Any) -> str:
+    """Hash everything a shard depends on, such as the digests of its inputs and its configuration.
+
+    The FEMR version is always included. The parts are pickled, so they have to pickle deterministically. Note that
+    functions are pickled by name, so changes to code outside of FEMR do not invalidate shards.
+    """
+    return _hash_bytes(pickle.dumps((femr.__version__,) + parts, protocol=4))
+
+
+class Checkpoints:
+    """The completion markers of the shards of an ETL stage, which are stored next to the output directory.
+
+    The marker of a shard records its key, the output files it wrote and any other information such as statistics.
+    A shard is complete if its marker has the expected key and all of its outputs still exist. Everything else in
+    the output directory is left over from a crash or from an invalidated shard, and is removed before resuming.
+    """
+
+    def __init__(self, output_path: str):
+        """Open the markers of the stage writing to output_path, which are stored in output_path + ".checkpoints"."""
+        self.output_path = output_path
+        self.path = os.path.abspath(output_path) + ".checkpoints"
+        os.makedirs(self.output_path, exist_ok=True)
+        os.makedirs(self.path, exist_ok=True)
+
+    def get_shard_id(self, shard: str) -> str:
+        """Get an identifier for a shard that can be used in file names, as shards can be named by paths."""
+        return _hash_bytes(shard.encode("utf8"))
+
+    def _get_marker_path(self, shard: str) -> str:
+        return os.path.join(self.path, self.get_shard_id(shard) + ".json")
+
+    def get_marker(self, shard: str, key: str) -> Optional[Dict[str, Any]]:
+        """Return the marker of a shard if it is complete with the given key, or None if it has to be redone."""
+        try:
+            with open(self._get_marker_path(shard)) as f:
+                marker: Dict[str, Any] = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        if marker["shard"] != shard or marker["key"] != key:
+            return None
+        if not all(os.path.exists(os.path.join(self.output_path, name)) for name in marker["outputs"]):
+            return None
+        return marker
+
+    def mark_complete(self, shard: str, key: str, outputs: Sequence[str], **info: Any) -> None:
+        """Record that a shard is complete, once all of its outputs have been written to the output directory."""
+        _write_json(self._get_marker_path(shard), {"shard": shard, "key": key, "outputs": list(outputs), **info})
+
+    def remove_incomplete(self, complete_shards: Collection[str]) -> None:
+        """Remove the markers of other shards and everything in the output directory besides the complete outputs."""
+        outputs = set()
+        for name in os.listdir(self.path):
+            if name == _DIGESTS_FILE:
+                continue
+
+            path = os.path.join(self.path, name)
+            if name.endswith(".json"):
+                with open(path) as f:
+                    marker = json.load(f)
+                if marker["shard"] in complete_shards:
+                    outputs.update(marker["outputs"])
+                    continue
+            os.remove(path)
+
+        for name in os.listdir(self.output_path):
+            if name not in outputs:
+                path = os.path.join(self.output_path, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+
+    def get_file_digests(self, paths: Sequence[str], num_threads: int = 1) -> Dict[str, str]:
+        """Hash the contents of files in parallel.
+
+        Like git, the digests are cached by the size and modification time of the files, so that the inputs of a
+        stage are only read again when they change.
+        """
+        cache_path = os.path.join(self.path, _DIGESTS_FILE)
+        cache: Dict[str, List[Any]] = {}
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                cache = json.load(f)
+
+        digests = {}
+        to_hash: List[Tuple[str, os.stat_result]] = []
+        for path in paths:
+            stat = os.stat(path)
+            entry = cache.get(os.path.abspath(path))
+            if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+                digests[path] = entry[2]
+            else:
+                to_hash.append((path, stat))
+
+        if to_hash:
+            with multiprocessing.pool.Pool(num_threads) as pool:
+                new_digests = pool.map(get_file_digest, [path for path, _ in to_hash])
+            for (path, stat), digest in zip(to_hash, new_digests):
+                digests[path] = digest
+                cache[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns, digest]
+            _write_json(cache_path, cache)
+
+        return digests
@@ -0,0 +1,112 @@
+"""Export a PatientDatabase to columnar files for use with other tools, such as DuckDB or Polars."""
+from __future__ import annotations
+
+import concurrent.futures
+import os
+from typing import Any, List, Optional, Sequence
+
+import numpy as np
+
+from femr.extension import datasets as extension_datasets
+
+# The sentinels used by PatientDatabase.get_patients for missing values
+_MISSING_TEXT = np.iinfo(np.uint32).max
+_MISSING_VISIT_ID = np.iinfo(np.int64).min
+_MISSING_END_OFFSET = np.iinfo(np.int32).min
+
+
+def _lookup_strings(dictionary: Optional[Sequence[str]], indices: np.ndarray, present: np.ndarray) -> np.ndarray:
+    """Look up the present indices in a dictionary, only converting each distinct index to a str once."""
+    result = np.full(len(indices), None, dtype=object)
+    if dictionary is not None and present.any():
+        unique, inverse = np.unique(indices[present], return_inverse=True)
+        result[present] = np.array([dictionary[i] for i in unique], dtype=object)[inverse]
+    return result
+
+
+def _dictionary_column(dictionary: Optional[Sequence[str]], indices: np.ndarray, present: np.ndarray) -> Any:
+    """Create a dictionary encoded string column, only containing the strings used in this batch."""
+    import pyarrow as pa
+
+    unique, inverse = np.unique(indices[present], return_inverse=True)
+    dictionary_indices = np.zeros(len(indices), dtype=np.int32)
+    dictionary_indices[present] = inverse
+    strings = [dictionary[i] for i in unique] if dictionary is not None else []
+    return pa.DictionaryArray.from_arrays(
+        pa.array(dictionary_indices, mask=~present), pa.array(strings, type=pa.string())
+    )
+
+
+def _patients_to_table(database: extension_datasets.PatientDatabase, patient_ids: np.ndarray) -> Any:
+    """Convert a batch of patients into an Arrow table with one row per event."""
+    import pyarrow as pa
+
+    batch = database.get_patients(patient_ids.tolist(), include_metadata=True)
+    num_events = np.diff(batch["offsets"])
+
+    start = np.repeat(batch["birth_date"], num_events).astype("datetime64[m]")
+    start += batch["start_age_in_minutes"].astype("timedelta64[m]")
+
+    value_type = batch["value_type"]
+    is_numeric = value_type == extension_datasets.ValueType.NUMERIC.value
+    is_shared_text = value_type == extension_datasets.ValueType.SHARED_TEXT.value
+    is_unique_text = value_type == extension_datasets.ValueType.UNIQUE_TEXT.value
+
+    text_value = _lookup_strings(database.get_shared_text_dictionary(), batch["text_value"], is_shared_text)
+    text_value[is_unique_text] = _lookup_strings(
+        database.get_unique_text_dictionary(), batch["text_value"], is_unique_text
+    )[is_unique_text]
+
+    has_end = batch["end_offset_in_minutes"] != _MISSING_END_OFFSET
+    end = start + batch["end_offset_in_minutes"].astype("timedelta64[m]")
+
+    metadata_text = database.get_event_metadata_text_dictionary()
+
+    return pa.table(
+        {
+            "patient_id": np.repeat(batch["patient_id"], num_events),
+            "start": start.astype("datetime64[us]"),
+            "code": _dictionary_column(
+                database.get_ontology().get_codes(), batch["code"], np.ones(len(start), dtype=bool)
+            ),
+            "numeric_value": pa.array(batch["numeric_value"], mask=~is_numeric),
+            "text_value": pa.array(text_value, type=pa.string()),
+            "visit_id": pa.array(batch["visit_id"], mask=batch["visit_id"] == _MISSING_VISIT_ID),
+            "end": pa.array(end.astype("datetime64[us]"), mask=~has_end),
+            "omop_table": _dictionary_column(metadata_text, batch["omop_table"], batch["omop_table"] != _MISSING_TEXT),
+            "unit": _dictionary_column(metadata_text, batch["unit"], batch["unit"] != _MISSING_TEXT),
+        }
+    )
+
+
+def export_to_parquet(
+    database: extension_datasets.PatientDatabase,
+    target_path: str,
+    num_threads: int = 1,
+    patients_per_file: int = 100_000,
+    compression: str = "zstd",
+) -> List[str]:
+    """Export every event of a PatientDatabase to a directory of Parquet files, one per batch of patients.
+
+    The columns are patient_id, start, code, numeric_value, text_value, visit_id, end, omop_table and unit.
+    Batches are decoded natively and written on `num_threads` threads, so at most `num_threads` batches
+    are held in memory at a time. Requires pyarrow.
+
+    Returns the paths of the written files.
+    """
+    import pyarrow.parquet as pq
+
+    os.makedirs(target_path, exist_ok=True)
+
+    patient_ids = np.fromiter(database, dtype=np.int64, count=len(database))
+    batches = [patient_ids[i : i + patients_per_file] for i in range(0, len(patient_ids), patients_per_file)]
+    if not batches:
+        return []
+
+    def write_batch(batch_index: int) -> str:
+        path = os.path.join(target_path, f"part-{batch_index:05d}.parquet")
+        pq.write_table(_patients_to_table(database, batches[batch_index]), path, compression=compression)
+        return path
+
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+        return list(executor.map(write_batch, range(len(batches))))
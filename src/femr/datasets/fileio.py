@@ -4,16 +4,22 @@ from __future__ import annotations
 import base64
 import csv
 import datetime
+import enum
 import io
+import itertools
 import pickle
+import struct
 import tempfile
 import warnings
-from typing import Any, Dict, Iterator, List, Optional, Tuple
+from typing import IO, Any, Dict, Iterator, List, Optional, Tuple
 
 import zstandard
 
 from femr.datasets.types import RawEvent, RawPatient
 
+# The formats that event and patient files can be written in
+FILE_FORMATS = ("rowgroups", "csv")
+
 
 def _encode_value(a: float | str | None) -> str:
     """Try to decode a string value."""
@@ -33,72 +39,371 @@ def _decode_value(a: str) -> float | str | None:
         return a
 
 
-class EventWriter:
-    """Writes events into a file."""
+# Standard metadata fields that are stored as typed columns instead of in the pickled metadata.
+# Values with other types are still pickled so they round trip exactly.
+_STANDARD_METADATA_FIELDS = ("visit_id", "end", "omop_table", "unit")
 
-    def __init__(self, path: str):
-        """Open a file for writing."""
-        self.file = tempfile.NamedTemporaryFile(dir=path, suffix=".csv.zst", delete=False)
+
+def _is_standard_metadata(name: str, value: Any) -> bool:
+    """Check whether a metadata field can be stored in its typed column."""
+    if name == "visit_id":
+        return isinstance(value, int) and not isinstance(value, bool)
+    elif name == "end":
+        return isinstance(value, datetime.datetime)
+    elif name in _STANDARD_METADATA_FIELDS:
+        return isinstance(value, str) and value != ""
+    else:
+        return False
+
+
+def _split_metadata(event: RawEvent) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Split the metadata of an event into the standard fields with typed columns and the rest."""
+    standard = {}
+    other = {}
+    for a, b in event.__dict__.items():
+        if a in ("start", "concept_id", "value"):
+            continue
+        if _is_standard_metadata(a, b):
+            standard[a] = b
+        else:
+            other[a] = b
+    return standard, other
+
+
+def _encode_standard_metadata(name: str, value: Any) -> str:
+    """Encode a standard metadata field as a CSV column value."""
+    if name == "end":
+        return value.isoformat()
+    else:
+        return str(value)
+
+
+def _decode_standard_metadata(name: str, value: str) -> Any:
+    """Decode a standard metadata CSV column value."""
+    if name == "visit_id":
+        return int(value)
+    elif name == "end":
+        return datetime.datetime.fromisoformat(value)
+    else:
+        return value
+
+
+# Event files are written in the row group format shared with the native code, see native/row_groups.hh.
+# Each row group holds the cells of every column contiguously and is compressed as a single zstd frame.
+ROW_GROUP_EXTENSION = ".rowgroups"
+_ROW_GROUP_MAGIC = b"FEMRRG01"
+_ROWS_PER_GROUP = 64 * 1024
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+class _ColumnType(enum.IntEnum):
+    INT64 = 0
+    FLOAT64 = 1
+    DATETIME = 2
+    STRING = 3
+    BYTES = 4
+    VALUE = 5
+
+
+_EVENT_COLUMNS = [
+    ("patient_id", _ColumnType.INT64),
+    ("start", _ColumnType.DATETIME),
+    ("concept_id", _ColumnType.INT64),
+    ("value", _ColumnType.VALUE),
+    ("visit_id", _ColumnType.INT64),
+    ("end", _ColumnType.DATETIME),
+    ("omop_table", _ColumnType.STRING),
+    ("unit", _ColumnType.STRING),
+    ("metadata", _ColumnType.BYTES),
+]
+
+
+def _encode_column(column_type: _ColumnType, values: List[Any]) -> bytes:
+    """Encode the values of a column in a row group as the cell lengths followed by the cell data."""
+    if column_type in (_ColumnType.INT64, _ColumnType.FLOAT64, _ColumnType.DATETIME):
+        present = [v for v in values if v is not None]
+        if column_type == _ColumnType.DATETIME:
+            present = [(v - _EPOCH) // _MICROSECOND for v in present]
+        lengths = [0 if v is None else 8 for v in values]
+        data = struct.pack(f"<{len(present)}{'d' if column_type == _ColumnType.FLOAT64 else 'q'}", *present)
+    else:
+        cells: List[bytes]
+        if column_type == _ColumnType.STRING:
+            cells = [b"" if v is None else v.encode("utf8") for v in values]
+        elif column_type == _ColumnType.BYTES:
+            cells = [b"" if v is None else v for v in values]
+        else:
+            cells = [_encode_value_cell(v) for v in values]
+        lengths = [len(c) for c in cells]
+        data = b"".join(cells)
+    return struct.pack(f"<{len(lengths)}I", *lengths) + data
+
+
+def _decode_column(column_type: _ColumnType, lengths: Tuple[int, ...], data: bytes) -> List[Any]:
+    """Decode the cells of a column in a row group, with None for missing values."""
+    if column_type in (_ColumnType.INT64, _ColumnType.FLOAT64, _ColumnType.DATETIME):
+        num_present = len(data) // 8
+        present = struct.unpack(f"<{num_present}{'d' if column_type == _ColumnType.FLOAT64 else 'q'}", data)
+        if num_present == len(lengths):
+            result: List[Any] = list(present)
+        else:
+            values = iter(present)
+            result = [next(values) if length else None for length in lengths]
+        if column_type == _ColumnType.DATETIME:
+            return [None if v is None else _EPOCH + datetime.timedelta(microseconds=v) for v in result]
+        return result
+
+    offsets = [0, *itertools.accumulate(lengths)]
+    cells = [data[offsets[i] : offsets[i + 1]] for i in range(len(lengths))]
+    if column_type == _ColumnType.STRING:
+        return [c.decode("utf8") if c else None for c in cells]
+    elif column_type == _ColumnType.BYTES:
+        return [c if c else None for c in cells]
+    else:
+        return [_decode_value_cell(c) for c in cells]
+
+
+def _encode_value_cell(value: float | str | None) -> bytes:
+    """Encode an event value, tagging whether it is numeric or text."""
+    if value is None:
+        return b""
+    elif isinstance(value, (int, float)):
+        return b"f" + struct.pack("<d", value)
+    else:
+        return b"s" + str(value).encode("utf8")
+
+
+def _decode_value_cell(cell: bytes) -> float | str | None:
+    """Decode an event value cell."""
+    if not cell:
+        return None
+    elif cell[:1] == b"f":
+        return struct.unpack("<d", cell[1:])[0]
+    else:
+        return cell[1:].decode("utf8")
+
+
+def _is_row_group_file(filename: str) -> bool:
+    with open(filename, "rb") as f:
+        return f.read(len(_ROW_GROUP_MAGIC)) == _ROW_GROUP_MAGIC
+
+
+class _RowGroupEventWriter:
+    """Writes events into a row group file."""
+
+    def __init__(self, file: IO[bytes]):
+        self.file = file
+        self.compressor = zstandard.ZstdCompressor(level=1)
+        self.columns: Dict[str, List[Any]] = {name: [] for name, _ in _EVENT_COLUMNS}
+
+        self.file.write(_ROW_GROUP_MAGIC)
+        self.file.write(struct.pack("<I", len(_EVENT_COLUMNS)))
+        for name, column_type in _EVENT_COLUMNS:
+            encoded_name = name.encode("utf8")
+            self.file.write(struct.pack("<BI", column_type, len(encoded_name)))
+            self.file.write(encoded_name)
+
+    def add_event(self, patient_id: int, event: RawEvent) -> None:
+        standard, other = _split_metadata(event)
+
+        self.columns["patient_id"].append(patient_id)
+        self.columns["start"].append(event.start)
+        self.columns["concept_id"].append(event.concept_id)
+        self.columns["value"].append(event.value)
+        for name in _STANDARD_METADATA_FIELDS:
+            self.columns[name].append(standard.get(name))
+        self.columns["metadata"].append(pickle.dumps(other) if other else None)
+
+        if len(self.columns["patient_id"]) >= _ROWS_PER_GROUP:
+            self.flush()
+
+    def flush(self) -> None:
+        num_rows = len(self.columns["patient_id"])
+        if num_rows == 0:
+            return
+
+        data = b"".join(_encode_column(column_type, self.columns[name]) for name, column_type in _EVENT_COLUMNS)
+        compressed = self.compressor.compress(data)
+        self.file.write(struct.pack("<IQ", num_rows, len(compressed)))
+        self.file.write(compressed)
+
+        for values in self.columns.values():
+            values.clear()
+
+    def close(self) -> None:
+        self.flush()
+        self.file.close()
+
+
+class _RowGroupEventReader:
+    """Reads events from a row group file."""
+
+    def __init__(self, filename: str):
+        self.file = open(filename, "rb")
+        if self.file.read(len(_ROW_GROUP_MAGIC)) != _ROW_GROUP_MAGIC:
+            raise ValueError(f"{filename} is not a row group file")
+
+        (num_columns,) = struct.unpack("<I", self.file.read(4))
+        self.schema = []
+        for _ in range(num_columns):
+            column_type, name_length = struct.unpack("<BI", self.file.read(5))
+            self.schema.append((self.file.read(name_length).decode("utf8"), _ColumnType(column_type)))
+
+    def _read_row_groups(self) -> Iterator[Dict[str, List[Any]]]:
+        decompressor = zstandard.ZstdDecompressor()
+        while True:
+            header = self.file.read(12)
+            if not header:
+                return
+            num_rows, compressed_size = struct.unpack("<IQ", header)
+            data = decompressor.decompress(self.file.read(compressed_size))
+
+            columns = {}
+            position = 0
+            for name, column_type in self.schema:
+                lengths = struct.unpack_from(f"<{num_rows}I", data, position)
+                position += 4 * num_rows
+                data_size = sum(lengths)
+                columns[name] = _decode_column(column_type, lengths, data[position : position + data_size])
+                position += data_size
+            yield columns
+
+    def __iter__(self) -> Iterator[Tuple[int, RawEvent]]:
+        for columns in self._read_row_groups():
+            standard_columns = [(name, columns[name]) for name in _STANDARD_METADATA_FIELDS if name in columns]
+            for i, (patient_id, start, concept_id, value, metadata) in enumerate(
+                zip(
+                    columns["patient_id"],
+                    columns["start"],
+                    columns["concept_id"],
+                    columns["value"],
+                    columns["metadata"],
+                )
+            ):
+                kwargs = pickle.loads(metadata) if metadata is not None else {}
+                for name, values in standard_columns:
+                    if values[i] is not None:
+                        kwargs[name] = values[i]
+                yield (patient_id, RawEvent(start=start, concept_id=concept_id, value=value, **kwargs))
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class _CSVEventWriter:
+    """Writes events into a zstd compressed CSV, with the non-standard metadata pickled and base64 encoded."""
+
+    def __init__(self, file: IO[bytes]):
         compressor = zstandard.ZstdCompressor(level=1)
         self.o = io.TextIOWrapper(
-            compressor.stream_writer(self.file),
+            compressor.stream_writer(file),
         )
-        self.rows_written = 0
         self.writer = csv.DictWriter(
             self.o,
-            fieldnames=["patient_id", "start", "concept_id", "value", "metadata"],
+            fieldnames=["patient_id", "start", "concept_id", "value", *_STANDARD_METADATA_FIELDS, "metadata"],
         )
         self.writer.writeheader()
 
     def add_event(self, patient_id: int, event: RawEvent) -> None:
-        """Add an event to the record."""
-        self.rows_written += 1
         data: Dict[str, Any] = {}
 
         data["patient_id"] = patient_id
         data["start"] = event.start.isoformat()
         data["concept_id"] = str(event.concept_id)
         data["value"] = _encode_value(event.value)
-        data["metadata"] = base64.b64encode(
-            pickle.dumps({a: b for a, b in event.__dict__.items() if a not in ("start", "concept_id", "value")})
-        ).decode("utf8")
+
+        standard, metadata = _split_metadata(event)
+        for a, b in standard.items():
+            data[a] = _encode_standard_metadata(a, b)
+
+        data["metadata"] = base64.b64encode(pickle.dumps(metadata)).decode("utf8") if metadata else ""
 
         self.writer.writerow(data)
 
     def close(self) -> None:
-        """Close the event writer."""
-        if self.rows_written == 0:
-            warnings.warn(f"Zero rows were written by the `EventWriter` for file: {self.file.name}")
         self.o.close()
 
 
-class EventReader:
-    """Read events from an event file."""
+class _CSVEventReader:
+    """Reads events from a zstd compressed CSV."""
 
     def __init__(self, filename: str):
-        """Open the event file."""
-        self.filename = filename
         decompressor = zstandard.ZstdDecompressor()
-        self.o = io.TextIOWrapper(decompressor.stream_reader(open(self.filename, "rb")))
+        self.o = io.TextIOWrapper(decompressor.stream_reader(open(filename, "rb")))
         self.reader = csv.DictReader(self.o)
 
     def __iter__(self) -> Iterator[Tuple[int, RawEvent]]:
-        """Iterate over each event."""
         for row in self.reader:
             id = int(row["patient_id"])
 
             concept_id = int(row["concept_id"])
             start = datetime.datetime.fromisoformat(row["start"])
             value = _decode_value(row["value"])
-            metadata = pickle.loads(base64.b64decode(row["metadata"]))
+            metadata = pickle.loads(base64.b64decode(row["metadata"])) if row["metadata"] else {}
+            for name in _STANDARD_METADATA_FIELDS:
+                if row.get(name):
+                    metadata[name] = _decode_standard_metadata(name, row[name])
 
             yield (id, RawEvent(start=start, concept_id=concept_id, value=value, **metadata))
 
     def close(self) -> None:
-        """Close the event file."""
         self.o.close()
 
 
+class EventWriter:
+    """Writes events into a file.
+
+    Files use the binary row group format by default. The older CSV format, which pickles all
+    non-standard metadata, can be chosen with `file_format="csv"`.
+    """
+
+    def __init__(self, path: str, file_format: str = "rowgroups"):
+        """Open a file for writing."""
+        if file_format == "rowgroups":
+            self.file = tempfile.NamedTemporaryFile(dir=path, suffix=ROW_GROUP_EXTENSION, delete=False)
+            self.writer: _RowGroupEventWriter | _CSVEventWriter = _RowGroupEventWriter(self.file)
+        elif file_format == "csv":
+            self.file = tempfile.NamedTemporaryFile(dir=path, suffix=".csv.zst", delete=False)
+            self.writer = _CSVEventWriter(self.file)
+        else:
+            raise ValueError(f"Unknown file format {file_format}, expected one of {FILE_FORMATS}")
+        self.rows_written = 0
+
+    def add_event(self, patient_id: int, event: RawEvent) -> None:
+        """Add an event to the record."""
+        self.rows_written += 1
+        self.writer.add_event(patient_id, event)
+
+    def close(self) -> None:
+        """Close the event writer."""
+        if self.rows_written == 0:
+            warnings.warn(f"Zero rows were written by the `EventWriter` for file: {self.file.name}")
+        self.writer.close()
+
+
+class EventReader:
+    """Read events from an event file, in either the row group or the CSV format."""
+
+    def __init__(self, filename: str):
+        """Open the event file."""
+        self.filename = filename
+        self.reader: _RowGroupEventReader | _CSVEventReader
+        if _is_row_group_file(filename):
+            self.reader = _RowGroupEventReader(filename)
+        else:
+            self.reader = _CSVEventReader(filename)
+
+    def __iter__(self) -> Iterator[Tuple[int, RawEvent]]:
+        """Iterate over each event."""
+        return iter(self.reader)
+
+    def close(self) -> None:
+        """Close the event file."""
+        self.reader.close()
+
+
 class PatientReader:
     """Read patients from a patient file."""
 
@@ -136,9 +441,9 @@ class PatientWriter:
     Note: this must be used in a context manager in order to close the file properly.
     """
 
-    def __init__(self, path: str):
+    def __init__(self, path: str, file_format: str = "rowgroups"):
         """Open a file for writing."""
-        self.writer = EventWriter(path)
+        self.writer = EventWriter(path, file_format)
 
     def add_patient(self, patient: RawPatient) -> None:
         """Add a patient to the record."""
@@ -0,0 +1,153 @@
+"""Instrumentation for finding where the time goes in the ETL stages."""
+from __future__ import annotations
+
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+# Stats that are summed when combining the timings of several tasks. Peak RSS is the maximum instead.
+_SUMMED_STATS = ("wall_seconds", "cpu_seconds", "bytes_read", "bytes_written", "rows")
+
+
+def _read_io_counters() -> Dict[str, int]:
+    """Get the bytes read and written by this process so far, which is only available on Linux."""
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return {"bytes_read": int(fields["rchar"]), "bytes_written": int(fields["wchar"])}
+    except (OSError, KeyError, ValueError):
+        return {}
+
+
+def _get_rusage(include_children: bool) -> Dict[str, float]:
+    usages = [resource.getrusage(resource.RUSAGE_SELF)]
+    if include_children:
+        usages.append(resource.getrusage(resource.RUSAGE_CHILDREN))
+
+    # ru_maxrss is in kilobytes, except on macOS where it is in bytes
+    rss_scale = 1 if sys.platform == "darwin" else 1024
+    return {
+        "cpu_seconds": sum(usage.ru_utime + usage.ru_stime for usage in usages),
+        "peak_rss_bytes": max(usage.ru_maxrss for usage in usages) * rss_scale,
+    }
+
+
+class ResourceTimer:
+    """Measure the wall time, CPU time, peak RSS and bytes read and written of a block of work.
+
+    Native code running on other threads of this process is included. With `include_children`, the CPU
+    time and peak RSS of finished child processes, such as the workers of a closed multiprocessing.Pool,
+    are included as well. Peak RSS is the peak over the lifetime of the process, not just the block.
+    """
+
+    def __init__(self, include_children: bool = False):
+        self.include_children = include_children
+        self.stats: Dict[str, Any] = {}
+
+    def __enter__(self) -> ResourceTimer:
+        self._start_wall = time.perf_counter()
+        self._start_usage = _get_rusage(self.include_children)
+        self._start_io = _read_io_counters()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        end_usage = _get_rusage(self.include_children)
+        end_io = _read_io_counters()
+
+        self.stats["wall_seconds"] = time.perf_counter() - self._start_wall
+        self.stats["cpu_seconds"] = end_usage["cpu_seconds"] - self._start_usage["cpu_seconds"]
+        self.stats["peak_rss_bytes"] = end_usage["peak_rss_bytes"]
+        for name, value in end_io.items():
+            self.stats[name] = value - self._start_io.get(name, 0)
+
+    def set_rows(self, rows: int) -> None:
+        """Record the number of rows processed, along with the rate."""
+        self.stats["rows"] = rows
+        self.stats["rows_per_second"] = rows / self.stats["wall_seconds"] if self.stats["wall_seconds"] > 0 else None
+
+
+@contextlib.contextmanager
+def profile_to(path: Optional[str]) -> Iterator[None]:
+    """Run a block under cProfile, writing pstats output to `path`. Does nothing if `path` is None.
+
+    The output can be loaded with pstats, snakeviz or converted for flamegraph tools such as py-spy's viewers.
+    """
+    if path is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        profiler.dump_stats(path)
+
+
+def combine_timings(timings: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """Combine the timings of several tasks, summing everything except peak RSS."""
+    result: Dict[str, Any] = collections.defaultdict(int)
+    for timing in timings:
+        result["tasks"] += 1
+        for name in _SUMMED_STATS:
+            if name in timing:
+                result[name] += timing[name]
+        if "peak_rss_bytes" in timing:
+            result["peak_rss_bytes"] = max(result["peak_rss_bytes"], timing["peak_rss_bytes"])
+
+    if "rows" in result:
+        result["rows_per_second"] = result["rows"] / result["wall_seconds"] if result["wall_seconds"] > 0 else None
+    return dict(result)
+
+
+def summarize_stage(
+    stage: Dict[str, Any], task_timings: List[Dict[str, Any]], group_by: Optional[str] = None
+) -> Dict[str, Any]:
+    """Summarize a stage run on a pool, given the timing of the stage as a whole and of every worker task.
+
+    The result has the stage totals along with the totals per worker process and, optionally, per `group_by`
+    key of the tasks, such as the extractor.
+    """
+    result = dict(stage)
+
+    # The I/O of the workers is not included in the stage timing, as it only covers this process
+    for name in ("bytes_read", "bytes_written"):
+        if name in result:
+            result[name] += sum(timing.get(name, 0) for timing in task_timings)
+
+    rows = sum(timing.get("rows", 0) for timing in task_timings)
+    result["rows"] = rows
+    result["rows_per_second"] = rows / result["wall_seconds"] if result["wall_seconds"] > 0 else None
+
+    by_worker: Dict[str, List[Dict[str, Any]]] = collections.defaultdict(list)
+    for timing in task_timings:
+        by_worker[str(timing["pid"])].append(timing)
+    result["workers"] = {pid: combine_timings(timings) for pid, timings in by_worker.items()}
+
+    if group_by is not None:
+        by_group: Dict[str, List[Dict[str, Any]]] = collections.defaultdict(list)
+        for timing in task_timings:
+            by_group[str(timing[group_by])].append(timing)
+        result[group_by] = {key: combine_timings(timings) for key, timings in by_group.items()}
+
+    result["tasks"] = task_timings
+    return result
+
+
+def write_timing_stats(path: str, timing_stats: Dict[str, Any]) -> None:
+    """Write timing stats to a JSON file, keeping the stages of earlier runs that were skipped this time."""
+    existing: Dict[str, Any] = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            existing = json.load(f)
+    existing.update(timing_stats)
+    with open(path, "w") as f:
+        json.dump(existing, f, indent=2)
@@ -0,0 +1,468 @@
+"""Composite views over multiple PatientDatabase extracts."""
+from __future__ import annotations
+
+import multiprocessing
+import os
+import tempfile
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from femr import Patient
+from femr.extension import datasets as extension_datasets
+
+
+class ShardedOntology:
+    """A merged view of the ontologies of several PatientDatabase shards.
+
+    Shards have their own code indices, so this provides a merged code dictionary along with a remap
+    from each shard's code indices to the merged ones.
+    """
+
+    def __init__(self, ontologies: Sequence[extension_datasets.Ontology]):
+        self.ontologies = list(ontologies)
+        self._codes: Optional[List[str]] = None
+        self._code_to_index: Optional[Dict[str, int]] = None
+        self._remaps: Dict[int, np.ndarray] = {}
+
+    def get_codes(self) -> Sequence[str]:
+        """Get the merged code dictionary, which is the sorted union of the codes of every shard."""
+        if self._codes is None:
+            codes: Set[str] = set()
+            for ontology in self.ontologies:
+                codes.update(ontology.get_codes())
+            self._codes = sorted(codes)
+            self._code_to_index = {code: i for i, code in enumerate(self._codes)}
+        return self._codes
+
+    def get_code_index(self, code: str) -> int:
+        """Get the index of a code in the merged code dictionary."""
+        self.get_codes()
+        assert self._code_to_index is not None
+        if code not in self._code_to_index:
+            raise IndexError(code)
+        return self._code_to_index[code]
+
+    def get_code_remap(self, shard_index: int) -> np.ndarray:
+        """Get an array mapping the code indices of a shard to merged code indices."""
+        if shard_index not in self._remaps:
+            self.get_codes()
+            assert self._code_to_index is not None
+            self._remaps[shard_index] = np.array(
+                [self._code_to_index[code] for code in self.ontologies[shard_index].get_codes()], dtype=np.uint32
+            )
+        return self._remaps[shard_index]
+
+    def _first_ontology_with(self, code: str) -> extension_datasets.Ontology:
+        for ontology in self.ontologies:
+            try:
+                ontology.get_code_index(code)
+                return ontology
+            except IndexError:
+                pass
+        raise IndexError(code)
+
+    def get_parents(self, code: str) -> Sequence[str]:
+        return self._first_ontology_with(code).get_parents(code)
+
+    def get_all_parents(self, code: str) -> Sequence[str]:
+        return self._first_ontology_with(code).get_all_parents(code)
+
+    def get_children(self, code: str) -> Sequence[str]:
+        """Get the children of a code in any shard, as shards only contain the codes they use."""
+        children: Dict[str, None] = {}
+        found = False
+        for ontology in self.ontologies:
+            try:
+                children.update((child, None) for child in ontology.get_children(code))
+                found = True
+            except IndexError:
+                pass
+        if not found:
+            raise IndexError(code)
+        return tuple(children)
+
+    def get_text_description(self, code: str) -> str:
+        return self._first_ontology_with(code).get_text_description(code)
+
+    def get_concept_id_from_code(self, code: str) -> int:
+        return self._first_ontology_with(code).get_concept_id_from_code(code)
+
+    def get_code_from_concept_id(self, concept_id: int) -> str:
+        for ontology in self.ontologies:
+            try:
+                return ontology.get_code_from_concept_id(concept_id)
+            except IndexError:
+                pass
+        raise IndexError(concept_id)
+
+
+class ShardedPatientDatabase(Mapping[int, Patient]):
+    """Presents several PatientDatabase extracts, each holding a disjoint set of patients, as one database."""
+
+    def __init__(self, paths: Sequence[str], read_all: bool = False, access: str = "normal"):
+        """Open every shard. Patient ids must be unique across shards."""
+        if len(paths) == 0:
+            raise ValueError("A ShardedPatientDatabase needs at least one shard")
+
+        self.paths: List[str] = list(paths)
+        self.shards: List[extension_datasets.PatientDatabase] = [
+            extension_datasets.PatientDatabase(path, read_all, access=access) for path in self.paths
+        ]
+
+        shard_patient_ids = [np.fromiter(shard, dtype=np.int64, count=len(shard)) for shard in self.shards]
+        patient_ids = np.concatenate(shard_patient_ids)
+        shard_indices = np.concatenate(
+            [np.full(len(ids), i, dtype=np.int32) for i, ids in enumerate(shard_patient_ids)]
+        )
+
+        order = np.argsort(patient_ids, kind="stable")
+        self._patient_ids: np.ndarray = patient_ids[order]
+        self._shard_indices: np.ndarray = shard_indices[order]
+
+        duplicates = self._patient_ids[1:][self._patient_ids[1:] == self._patient_ids[:-1]]
+        if len(duplicates) > 0:
+            raise ValueError(f"Patient ids are duplicated across shards, such as {duplicates[0]}")
+
+        self._ontology: Optional[ShardedOntology] = None
+
+    def get_shard_index(self, patient_id: int) -> int:
+        """Get the index of the shard that contains a patient."""
+        index = np.searchsorted(self._patient_ids, patient_id)
+        if index == len(self._patient_ids) or self._patient_ids[index] != patient_id:
+            raise IndexError(patient_id)
+        return int(self._shard_indices[index])
+
+    def get_shard_indices(self, patient_ids: Sequence[int] | np.ndarray) -> np.ndarray:
+        """Get the index of the shard of each patient."""
+        ids = np.asarray(patient_ids, dtype=np.int64)
+        indices = np.searchsorted(self._patient_ids, ids)
+        indices[indices == len(self._patient_ids)] = 0
+        if len(ids) > 0 and (len(self._patient_ids) == 0 or np.any(self._patient_ids[indices] != ids)):
+            raise IndexError("Could not find all patients")
+        return self._shard_indices[indices]
+
+    def __getitem__(self, patient_id: int) -> Patient:
+        return self.shards[self.get_shard_index(patient_id)][patient_id]
+
+    def __contains__(self, patient_id: object) -> bool:
+        try:
+            self.get_shard_index(patient_id)  # type: ignore
+            return True
+        except (IndexError, TypeError):
+            return False
+
+    def __len__(self) -> int:
+        return len(self._patient_ids)
+
+    def __iter__(self) -> Iterator[int]:
+        """Iterate over the patients shard by shard."""
+        for shard in self.shards:
+            yield from shard
+
+    def get_patient_birth_date(self, patient_id: int) -> Any:
+        return self.shards[self.get_shard_index(patient_id)].get_patient_birth_date(patient_id)
+
+    def get_ontology(self) -> ShardedOntology:
+        if self._ontology is None:
+            self._ontology = ShardedOntology([shard.get_ontology() for shard in self.shards])
+        return self._ontology
+
+    def split_patient_ids(self, patient_ids: Sequence[int], num_tasks: int) -> List[Tuple[str, np.ndarray]]:
+        """Split patients into about `num_tasks` tasks that each only touch a single shard.
+
+        Returns a list of (shard path, patient ids) pairs.
+        """
+        ids = np.asarray(patient_ids, dtype=np.int64)
+        shard_indices = self.get_shard_indices(ids)
+
+        tasks: List[Tuple[str, np.ndarray]] = []
+        for i, path in enumerate(self.paths):
+            shard_patient_ids = ids[shard_indices == i]
+            if len(shard_patient_ids) == 0:
+                continue
+            num_shard_tasks = max(1, round(num_tasks * len(shard_patient_ids) / len(ids)))
+            tasks.extend((path, part) for part in np.array_split(shard_patient_ids, num_shard_tasks))
+        return tasks
+
+    def close(self) -> None:
+        self._ontology = None
+        for shard in self.shards:
+            shard.close()
+
+    def __enter__(self) -> ShardedPatientDatabase:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+OVERLAY_DIRECTORY = "overlays"
+DELETED_PATIENTS_FILE = "deleted_patient_ids.npy"
+
+
+def get_overlay_paths(path: str) -> List[str]:
+    """Get the paths of the overlays of a PatientDatabase, from oldest to newest."""
+    overlay_root = os.path.join(path, OVERLAY_DIRECTORY)
+    if not os.path.exists(overlay_root):
+        return []
+    return [os.path.join(overlay_root, child) for child in sorted(os.listdir(overlay_root), key=int)]
+
+
+class OverlayPatientDatabase(Mapping[int, Patient]):
+    """A base PatientDatabase together with overlays holding new, modified or deleted patients.
+
+    Reads resolve overlay-first, with newer overlays taking precedence. Note that `event.code_index` refers
+    to the ontology of the layer the patient was read from.
+
+    Overlays are only resolved by this class. Native consumers that open the path directly, such as
+    `PatientDatabase`, `BatchLoader`, `create_batches` and `create_dictionary`, only see the base patients,
+    although the database id they report does change with every overlay. Run `compact_patient_database`
+    with `flatten=True` before handing the database to them.
+    """
+
+    def __init__(self, path: str, read_all: bool = False, access: str = "normal"):
+        """Open the database at `path` along with all of its overlays."""
+        self.path = path
+        self.base = extension_datasets.PatientDatabase(path, read_all, access=access)
+
+        # Every overlay can hold a database of new or modified patients and a list of deleted patients
+        generations: List[Tuple[Optional[extension_datasets.PatientDatabase], np.ndarray]] = []
+        for overlay_path in get_overlay_paths(path):
+            overlay = None
+            if os.path.exists(os.path.join(overlay_path, "meta")):
+                overlay = extension_datasets.PatientDatabase(overlay_path, read_all, access=access)
+            deleted_path = os.path.join(overlay_path, DELETED_PATIENTS_FILE)
+            deleted = np.load(deleted_path) if os.path.exists(deleted_path) else np.zeros(0, dtype=np.int64)
+            generations.append((overlay, deleted))
+        self.overlays = [overlay for overlay, _ in generations if overlay is not None]
+
+        # The layers in resolution order, newest overlay first
+        self.layers: List[extension_datasets.PatientDatabase] = list(reversed(self.overlays)) + [self.base]
+
+        # Resolve newest first, where -1 marks a deleted patient.
+        # Patients an overlay adds take precedence over the ones it deletes.
+        patient_id_parts: List[np.ndarray] = []
+        layer_index_parts: List[np.ndarray] = []
+        layer_index = 0
+        for overlay, deleted in reversed(generations):
+            if overlay is not None:
+                patient_id_parts.append(np.fromiter(overlay, dtype=np.int64, count=len(overlay)))
+                layer_index_parts.append(np.full(len(overlay), layer_index, dtype=np.int32))
+                layer_index += 1
+            patient_id_parts.append(deleted.astype(np.int64))
+            layer_index_parts.append(np.full(len(deleted), -1, dtype=np.int32))
+        patient_id_parts.append(np.fromiter(self.base, dtype=np.int64, count=len(self.base)))
+        layer_index_parts.append(np.full(len(self.base), layer_index, dtype=np.int32))
+
+        patient_ids, first_index = np.unique(np.concatenate(patient_id_parts), return_index=True)
+        layer_indices = np.concatenate(layer_index_parts)[first_index]
+        self._patient_ids: np.ndarray = patient_ids[layer_indices != -1]
+        self._layer_indices: np.ndarray = layer_indices[layer_indices != -1]
+
+        self._ontology: Optional[ShardedOntology] = None
+
+    def get_layer_index(self, patient_id: int) -> int:
+        """Get the index into `self.layers` of the layer a patient is read from."""
+        index = np.searchsorted(self._patient_ids, patient_id)
+        if index == len(self._patient_ids) or self._patient_ids[index] != patient_id:
+            raise IndexError(patient_id)
+        return int(self._layer_indices[index])
+
+    def get_overlaid_patient_ids(self) -> np.ndarray:
+        """Get the ids of the patients that are read from an overlay rather than the base."""
+        return self._patient_ids[self._layer_indices != len(self.layers) - 1]
+
+    def __getitem__(self, patient_id: int) -> Patient:
+        return self.layers[self.get_layer_index(patient_id)][patient_id]
+
+    def __contains__(self, patient_id: object) -> bool:
+        try:
+            self.get_layer_index(patient_id)  # type: ignore
+            return True
+        except (IndexError, TypeError):
+            return False
+
+    def __len__(self) -> int:
+        return len(self._patient_ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._patient_ids.tolist())
+
+    def get_patient_birth_date(self, patient_id: int) -> Any:
+        return self.layers[self.get_layer_index(patient_id)].get_patient_birth_date(patient_id)
+
+    def get_ontology(self) -> ShardedOntology:
+        if self._ontology is None:
+            self._ontology = ShardedOntology([layer.get_ontology() for layer in self.layers])
+        return self._ontology
+
+    def version_id(self) -> int:
+        return self.base.version_id()
+
+    def database_id(self) -> int:
+        """The id of the base database, which changes whenever an overlay is added."""
+        return self.base.database_id()
+
+    def close(self) -> None:
+        self._ontology = None
+        for layer in self.layers:
+            layer.close()
+
+    def __enter__(self) -> OverlayPatientDatabase:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+def _create_overlay(database_path: str) -> str:
+    """Create the directory of the next overlay of a database."""
+    overlay_paths = get_overlay_paths(database_path)
+    next_overlay = int(os.path.basename(overlay_paths[-1])) + 1 if overlay_paths else 0
+    target_path = os.path.join(database_path, OVERLAY_DIRECTORY, str(next_overlay))
+    os.makedirs(target_path)
+    return target_path
+
+
+def add_patient_overlay(
+    database_path: str,
+    patient_collection: Any,
+    concept_path: str,
+    num_threads: int = 1,
+    delimiter: str = ",",
+) -> OverlayPatientDatabase:
+    """Add a PatientCollection of new or modified patients as an overlay on top of an existing database.
+
+    The overlay takes precedence over the base database and any earlier overlays.
+    """
+    target_path = _create_overlay(database_path)
+    patient_collection.to_patient_database(target_path, concept_path, num_threads, delimiter).close()
+    return OverlayPatientDatabase(database_path)
+
+
+def delete_patients(database_path: str, patient_ids: Sequence[int]) -> OverlayPatientDatabase:
+    """Delete patients by adding an overlay that hides them from the base database and any earlier overlays.
+
+    Deleted patients can be added back by a later overlay.
+    """
+    target_path = _create_overlay(database_path)
+    np.save(os.path.join(target_path, DELETED_PATIENTS_FILE), np.asarray(patient_ids, dtype=np.int64))
+    return OverlayPatientDatabase(database_path)
+
+
+def _export_patients(args: Tuple[str, str, np.ndarray]) -> None:
+    """Write the given patients of an overlay database into an EventCollection."""
+    from femr.datasets import EventCollection, RawEvent
+
+    database_path, events_path, patient_ids = args
+    events = EventCollection(events_path)
+    with OverlayPatientDatabase(database_path) as database:
+        ontologies = [layer.get_ontology() for layer in database.layers]
+        writer = events.create_writer()
+        try:
+            for patient_id in patient_ids:
+                ontology = ontologies[database.get_layer_index(patient_id)]
+                for event in database[patient_id].events:
+                    writer.add_event(
+                        patient_id,
+                        RawEvent(
+                            start=event.start,
+                            concept_id=ontology.get_concept_id_from_code(event.code),
+                            value=event.value,
+                            **event.metadata,
+                        ),
+                    )
+        finally:
+            writer.close()
+
+
+def _rebuild_patients(
+    database_path: str,
+    patient_ids: np.ndarray,
+    target_path: str,
+    concept_path: str,
+    num_threads: int,
+    delimiter: str,
+) -> extension_datasets.PatientDatabase:
+    """Write the given patients of an overlay database to a new PatientDatabase, re-encoding every event."""
+    from femr.datasets import EventCollection
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        events_path = os.path.join(temp_dir, "events")
+        tasks = [
+            (database_path, events_path, part)
+            for part in np.array_split(patient_ids, num_threads * 10)
+            if len(part) > 0
+        ]
+        EventCollection(events_path)
+        with multiprocessing.Pool(num_threads) as pool:
+            for _ in pool.imap_unordered(_export_patients, tasks):
+                pass
+
+        patients = EventCollection(events_path).to_patient_collection(os.path.join(temp_dir, "patients"), num_threads)
+        return patients.to_patient_database(target_path, concept_path, num_threads, delimiter)
+
+
+def compact_patient_database(
+    database_path: str,
+    target_path: str,
+    concept_path: str,
+    num_threads: int = 1,
+    delimiter: str = ",",
+    flatten: bool = False,
+) -> extension_datasets.PatientDatabase | OverlayPatientDatabase:
+    """Compact the overlays of a database, writing the result to `target_path`.
+
+    Patients that only exist in the base are copied as is with `PatientDatabase.subset`, deleted and
+    shadowed patients are dropped, and the patients that are read from an overlay are rebuilt into a single
+    overlay. Overlays have their own dictionaries, so their patients cannot be copied into the base.
+
+    With `flatten=True` the overlaid patients are merged into the base instead, which rebuilds every patient
+    but produces a plain PatientDatabase that native consumers can read.
+    """
+    with OverlayPatientDatabase(database_path) as database:
+        all_patient_ids = database._patient_ids
+        overlaid_patient_ids = database.get_overlaid_patient_ids()
+        if len(overlaid_patient_ids) == 0 or not flatten:
+            unchanged_patient_ids = np.setdiff1d(all_patient_ids, overlaid_patient_ids, assume_unique=True)
+            database.base.subset(unchanged_patient_ids.tolist(), target_path).close()
+
+    if len(overlaid_patient_ids) == 0:
+        return extension_datasets.PatientDatabase(target_path)
+    elif flatten:
+        return _rebuild_patients(database_path, all_patient_ids, target_path, concept_path, num_threads, delimiter)
+    else:
+        overlay_path = _create_overlay(target_path)
+        _rebuild_patients(
+            database_path, overlaid_patient_ids, overlay_path, concept_path, num_threads, delimiter
+        ).close()
+        return OverlayPatientDatabase(target_path)
+
+
+def open_patient_database(path: str | Sequence[str], read_all: bool = False, access: str = "normal") -> Any:
+    """Open a PatientDatabase, resolving overlays if it has any.
+
+    A list of shard paths opens a ShardedPatientDatabase instead. `access` is a hint for how patients
+    will be read, one of "normal", "sequential" (in database order) or "random".
+    """
+    if isinstance(path, str):
+        if get_overlay_paths(path):
+            return OverlayPatientDatabase(path, read_all, access)
+        return extension_datasets.PatientDatabase(path, read_all, access=access)
+    else:
+        return ShardedPatientDatabase(path, read_all, access)
+
+
+def split_patient_ids(
+    path: str | Sequence[str], patient_ids: Sequence[int], num_tasks: int
+) -> List[Tuple[str, np.ndarray]]:
+    """Split patients into about `num_tasks` (database path, patient ids) tasks.
+
+    For sharded databases every task only touches a single shard, so each worker only opens its local shard.
+    """
+    if isinstance(path, str):
+        return [(path, part) for part in np.array_split(np.asarray(patient_ids, dtype=np.int64), num_tasks)]
+    else:
+        with ShardedPatientDatabase(path) as database:
+            return database.split_patient_ids(patient_ids, num_tasks)
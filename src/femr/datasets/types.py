@@ -1,8 +1,9 @@
 from __future__ import annotations
 
 import datetime
+import operator
 from dataclasses import dataclass
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List
 
 
 @dataclass
@@ -14,7 +15,7 @@ class RawPatient:
 
     def resort(self) -> None:
         """Resort the events to maintain the day invariant"""
-        self.events.sort()
+        self.events.sort(key=_get_event_sort_key)
 
 
 class RawEvent:
@@ -60,16 +61,14 @@ class RawEvent:
         return None
 
     def __setattr__(self, name: str, value: Any) -> None:
+        # Missing attributes are None, so setting an attribute to None removes it
         if value is not None:
             self.__dict__[name] = value
+        else:
+            self.__dict__.pop(name, None)
 
     def __lt__(self, other: RawEvent) -> bool:
-        def sort_key(
-            a: RawEvent,
-        ) -> Tuple[datetime.datetime, int]:
-            return (a.start, a.concept_id)
-
-        return sort_key(self) < sort_key(other)
+        return (self.start, self.concept_id) < (other.start, other.concept_id)
 
     def __eq__(self, other: object) -> bool:
         if other is None:
@@ -98,3 +97,7 @@ class RawEvent:
         """Make this object pickleable (read)"""
         for a, b in d.items():
             self.__dict__[a] = b
+
+
+# Sorting with a key computes it once per event, which is much cheaper than comparing events with __lt__
+_get_event_sort_key = operator.attrgetter("start", "concept_id")
@@ -6,20 +6,22 @@ import json
 import logging
 import os
 import resource
-from typing import Callable, Dict, Optional, Sequence
+import shutil
+from typing import Any, Callable, Dict, Optional, Sequence
 
-from femr.datasets import EventCollection, PatientCollection, RawPatient
-from femr.extractors.csv import run_csv_extractors
+from femr.datasets import RawPatient
+from femr.datasets.profiling import write_timing_stats
+from femr.extractors.csv import run_csv_extractors, run_csv_extractors_to_patients
 from femr.extractors.omop import get_omop_csv_extractors
-from femr.transforms import delta_encode, remove_nones
+from femr.transforms import DeltaEncode, RemoveNones
 
 
 def _get_generic_omop_transformations() -> Sequence[Callable[[RawPatient], Optional[RawPatient]]]:
     """Get the list of current OMOP transformations."""
     # All of these transformations are information preserving
     transforms: Sequence[Callable[[RawPatient], Optional[RawPatient]]] = [
-        remove_nones,
-        delta_encode,
+        RemoveNones(),
+        DeltaEncode(),
     ]
 
     return transforms
@@ -55,6 +57,21 @@ def etl_generic_omop_program() -> None:
         default=1,
     )
 
+    parser.add_argument(
+        "--profile",
+        default=False,
+        action="store_true",
+        help="Write cProfile dumps of every worker task to a profiles folder in the target location",
+    )
+
+    parser.add_argument(
+        "--streaming",
+        default=False,
+        action="store_true",
+        help="Stream the extracted events into transformed patients without storing the events and the raw patients. "
+        "This uses less temporary space, but cannot resume an interrupted run",
+    )
+
     args = parser.parse_args()
 
     soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
@@ -87,9 +104,40 @@ def etl_generic_omop_program() -> None:
         raw_patients_dir = os.path.join(args.temp_location, "patients_raw")
         cleaned_patients_dir = os.path.join(args.temp_location, "patients_cleaned")
 
-        if not os.path.exists(event_dir):
+        timing_path = os.path.join(args.target_location, "timing_stats.json")
+        profile_dir = os.path.join(args.target_location, "profiles") if args.profile else None
+
+        stats_dict: Dict[str, Dict[str, int]] = {}
+        timing_dict: Dict[str, Any] = {}
+
+        if args.streaming:
+            # Streaming cannot resume, so the patients are only converted again if the extract is missing
+            if not os.path.exists(os.path.join(args.target_location, "meta")):
+                rootLogger.info("Converting to patients and applying transformations")
+                if os.path.exists(cleaned_patients_dir):
+                    shutil.rmtree(cleaned_patients_dir)
+                transform_stats_dict: Dict[str, Dict[str, int]] = {}
+                patient_collection = run_csv_extractors_to_patients(
+                    args.omop_source,
+                    cleaned_patients_dir,
+                    get_omop_csv_extractors(),
+                    _get_generic_omop_transformations(),
+                    num_threads=args.num_threads,
+                    debug_folder=os.path.join(args.temp_location, "lost_csv_rows"),
+                    stats_dict=stats_dict,
+                    transform_stats_dict=transform_stats_dict,
+                    timing_dict=timing_dict,
+                    profile_dir=profile_dir,
+                )
+                rootLogger.info("Got converter statistics " + str(stats_dict))
+                with open(os.path.join(args.target_location, "convert_stats.json"), "w") as f:
+                    json.dump(stats_dict, f)
+                rootLogger.info("Got transform statistics " + str(transform_stats_dict))
+                with open(os.path.join(args.target_location, "transform_stats.json"), "w") as f:
+                    json.dump(transform_stats_dict, f)
+                write_timing_stats(timing_path, {"run_csv_extractors_to_patients": timing_dict})
+        else:
             rootLogger.info("Converting to events")
-            stats_dict: Dict[str, Dict[str, int]] = {}
             event_collection = run_csv_extractors(
                 args.omop_source,
                 event_dir,
@@ -97,49 +145,54 @@ def etl_generic_omop_program() -> None:
                 num_threads=args.num_threads,
                 debug_folder=os.path.join(args.temp_location, "lost_csv_rows"),
                 stats_dict=stats_dict,
+                timing_dict=timing_dict,
+                profile_dir=profile_dir,
+                checkpoint=True,
             )
             rootLogger.info("Got converter statistics " + str(stats_dict))
             with open(os.path.join(args.target_location, "convert_stats.json"), "w") as f:
                 json.dump(stats_dict, f)
-        else:
-            rootLogger.info("Already converted to events, skipping")
-            event_collection = EventCollection(event_dir)
+            write_timing_stats(timing_path, {"run_csv_extractors": timing_dict})
 
-        if not os.path.exists(raw_patients_dir):
             rootLogger.info("Converting to patients")
+            timing_dict = {}
             patient_collection = event_collection.to_patient_collection(
                 raw_patients_dir,
                 num_threads=args.num_threads,
+                timing_dict=timing_dict,
+                checkpoint=True,
             )
-        else:
-            rootLogger.info("Already converted to patients, skipping")
-            patient_collection = PatientCollection(raw_patients_dir)
+            write_timing_stats(timing_path, {"to_patient_collection": timing_dict})
 
-        if not os.path.exists(cleaned_patients_dir):
             stats_dict = {}
+            timing_dict = {}
             rootLogger.info("Appling transformations")
             patient_collection = patient_collection.transform(
                 cleaned_patients_dir,
                 _get_generic_omop_transformations(),
                 num_threads=args.num_threads,
                 stats_dict=stats_dict,
+                timing_dict=timing_dict,
+                profile_dir=profile_dir,
+                checkpoint=True,
             )
             rootLogger.info("Got transform statistics " + str(stats_dict))
             with open(os.path.join(args.target_location, "transform_stats.json"), "w") as f:
                 json.dump(stats_dict, f)
-        else:
-            rootLogger.info("Already applied transformations, skipping")
-            patient_collection = PatientCollection(cleaned_patients_dir)
+            write_timing_stats(timing_path, {"transform": timing_dict})
 
         if not os.path.exists(os.path.join(args.target_location, "meta")):
             rootLogger.info("Converting to extract")
 
             print("Converting to extract", datetime.datetime.now())
+            timing_dict = {}
             patient_collection.to_patient_database(
                 args.target_location,
                 args.omop_source,
                 num_threads=args.num_threads,
+                timing_dict=timing_dict,
             ).close()
+            write_timing_stats(timing_path, {"to_patient_database": timing_dict})
         else:
             rootLogger.info("Already converted to extract, skipping")
 
@@ -10,23 +10,19 @@ match the assumptions for timestamps. Exceptions ares:
 
 import argparse
 import datetime
-import functools
 import json
 import logging
 import os
 import resource
-from typing import Callable, Dict, Optional, Sequence
+from typing import Any, Callable, Dict, Optional, Sequence
 
-from femr.datasets import EventCollection, PatientCollection, RawEvent, RawPatient
+from femr.datasets import RawPatient
+from femr.datasets.profiling import write_timing_stats
 from femr.extractors.csv import run_csv_extractors
 from femr.extractors.omop import get_omop_csv_extractors
-from femr.transforms import delta_encode, remove_nones
-from femr.transforms.sickkids import replace_categorical_measurement_results, replace_default_birthdate
-from femr.transforms.stanford import move_pre_birth, move_to_day_end, move_visit_start_to_first_event_start
-
-
-def _is_visit_event(e: RawEvent) -> bool:
-    return e.omop_table == "visit_occurrence"
+from femr.transforms import DeltaEncode, RemoveNones
+from femr.transforms.sickkids import ReplaceCategoricalMeasurementResults, ReplaceDefaultBirthdate
+from femr.transforms.stanford import MovePreBirth, MoveToDayEnd, MoveVisitStartToFirstEventStart
 
 
 def _get_sk_transformations() -> Sequence[Callable[[RawPatient], Optional[RawPatient]]]:
@@ -34,21 +30,15 @@ def _get_sk_transformations() -> Sequence[Callable[[RawPatient], Optional[RawPat
     # All of these transformations are information preserving except
     # replace_categorical_measurement_results
     transforms: Sequence[Callable[[RawPatient], Optional[RawPatient]]] = [
-        replace_default_birthdate,
-        move_pre_birth,
-        move_visit_start_to_first_event_start,
-        move_to_day_end,
-        replace_categorical_measurement_results,
-        functools.partial(
-            remove_nones,  # We have to keep visits in order to sync up visit_ids later in the process
-            # If we ever remove or revisit visit_id, we would want to revisit this
-            do_not_apply_to_filter=_is_visit_event,
-        ),
-        functools.partial(
-            delta_encode,  # We have to keep visits in order to sync up visit_ids later in the process
-            # If we ever remove or revisit visit_id, we would want to revisit this
-            do_not_apply_to_filter=_is_visit_event,
-        ),
+        ReplaceDefaultBirthdate(),
+        MovePreBirth(),
+        MoveVisitStartToFirstEventStart(),
+        MoveToDayEnd(),
+        ReplaceCategoricalMeasurementResults(),
+        # We have to keep visits in order to sync up visit_ids later in the process
+        # If we ever remove or revisit visit_id, we would want to revisit this
+        RemoveNones(skip_omop_table="visit_occurrence"),
+        DeltaEncode(skip_omop_table="visit_occurrence"),
     ]
 
     return transforms
@@ -84,6 +74,13 @@ def etl_sk_omop_program() -> None:
         default=1,
     )
 
+    parser.add_argument(
+        "--profile",
+        default=False,
+        action="store_true",
+        help="Write cProfile dumps of every worker task to a profiles folder in the target location",
+    )
+
     args = parser.parse_args()
 
     soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
@@ -116,61 +113,69 @@ def etl_sk_omop_program() -> None:
         raw_patients_dir = os.path.join(args.temp_location, "patients_raw")
         cleaned_patients_dir = os.path.join(args.temp_location, "patients_cleaned")
 
-        if not os.path.exists(event_dir):
-            rootLogger.info("Converting to events")
-            stats_dict: Dict[str, Dict[str, int]] = {}
-            event_collection = run_csv_extractors(
-                args.omop_source,
-                event_dir,
-                get_omop_csv_extractors(),
-                num_threads=args.num_threads,
-                debug_folder=os.path.join(args.temp_location, "lost_csv_rows"),
-                stats_dict=stats_dict,
-                delimiter="\t",
-            )
-            rootLogger.info("Got converter statistics " + str(stats_dict))
-            with open(os.path.join(args.target_location, "convert_stats.json"), "w") as f:
-                json.dump(stats_dict, f)
-        else:
-            rootLogger.info("Already converted to events, skipping")
-            event_collection = EventCollection(event_dir)
-
-        if not os.path.exists(raw_patients_dir):
-            rootLogger.info("Converting to patients")
-            patient_collection = event_collection.to_patient_collection(
-                raw_patients_dir,
-                num_threads=args.num_threads,
-            )
-        else:
-            rootLogger.info("Already converted to patients, skipping")
-            patient_collection = PatientCollection(raw_patients_dir)
-
-        if not os.path.exists(cleaned_patients_dir):
-            stats_dict = {}
-            rootLogger.info("Appling transformations")
-            patient_collection = patient_collection.transform(
-                cleaned_patients_dir,
-                _get_sk_transformations(),
-                num_threads=args.num_threads,
-                stats_dict=stats_dict,
-            )
-            rootLogger.info("Got transform statistics " + str(stats_dict))
-            with open(os.path.join(args.target_location, "transform_stats.json"), "w") as f:
-                json.dump(stats_dict, f)
-        else:
-            rootLogger.info("Already applied transformations, skipping")
-            patient_collection = PatientCollection(cleaned_patients_dir)
+        timing_path = os.path.join(args.target_location, "timing_stats.json")
+        profile_dir = os.path.join(args.target_location, "profiles") if args.profile else None
+
+        rootLogger.info("Converting to events")
+        stats_dict: Dict[str, Dict[str, int]] = {}
+        timing_dict: Dict[str, Any] = {}
+        event_collection = run_csv_extractors(
+            args.omop_source,
+            event_dir,
+            get_omop_csv_extractors(),
+            num_threads=args.num_threads,
+            debug_folder=os.path.join(args.temp_location, "lost_csv_rows"),
+            stats_dict=stats_dict,
+            delimiter="\t",
+            timing_dict=timing_dict,
+            profile_dir=profile_dir,
+            checkpoint=True,
+        )
+        rootLogger.info("Got converter statistics " + str(stats_dict))
+        with open(os.path.join(args.target_location, "convert_stats.json"), "w") as f:
+            json.dump(stats_dict, f)
+        write_timing_stats(timing_path, {"run_csv_extractors": timing_dict})
+
+        rootLogger.info("Converting to patients")
+        timing_dict = {}
+        patient_collection = event_collection.to_patient_collection(
+            raw_patients_dir,
+            num_threads=args.num_threads,
+            timing_dict=timing_dict,
+            checkpoint=True,
+        )
+        write_timing_stats(timing_path, {"to_patient_collection": timing_dict})
+
+        stats_dict = {}
+        timing_dict = {}
+        rootLogger.info("Appling transformations")
+        patient_collection = patient_collection.transform(
+            cleaned_patients_dir,
+            _get_sk_transformations(),
+            num_threads=args.num_threads,
+            stats_dict=stats_dict,
+            timing_dict=timing_dict,
+            profile_dir=profile_dir,
+            checkpoint=True,
+        )
+        rootLogger.info("Got transform statistics " + str(stats_dict))
+        with open(os.path.join(args.target_location, "transform_stats.json"), "w") as f:
+            json.dump(stats_dict, f)
+        write_timing_stats(timing_path, {"transform": timing_dict})
 
         if not os.path.exists(os.path.join(args.target_location, "meta")):
             rootLogger.info("Converting to extract")
 
             print("Converting to extract", datetime.datetime.now())
+            timing_dict = {}
             patient_collection.to_patient_database(
                 args.target_location,
                 args.omop_source,
                 num_threads=args.num_threads,
                 delimiter="\t",
+                timing_dict=timing_dict,
             ).close()
+            write_timing_stats(timing_path, {"to_patient_database": timing_dict})
         else:
             rootLogger.info("Already converted to extract, skipping")
 
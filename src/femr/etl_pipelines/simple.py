@@ -9,7 +9,7 @@ import logging
 import multiprocessing
 import os
 import resource
-from typing import Dict, Iterable, List, Mapping, Set, Tuple
+from typing import Dict, Iterable, List, Mapping, Optional, Set, Tuple
 
 import zstandard
 
@@ -69,6 +69,61 @@ def convert_file_to_event_file(args: Tuple[str, Mapping[str, int], EventCollecti
             writer.add_event(int(row["patient_id"]), event)
 
 
+def create_concept_table(
+    omop_dir: str, concept_ids: Iterable[str], athena_download: Optional[str] = None
+) -> Dict[str, int]:
+    """Write an OMOP concept table covering `concept_ids` to `omop_dir`, returning the map from code to concept_id."""
+    os.mkdir(omop_dir)
+    with open(os.path.join(omop_dir, "concept.csv"), "w") as f:
+        concept_id_map: Dict[str, int] = {}
+        writer = csv.DictWriter(f, ["concept_id", "concept_name", "vocabulary_id", "standard_concept", "concept_code"])
+
+        writer.writeheader()
+        if athena_download:
+            with open(os.path.join(athena_download, "CONCEPT.csv"), "r") as f:
+                reader = csv.DictReader(f, delimiter="\t")
+                for row in reader:
+                    del row["invalid_reason"]
+                    del row["domain_id"]
+                    del row["valid_end_date"]
+                    del row["concept_class_id"]
+                    del row["valid_start_date"]
+                    writer.writerow(row)
+                    concept_id_map[f'{row["vocabulary_id"]}/{row["concept_code"]}'] = int(row["concept_id"])
+
+        for i, concept_id in enumerate(concept_ids):
+            if concept_id in concept_id_map:
+                continue
+            index = i + 11_000_000_000
+            prefix_index = concept_id.index("/")
+            vocab = concept_id[:prefix_index]
+            code = concept_id[prefix_index + 1 :]
+            writer.writerow(
+                {
+                    "concept_id": index,
+                    "concept_name": concept_id,
+                    "vocabulary_id": vocab,
+                    "standard_concept": "",
+                    "concept_code": code,
+                }
+            )
+            concept_id_map[concept_id] = index
+
+    if athena_download:
+        with open(os.path.join(athena_download, "CONCEPT_RELATIONSHIP.csv"), "r") as f:
+            with open(os.path.join(omop_dir, "concept_relationship.csv"), "w") as wf:
+                reader = csv.DictReader(f, delimiter="\t")
+                assert reader.fieldnames is not None
+                writer = csv.DictWriter(wf, fieldnames=reader.fieldnames)
+                writer.writeheader()
+                for row in reader:
+                    writer.writerow(row)
+    else:
+        os.mkdir(os.path.join(omop_dir, "concept_relationship"))
+
+    return concept_id_map
+
+
 def etl_simple_femr_program() -> None:
     """Extract data from an generic OMOP source to create a femr PatientDatabase."""
     parser = argparse.ArgumentParser(description="An extraction tool for generic OMOP sources")
@@ -153,55 +208,7 @@ def etl_simple_femr_program() -> None:
                 for f_concepts in pool.imap_unordered(get_concept_ids_from_file, input_files):
                     concept_ids |= f_concepts
 
-            os.mkdir(omop_dir)
-            with open(os.path.join(omop_dir, "concept.csv"), "w") as f:
-                concept_id_map: Dict[str, int] = {}
-                writer = csv.DictWriter(
-                    f, ["concept_id", "concept_name", "vocabulary_id", "standard_concept", "concept_code"]
-                )
-
-                writer.writeheader()
-                if args.athena_download:
-                    with open(os.path.join(args.athena_download, "CONCEPT.csv"), "r") as f:
-                        reader = csv.DictReader(f, delimiter="\t")
-                        for row in reader:
-                            del row["invalid_reason"]
-                            del row["domain_id"]
-                            del row["valid_end_date"]
-                            del row["concept_class_id"]
-                            del row["valid_start_date"]
-                            writer.writerow(row)
-                            concept_id_map[f'{row["vocabulary_id"]}/{row["concept_code"]}'] = int(row["concept_id"])
-
-                for i, concept_id in enumerate(concept_ids):
-                    if concept_id in concept_id_map:
-                        continue
-                    index = i + 11_000_000_000
-                    prefix_index = concept_id.index("/")
-                    vocab = concept_id[:prefix_index]
-                    code = concept_id[prefix_index + 1 :]
-                    writer.writerow(
-                        {
-                            "concept_id": index,
-                            "concept_name": concept_id,
-                            "vocabulary_id": vocab,
-                            "standard_concept": "",
-                            "concept_code": code,
-                        }
-                    )
-                    concept_id_map[concept_id] = index
-
-            if args.athena_download:
-                with open(os.path.join(args.athena_download, "CONCEPT_RELATIONSHIP.csv"), "r") as f:
-                    with open(os.path.join(omop_dir, "concept_relationship.csv"), "w") as wf:
-                        reader = csv.DictReader(f, delimiter="\t")
-                        assert reader.fieldnames is not None
-                        writer = csv.DictWriter(wf, fieldnames=reader.fieldnames)
-                        writer.writeheader()
-                        for row in reader:
-                            writer.writerow(row)
-            else:
-                os.mkdir(os.path.join(omop_dir, "concept_relationship"))
+            concept_id_map = create_concept_table(omop_dir, concept_ids, args.athena_download)
 
             event_collection = EventCollection(event_dir)
             with multiprocessing.Pool(args.num_threads) as pool:
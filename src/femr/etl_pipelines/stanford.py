@@ -2,37 +2,21 @@
 
 import argparse
 import datetime
-import functools
 import io
 import json
 import logging
 import os
 import resource
-from typing import Callable, Dict, Optional, Sequence
+from typing import Any, Callable, Dict, Optional, Sequence
 
 import zstandard
 
-from femr.datasets import EventCollection, PatientCollection, RawEvent, RawPatient
+from femr.datasets import RawPatient
+from femr.datasets.profiling import write_timing_stats
 from femr.extractors.csv import run_csv_extractors
 from femr.extractors.omop import get_omop_csv_extractors
-from femr.transforms import delta_encode, remove_nones
-from femr.transforms.stanford import (
-    move_billing_codes,
-    move_pre_birth,
-    move_to_day_end,
-    move_visit_start_to_first_event_start,
-)
-
-
-def _is_visit_event(e: RawEvent) -> bool:
-    return e.omop_table == "visit_occurrence"
-
-
-def _map_bad_concepts(concept_map: Dict[int, int], patient: RawPatient) -> RawPatient:
-    for event in patient.events:
-        event.concept_id = concept_map.get(event.concept_id, event.concept_id)
-
-    return patient
+from femr.transforms import DeltaEncode, MapConcepts, RemoveNones
+from femr.transforms.stanford import MoveBillingCodes, MovePreBirth, MoveToDayEnd, MoveVisitStartToFirstEventStart
 
 
 def _get_stanford_transformations(
@@ -41,21 +25,15 @@ def _get_stanford_transformations(
     """Get the list of current OMOP transformations."""
     # All of these transformations are information preserving
     transforms: Sequence[Callable[[RawPatient], Optional[RawPatient]]] = [
-        functools.partial(_map_bad_concepts, concept_map),
-        move_pre_birth,
-        move_visit_start_to_first_event_start,
-        move_to_day_end,
-        move_billing_codes,
-        functools.partial(
-            remove_nones,  # We have to keep visits in order to sync up visit_ids later in the process
-            # If we ever remove or revisit visit_id, we would want to revisit this
-            do_not_apply_to_filter=_is_visit_event,
-        ),
-        functools.partial(
-            delta_encode,  # We have to keep visits in order to sync up visit_ids later in the process
-            # If we ever remove or revisit visit_id, we would want to revisit this
-            do_not_apply_to_filter=_is_visit_event,
-        ),
+        MapConcepts(concept_map),
+        MovePreBirth(),
+        MoveVisitStartToFirstEventStart(),
+        MoveToDayEnd(),
+        MoveBillingCodes(),
+        # We have to keep visits in order to sync up visit_ids later in the process
+        # If we ever remove or revisit visit_id, we would want to revisit this
+        RemoveNones(skip_omop_table="visit_occurrence"),
+        DeltaEncode(skip_omop_table="visit_occurrence"),
     ]
 
     return transforms
@@ -91,6 +69,13 @@ def etl_starr_omop_program() -> None:
         default=1,
     )
 
+    parser.add_argument(
+        "--profile",
+        default=False,
+        action="store_true",
+        help="Write cProfile dumps of every worker task to a profiles folder in the target location",
+    )
+
     args = parser.parse_args()
 
     soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
@@ -123,69 +108,77 @@ def etl_starr_omop_program() -> None:
         raw_patients_dir = os.path.join(args.temp_location, "patients_raw")
         cleaned_patients_dir = os.path.join(args.temp_location, "patients_cleaned")
 
-        if not os.path.exists(event_dir):
-            rootLogger.info("Converting to events")
-            stats_dict: Dict[str, Dict[str, int]] = {}
-            event_collection = run_csv_extractors(
-                args.omop_source,
-                event_dir,
-                get_omop_csv_extractors(),
-                num_threads=args.num_threads,
-                debug_folder=os.path.join(args.temp_location, "lost_csv_rows"),
-                stats_dict=stats_dict,
-            )
-            rootLogger.info("Got converter statistics " + str(stats_dict))
-            with open(os.path.join(args.target_location, "convert_stats.json"), "w") as f:
-                json.dump(stats_dict, f)
-        else:
-            rootLogger.info("Already converted to events, skipping")
-            event_collection = EventCollection(event_dir)
-
-        if not os.path.exists(raw_patients_dir):
-            rootLogger.info("Converting to patients")
-            patient_collection = event_collection.to_patient_collection(
-                raw_patients_dir,
-                num_threads=args.num_threads,
+        timing_path = os.path.join(args.target_location, "timing_stats.json")
+        profile_dir = os.path.join(args.target_location, "profiles") if args.profile else None
+
+        rootLogger.info("Converting to events")
+        stats_dict: Dict[str, Dict[str, int]] = {}
+        timing_dict: Dict[str, Any] = {}
+        event_collection = run_csv_extractors(
+            args.omop_source,
+            event_dir,
+            get_omop_csv_extractors(),
+            num_threads=args.num_threads,
+            debug_folder=os.path.join(args.temp_location, "lost_csv_rows"),
+            stats_dict=stats_dict,
+            timing_dict=timing_dict,
+            profile_dir=profile_dir,
+            checkpoint=True,
+        )
+        rootLogger.info("Got converter statistics " + str(stats_dict))
+        with open(os.path.join(args.target_location, "convert_stats.json"), "w") as f:
+            json.dump(stats_dict, f)
+        write_timing_stats(timing_path, {"run_csv_extractors": timing_dict})
+
+        rootLogger.info("Converting to patients")
+        timing_dict = {}
+        patient_collection = event_collection.to_patient_collection(
+            raw_patients_dir,
+            num_threads=args.num_threads,
+            timing_dict=timing_dict,
+            checkpoint=True,
+        )
+        write_timing_stats(timing_path, {"to_patient_collection": timing_dict})
+
+        concept_map = {}
+        with io.TextIOWrapper(
+            zstandard.ZstdDecompressor().stream_reader(
+                open(os.path.join(args.omop_source, "concept_remap.csv.zst"), "rb")
             )
-        else:
-            rootLogger.info("Already converted to patients, skipping")
-            patient_collection = PatientCollection(raw_patients_dir)
-
-        if not os.path.exists(cleaned_patients_dir):
-            concept_map = {}
-            with io.TextIOWrapper(
-                zstandard.ZstdDecompressor().stream_reader(
-                    open(os.path.join(args.omop_source, "concept_remap.csv.zst"), "rb")
-                )
-            ) as f:
-                for row in f:
-                    a, b = [int(a) for a in row.split(",")]
-                    concept_map[a] = b
-
-            stats_dict = {}
-            rootLogger.info("Appling transformations")
-            patient_collection = patient_collection.transform(
-                cleaned_patients_dir,
-                _get_stanford_transformations(concept_map),
-                num_threads=args.num_threads,
-                stats_dict=stats_dict,
-            )
-            rootLogger.info("Got transform statistics " + str(stats_dict))
-            with open(os.path.join(args.target_location, "transform_stats.json"), "w") as f:
-                json.dump(stats_dict, f)
-        else:
-            rootLogger.info("Already applied transformations, skipping")
-            patient_collection = PatientCollection(cleaned_patients_dir)
+        ) as f:
+            for row in f:
+                a, b = [int(a) for a in row.split(",")]
+                concept_map[a] = b
+
+        stats_dict = {}
+        timing_dict = {}
+        rootLogger.info("Appling transformations")
+        patient_collection = patient_collection.transform(
+            cleaned_patients_dir,
+            _get_stanford_transformations(concept_map),
+            num_threads=args.num_threads,
+            stats_dict=stats_dict,
+            timing_dict=timing_dict,
+            profile_dir=profile_dir,
+            checkpoint=True,
+        )
+        rootLogger.info("Got transform statistics " + str(stats_dict))
+        with open(os.path.join(args.target_location, "transform_stats.json"), "w") as f:
+            json.dump(stats_dict, f)
+        write_timing_stats(timing_path, {"transform": timing_dict})
 
         if not os.path.exists(os.path.join(args.target_location, "meta")):
             rootLogger.info("Converting to extract")
 
             print("Converting to extract", datetime.datetime.now())
+            timing_dict = {}
             patient_collection.to_patient_database(
                 args.target_location,
                 args.omop_source,
                 num_threads=args.num_threads,
+                timing_dict=timing_dict,
             ).close()
+            write_timing_stats(timing_path, {"to_patient_database": timing_dict})
         else:
             rootLogger.info("Already converted to extract, skipping")
 
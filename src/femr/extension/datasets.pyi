@@ -1,6 +1,7 @@
 import collections.abc
 import datetime
-from typing import List, Optional
+import enum
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
 import numpy as np
 
@@ -11,14 +12,102 @@ class Ontology:
     def get_all_parents(self, arg0: str) -> Sequence[str]: ...
     def get_children(self, arg0: str) -> Sequence[str]: ...
     def get_parents(self, arg0: str) -> Sequence[str]: ...
+    def get_codes(self) -> Dictionary: ...
+    def get_code_index(self, code: str) -> int: ...
+    def get_parent_indices(self, code_index: int) -> np.ndarray: ...
+    def get_children_indices(self, code_index: int) -> np.ndarray: ...
+    def get_all_parent_indices(self, code_index: int) -> np.ndarray: ...
+    def get_parents_csr(self) -> Tuple[np.ndarray, np.ndarray]: ...
+    def get_children_csr(self) -> Tuple[np.ndarray, np.ndarray]: ...
+    def get_all_parents_csr(self) -> Tuple[np.ndarray, np.ndarray]: ...
+    def get_text_description(self, code: str) -> str: ...
+    def get_code_from_concept_id(self, concept_id: int) -> str: ...
+    def get_concept_id_from_code(self, code: str) -> int: ...
+    def get_database_id(self) -> int: ...
+
+class ValueType(enum.Enum):
+    NONE = 0
+    NUMERIC = 1
+    SHARED_TEXT = 2
+    UNIQUE_TEXT = 3
+
+class Dictionary(collections.abc.Sequence):
+    def __getitem__(self, index: int) -> str: ...
+    def __len__(self) -> int: ...
+    def index(self, value: str) -> int: ...
 
 class PatientDatabase(collections.abc.Sequence):
-    def __init__(self, filename: str, read_all: bool = ...) -> None: ...
+    def __init__(
+        self, filename: str, read_all: bool = ..., read_all_unique_text: bool = ..., access: str = ...
+    ) -> None: ...
     def close(self) -> None: ...
+    def __enter__(self) -> PatientDatabase: ...
+    def __exit__(self, *args: Any) -> None: ...
     def get_patient_birth_date(self, arg: int) -> datetime.datetime: ...
     def get_ontology(self) -> Ontology: ...
-    def __getitem__(self, arg0: int) -> object: ...
+    def get_shared_text_dictionary(self) -> Dictionary: ...
+    def get_unique_text_dictionary(self) -> Optional[Dictionary]: ...
+    def get_event_metadata_text_dictionary(self) -> Optional[Dictionary]: ...
+    def get_patient_arrays(self, patient_id: int) -> Dict[str, Any]: ...
+    def get_events_in_range(
+        self, patient_id: int, start: Optional[datetime.datetime] = ..., end: Optional[datetime.datetime] = ...
+    ) -> Sequence[femr.Event]: ...
+    def map_reduce(
+        self, func: Any, reducer: Callable[[Any, Any], Any], num_threads: int = ..., initial: Any = ...
+    ) -> Any: ...
+    def searchsorted_events(
+        self, patient_id: int, times: Sequence[datetime.datetime], side: str = ...
+    ) -> np.ndarray: ...
+    def enable_cache(self, max_patients: Optional[int] = ..., max_bytes: Optional[int] = ...) -> None: ...
+    def disable_cache(self) -> None: ...
+    def get_cache_stats(self) -> Dict[str, int]: ...
+    def get_patients(
+        self, patient_ids: Sequence[int], num_threads: int = ..., include_metadata: bool = ...
+    ) -> Dict[str, np.ndarray]: ...
+    def get_patient_ids_with_codes(self, codes: Sequence[str], include_descendants: bool = ...) -> np.ndarray: ...
+    def get_patient_ids_with_shared_text(self, values: Sequence[str]) -> np.ndarray: ...
+    def subset(self, patient_ids: Sequence[int], target_path: str) -> PatientDatabase: ...
+    def version_id(self) -> int: ...
+    def database_id(self) -> int: ...
+    def __getitem__(self, arg0: int) -> femr.Patient: ...
     def __len__(self) -> int: ...
 
 def convert_patient_collection_to_patient_database(arg0, arg1, arg2, arg3: str, arg4: int) -> None: ...
-def sort_and_join_csvs(arg0, arg1, arg2: List[str] | np.dtype, arg3: str, arg4: int) -> None: ...
+def sort_and_join_csvs(
+    source_path: str,
+    target_path: str,
+    fields: List[str] | np.dtype,
+    delimiter: str,
+    num_threads: int,
+    max_memory_bytes: int = ...,
+    shards: Optional[Sequence[int]] = ...,
+) -> None: ...
+def partition_csvs(
+    source_path: str,
+    target_path: str,
+    fields: List[str] | np.dtype,
+    delimiter: str,
+    num_partitions: int,
+    max_memory_bytes: int = ...,
+) -> None: ...
+def join_csvs(
+    source_path: str,
+    target_file: str,
+    fields: List[str] | np.dtype,
+    delimiter: str,
+    max_memory_bytes: int = ...,
+) -> None: ...
+def extract_concept_table(
+    source: str,
+    target: str,
+    spec: Dict[str, Any],
+    delimiter: str,
+    debug_file: Optional[str],
+    debug_name: str,
+    file_offset: int = ...,
+    length: Optional[int] = ...,
+    start: Optional[int] = ...,
+) -> Tuple[Dict[str, int], int, int]: ...
+def transform_patients(
+    source: str, target: str, transforms: List[Tuple[str, Dict[str, Any]]]
+) -> Tuple[int, List[Dict[str, Any]]]: ...
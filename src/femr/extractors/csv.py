@@ -5,21 +5,59 @@ import abc
 import collections
 import contextlib
 import csv
+import dataclasses
+import functools
 import io
 import logging
-import multiprocessing
+import multiprocessing.pool
 import os
+import shutil
+import struct
 import sys
-from typing import Dict, Iterable, Mapping, Optional, Sequence, Tuple
+import tempfile
+from typing import IO, Any, Callable, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple, cast
 
 import zstandard
 
-from femr.datasets import EventCollection, RawEvent
+from femr.datasets import (
+    DEFAULT_SORT_MEMORY_BYTES,
+    EventCollection,
+    PatientCollection,
+    RawEvent,
+    RawPatient,
+    _transform_single_reader,
+)
+from femr.datasets.checkpoints import Checkpoints, get_checkpoint_key
+from femr.datasets.fileio import ROW_GROUP_EXTENSION
+from femr.datasets.profiling import ResourceTimer, profile_to, summarize_stage
+from femr.extension import datasets as extension_datasets
 
 # Note that we want to support huge CSV records
 csv.field_size_limit(sys.maxsize)
 
 
+@dataclasses.dataclass(frozen=True)
+class ConceptTableSpec:
+    """A declarative description of a table with one event per row, which can be extracted without calling Python.
+
+    The semantics follow `femr.extractors.omop._ConceptTableConverter`, see native/csv_extractor.hh for the details.
+    Field names are lowercase and None means unset.
+    """
+
+    file_prefix: str
+    patient_id_field: str
+    prefix: str
+    concept_id_field: Optional[str] = None
+    source_concept_id_field: Optional[str] = None
+    force_concept_id: Optional[int] = None
+    string_value_field: Optional[str] = None
+    numeric_value_field: Optional[str] = None
+    concept_id_value_field: Optional[str] = None
+    value_source_concept_id_field: Optional[str] = None
+    value_source_code_field: Optional[str] = None
+    fallback_concept_id: Optional[int] = None
+
+
 class CSVExtractor(abc.ABC):
     """An interface for converting a csv into events."""
 
@@ -41,74 +79,443 @@ class CSVExtractor(abc.ABC):
         """Return the events generated for a particular row."""
         ...
 
+    def get_spec(self) -> Optional[ConceptTableSpec]:
+        """Return a spec that generates the same events as get_events, so that files can be extracted natively.
+
+        By default this is None and get_events is called for every row.
+        """
+        return None
+
+
+# Large source files are split into chunks of roughly this many bytes of (decompressed) data
+DEFAULT_CHUNK_SIZE = 256 * 1024 * 1024
+
+_ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+_ZSTD_SEEKABLE_MAGIC = 0x8F92EAB1
+_ZSTD_MAX_FRAME_HEADER_SIZE = 18
+
+
+@dataclasses.dataclass(frozen=True)
+class _SourceChunk:
+    """A part of a source file that can be extracted independently, see native/csv_extractor.hh.
+
+    Offsets other than `file_offset` are in bytes of decompressed data, relative to the start of the chunk.
+    Rows that start at or before `length` belong to the chunk. Unless `start` is set, chunks after the first
+    guess that their first row starts after the first newline, which is checked against the previous chunk.
+    """
+
+    file_offset: int = 0
+    length: Optional[int] = None
+    start: Optional[int] = None
+
+    def is_speculative(self) -> bool:
+        return self.file_offset != 0 and self.start is None
+
+
+def _get_zstd_frames(source: str) -> Optional[List[Tuple[int, int]]]:
+    """Get the file offset and decompressed size of every frame of a zstd file, or None if a size is unknown.
+
+    Sizes come from the seek table of files in the zstd seekable format, or otherwise from the frame headers.
+    Finding where a frame ends requires walking its blocks unless pzstd stored its size in a skippable frame, so
+    a file that starts with a frame whose content is larger than the file is taken to be that one frame.
+    """
+    with open(source, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+
+        if size >= 9:
+            f.seek(size - 9)
+            num_frames, descriptor, magic = struct.unpack("<IBI", f.read(9))
+            if magic == _ZSTD_SEEKABLE_MAGIC:
+                entry_size = 12 if descriptor & 0x80 else 8
+                f.seek(size - 9 - num_frames * entry_size)
+                seek_table = f.read(num_frames * entry_size)
+                frames = []
+                offset = 0
+                for i in range(num_frames):
+                    compressed_size, decompressed_size = struct.unpack_from("<II", seek_table, i * entry_size)
+                    frames.append((offset, decompressed_size))
+                    offset += compressed_size
+                return frames
+
+        frames = []
+        offset = 0
+        frame_size: Optional[int] = None
+        while offset < size:
+            f.seek(offset)
+            header = f.read(_ZSTD_MAX_FRAME_HEADER_SIZE)
+            magic, skippable_size = struct.unpack_from("<II", header)
+            if magic & 0xFFFFFFF0 == _ZSTD_SKIPPABLE_MAGIC:
+                # pzstd precedes every frame with the frame's compressed size
+                if magic == _ZSTD_SKIPPABLE_MAGIC and skippable_size == 4:
+                    frame_size = struct.unpack_from("<I", header, 8)[0]
+                offset += 8 + skippable_size
+                continue
+
+            params = zstandard.get_frame_parameters(header)
+            if params.content_size == zstandard.CONTENTSIZE_UNKNOWN:
+                return None
+            if offset == 0 and params.content_size >= size:
+                # Almost certainly a single frame, as written by the zstd CLI
+                return [(0, params.content_size)]
+            frames.append((offset, params.content_size))
+
+            if frame_size is not None:
+                offset += frame_size
+                frame_size = None
+                continue
+
+            # Otherwise the compressed size of a frame is only known by walking its blocks
+            offset += zstandard.frame_header_size(header)
+            while True:
+                f.seek(offset)
+                block_header = int.from_bytes(f.read(3), "little")
+                is_rle = (block_header >> 1) & 3 == 1
+                offset += 3 + (1 if is_rle else block_header >> 3)
+                if block_header & 1:
+                    break
+            if params.has_checksum:
+                offset += 4
+
+        return frames
+
+
+def _split_source(source: str, chunk_size: Optional[int]) -> List[_SourceChunk]:
+    """Split a source file into chunks of roughly chunk_size bytes of data that can be extracted in parallel.
+
+    Uncompressed files are split at arbitrary offsets. Zstd compressed files are split at frame boundaries and
+    so can only be split if they have several frames with known sizes, as written by pzstd or the zstd seekable
+    format. Other files are a single chunk.
+    """
+    if chunk_size is None or os.path.getsize(source) <= chunk_size:
+        return [_SourceChunk()]
+
+    chunks = []
+    if source.endswith(".zst"):
+        frames = _get_zstd_frames(source)
+        if frames is None:
+            return [_SourceChunk()]
+
+        file_offset, length = 0, 0
+        for frame_offset, frame_size in frames:
+            if length >= chunk_size:
+                chunks.append(_SourceChunk(file_offset, length))
+                file_offset, length = frame_offset, 0
+            length += frame_size
+    else:
+        file_offset = 0
+        while file_offset + chunk_size < os.path.getsize(source):
+            chunks.append(_SourceChunk(file_offset, chunk_size))
+            file_offset += chunk_size
+
+    chunks.append(_SourceChunk(file_offset))
+    return chunks
+
+
+def _open_source(source: str, file_offset: int = 0) -> IO[bytes]:
+    """Open a source file as a binary stream of decompressed data, starting at an offset or zstd frame."""
+    f = open(source, "rb")
+    f.seek(file_offset)
+    if source.endswith(".csv.zst"):
+        # Support Zstandard compressed CSVs
+        # The reader implements readinto, which is all BufferedReader needs from a raw stream
+        reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+        return io.BufferedReader(cast(io.RawIOBase, reader))
+    else:
+        # Support normal CSVs
+        return f
+
+
+class _SourceLines:
+    """Iterate over the decoded lines of a source, keeping track of the position of the next line."""
+
+    def __init__(self, f: IO[bytes]):
+        self.f = f
+        self.position = 0
+
+    def __iter__(self) -> Iterator[str]:
+        return self
+
+    def __next__(self) -> str:
+        line = self.f.readline()
+        if not line:
+            raise StopIteration
+        self.position += len(line)
+        return line.decode("utf8")
+
+    def skip(self, num_bytes: int) -> None:
+        self.position += len(self.f.read(num_bytes))
+
+    def skip_line(self) -> None:
+        self.position += len(self.f.readline())
+
+
+def _read_header(source: str, delimiter: str) -> List[str]:
+    with contextlib.closing(_open_source(source)) as f:
+        return next(csv.reader(_SourceLines(f), delimiter=delimiter))
+
+
+def _run_spec_extractor(
+    source: str,
+    target: EventCollection,
+    spec: ConceptTableSpec,
+    delimiter: str,
+    debug_file: Optional[str],
+    debug_name: str,
+    chunk: _SourceChunk,
+) -> Tuple[Dict[str, int], int, int]:
+    """Extract a chunk with the native implementation of a spec.
+
+    Returns the count dict, the start of the chunk and the start of the next chunk.
+    """
+    fd, target_file = tempfile.mkstemp(dir=target.path, suffix=ROW_GROUP_EXTENSION)
+    os.close(fd)
+
+    return extension_datasets.extract_concept_table(
+        source,
+        target_file,
+        dataclasses.asdict(spec),
+        delimiter,
+        debug_file,
+        debug_name,
+        chunk.file_offset,
+        chunk.length,
+        chunk.start,
+    )
+
+
+def _run_row_extractor(
+    source: str,
+    target: EventCollection,
+    extractor: CSVExtractor,
+    delimiter: str,
+    debug_file: Optional[str],
+    chunk: _SourceChunk,
+    stats: Dict[str, int],
+) -> Tuple[int, int]:
+    """Extract a chunk by calling get_events for every row, updating the count dict.
+
+    Returns the start of the chunk and the start of the next chunk.
+    """
+    with contextlib.ExitStack() as stack:
+        lines = _SourceLines(stack.enter_context(_open_source(source, chunk.file_offset)))
+        if chunk.file_offset == 0:
+            reader = csv.DictReader(lines, delimiter=delimiter)
+            # Read the header
+            reader.fieldnames
+        else:
+            reader = csv.DictReader(lines, fieldnames=_read_header(source, delimiter), delimiter=delimiter)
+            if chunk.start is not None:
+                lines.skip(chunk.start)
+            else:
+                lines.skip_line()
+
+        start = lines.position
+
+        debug_writer = None
+
+        with contextlib.closing(target.create_writer()) as o:
+            while chunk.length is None or lines.position <= chunk.length:
+                row = next(reader, None)
+                if row is None:
+                    break
+
+                lower_row = {a.lower(): b for a, b in row.items()}
+                events = extractor.get_events(lower_row)
+                stats["input_rows"] += 1
+                if events:
+                    stats["valid_rows"] += 1
+                    for event in events:
+                        stats["valid_events"] += 1
+                        o.add_event(
+                            int(lower_row[extractor.get_patient_id_field()]),
+                            event,
+                        )
+                else:
+                    stats["invalid_rows"] += 1
+                    # This is a bad row, should be inspected further
+                    if debug_file is not None:
+                        if debug_writer is None:
+                            os.makedirs(os.path.dirname(debug_file), exist_ok=True)
+                            if debug_file.endswith(".csv.zst"):
+                                # Support Zstandard compressed CSVs
+                                debug_f = stack.enter_context(
+                                    io.TextIOWrapper(
+                                        zstandard.ZstdCompressor(level=1).stream_writer(open(debug_file, "wb"))
+                                    )
+                                )
+                            else:
+                                # Support normal CSVs
+                                debug_f = stack.enter_context(open(debug_file, "w"))
+                            assert reader.fieldnames is not None
+                            debug_writer = csv.DictWriter(
+                                debug_f,
+                                fieldnames=list(reader.fieldnames) + ["extractor"],
+                            )
+                            debug_writer.writeheader()
+                        row["extractor"] = repr(extractor)
+                        debug_writer.writerow(row)
 
-def _run_csv_extractor(
-    args: Tuple[str, EventCollection, CSVExtractor, str, Optional[str]]
-) -> Tuple[str, Dict[str, int]]:
+    if chunk.length is not None and lines.position > chunk.length:
+        return start, lines.position - chunk.length
+    else:
+        return start, 0
+
+
+# The source, target, extractor, delimiter, debug file, profile file, whether to use specs and chunk of a task
+_ExtractorTask = Tuple[str, EventCollection, CSVExtractor, str, Optional[str], Optional[str], bool, _SourceChunk]
+
+# The prefix, the count dicts, the timing and the starts of a task, see _run_csv_extractor
+_ExtractorResult = Tuple[str, Dict[str, int], Dict[str, Any], Optional[Tuple[int, int]]]
+
+
+def _run_csv_extractor(args: _ExtractorTask) -> _ExtractorResult:
     """
-    Run a single csv converter, returns the prefix and the count dicts.
+    Run a single csv converter over a chunk of a file.
+
+    Returns the prefix, the count dicts, the timing and the start of the chunk and the next chunk. The starts are
+    None if a speculative chunk failed, as it probably guessed the wrong start.
 
     This function is supposed to run with a multiprocess pool.
     """
-    source, target, extractor, delimiter, debug_file = args
+    source, target, extractor, delimiter, debug_file, profile_file, use_specs, chunk = args
     stats: Dict[str, int] = collections.defaultdict(int)
+    starts: Optional[Tuple[int, int]] = None
     try:
-        with contextlib.ExitStack() as stack:
-            f: Iterable[str]
-            if source.endswith(".csv.zst"):
-                # Support Zstandard compressed CSVs
-                f = stack.enter_context(
-                    io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(source, "rb")))
+        with ResourceTimer() as timer, profile_to(profile_file):
+            # The native extractor only writes row group files
+            spec = extractor.get_spec() if use_specs and target.file_format == "rowgroups" else None
+            if spec is not None:
+                spec_stats, start, next_start = _run_spec_extractor(
+                    source, target, spec, delimiter, debug_file, repr(extractor), chunk
                 )
+                starts = (start, next_start)
+                # Only count what happened, like the Python extractor
+                stats.update((k, v) for k, v in spec_stats.items() if v != 0)
             else:
-                # Support normal CSVs
-                f = stack.enter_context(open(source, "r"))
-
-            debug_writer = None
-
-            reader = csv.DictReader(f, delimiter=delimiter)
-            with contextlib.closing(target.create_writer()) as o:
-                for row in reader:
-                    lower_row = {a.lower(): b for a, b in row.items()}
-                    events = extractor.get_events(lower_row)
-                    stats["input_rows"] += 1
-                    if events:
-                        stats["valid_rows"] += 1
-                        for event in events:
-                            stats["valid_events"] += 1
-                            o.add_event(
-                                int(lower_row[extractor.get_patient_id_field()]),
-                                event,
-                            )
-                    else:
-                        stats["invalid_rows"] += 1
-                        # This is a bad row, should be inspected further
-                        if debug_file is not None:
-                            if debug_writer is None:
-                                os.makedirs(os.path.dirname(debug_file), exist_ok=True)
-                                if debug_file.endswith(".csv.zst"):
-                                    # Support Zstandard compressed CSVs
-                                    debug_f = stack.enter_context(
-                                        io.TextIOWrapper(
-                                            zstandard.ZstdCompressor(level=1).stream_writer(open(debug_file, "wb"))
-                                        )
-                                    )
-                                else:
-                                    # Support normal CSVs
-                                    debug_f = stack.enter_context(open(debug_file, "w"))
-                                assert reader.fieldnames is not None
-                                debug_writer = csv.DictWriter(
-                                    debug_f,
-                                    fieldnames=list(reader.fieldnames) + ["extractor"],
-                                )
-                                debug_writer.writeheader()
-                            row["extractor"] = repr(extractor)
-                            debug_writer.writerow(row)
-        return (extractor.get_file_prefix(), stats)
+                starts = _run_row_extractor(source, target, extractor, delimiter, debug_file, chunk, stats)
 
     except Exception as e:
-        logging.error("Failing on %s %s", source, extractor)
-        raise e
+        if not chunk.is_speculative():
+            logging.error("Failing on %s %s", source, extractor)
+            raise e
+
+    timer.set_rows(stats["input_rows"])
+    timing = {
+        "source": source,
+        "file_offset": chunk.file_offset,
+        "extractor": extractor.get_file_prefix(),
+        "pid": os.getpid(),
+        **timer.stats,
+    }
+    return (extractor.get_file_prefix(), stats, timing, starts)
+
+
+def _find_sources(source_csvs: str, extractors: Sequence[CSVExtractor]) -> List[Tuple[str, str, CSVExtractor]]:
+    """Find the files in source_csvs for every extractor, returning their relative and full paths."""
+    files_per_extractor = [0 for _ in extractors]
+
+    sources = []
+
+    for root, dirs, files in os.walk(source_csvs):
+        for name in files:
+            full_path = os.path.join(root, name)
+            relative_path = os.path.relpath(full_path, source_csvs)
+            matching_extractors = [
+                (i, a)
+                for i, a in enumerate(extractors)
+                if (
+                    str(relative_path).startswith(a.get_file_prefix() + ".csv")
+                    or str(relative_path).startswith(a.get_file_prefix() + "/")
+                )
+            ]
+            if len(matching_extractors) > 1:
+                raise RuntimeError("Multiple extractors matched " + full_path + " " + str(matching_extractors))
+            elif len(matching_extractors) == 0:
+                pass
+            else:
+                i, extractor = matching_extractors[0]
+                files_per_extractor[i] += 1
+                sources.append((relative_path, full_path, extractor))
+
+    for count, c in zip(files_per_extractor, extractors):
+        if count == 0:
+            print("Could not find any files for extractor", c)
+
+    return sources
+
+
+def _get_extractor_tasks(
+    sources: Sequence[Tuple[str, str, CSVExtractor]],
+    target: Optional[EventCollection],
+    file_format: str,
+    staging_location: str,
+    delimiter: str,
+    debug_folder: Optional[str],
+    profile_dir: Optional[str],
+    use_specs: bool,
+    chunk_size: Optional[int],
+) -> Tuple[List[_ExtractorTask], List[str]]:
+    """Split the sources into chunks, returning a task for every chunk and the relative path of its source.
+
+    Speculative chunks write to their own collection in staging_location, as do all chunks if there is no target.
+    The others write directly to the target.
+    """
+    tasks: List[_ExtractorTask] = []
+    task_sources = []
+
+    for relative_path, full_path, extractor in sources:
+        for chunk_index, chunk in enumerate(_split_source(full_path, chunk_size)):
+            if debug_folder is not None:
+                debug_path = os.path.join(debug_folder, relative_path)
+                if chunk_index != 0:
+                    base, csv_suffix, compression_suffix = debug_path.rpartition(".csv")
+                    debug_path = f"{base}.{chunk_index}{csv_suffix}{compression_suffix}"
+            else:
+                debug_path = None
+
+            if profile_dir is not None:
+                profile_path = os.path.join(profile_dir, f"extractor_{len(tasks)}.prof")
+            else:
+                profile_path = None
+
+            if chunk.is_speculative() or target is None:
+                chunk_target = EventCollection(os.path.join(staging_location, str(len(tasks))), file_format)
+            else:
+                chunk_target = target
+
+            tasks.append((full_path, chunk_target, extractor, delimiter, debug_path, profile_path, use_specs, chunk))
+            task_sources.append(relative_path)
+
+    return tasks, task_sources
+
+
+def _check_chunk_start(
+    pool: multiprocessing.pool.Pool,
+    run_task: Callable[[_ExtractorTask], _ExtractorResult],
+    tasks: List[_ExtractorTask],
+    results: List[_ExtractorResult],
+    i: int,
+) -> None:
+    """Check the guessed start of a speculative chunk against where the previous chunk of the file ended.
+
+    If a quoted field contained a newline, the chunk is run again from the right start, replacing its task and result.
+    """
+    source, chunk_target, extractor, delimiter, debug_path, profile_path, use_specs, chunk = tasks[i]
+    if not chunk.is_speculative():
+        return
+
+    previous_starts = results[i - 1][3]
+    assert previous_starts is not None
+    starts = results[i][3]
+    if starts is None or starts[0] != previous_starts[1]:
+        logging.info("Extracting chunk %s of %s again with the right start", chunk, source)
+        if debug_path is not None and os.path.exists(debug_path):
+            os.remove(debug_path)
+        shutil.rmtree(chunk_target.path)
+        chunk_target = EventCollection(chunk_target.path, chunk_target.file_format)
+        chunk = dataclasses.replace(chunk, start=previous_starts[1])
+        tasks[i] = (source, chunk_target, extractor, delimiter, debug_path, profile_path, use_specs, chunk)
+        results[i] = pool.apply(run_task, (tasks[i],))
 
 
 def run_csv_extractors(
@@ -119,6 +526,12 @@ def run_csv_extractors(
     delimiter: str = ",",
     debug_folder: Optional[str] = None,
     stats_dict: Optional[Dict[str, Dict[str, int]]] = None,
+    timing_dict: Optional[Dict[str, Any]] = None,
+    profile_dir: Optional[str] = None,
+    file_format: str = "rowgroups",
+    use_specs: bool = True,
+    chunk_size: Optional[int] = DEFAULT_CHUNK_SIZE,
+    checkpoint: bool = False,
 ) -> EventCollection:
     """Run a collection of CSV converters over a directory, producing an EventCollection.
 
@@ -129,6 +542,16 @@ def run_csv_extractors(
         num_threads: The number of threads to use when converting.
         debug_folder: An optional directory where the unmapped rows should be stored for debuggin
         stats_dict: An optional dictionary to store statistics about the conversion process.
+        timing_dict: An optional dictionary to store the timing of the conversion, per worker and per extractor.
+        profile_dir: An optional directory where a cProfile dump is written for each source file.
+        file_format: The format of the event files, either "rowgroups" or "csv".
+        use_specs: Whether to natively extract files for extractors that provide a spec, see CSVExtractor.get_spec.
+        chunk_size: Files with more than this many bytes are split into chunks that are converted in parallel.
+            Zstd compressed files can only be split if they have several frames, see _split_source. None
+            disables splitting.
+        checkpoint: Whether to resume from the completion markers of a previous run, only extracting the source
+            files that are new or changed since. Event files that do not belong to a completed source file are
+            removed, see femr.datasets.checkpoints.Checkpoints.
 
 
     Returns:
@@ -139,49 +562,287 @@ def run_csv_extractors(
     if debug_folder:
         os.makedirs(debug_folder, exist_ok=True)
 
-    target = EventCollection(target_location)
+    target = EventCollection(target_location, file_format)
+
+    sources = _find_sources(source_csvs, extractors)
+
+    # Every source file is a shard, keyed by its contents and how it is extracted
+    checkpoints = Checkpoints(target_location) if checkpoint else None
+    checkpoint_keys: Dict[str, str] = {}
+    if checkpoints is not None:
+        digests = checkpoints.get_file_digests([full_path for _, full_path, _ in sources], num_threads)
+        complete_sources = set()
+        for relative_path, full_path, extractor in sources:
+            key = get_checkpoint_key(digests[full_path], extractor, delimiter, file_format, use_specs)
+            marker = checkpoints.get_marker(relative_path, key)
+            if marker is None:
+                checkpoint_keys[relative_path] = key
+            else:
+                complete_sources.add(relative_path)
+                for k, v in marker["stats"].items():
+                    stats[extractor.get_file_prefix()][k] += v
+        checkpoints.remove_incomplete(complete_sources)
+        sources = [source for source in sources if source[0] in checkpoint_keys]
+
+    # Speculative chunks write to their own collection, which is only moved into the target once the start of the
+    # chunk has been checked. With checkpoints, all chunks do so that the files of every source are known.
+    staging_location = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(target_location)), prefix=".chunks_")
+
+    to_process, task_sources = _get_extractor_tasks(
+        sources,
+        target if checkpoints is None else None,
+        file_format,
+        staging_location,
+        delimiter,
+        debug_folder,
+        profile_dir,
+        use_specs,
+        chunk_size,
+    )
+
+    task_timings = []
+    try:
+        with ResourceTimer(include_children=True) as timer:
+            with multiprocessing.Pool(num_threads) as pool:
+                # The results are handled as they arrive, so that sources are marked complete as soon as possible
+                results: List[_ExtractorResult] = []
+                source_outputs: Dict[str, List[str]] = collections.defaultdict(list)
+                source_stats: Dict[str, Dict[str, int]] = collections.defaultdict(lambda: collections.defaultdict(int))
+                for i, result in enumerate(pool.imap(_run_csv_extractor, to_process)):
+                    results.append(result)
+                    _check_chunk_start(pool, _run_csv_extractor, to_process, results, i)
+                    chunk_target = to_process[i][1]
+                    relative_path = task_sources[i]
+
+                    if chunk_target is not target:
+                        # With checkpoints, the files of a source are named after it
+                        prefix = checkpoints.get_shard_id(relative_path) + "_" if checkpoints is not None else ""
+                        for child in os.listdir(chunk_target.path):
+                            name = f"{prefix}{i}_{child}"
+                            os.rename(os.path.join(chunk_target.path, child), os.path.join(target.path, name))
+                            source_outputs[relative_path].append(name)
+
+                    for k, v in results[i][1].items():
+                        source_stats[relative_path][k] += v
+
+                    is_last_chunk = i + 1 == len(to_process) or task_sources[i + 1] != relative_path
+                    if checkpoints is not None and is_last_chunk:
+                        checkpoints.mark_complete(
+                            relative_path,
+                            checkpoint_keys[relative_path],
+                            source_outputs[relative_path],
+                            stats=source_stats[relative_path],
+                        )
+
+        for prefix, s, timing, _ in results:
+            for k, v in s.items():
+                stats[prefix][k] += v
+            task_timings.append(timing)
+    finally:
+        shutil.rmtree(staging_location)
 
-    files_per_extractor = [0 for _ in extractors]
+    if stats_dict is not None:
+        stats_dict.update(stats)
 
-    to_process = []
+    if timing_dict is not None:
+        timing_dict.update(summarize_stage(timer.stats, task_timings, group_by="extractor"))
 
-    for root, dirs, files in os.walk(source_csvs):
-        for name in files:
-            full_path = os.path.join(root, name)
-            relative_path = os.path.relpath(full_path, source_csvs)
-            matching_extractors = [
-                (i, a)
-                for i, a in enumerate(extractors)
-                if (
-                    str(relative_path).startswith(a.get_file_prefix() + ".csv")
-                    or str(relative_path).startswith(a.get_file_prefix() + "/")
-                )
-            ]
-            if len(matching_extractors) > 1:
-                raise RuntimeError("Multiple extractors matched " + full_path + " " + str(matching_extractors))
-            elif len(matching_extractors) == 0:
-                pass
-            else:
-                i, extractor = matching_extractors[0]
-                files_per_extractor[i] += 1
+    return target
 
-                if debug_folder is not None:
-                    debug_path = os.path.join(debug_folder, relative_path)
-                else:
-                    debug_path = None
 
-                to_process.append((full_path, target, extractor, delimiter, debug_path))
+def _run_partitioned_csv_extractor(
+    num_partitions: int, max_memory_bytes: int, args: _ExtractorTask
+) -> _ExtractorResult:
+    """Run a single csv converter over a chunk of a file, then split the events into partitions of sorted runs.
 
-    for count, c in zip(files_per_extractor, extractors):
-        if count == 0:
-            print("Could not find any files for extractor", c)
+    The partitions are written to <target>.partitions, see EventCollection.partition, and the events are removed.
+    """
+    result = _run_csv_extractor(args)
+    if result[3] is None:
+        # A failed speculative chunk is always run again
+        return result
+
+    target = args[1]
+    partitions_path = target.path + ".partitions"
+    if os.path.exists(partitions_path):
+        shutil.rmtree(partitions_path)
+
+    with ResourceTimer() as timer:
+        target.partition(partitions_path, num_partitions, max_memory_bytes)
+    for child in os.listdir(target.path):
+        os.remove(os.path.join(target.path, child))
+
+    result[2]["partition_seconds"] = timer.stats["wall_seconds"]
+    return result
+
+
+def _join_and_transform_partition(
+    target_path: str,
+    transforms: Sequence[Callable[[RawPatient], Optional[RawPatient]]],
+    file_format: str,
+    max_memory_bytes: int,
+    capture_timing: bool,
+    profile_dir: Optional[str],
+    task: Tuple[int, str],
+) -> Tuple[Optional[Dict[str, Dict[str, int]]], Optional[Dict[str, Any]]]:
+    """Join the sorted runs of a partition into patients and transform them, writing a patient file in target_path.
+
+    The runs and the untransformed patients are removed once they have been used.
+    Returns the statistics of the transforms and the timing, if requested.
+    """
+    partition, partition_path = task
+    patient_file = partition_path + ".patients"
+
+    with ResourceTimer() as timer:
+        is_written = EventCollection(partition_path, file_format).join_sorted_runs(patient_file, max_memory_bytes)
+    shutil.rmtree(partition_path)
+    if not is_written:
+        return None, None
+
+    _, _, stats, timing = _transform_single_reader(
+        target_path, transforms, file_format, True, capture_timing, profile_dir, (partition, patient_file)
+    )
+    os.remove(patient_file)
+
+    if timing is not None:
+        timing["join_seconds"] = timer.stats["wall_seconds"]
+    return stats, timing
+
+
+def run_csv_extractors_to_patients(
+    source_csvs: str,
+    target_location: str,
+    extractors: Sequence[CSVExtractor],
+    transforms: Sequence[Callable[[RawPatient], Optional[RawPatient]]],
+    num_threads: int = 1,
+    delimiter: str = ",",
+    debug_folder: Optional[str] = None,
+    stats_dict: Optional[Dict[str, Dict[str, int]]] = None,
+    transform_stats_dict: Optional[Dict[str, Dict[str, int]]] = None,
+    timing_dict: Optional[Dict[str, Any]] = None,
+    profile_dir: Optional[str] = None,
+    file_format: str = "rowgroups",
+    use_specs: bool = True,
+    chunk_size: Optional[int] = DEFAULT_CHUNK_SIZE,
+    max_memory_bytes: int = DEFAULT_SORT_MEMORY_BYTES,
+) -> PatientCollection:
+    """Run a collection of CSV converters over a directory and transform the patients, producing a PatientCollection.
+
+    This gives the same patients as run_csv_extractors followed by EventCollection.to_patient_collection and
+    PatientCollection.transform, but streams the events into patients without storing the intermediate collections.
+    Every extractor task splits the events of its chunk by patient id into num_threads partitions of sorted runs.
+    Once all chunks are extracted, the same pool merges the runs of every partition into patients and transforms
+    them, writing one patient file per partition. The runs are the only copy of the events on disk, and are stored in
+    a temporary directory next to target_location.
 
-    with multiprocessing.Pool(num_threads) as pool:
-        for prefix, s in pool.imap_unordered(_run_csv_extractor, to_process):
+    Args:
+        source_csvs: A path to the directory containing the source csvs.
+        target_location: A path where you want to store the PatientCollection.
+        extractors: A series of classes that implement the CSVExtractor API.
+        transforms: The transforms to apply to every patient, as in PatientCollection.transform.
+        num_threads: The number of threads to use, which is also the number of partitions.
+        debug_folder: An optional directory where the unmapped rows should be stored for debugging.
+        stats_dict: An optional dictionary to store statistics about the conversion process.
+        transform_stats_dict: An optional dictionary to store statistics about the transforms.
+        timing_dict: An optional dictionary to store the timing of the stage, per worker and per phase.
+        profile_dir: An optional directory where a cProfile dump is written for each task.
+        file_format: The format of the event and patient files, either "rowgroups" or "csv".
+        use_specs: Whether to natively extract files for extractors that provide a spec, see CSVExtractor.get_spec.
+        chunk_size: Files with more than this many bytes are split into chunks that are converted in parallel.
+        max_memory_bytes: The budget for the events held in memory while sorting and joining, shared between all
+            workers.
+
+    Returns:
+        A PatientCollection storing the transformed patients
+    """
+    stats: Dict[str, Dict[str, int]] = collections.defaultdict(lambda: collections.defaultdict(int))
+    transform_stats: Dict[str, Dict[str, int]] = collections.defaultdict(lambda: collections.defaultdict(int))
+
+    if debug_folder:
+        os.makedirs(debug_folder, exist_ok=True)
+
+    os.mkdir(target_location)
+
+    sources = _find_sources(source_csvs, extractors)
+
+    staging_location = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(target_location)), prefix=".streaming_")
+    chunks_location = os.path.join(staging_location, "chunks")
+    partitions_location = os.path.join(staging_location, "partitions")
+    os.mkdir(chunks_location)
+    os.mkdir(partitions_location)
+
+    tasks, _ = _get_extractor_tasks(
+        sources, None, file_format, chunks_location, delimiter, debug_folder, profile_dir, use_specs, chunk_size
+    )
+    run_task = functools.partial(_run_partitioned_csv_extractor, num_threads, max_memory_bytes // num_threads)
+
+    task_timings = []
+    try:
+        with ResourceTimer(include_children=True) as timer:
+            with multiprocessing.pool.Pool(num_threads) as pool:
+                results: List[_ExtractorResult] = []
+                for i, result in enumerate(pool.imap(run_task, tasks)):
+                    results.append(result)
+                    _check_chunk_start(pool, run_task, tasks, results, i)
+
+                    # The runs of a chunk are only combined with the others once its start has been checked
+                    chunk_path = tasks[i][1].path
+                    chunk_partitions_path = chunk_path + ".partitions"
+                    for partition in os.listdir(chunk_partitions_path):
+                        partition_path = os.path.join(partitions_location, partition)
+                        os.makedirs(partition_path, exist_ok=True)
+                        for run in os.listdir(os.path.join(chunk_partitions_path, partition)):
+                            os.rename(
+                                os.path.join(chunk_partitions_path, partition, run),
+                                os.path.join(partition_path, f"{i}_{run}"),
+                            )
+                    shutil.rmtree(chunk_partitions_path)
+                    shutil.rmtree(chunk_path)
+
+                # Joining a partition needs all of its runs, so it can only start once every chunk is extracted
+                join_tasks = [
+                    (int(partition), os.path.join(partitions_location, partition))
+                    for partition in sorted(os.listdir(partitions_location), key=int)
+                    if os.listdir(os.path.join(partitions_location, partition))
+                ]
+                for partition_stats, timing in pool.imap_unordered(
+                    functools.partial(
+                        _join_and_transform_partition,
+                        target_location,
+                        transforms,
+                        file_format,
+                        max_memory_bytes // num_threads,
+                        timing_dict is not None,
+                        profile_dir,
+                    ),
+                    join_tasks,
+                ):
+                    if partition_stats is not None:
+                        for name, counts in partition_stats.items():
+                            for k, count in counts.items():
+                                transform_stats[name][k] += count
+                    if timing is not None:
+                        task_timings.append({**timing, "phase": "join_and_transform"})
+
+        for prefix, s, timing, _ in results:
             for k, v in s.items():
                 stats[prefix][k] += v
+            task_timings.append({**timing, "phase": "extract"})
+    finally:
+        shutil.rmtree(staging_location)
 
     if stats_dict is not None:
         stats_dict.update(stats)
 
-    return target
+    if transform_stats_dict is not None:
+        transform_stats_dict.update(transform_stats)
+
+    if timing_dict is not None:
+        transform_seconds: Dict[str, float] = collections.defaultdict(float)
+        for timing in task_timings:
+            for name, seconds in timing.get("transform_seconds", {}).items():
+                transform_seconds[name] += seconds
+        timing_dict.update(summarize_stage(timer.stats, task_timings, group_by="phase"))
+        timing_dict["transform_seconds"] = dict(transform_seconds)
+
+    return PatientCollection(target_location, file_format)
@@ -7,7 +7,7 @@ import datetime
 from typing import Any, Dict, Mapping, Optional, Sequence
 
 from femr.datasets import RawEvent
-from femr.extractors.csv import CSVExtractor
+from femr.extractors.csv import ConceptTableSpec, CSVExtractor
 
 OMOP_BIRTH = 4083587
 OMOP_DEATH = 4306655
@@ -94,6 +94,14 @@ def _try_numeric(val: str) -> float | str | None:
         return val
 
 
+# The following are worth recovering even without the code ...
+_FALLBACK_CONCEPT_IDS = {
+    "note": 46235038,
+    "visit": 8,
+    "visit_detail": 8,
+}
+
+
 @dataclasses.dataclass
 class _ConceptTableConverter(CSVExtractor):
     """A generic OMOP converter for handling tables that contain a single concept."""
@@ -116,6 +124,23 @@ class _ConceptTableConverter(CSVExtractor):
         else:
             return self.prefix
 
+    def get_spec(self) -> Optional[ConceptTableSpec]:
+        concept_id_field = self.concept_id_field or (self.prefix + "_concept_id")
+        return ConceptTableSpec(
+            file_prefix=self.get_file_prefix(),
+            patient_id_field=self.get_patient_id_field(),
+            prefix=self.prefix,
+            concept_id_field=concept_id_field,
+            source_concept_id_field=concept_id_field.replace("concept_id", "source_concept_id"),
+            force_concept_id=self.force_concept_id,
+            string_value_field=self.string_value_field,
+            numeric_value_field=self.numeric_value_field,
+            concept_id_value_field=self.concept_id_value_field,
+            value_source_concept_id_field=concept_id_field.replace("_concept_id", "_source_concept_id"),
+            value_source_code_field=concept_id_field.replace("_concept_id", "_source_value"),
+            fallback_concept_id=_FALLBACK_CONCEPT_IDS.get(self.prefix),
+        )
+
     def get_events(self, row: Mapping[str, str]) -> Sequence[RawEvent]:
         def normalize_to_float_if_possible(field_name: Optional[str], value: str | float | None) -> str | float | None:
             if field_name is not None and field_name in row:
@@ -170,13 +195,8 @@ class _ConceptTableConverter(CSVExtractor):
                 value = None
 
         if concept_id == 0:
-            # The following are worth recovering even without the code ...
-            if self.prefix == "note":
-                concept_id = 46235038
-            elif self.prefix == "visit":
-                concept_id = 8
-            elif self.prefix == "visit_detail":
-                concept_id = 8
+            if self.prefix in _FALLBACK_CONCEPT_IDS:
+                concept_id = _FALLBACK_CONCEPT_IDS[self.prefix]
             else:
                 return []
 
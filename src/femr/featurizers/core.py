@@ -3,13 +3,14 @@ from __future__ import annotations
 
 import multiprocessing
 from abc import ABC, abstractmethod
-from typing import Any, List, Literal, NamedTuple, Optional, Tuple, TypeVar
+from typing import Any, List, Literal, NamedTuple, Optional, Sequence, Tuple, TypeVar
 
 import numpy as np
 import scipy.sparse
 from nptyping import NDArray
 
 from femr import Patient
+from femr.datasets import open_patient_database, split_patient_ids
 from femr.extension import datasets as extension_datasets
 from femr.labelers import Label, LabeledPatients
 
@@ -27,19 +28,15 @@ class ColumnValue(NamedTuple):
     value: float | int
 
 
-def _run_featurizer(args: Tuple[str, List[int], LabeledPatients, List[Featurizer]]) -> Tuple[Any, Any, Any, Any]:
+def _run_featurizer(args: Tuple[str, np.ndarray, LabeledPatients, List[Featurizer]]) -> Tuple[Any, Any, Any, Any]:
     """Apply featurization to the set of patients included in `patient_ids`.
     Gets called as a parallelized subprocess of the .featurize() method of `FeaturizerList`.
     """
     database_path: str = args[0]
-    patient_ids: List[int] = args[1]
+    patient_ids: np.ndarray = args[1]
     labeled_patients: LabeledPatients = args[2]
     featurizers: List[Featurizer] = args[3]
 
-    # Load patients + ontology
-    database: PatientDatabase = PatientDatabase(database_path)
-    ontology: Ontology = database.get_ontology()
-
     # Construct CSR sparse matrix
     #   non-zero entries in sparse matrix
     data: List[Any] = []
@@ -50,51 +47,55 @@ def _run_featurizer(args: Tuple[str, List[int], LabeledPatients, List[Featurizer
     #   tracks Labels
     label_data: List[Tuple] = []
 
-    # For each Patient...
-    for patient_id in patient_ids:
-        patient: Patient = database[patient_id]  # type: ignore
-        labels: List[Label] = labeled_patients.get_labels_from_patient_idx(patient_id)
-
-        if len(labels) == 0:
-            continue
-
-        # For each Featurizer, apply it to this Patient...
-        columns_by_featurizer: List[List[List[ColumnValue]]] = []
-        for featurizer in featurizers:
-            # `features` can be thought of as a 2D array (i.e. list of lists),
-            # where rows correspond to `labels` and columns to `ColumnValue` (i.e. features)
-            features: List[List[ColumnValue]] = featurizer.featurize(patient, labels, ontology)
-            assert len(features) == len(labels), (
-                f"The featurizer `{featurizer}` didn't generate a set of features for "
-                f"every label for patient {patient_id} ({len(features)} != {len(labels)})"
-            )
-            columns_by_featurizer.append(features)
-
-        for i, label in enumerate(labels):
-            indptr.append(len(indices))
-            label_data.append(
-                (
-                    patient_id,  # patient_ids
-                    label.value,  # result_labels
-                    label.time,  # labeling_time
+    # Load patients + ontology
+    with open_patient_database(database_path) as database:
+        ontology: Ontology = database.get_ontology()
+
+        # For each Patient...
+        for patient_id in patient_ids:
+            patient: Patient = database[patient_id]  # type: ignore
+            labels: List[Label] = labeled_patients.get_labels_from_patient_idx(patient_id)
+
+            if len(labels) == 0:
+                continue
+
+            # For each Featurizer, apply it to this Patient...
+            columns_by_featurizer: List[List[List[ColumnValue]]] = []
+            for featurizer in featurizers:
+                # `features` can be thought of as a 2D array (i.e. list of lists),
+                # where rows correspond to `labels` and columns to `ColumnValue` (i.e. features)
+                features: List[List[ColumnValue]] = featurizer.featurize(patient, labels, ontology)
+                assert len(features) == len(labels), (
+                    f"The featurizer `{featurizer}` didn't generate a set of features for "
+                    f"every label for patient {patient_id} ({len(features)} != {len(labels)})"
                 )
-            )
-
-            # Keep track of starting column for each successive featurizer as we
-            # combine their features into one large matrix
-            column_offset: int = 0
-            for j, feature_columns in enumerate(columns_by_featurizer):
-                for column, value in feature_columns[i]:
-                    assert 0 <= column < featurizers[j].get_num_columns(), (
-                        f"The featurizer {featurizers[j]} provided an out of bounds column for "
-                        f"{column} on patient {patient_id} ({column} must be between 0 and "
-                        f"{featurizers[j].get_num_columns()})"
+                columns_by_featurizer.append(features)
+
+            for i, label in enumerate(labels):
+                indptr.append(len(indices))
+                label_data.append(
+                    (
+                        patient_id,  # patient_ids
+                        label.value,  # result_labels
+                        label.time,  # labeling_time
                     )
-                    indices.append(column_offset + column)
-                    data.append(value)
+                )
 
-                # Record what the starting column should be for the next featurizer
-                column_offset += featurizers[j].get_num_columns()
+                # Keep track of starting column for each successive featurizer as we
+                # combine their features into one large matrix
+                column_offset: int = 0
+                for j, feature_columns in enumerate(columns_by_featurizer):
+                    for column, value in feature_columns[i]:
+                        assert 0 <= column < featurizers[j].get_num_columns(), (
+                            f"The featurizer {featurizers[j]} provided an out of bounds column for "
+                            f"{column} on patient {patient_id} ({column} must be between 0 and "
+                            f"{featurizers[j].get_num_columns()})"
+                        )
+                        indices.append(column_offset + column)
+                        data.append(value)
+
+                    # Record what the starting column should be for the next featurizer
+                    column_offset += featurizers[j].get_num_columns()
     # Need one last `indptr` for end of last row in CSR sparse matrix
     indptr.append(len(indices))
 
@@ -128,30 +129,29 @@ def _run_featurizer(args: Tuple[str, List[int], LabeledPatients, List[Featurizer
     return data_matrix, label_pids, label_values, label_times
 
 
-def _run_preprocess_featurizers(args: Tuple[str, List[int], LabeledPatients, List[Featurizer]]) -> List[Featurizer]:
+def _run_preprocess_featurizers(args: Tuple[str, np.ndarray, LabeledPatients, List[Featurizer]]) -> List[Featurizer]:
     """Apply preprocessing of featurizers to the set of patients included in `patient_ids`.
     Gets called as a parallelized subprocess of the .preprocess_featurizers() method of `FeaturizerList`.
     """
     database_path: str = args[0]
-    patient_ids: List[int] = args[1]
+    patient_ids: np.ndarray = args[1]
     labeled_patients: LabeledPatients = args[2]
     featurizers: List[Featurizer] = args[3]
 
     # Load patients
-    database: PatientDatabase = PatientDatabase(database_path)
-
-    # Preprocess featurizers on all Labels for each Patient...
-    for patient_id in patient_ids:
-        patient: Patient = database[patient_id]  # type: ignore
-        labels: List[Label] = labeled_patients.get_labels_from_patient_idx(patient_id)
+    with open_patient_database(database_path) as database:
+        # Preprocess featurizers on all Labels for each Patient...
+        for patient_id in patient_ids:
+            patient: Patient = database[patient_id]  # type: ignore
+            labels: List[Label] = labeled_patients.get_labels_from_patient_idx(patient_id)
 
-        if len(labels) == 0:
-            continue
+            if len(labels) == 0:
+                continue
 
-        # Preprocess featurizers
-        for featurizer in featurizers:
-            if featurizer.is_needs_preprocessing():
-                featurizer.preprocess(patient, labels, database.get_ontology())
+            # Preprocess featurizers
+            for featurizer in featurizers:
+                if featurizer.is_needs_preprocessing():
+                    featurizer.preprocess(patient, labels, database.get_ontology())
 
     return featurizers
 
@@ -275,11 +275,14 @@ class FeaturizerList:
 
     def preprocess_featurizers(
         self,
-        database_path: str,
+        database_path: str | Sequence[str],
         labeled_patients: LabeledPatients,
         num_threads: int = 1,
     ):
-        """Preprocess `self.featurizers` on the provided set of `labeled_patients`."""
+        """Preprocess `self.featurizers` on the provided set of `labeled_patients`.
+
+        A list of database paths is treated as a sharded database, where each task only opens a single shard.
+        """
 
         # Check if any featurizers need preprocessing. If not, return early.
         any_needs_preprocessing: bool = any(featurizer.is_needs_preprocessing() for featurizer in self.featurizers)
@@ -288,9 +291,9 @@ class FeaturizerList:
 
         # Split patients across multiple threads
         patient_ids: List[int] = labeled_patients.get_all_patient_ids()
-        patient_ids_per_thread: List[NDArray[np.int64]] = np.array_split(patient_ids, num_threads * 10)
         tasks = [
-            (database_path, patient_ids, labeled_patients, self.featurizers) for patient_ids in patient_ids_per_thread
+            (path, part, labeled_patients, self.featurizers)
+            for path, part in split_patient_ids(database_path, patient_ids, num_threads * 10)
         ]
 
         # Preprocess in parallel
@@ -312,7 +315,7 @@ class FeaturizerList:
 
     def featurize(
         self,
-        database_path: str,
+        database_path: str | Sequence[str],
         labeled_patients: LabeledPatients,
         num_threads: int = 1,
     ) -> Tuple[
@@ -325,7 +328,8 @@ class FeaturizerList:
         Apply a list of Featurizers (in sequence) to obtain a feature matrix for each Label for each patient.
 
         Args:
-            database_path (str): Path to `PatientDatabase` on disk
+            database_path (str | Sequence[str]): Path to `PatientDatabase` on disk, or a list of paths to the
+                shards of a sharded database
 
         Returns:
             This returns a tuple (data_matrix, labels, patient_ids, labeling_time).
@@ -336,11 +340,10 @@ class FeaturizerList:
         """
 
         patient_ids: List[int] = labeled_patients.get_all_patient_ids()
-        patient_ids_per_thread: List[NDArray[np.int64]] = np.array_split(patient_ids, num_threads * 10)
         tasks = [
-            (database_path, patient_ids, labeled_patients, self.featurizers)
-            for patient_ids in patient_ids_per_thread
-            if len(patient_ids) > 0
+            (path, part, labeled_patients, self.featurizers)
+            for path, part in split_patient_ids(database_path, patient_ids, num_threads * 10)
+            if len(part) > 0
         ]
 
         # Run featurizers in parallel
@@ -5,13 +5,13 @@ import datetime
 import functools
 import random
 from collections import defaultdict, deque
-from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
 
 import numpy as np
 
 from .. import Event, Patient
 from ..extension import datasets as extension_datasets
-from ..labelers import Label
+from ..labelers import CodeSet, Label
 from .core import ColumnValue, Featurizer
 from .utils import OnlineStatistics
 
@@ -167,9 +167,9 @@ class ReservoirSampler:
         self.total += 1
 
 
-def exclusion_helper(event, fallback_function, excluded_codes_set):
+def exclusion_helper(event, fallback_function, excluded_codes_set: Optional[CodeSet]):
     if excluded_codes_set is not None:
-        if event.code in excluded_codes_set:
+        if excluded_codes_set.contains_event(event):
             return True
     if fallback_function is not None:
         return fallback_function(event)
@@ -187,7 +187,7 @@ class CountFeaturizer(Featurizer):
     def __init__(
         self,
         is_ontology_expansion: bool = False,
-        excluded_codes: Iterable[str] = [],
+        excluded_codes: Iterable[str | int] = [],
         excluded_event_filter: Optional[Callable[[Event], bool]] = None,
         time_bins: Optional[List[datetime.timedelta]] = None,
         numeric_value_decile: bool = False,
@@ -204,7 +204,8 @@ class CountFeaturizer(Featurizer):
                     Where "->" denotes "is a parent of" relationship (i.e. A is a parent of B, B is a parent of C).
                     Then if we see 2 occurrences of Code "C", we count 2 occurrences of Code "B" and Code "A".
 
-            excluded_codes (List[str], optional): A list of femr codes that we will ignore. Defaults to [].
+            excluded_codes (List[str | int], optional): A list of femr codes that we will ignore. Defaults to [].
+                Codes can also be given as integer code indices (see `Event.code_index`).
 
             time_bins (Optional[List[datetime.timedelta]], optional): Group counts into buckets.
                 Starts from the label time, and works backwards according to each successive value in `time_bins`.
@@ -231,7 +232,7 @@ class CountFeaturizer(Featurizer):
         """
         self.is_ontology_expansion: bool = is_ontology_expansion
         self.excluded_event_filter = functools.partial(
-            exclusion_helper, fallback_function=excluded_event_filter, excluded_codes_set=set(excluded_codes)
+            exclusion_helper, fallback_function=excluded_event_filter, excluded_codes_set=CodeSet(excluded_codes)
         )
         self.time_bins: Optional[List[datetime.timedelta]] = time_bins
         self.characters_for_string_values: int = characters_for_string_values
@@ -252,6 +253,10 @@ class CountFeaturizer(Featurizer):
 
         self.finalized = False
 
+        # Caches keyed by event code index, which are only valid for the database they were built from
+        self._code_index_database_id: Optional[int] = None
+        self._code_index_caches: Dict[str, Dict[int, Any]] = {}
+
     def get_codes(self, code: str, ontology: extension_datasets.Ontology) -> Iterator[str]:
         if self.is_ontology_expansion:
             for subcode in ontology.get_all_parents(code):
@@ -259,12 +264,67 @@ class CountFeaturizer(Featurizer):
         else:
             yield code
 
+    def _get_code_index_cache(
+        self, event, ontology: extension_datasets.Ontology, name: str
+    ) -> Optional[Dict[int, Any]]:
+        """Get a cache keyed by `event.code_index`, which is only valid for a single database's ontology.
+
+        Returns None if the event has no code index, the ontology is a composite of several databases,
+        or the database is too old to have an id.
+        """
+        if event.code_index is None or not isinstance(ontology, extension_datasets.Ontology):
+            return None
+        database_id = ontology.get_database_id()
+        if database_id == 0:
+            return None
+        if database_id != self._code_index_database_id:
+            self._code_index_database_id = database_id
+            self._code_index_caches = {}
+        return self._code_index_caches.setdefault(name, {})
+
+    def get_event_codes(self, event, ontology: extension_datasets.Ontology) -> Sequence[str]:
+        """Get the (possibly ontology expanded) codes for an event, caching them by code index if possible."""
+        cache = self._get_code_index_cache(event, ontology, "codes")
+        if cache is None:
+            return list(self.get_codes(event.code, ontology))
+
+        code_index = event.code_index
+        codes = cache.get(code_index)
+        if codes is None:
+            codes = cache[code_index] = tuple(self.get_codes(event.code, ontology))
+        return codes
+
+    def get_code_columns(self, event, ontology: extension_datasets.Ontology) -> Sequence[int]:
+        """Get the columns for an event without a value, caching them by code index if possible."""
+        code_index = event.code_index
+        cache = self._get_code_index_cache(event, ontology, "columns")
+        if cache is not None and code_index in cache:
+            return cache[code_index]
+
+        columns = tuple(
+            self.code_to_column_index[code]
+            for code in self.get_event_codes(event, ontology)
+            if code in self.code_to_column_index
+        )
+        if cache is not None:
+            cache[code_index] = columns
+        return columns
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Drop the code index caches, as they are tied to the database they were built from."""
+        state = self.__dict__.copy()
+        state["_code_index_database_id"] = None
+        state["_code_index_caches"] = {}
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self._code_index_database_id = None
+        self._code_index_caches = {}
+        self.__dict__.update(state)
+
     def get_columns(self, event, ontology: extension_datasets.Ontology) -> Iterator[int]:
         if event.value is None:
-            for code in self.get_codes(event.code, ontology):
-                # If we haven't seen this code before, then add it to our list of included codes
-                if code in self.code_to_column_index:
-                    yield self.code_to_column_index[code]
+            yield from self.get_code_columns(event, ontology)
         elif type(event.value) is str:
             k = (event.code, event.value[: self.characters_for_string_values])
             if k in self.code_string_to_column_index:
@@ -284,9 +344,8 @@ class CountFeaturizer(Featurizer):
                 continue
 
             if event.value is None:
-                for code in self.get_codes(event.code, ontology):
-                    # If we haven't seen this code before, then add it to our list of included codes
-                    self.observed_codes.add(code)
+                # If we haven't seen this code before, then add it to our list of included codes
+                self.observed_codes.update(self.get_event_codes(event, ontology))
             elif type(event.value) is str:
                 if self.string_value_combination:
                     self.observed_string_value[(event.code, event.value[: self.characters_for_string_values])] += 1
@@ -12,13 +12,13 @@ import warnings
 from abc import ABC, abstractmethod
 from collections.abc import MutableMapping
 from dataclasses import dataclass
-from typing import Any, DefaultDict, Dict, List, Literal, Mapping, Optional, Sequence, Set, Tuple, Union, cast
+from typing import Any, DefaultDict, Dict, Iterable, List, Literal, Mapping, Optional, Sequence, Set, Tuple, Union, cast
 
 import numpy as np
 from nptyping import NDArray
 
-from femr import Patient
-from femr.datasets import PatientDatabase
+from femr import Event, Patient
+from femr.datasets import open_patient_database, split_patient_ids
 from femr.extension import datasets as extension_datasets
 
 
@@ -49,6 +49,34 @@ LabelType = Union[
 VALID_LABEL_TYPES = ["boolean", "numeric", "survival", "categorical", "none"]
 
 
+class CodeSet:
+    """A set of codes, given as femr code strings and/or integer code indices.
+
+    Integer code indices are matched against `event.code_index`, which avoids materializing and hashing the
+    code string of every event. Code indices are only valid for the database they come from.
+    """
+
+    def __init__(self, codes: Iterable[str | int] = ()):
+        self.code_strs: Set[str] = set()
+        self.code_indices: Set[int] = set()
+        for code in codes:
+            if isinstance(code, str):
+                self.code_strs.add(code)
+            else:
+                self.code_indices.add(int(code))
+
+    def contains_event(self, event: Event) -> bool:
+        """Check whether the code of `event` is in this set."""
+        if self.code_indices:
+            code_index = event.code_index
+            if code_index is not None and code_index in self.code_indices:
+                return True
+        return len(self.code_strs) > 0 and event.code in self.code_strs
+
+    def __len__(self) -> int:
+        return len(self.code_strs) + len(self.code_indices)
+
+
 @dataclass
 class Label:
     """An individual label for a particular patient at a particular time.
@@ -59,38 +87,40 @@ class Label:
 
 
 def _apply_labeling_function(
-    args: Tuple[Labeler, Optional[Mapping[int, Patient]], Optional[str], List[int]]
+    args: Tuple[Labeler, Optional[Mapping[int, Patient]], Optional[str], np.ndarray]
 ) -> Dict[int, List[Label]]:
     """Apply a labeling function to the set of patients included in `patient_ids`.
     Gets called as a parallelized subprocess of the .apply() method of `Labeler`."""
     labeling_function: Labeler = args[0]
     patients: Optional[Mapping[int, Patient]] = args[1]
     path_to_patient_database: Optional[str] = args[2]
-    patient_ids: List[int] = args[3]
+    patient_ids: np.ndarray = args[3]
 
+    database = None
+    ontology_targets: List[Any] = []
     if path_to_patient_database is not None:
-        patients = cast(Mapping[int, Patient], PatientDatabase(path_to_patient_database))
-
-    # Hacky workaround for Ontology not being picklable
-    if (
-        hasattr(labeling_function, "ontology")  # type: ignore
-        and labeling_function.ontology is None  # type: ignore
-        and path_to_patient_database  # type: ignore
-    ):  # type: ignore
-        labeling_function.ontology = patients.get_ontology()  # type: ignore
-    if (
-        hasattr(labeling_function, "labeler")
-        and hasattr(labeling_function.labeler, "ontology")
-        and labeling_function.labeler.ontology is None
-        and path_to_patient_database
-    ):
-        labeling_function.labeler.ontology = patients.get_ontology()  # type: ignore
-
-    patients_to_labels: Dict[int, List[Label]] = {}
-    for patient_id in patient_ids:
-        patient: Patient = patients[patient_id]  # type: ignore
-        labels: List[Label] = labeling_function.label(patient)
-        patients_to_labels[patient_id] = labels
+        # Tasks hold contiguous runs of patients in database order
+        database = open_patient_database(path_to_patient_database, access="sequential")
+        patients = cast(Mapping[int, Patient], database)
+
+        # Hacky workaround for Ontology not being picklable
+        for target in (labeling_function, getattr(labeling_function, "labeler", None)):
+            if hasattr(target, "ontology") and target.ontology is None:  # type: ignore
+                target.ontology = database.get_ontology()  # type: ignore
+                ontology_targets.append(target)
+
+    try:
+        patients_to_labels: Dict[int, List[Label]] = {}
+        for patient_id in patient_ids:
+            patient: Patient = patients[patient_id]  # type: ignore
+            labels: List[Label] = labeling_function.label(patient)
+            patients_to_labels[patient_id] = labels
+    finally:
+        if database is not None:
+            # Detach the ontology before closing the database so later tasks reload it
+            for target in ontology_targets:
+                target.ontology = None
+            database.close()
 
     return patients_to_labels
 
@@ -354,7 +384,7 @@ class Labeler(ABC):
 
     def apply(
         self,
-        path_to_patient_database: Optional[str] = None,
+        path_to_patient_database: Optional[str | Sequence[str]] = None,
         patients: Optional[Sequence[Patient]] = None,
         num_threads: int = 1,
         num_patients: Optional[int] = None,
@@ -363,8 +393,9 @@ class Labeler(ABC):
         """Apply the `label()` function one-by-one to each Patient in a sequence of Patients.
 
         Args:
-            path_to_patient_database (str, optional): Path to `PatientDatabase` on disk.
-                Must be specified if `patients = None`
+            path_to_patient_database (str | Sequence[str], optional): Path to `PatientDatabase` on disk.
+                Must be specified if `patients = None`. A list of paths is treated as a sharded database,
+                and each task then only opens the shard holding its patients.
             patients (Sequence[Patient], optional): An Sequence (i.e. list) of `Patient` objects.
                 Must be specified if `path_to_patient_database = None`
                 Typically this will be a `PatientDatabase` object.
@@ -384,9 +415,9 @@ class Labeler(ABC):
         if path_to_patient_database:
             # Load patientdatabase if specified
             assert patients is None
-            patient_database = PatientDatabase(path_to_patient_database)
-            num_patients = len(patient_database) if not num_patients else num_patients
-            pids = list(patient_database)
+            with open_patient_database(path_to_patient_database) as patient_database:
+                num_patients = len(patient_database) if not num_patients else num_patients
+                pids = list(patient_database)
             patient_map = None
         else:
             # Use `patients` if specified
@@ -401,7 +432,11 @@ class Labeler(ABC):
         pids = pids[:num_patients]
 
         # Split patient IDs across parallelized processes
-        pid_parts = np.array_split(pids, num_threads * 10)
+        path_and_pid_parts: Sequence[Tuple[Optional[str], np.ndarray]]
+        if path_to_patient_database:
+            path_and_pid_parts = split_patient_ids(path_to_patient_database, pids, num_threads * 10)
+        else:
+            path_and_pid_parts = [(None, pid_part) for pid_part in np.array_split(pids, num_threads * 10)]
 
         # NOTE: Super hacky workaround to pickling limitations
         if hasattr(self, "ontology") and isinstance(self.ontology, extension_datasets.Ontology):  # type: ignore
@@ -416,7 +451,9 @@ class Labeler(ABC):
             self.labeler.ontology: extension_datasets.Ontology = None  # type: ignore
 
         # Multiprocessing
-        tasks = [(self, patient_map, path_to_patient_database, pid_part) for pid_part in pid_parts if len(pid_part) > 0]
+        tasks: List[Tuple[Labeler, Optional[Mapping[int, Patient]], Optional[str], np.ndarray]] = [
+            (self, patient_map, path, pid_part) for path, pid_part in path_and_pid_parts if len(pid_part) > 0
+        ]
 
         if num_threads != 1:
             ctx = multiprocessing.get_context("forkserver")
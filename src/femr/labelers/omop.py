@@ -5,11 +5,11 @@ import datetime
 import warnings
 from abc import abstractmethod
 from collections import deque
-from typing import Any, Callable, List, Optional, Set, Tuple
+from typing import Any, Callable, List, Optional, Sequence, Set, Tuple
 
 from .. import Event, Patient
 from ..extension import datasets as extension_datasets
-from .core import Label, Labeler, LabelType, TimeHorizon, TimeHorizonEventLabeler
+from .core import CodeSet, Label, Labeler, LabelType, TimeHorizon, TimeHorizonEventLabeler
 
 
 def identity(x: Any) -> Any:
@@ -268,27 +268,35 @@ class CodeLabeler(TimeHorizonEventLabeler):
 
     def __init__(
         self,
-        outcome_codes: List[str],
+        outcome_codes: Sequence[str | int],
         time_horizon: TimeHorizon,
-        prediction_codes: Optional[List[str]] = None,
+        prediction_codes: Optional[Sequence[str | int]] = None,
         prediction_time_adjustment_func: Callable = identity,
     ):
         """Create a CodeLabeler, which labels events whose index in your Ontology is in `self.outcome_codes`
 
+        Codes can be given as femr code strings or as integer code indices (see `Event.code_index`).
+        Integer code indices are faster to match, but are only valid for a single database.
+
         Args:
-            prediction_codes (List[int]): Events that count as an occurrence of the outcome.
+            outcome_codes (Sequence[str | int]): Events that count as an occurrence of the outcome.
             time_horizon (TimeHorizon): An interval of time. If the event occurs during this time horizon, then
                 the label is TRUE. Otherwise, FALSE.
-            prediction_codes (Optional[List[int]]): If not None, limit events at which you make predictions to
-                only events with an `event.code` in these codes.
+            prediction_codes (Optional[Sequence[str | int]]): If not None, limit events at which you make predictions
+                to only events with an `event.code` in these codes.
             prediction_time_adjustment_func (Optional[Callable]). A function that takes in a `datetime.datetime`
                 and returns a different `datetime.datetime`. Defaults to the identity function.
         """
-        self.outcome_codes: List[str] = outcome_codes
+        self.outcome_codes: Sequence[str | int] = outcome_codes
         self.time_horizon: TimeHorizon = time_horizon
-        self.prediction_codes: Optional[List[str]] = prediction_codes
+        self.prediction_codes: Optional[Sequence[str | int]] = prediction_codes
         self.prediction_time_adjustment_func: Callable = prediction_time_adjustment_func
 
+        self.outcome_code_set: CodeSet = CodeSet(outcome_codes)
+        self.prediction_code_set: Optional[CodeSet] = (
+            CodeSet(prediction_codes) if prediction_codes is not None else None
+        )
+
     def get_prediction_times(self, patient: Patient) -> List[datetime.datetime]:
         """Return each event's start time (possibly modified by prediction_time_adjustment_func)
         as the time to make a prediction. Default to all events whose `code` is in `self.prediction_codes`."""
@@ -296,7 +304,7 @@ class CodeLabeler(TimeHorizonEventLabeler):
         last_time = None
         for e in patient.events:
             prediction_time: datetime.datetime = self.prediction_time_adjustment_func(e.start)
-            if ((self.prediction_codes is None) or (e.code in self.prediction_codes)) and (
+            if ((self.prediction_code_set is None) or self.prediction_code_set.contains_event(e)) and (
                 last_time != prediction_time
             ):
                 times.append(prediction_time)
@@ -310,7 +318,7 @@ class CodeLabeler(TimeHorizonEventLabeler):
         """Return the start times of this patient's events whose `code` is in `self.outcome_codes`."""
         times: List[datetime.datetime] = []
         for event in patient.events:
-            if event.code in self.outcome_codes:
+            if self.outcome_code_set.contains_event(event):
                 times.append(event.start)
         return times
 
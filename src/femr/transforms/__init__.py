@@ -1,13 +1,15 @@
 """A collection of general use transforms."""
+import dataclasses
 import datetime
-from typing import Any, Callable, Dict, Optional, Set, Tuple
+from typing import Any, Callable, Dict, Mapping, Optional, Set, Tuple
 
-from femr.datasets import RawEvent, RawPatient
+from femr.datasets import NativeTransform, RawEvent, RawPatient
 
 
 def remove_nones(
     patient: RawPatient,
     do_not_apply_to_filter: Optional[Callable[[RawEvent], bool]] = None,
+    resort: bool = True,
 ) -> RawPatient:
     """Remove duplicate codes w/in same day if duplicate code has None value.
 
@@ -34,7 +36,8 @@ def remove_nones(
 
     patient.events = new_events
 
-    patient.resort()
+    if resort:
+        patient.resort()
 
     return patient
 
@@ -42,6 +45,7 @@ def remove_nones(
 def delta_encode(
     patient: RawPatient,
     do_not_apply_to_filter: Optional[Callable[[RawEvent], bool]] = None,
+    resort: bool = True,
 ) -> RawPatient:
     """Delta encodes the patient.
 
@@ -64,6 +68,63 @@ def delta_encode(
 
     patient.events = new_events
 
-    patient.resort()
+    if resort:
+        patient.resort()
 
     return patient
+
+
+def _get_omop_table_filter(omop_table: Optional[str]) -> Optional[Callable[[RawEvent], bool]]:
+    """Get a do_not_apply_to_filter that matches the events from a given OMOP table."""
+    if omop_table is None:
+        return None
+    return lambda event: event.omop_table == omop_table
+
+
+@dataclasses.dataclass(frozen=True)
+class MapConcepts(NativeTransform):
+    """Replace the concept ids in `concept_map` with the concept ids they map to."""
+
+    concept_map: Mapping[int, int] = dataclasses.field(repr=False)
+
+    needs_sorted_events = False
+
+    def apply(self, patient: RawPatient) -> RawPatient:
+        for event in patient.events:
+            event.concept_id = self.concept_map.get(event.concept_id, event.concept_id)
+
+        return patient
+
+    def get_native_transform(self) -> Tuple[str, Dict[str, Any]]:
+        return "map_concepts", {"concept_map": dict(self.concept_map)}
+
+
+@dataclasses.dataclass(frozen=True)
+class RemoveNones(NativeTransform):
+    """`remove_nones`, which never removes events from `skip_omop_table`."""
+
+    skip_omop_table: Optional[str] = None
+
+    needs_sorted_events = False
+    preserves_order = True
+
+    def apply(self, patient: RawPatient) -> RawPatient:
+        return remove_nones(patient, _get_omop_table_filter(self.skip_omop_table), resort=False)
+
+    def get_native_transform(self) -> Tuple[str, Dict[str, Any]]:
+        return "remove_nones", {"skip_omop_table": self.skip_omop_table}
+
+
+@dataclasses.dataclass(frozen=True)
+class DeltaEncode(NativeTransform):
+    """`delta_encode`, which never removes events from `skip_omop_table`."""
+
+    skip_omop_table: Optional[str] = None
+
+    preserves_order = True
+
+    def apply(self, patient: RawPatient) -> RawPatient:
+        return delta_encode(patient, _get_omop_table_filter(self.skip_omop_table), resort=False)
+
+    def get_native_transform(self) -> Tuple[str, Dict[str, Any]]:
+        return "delta_encode", {"skip_omop_table": self.skip_omop_table}
@@ -1,8 +1,9 @@
 """Transforms that are unique to MIMIC OMOP."""
+import dataclasses
 import datetime
-from typing import Dict, List
+from typing import Any, Dict, List, Tuple
 
-from femr.datasets import RawPatient
+from femr.datasets import NativeTransform, RawPatient
 
 
 def move_early_end_date_to_start_date(patient: RawPatient) -> RawPatient:
@@ -19,7 +20,7 @@ def move_early_end_date_to_start_date(patient: RawPatient) -> RawPatient:
     return patient
 
 
-def move_billing_codes(patient: RawPatient) -> RawPatient:
+def move_billing_codes(patient: RawPatient, resort: bool = True) -> RawPatient:
     """Move billing codes to the end of each visit.
 
     One issue with MIMIC is that billing codes are assigned at the start of the visit.
@@ -58,7 +59,8 @@ def move_billing_codes(patient: RawPatient) -> RawPatient:
             new_events.append(event)
 
     patient.events = new_events
-    patient.resort()
+    if resort:
+        patient.resort()
 
     return patient
 
@@ -74,3 +76,41 @@ def remove_very_old(patient: RawPatient) -> RawPatient:
         new_events.append(event)
     patient.events = new_events
     return patient
+
+
+@dataclasses.dataclass(frozen=True)
+class MoveEarlyEndDateToStartDate(NativeTransform):
+    """`move_early_end_date_to_start_date` as a transform that can also be applied natively."""
+
+    needs_sorted_events = False
+    preserves_order = True
+
+    def apply(self, patient: RawPatient) -> RawPatient:
+        return move_early_end_date_to_start_date(patient)
+
+    def get_native_transform(self) -> Tuple[str, Dict[str, Any]]:
+        return "move_early_end_date_to_start_date", {}
+
+
+@dataclasses.dataclass(frozen=True)
+class MoveBillingCodes(NativeTransform):
+    """`move_billing_codes` as a transform that can also be applied natively."""
+
+    def apply(self, patient: RawPatient) -> RawPatient:
+        return move_billing_codes(patient, resort=False)
+
+    def get_native_transform(self) -> Tuple[str, Dict[str, Any]]:
+        return "move_mimic_billing_codes", {}
+
+
+@dataclasses.dataclass(frozen=True)
+class RemoveVeryOld(NativeTransform):
+    """`remove_very_old` as a transform that can also be applied natively."""
+
+    preserves_order = True
+
+    def apply(self, patient: RawPatient) -> RawPatient:
+        return remove_very_old(patient)
+
+    def get_native_transform(self) -> Tuple[str, Dict[str, Any]]:
+        return "remove_very_old", {}
@@ -7,7 +7,7 @@ from typing import List, Optional
 
 from .. import Event
 from ..featurizers.featurizers_notes import Note
-from ..labelers import Label
+from ..labelers import CodeSet, Label
 
 
 def remove_short_notes(notes: List[Note], label: Label, min_char_count: int = 0, **kwargs) -> List[Note]:
@@ -25,13 +25,17 @@ def remove_short_notes(notes: List[Note], label: Label, min_char_count: int = 0,
 def keep_only_notes_matching_codes(
     notes: List[Note],
     label: Label,
-    keep_notes_with_codes: List[int] = [],
+    keep_notes_with_codes: List[str | int] = [],
     **kwargs,
 ) -> List[Note]:
-    """Keep only notes that have a `code` contained in `keep_notes_with_codes`."""
+    """Keep only notes that have a `code` contained in `keep_notes_with_codes`.
+
+    Codes can be femr code strings or integer code indices (see `Event.code_index`).
+    """
+    codes = CodeSet(keep_notes_with_codes)
     new_notes: List[Note] = []
     for note in notes:
-        if note.event.code in keep_notes_with_codes:
+        if codes.contains_event(note.event):
             new_notes.append(note)
     return new_notes
 
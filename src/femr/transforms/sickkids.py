@@ -1,9 +1,10 @@
 """Transforms that are unique to SK OMOP."""
 
+import dataclasses
 import datetime
-from typing import Optional
+from typing import Any, Dict, Optional, Tuple
 
-from femr.datasets import RawPatient
+from femr.datasets import NativeTransform, RawPatient
 from femr.extractors.omop import OMOP_BIRTH
 
 
@@ -18,12 +19,40 @@ def replace_categorical_measurement_results(patient: RawPatient) -> RawPatient:
     return patient
 
 
-def replace_default_birthdate(patient: RawPatient) -> Optional[RawPatient]:
+def replace_default_birthdate(patient: RawPatient, resort: bool = True) -> Optional[RawPatient]:
     """Replace default birthdate in SickKids OMOP (1-1-1) with (1900-1-1)."""
     for event in patient.events:
         if event.concept_id == OMOP_BIRTH and event.start == datetime.datetime(1, 1, 1):
             event.start = datetime.datetime(1900, 1, 1)
 
-    patient.resort()
+    if resort:
+        patient.resort()
 
     return patient
+
+
+@dataclasses.dataclass(frozen=True)
+class ReplaceCategoricalMeasurementResults(NativeTransform):
+    """`replace_categorical_measurement_results` as a transform that can also be applied natively."""
+
+    needs_sorted_events = False
+    preserves_order = True
+
+    def apply(self, patient: RawPatient) -> RawPatient:
+        return replace_categorical_measurement_results(patient)
+
+    def get_native_transform(self) -> Tuple[str, Dict[str, Any]]:
+        return "replace_categorical_measurement_results", {}
+
+
+@dataclasses.dataclass(frozen=True)
+class ReplaceDefaultBirthdate(NativeTransform):
+    """`replace_default_birthdate` as a transform that can also be applied natively."""
+
+    needs_sorted_events = False
+
+    def apply(self, patient: RawPatient) -> Optional[RawPatient]:
+        return replace_default_birthdate(patient, resort=False)
+
+    def get_native_transform(self) -> Tuple[str, Dict[str, Any]]:
+        return "replace_default_birthdate", {"birth_concept_id": OMOP_BIRTH}
@@ -1,9 +1,10 @@
 """Transforms that are unique to STARR OMOP."""
 
+import dataclasses
 import datetime
-from typing import Dict, Optional, Tuple
+from typing import Any, Dict, Optional, Tuple
 
-from femr.datasets import RawPatient
+from femr.datasets import NativeTransform, RawPatient
 from femr.extractors.omop import OMOP_BIRTH
 
 
@@ -39,7 +40,7 @@ def move_visit_start_to_day_start(patient: RawPatient) -> RawPatient:
     return patient
 
 
-def move_visit_start_to_first_event_start(patient: RawPatient) -> RawPatient:
+def move_visit_start_to_first_event_start(patient: RawPatient, resort: bool = True) -> RawPatient:
     """Assign visit start times to equal start time of first event in visit
 
     This function assigns the start time associated with each visit to be
@@ -94,12 +95,13 @@ def move_visit_start_to_first_event_start(patient: RawPatient) -> RawPatient:
                 # Reset the visit end to be ≥ the visit start
                 event.end = max(event.start, event.end)
 
-    patient.resort()
+    if resort:
+        patient.resort()
 
     return patient
 
 
-def move_to_day_end(patient: RawPatient) -> RawPatient:
+def move_to_day_end(patient: RawPatient, resort: bool = True) -> RawPatient:
     """We assume that everything coded at midnight should actually be moved to the end of the day."""
     for event in patient.events:
         if event.concept_id == OMOP_BIRTH:
@@ -110,12 +112,13 @@ def move_to_day_end(patient: RawPatient) -> RawPatient:
             event.end = _move_date_to_end(event.end)
             event.end = max(event.end, event.start)
 
-    patient.resort()
+    if resort:
+        patient.resort()
 
     return patient
 
 
-def move_pre_birth(patient: RawPatient) -> Optional[RawPatient]:
+def move_pre_birth(patient: RawPatient, resort: bool = True) -> Optional[RawPatient]:
     """Move all events to after the birth of a patient."""
     birth_date = None
     for event in patient.events:
@@ -140,12 +143,13 @@ def move_pre_birth(patient: RawPatient) -> Optional[RawPatient]:
         new_events.append(event)
 
     patient.events = new_events
-    patient.resort()
+    if resort:
+        patient.resort()
 
     return patient
 
 
-def move_billing_codes(patient: RawPatient) -> RawPatient:
+def move_billing_codes(patient: RawPatient, resort: bool = True) -> RawPatient:
     """Move billing codes to the end of each visit.
 
     One issue with our OMOP extract is that billing codes are incorrectly assigned at the start of the visit.
@@ -215,6 +219,61 @@ def move_billing_codes(patient: RawPatient) -> RawPatient:
 
     patient.events = new_events
 
-    patient.resort()
+    if resort:
+        patient.resort()
 
     return patient
+
+
+@dataclasses.dataclass(frozen=True)
+class MovePreBirth(NativeTransform):
+    """`move_pre_birth` as a transform that can also be applied natively."""
+
+    def apply(self, patient: RawPatient) -> Optional[RawPatient]:
+        return move_pre_birth(patient, resort=False)
+
+    def get_native_transform(self) -> Tuple[str, Dict[str, Any]]:
+        return "move_pre_birth", {"birth_concept_id": OMOP_BIRTH}
+
+
+@dataclasses.dataclass(frozen=True)
+class MoveVisitStartToFirstEventStart(NativeTransform):
+    """`move_visit_start_to_first_event_start` as a transform that can also be applied natively."""
+
+    needs_sorted_events = False
+
+    def apply(self, patient: RawPatient) -> RawPatient:
+        return move_visit_start_to_first_event_start(patient, resort=False)
+
+    def get_native_transform(self) -> Tuple[str, Dict[str, Any]]:
+        return "move_visit_start_to_first_event_start", {}
+
+
+@dataclasses.dataclass(frozen=True)
+class MoveToDayEnd(NativeTransform):
+    """`move_to_day_end` as a transform that can also be applied natively."""
+
+    needs_sorted_events = False
+
+    def apply(self, patient: RawPatient) -> RawPatient:
+        return move_to_day_end(patient, resort=False)
+
+    def get_native_transform(self) -> Tuple[str, Dict[str, Any]]:
+        return "move_to_day_end", {"birth_concept_id": OMOP_BIRTH}
+
+
+@dataclasses.dataclass(frozen=True)
+class MoveBillingCodes(NativeTransform):
+    """`move_billing_codes` as a transform that can also be applied natively.
+
+    The native implementation reads the clarity_table from the pickled metadata of events, so it only supports
+    metadata that is pickled from plain data.
+    """
+
+    needs_sorted_events = False
+
+    def apply(self, patient: RawPatient) -> RawPatient:
+        return move_billing_codes(patient, resort=False)
+
+    def get_native_transform(self) -> Tuple[str, Dict[str, Any]]:
+        return "move_billing_codes", {}
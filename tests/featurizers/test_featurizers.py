@@ -229,6 +229,14 @@ def test_count_featurizer_exclude_filter(tmp_path: pathlib.Path):
 
     assert count_nonempty_columns(patient_features) == 2
 
+    # Test excluding codes by string and by integer code index
+    for excluded_code in ("dummy/three", ontology.get_code_index("dummy/three")):
+        featurizer = CountFeaturizer(excluded_codes=[excluded_code])
+        featurizer.preprocess(patient, labels, ontology)
+        patient_features = featurizer.featurize(patient, labels, ontology)
+
+        assert count_nonempty_columns(patient_features) == 2
+
 
 def test_count_bins_featurizer(tmp_path: pathlib.Path):
     time_horizon = TimeHorizon(datetime.timedelta(days=0), datetime.timedelta(days=180))
@@ -6,6 +6,7 @@ import pathlib
 import sys
 from typing import List
 
+import femr
 from femr.labelers import TimeHorizon
 from femr.labelers.omop import (
     AKICodeLabeler,
@@ -106,6 +107,14 @@ def test_outcome_codes(tmp_path: pathlib.Path):
     ]
     run_test_for_labeler(labeler, events_with_labels, help_text="test_outcome_codes_multiple")
 
+    # Integer code indices match `event.code_index` instead of `event.code`
+    labeler = CodeLabeler([1, "4"], time_horizon)
+    events_with_labels = [
+        (femr.Event(start=e.start, code=e.code, value=e.value, code_index=int(e.code)), label)
+        for e, label in events_with_labels
+    ]
+    run_test_for_labeler(labeler, events_with_labels, help_text="test_outcome_codes_indices")
+
 
 def test_prediction_codes(tmp_path: pathlib.Path):
     # One outcome + multiple predictions
@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+import json
+import pathlib
+
+import femr.benchmarks
+
+
+def test_run_benchmarks(tmp_path: pathlib.Path) -> None:
+    results = femr.benchmarks.run_benchmarks(
+        str(tmp_path), num_patients=50, events_per_patient=20, num_random_access=100, skip_batches=True
+    )
+
+    assert results["config"]["num_patients"] == 50
+    timings = results["results"]
+    for name in [
+        "etl_run_csv_extractors",
+        "etl_to_patient_collection",
+        "etl_transform",
+        "etl_to_patient_database",
+        "patient_random_access",
+        "patient_full_iteration",
+        "labeler_apply",
+        "featurizer_featurize",
+    ]:
+        assert timings[name]["seconds"] >= 0
+
+    assert timings["patient_random_access"]["count"] == 100
+    # The transforms drop some of the generated events
+    assert 0 < timings["patient_full_iteration"]["count"] <= 50 * 20
+
+    # Results must be serializable for tracking across releases
+    json.dumps(results)
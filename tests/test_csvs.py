@@ -3,13 +3,17 @@ import datetime
 import io
 import os
 import pathlib
-from typing import Dict, Mapping, Sequence
+import random
+import struct
+from typing import Any, Dict, List, Mapping, Sequence, Tuple
 
 import zstandard as zst
 
 import femr
 import femr.datasets
-from femr.extractors.csv import run_csv_extractors
+from femr.extractors.csv import _get_zstd_frames, run_csv_extractors, run_csv_extractors_to_patients
+from femr.extractors.omop import get_omop_csv_extractors
+from femr.transforms import RemoveNones
 
 
 class DummyConverter(femr.extractors.csv.CSVExtractor):
@@ -75,3 +79,263 @@ def test_csv_zst(tmp_path: pathlib.Path) -> None:
 def test_csv(tmp_path: pathlib.Path) -> None:
     _ = create_csv(tmp_path)
     run_test(tmp_path)
+
+
+def test_csv_timing(tmp_path: pathlib.Path) -> None:
+    _ = create_csv(tmp_path)
+
+    timing_dict: Dict[str, Any] = {}
+    run_csv_extractors(
+        str(tmp_path),
+        os.path.join(tmp_path, "event_collection"),
+        [DummyConverter()],
+        timing_dict=timing_dict,
+    )
+
+    assert timing_dict["rows"] == len(ROWS)
+    assert timing_dict["extractor"]["temp"]["rows"] == len(ROWS)
+    assert timing_dict["extractor"]["temp"]["tasks"] == 1
+    assert len(timing_dict["workers"]) == 1
+    assert timing_dict["cpu_seconds"] >= 0
+
+
+OMOP_TABLES: Dict[str, List[List[Any]]] = {
+    "measurement": [
+        [
+            "person_id",
+            "measurement_concept_id",
+            "measurement_source_concept_id",
+            "measurement_date",
+            "measurement_datetime",
+            "value_source_value",
+            "value_as_number",
+            "value_as_concept_id",
+            "measurement_source_value",
+            "visit_occurrence_id",
+            "unit_source_value",
+            "load_table_id",
+        ],
+        [1, 5, 0, "2010-01-03", "", "foo", "", "", "", "", "", "lab"],
+        [1, 5, 7, "2010-01-03", "2010-01-03 04:05:06", "", "2.5", "", "", 3, "mg", ""],
+        [2, 0, 0, "2011-02-01", "", "", "", "", "", "", "", ""],
+        [2, 6, 0, "2011-02-01", "", "", "", 9, "code", "", "", ""],
+        [2, 6, 10, "2011-02-01", "", "", "", 9, "code", "", "", ""],
+    ],
+    "visit_occurrence": [
+        ["Person_ID", "visit_concept_id", "visit_start_date", "visit_end_date", "visit_end_datetime"],
+        [3, 0, "2012-05-06", "2012-05-08", "2012-05-08T10:00:00.250"],
+        [3, 9202, "2012-06-01", "", ""],
+    ],
+    "note": [
+        ["person_id", "note_class_concept_id", "note_date", "note_text", "note_id"],
+        [4, 0, "2013-01-01", "Some text, with a comma", 12],
+    ],
+}
+
+
+def test_spec_extractors(tmp_path: pathlib.Path) -> None:
+    source = os.path.join(tmp_path, "source")
+    os.makedirs(source)
+    for table, rows in OMOP_TABLES.items():
+        with open(os.path.join(source, table + ".csv"), "w") as fd:
+            csv.writer(fd).writerows(rows)
+
+    extractors = [extractor for extractor in get_omop_csv_extractors() if extractor.get_file_prefix() in OMOP_TABLES]
+
+    results = []
+    for use_specs in (True, False):
+        stats_dict: Dict[str, Dict[str, int]] = {}
+        event_collection = run_csv_extractors(
+            source,
+            os.path.join(tmp_path, f"events_{use_specs}"),
+            extractors,
+            debug_folder=os.path.join(tmp_path, f"debug_{use_specs}"),
+            stats_dict=stats_dict,
+            use_specs=use_specs,
+        )
+        with event_collection.reader() as event_reader:
+            events = sorted(event_reader, key=lambda a: (a[0], a[1].start, a[1].concept_id, repr(a[1])))
+        results.append((events, stats_dict))
+
+    (spec_events, spec_stats), (python_events, python_stats) = results
+    assert len(spec_events) == 7
+    assert spec_events == python_events
+    assert spec_stats == python_stats
+    assert spec_stats["measurement"]["invalid_rows"] == 1
+
+    with open(os.path.join(tmp_path, "debug_True", "measurement.csv")) as fd:
+        assert [row["person_id"] for row in csv.DictReader(fd)] == ["2"]
+
+
+def test_zstd_frames(tmp_path: pathlib.Path) -> None:
+    def write(name: str, data: bytes) -> str:
+        path = os.path.join(tmp_path, name)
+        with open(path, "wb") as fd:
+            fd.write(data)
+        return path
+
+    compressor = zst.ZstdCompressor(1)
+    text = b"".join(b"%d,1995,0,test_value\n" % i for i in range(10000))
+    assert _get_zstd_frames(write("single.csv.zst", compressor.compress(text))) == [(0, len(text))]
+
+    # Incompressible frames are smaller than their content, so their blocks have to be walked
+    parts = [random.Random(i).randbytes(1000 * (i + 1)) for i in range(3)]
+    frames = [compressor.compress(part) for part in parts]
+    offsets = [sum(len(frame) for frame in frames[:i]) for i in range(3)]
+    expected = [(offset, len(part)) for offset, part in zip(offsets, parts)]
+    assert _get_zstd_frames(write("concatenated.csv.zst", b"".join(frames))) == expected
+
+    # pzstd stores the compressed size of every frame in a skippable frame before it
+    frames = [compressor.compress(text[i::3]) for i in range(3)]
+    pzstd = b"".join(struct.pack("<III", 0x184D2A50, 4, len(frame)) + frame for frame in frames)
+    offsets = [sum(len(frame) + 12 for frame in frames[:i]) + 12 for i in range(3)]
+    expected = [(offset, len(text[i::3])) for i, offset in enumerate(offsets)]
+    assert _get_zstd_frames(write("pzstd.csv.zst", pzstd)) == expected
+
+
+def test_chunked_extractors(tmp_path: pathlib.Path) -> None:
+    source = os.path.join(tmp_path, "source")
+    os.makedirs(source)
+    for table, rows in OMOP_TABLES.items():
+        with open(os.path.join(source, table + ".csv"), "w") as fd:
+            writer = csv.writer(fd)
+            writer.writerows(rows)
+            if table == "note":
+                # Quoted newlines make some chunks guess the wrong start of their first row
+                for i in range(200):
+                    writer.writerow([5 + i % 3, 5, "2013-01-02", "First line\nsecond line" if i % 7 else "Text", i])
+
+    extractors = [extractor for extractor in get_omop_csv_extractors() if extractor.get_file_prefix() in OMOP_TABLES]
+
+    for use_specs in (True, False):
+        results = []
+        for chunk_size in (None, 100):
+            stats_dict: Dict[str, Dict[str, int]] = {}
+            event_collection = run_csv_extractors(
+                source,
+                os.path.join(tmp_path, f"events_{use_specs}_{chunk_size}"),
+                extractors,
+                num_threads=2,
+                stats_dict=stats_dict,
+                use_specs=use_specs,
+                chunk_size=chunk_size,
+            )
+            with event_collection.reader() as event_reader:
+                events = sorted(event_reader, key=lambda a: (a[0], a[1].start, a[1].concept_id, repr(a[1])))
+            results.append((events, stats_dict))
+
+        (events, stats), (chunked_events, chunked_stats) = results
+        assert len(events) == 7 + 200
+        assert chunked_events == events
+        assert chunked_stats == stats
+        assert not [name for name in os.listdir(tmp_path) if name.startswith(".chunks_")]
+
+
+def test_checkpointed_extractors(tmp_path: pathlib.Path) -> None:
+    source = os.path.join(tmp_path, "source")
+    os.makedirs(source)
+
+    def write_tables(num_notes: int) -> None:
+        for table, rows in OMOP_TABLES.items():
+            with open(os.path.join(source, table + ".csv"), "w") as fd:
+                writer = csv.writer(fd)
+                writer.writerows(rows)
+                if table == "note":
+                    for i in range(num_notes):
+                        writer.writerow([5 + i % 3, 5, "2013-01-02", "Text", i])
+
+    def extract(name: str, checkpoint: bool) -> Tuple[Any, Dict[str, Dict[str, int]], Dict[str, int]]:
+        stats_dict: Dict[str, Dict[str, int]] = {}
+        event_collection = run_csv_extractors(
+            source,
+            os.path.join(tmp_path, name),
+            extractors,
+            num_threads=2,
+            stats_dict=stats_dict,
+            chunk_size=100,
+            checkpoint=checkpoint,
+        )
+        with event_collection.reader() as event_reader:
+            events = sorted(event_reader, key=lambda a: (a[0], a[1].start, a[1].concept_id, repr(a[1])))
+        files = {
+            child: os.stat(os.path.join(event_collection.path, child)).st_mtime_ns
+            for child in os.listdir(event_collection.path)
+        }
+        return events, stats_dict, files
+
+    extractors = [extractor for extractor in get_omop_csv_extractors() if extractor.get_file_prefix() in OMOP_TABLES]
+
+    write_tables(100)
+    events, stats, files = extract("events", True)
+    assert (events, stats) == extract("expected", False)[:2]
+
+    # Nothing is extracted again if nothing changed
+    assert extract("events", True) == (events, stats, files)
+
+    # Only the files of a changed source are replaced
+    write_tables(200)
+    new_events, new_stats, new_files = extract("events", True)
+    assert (new_events, new_stats) == extract("expected_200", False)[:2]
+
+    note_id = femr.datasets.checkpoints.Checkpoints(os.path.join(tmp_path, "events")).get_shard_id("note.csv")
+    assert {k: v for k, v in new_files.items() if not k.startswith(note_id)} == {
+        k: v for k, v in files.items() if not k.startswith(note_id)
+    }
+    assert not set(new_files) & {k for k in files if k.startswith(note_id)}
+
+
+def test_streaming_extractors(tmp_path: pathlib.Path) -> None:
+    source = os.path.join(tmp_path, "source")
+    os.makedirs(source)
+    for table, rows in OMOP_TABLES.items():
+        with open(os.path.join(source, table + ".csv"), "w") as fd:
+            writer = csv.writer(fd)
+            writer.writerows(rows)
+            if table == "note":
+                for i in range(200):
+                    writer.writerow([5 + i % 3, 5, "2013-01-02", "First line\nsecond line" if i % 7 else "Text", i])
+
+    extractors = [extractor for extractor in get_omop_csv_extractors() if extractor.get_file_prefix() in OMOP_TABLES]
+    transforms = [RemoveNones()]
+
+    def get_patients(patient_collection: femr.datasets.PatientCollection) -> Any:
+        with patient_collection.reader() as reader:
+            return sorted(
+                (p.patient_id, sorted(p.events, key=lambda e: (e.start, e.concept_id, repr(e)))) for p in reader
+            )
+
+    stats_dict: Dict[str, Dict[str, int]] = {}
+    transform_stats_dict: Dict[str, Dict[str, int]] = {}
+    timing_dict: Dict[str, Any] = {}
+    patients = run_csv_extractors_to_patients(
+        source,
+        os.path.join(tmp_path, "streamed_patients"),
+        extractors,
+        transforms,
+        num_threads=2,
+        stats_dict=stats_dict,
+        transform_stats_dict=transform_stats_dict,
+        timing_dict=timing_dict,
+        chunk_size=100,
+    )
+
+    expected_stats_dict: Dict[str, Dict[str, int]] = {}
+    expected_transform_stats_dict: Dict[str, Dict[str, int]] = {}
+    expected_patients = (
+        run_csv_extractors(
+            source, os.path.join(tmp_path, "events"), extractors, num_threads=2, stats_dict=expected_stats_dict
+        )
+        .to_patient_collection(os.path.join(tmp_path, "patients"), num_threads=2)
+        .transform(
+            os.path.join(tmp_path, "transformed_patients"),
+            transforms,
+            num_threads=2,
+            stats_dict=expected_transform_stats_dict,
+        )
+    )
+
+    assert get_patients(patients) == get_patients(expected_patients)
+    assert stats_dict == expected_stats_dict
+    assert transform_stats_dict == expected_transform_stats_dict
+    assert set(timing_dict["phase"]) == {"extract", "join_and_transform"}
+    assert not [name for name in os.listdir(tmp_path) if name.startswith(".streaming_")]
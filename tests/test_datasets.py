@@ -1,13 +1,25 @@
 import contextlib
+import csv
+import dataclasses
 import datetime
+import io
 import os
 import pathlib
+import pstats
 import random
-from typing import List, Optional, Tuple
+import sys
+from typing import Any, Dict, List, Optional, Tuple
+
+import pytest
+import zstandard
 
 import femr
 import femr.datasets
 
+# Needed to import `tools` for local testing
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from tools import DUMMY_CONCEPTS, create_ontology  # type: ignore # noqa: E402
+
 dummy_events = [
     femr.datasets.RawEvent(start=datetime.datetime(1995, 1, 3), concept_id=0, value=float(34)),
     femr.datasets.RawEvent(
@@ -28,8 +40,8 @@ for patient_id in range(10, 25):
     all_events.extend((patient_id, event) for event in dummy_events)
 
 
-def create_events(tmp_path: pathlib.Path) -> femr.datasets.EventCollection:
-    events = femr.datasets.EventCollection(os.path.join(tmp_path, "events"))
+def create_events(tmp_path: pathlib.Path, file_format: str = "rowgroups") -> femr.datasets.EventCollection:
+    events = femr.datasets.EventCollection(os.path.join(tmp_path, "events"), file_format)
 
     random.shuffle(all_events)
 
@@ -44,8 +56,8 @@ def create_events(tmp_path: pathlib.Path) -> femr.datasets.EventCollection:
     return events
 
 
-def create_patients(tmp_path: pathlib.Path) -> femr.datasets.PatientCollection:
-    return create_events(tmp_path).to_patient_collection(os.path.join(tmp_path, "patients"))
+def create_patients(tmp_path: pathlib.Path, file_format: str = "rowgroups") -> femr.datasets.PatientCollection:
+    return create_events(tmp_path, file_format).to_patient_collection(os.path.join(tmp_path, "patients"))
 
 
 def test_events(tmp_path: pathlib.Path) -> None:
@@ -59,10 +71,13 @@ def test_events(tmp_path: pathlib.Path) -> None:
     assert sorted(read_events) == sorted(all_events)
 
 
-def test_sort_events(tmp_path: pathlib.Path) -> None:
+@pytest.mark.parametrize("max_memory_bytes", [femr.datasets.DEFAULT_SORT_MEMORY_BYTES, 4096])
+def test_sort_events(tmp_path: pathlib.Path, max_memory_bytes: int) -> None:
     events = create_events(tmp_path)
 
-    sorted_events = events.sort(os.path.join(tmp_path, "sorted_events"), num_threads=2)
+    sorted_events = events.sort(
+        os.path.join(tmp_path, "sorted_events"), num_threads=2, max_memory_bytes=max_memory_bytes
+    )
 
     with sorted_events.reader() as reader:
         all_sorted_events = list(reader)
@@ -75,8 +90,12 @@ def test_sort_events(tmp_path: pathlib.Path) -> None:
             assert sorted(s_events, key=lambda a: (a[0], a[1].start)) == s_events
 
 
-def test_patients(tmp_path: pathlib.Path) -> None:
-    patients = create_patients(tmp_path)
+@pytest.mark.parametrize("file_format", femr.datasets.fileio.FILE_FORMATS)
+def test_patients(tmp_path: pathlib.Path, file_format: str) -> None:
+    patients = create_patients(tmp_path, file_format)
+
+    expected_suffix = ".csv.zst" if file_format == "csv" else femr.datasets.fileio.ROW_GROUP_EXTENSION
+    assert all(name.endswith(expected_suffix) for name in os.listdir(patients.path))
 
     with patients.reader() as reader:
         all_patients = list(reader)
@@ -123,3 +142,344 @@ def test_transform_patients(tmp_path: pathlib.Path) -> None:
             for event in dummy_events
         ]
         assert sorted(patient.events) == sorted(better_dummy_events)
+
+
+def test_transform_timing(tmp_path: pathlib.Path) -> None:
+    patients = create_patients(tmp_path)
+
+    timing_dict: Dict[str, Any] = {}
+    profile_dir = os.path.join(tmp_path, "profiles")
+    patients.transform(
+        os.path.join(tmp_path, "transformed_patients"),
+        transform_func,
+        num_threads=2,
+        timing_dict=timing_dict,
+        profile_dir=profile_dir,
+    )
+
+    assert timing_dict["rows"] == 15
+    assert timing_dict["wall_seconds"] > 0
+    assert sum(worker["rows"] for worker in timing_dict["workers"].values()) == 15
+    assert list(timing_dict["transform_seconds"]) == [str(transform_func)]
+
+    profiles = os.listdir(profile_dir)
+    assert len(profiles) == len(timing_dict["tasks"])
+    pstats.Stats(os.path.join(profile_dir, profiles[0]))
+
+
+@dataclasses.dataclass(frozen=True)
+class ReverseEvents(femr.datasets.PatientTransform):
+    needs_sorted_events = False
+
+    def apply(self, patient: femr.datasets.RawPatient) -> femr.datasets.RawPatient:
+        patient.events.reverse()
+        return patient
+
+
+@dataclasses.dataclass(frozen=True)
+class MarkSortedEvents(femr.datasets.PatientTransform):
+    preserves_order = True
+
+    def apply(self, patient: femr.datasets.RawPatient) -> femr.datasets.RawPatient:
+        is_sorted = patient.events == sorted(patient.events)
+        for event in patient.events:
+            event.value = "sorted" if is_sorted else "unsorted"
+        return patient
+
+
+@dataclasses.dataclass(frozen=True)
+class MarkEvents(MarkSortedEvents):
+    needs_sorted_events = False
+
+
+@pytest.mark.parametrize("mark, expected", [(MarkSortedEvents(), "sorted"), (MarkEvents(), "unsorted")])
+def test_transform_patients_sorts_lazily(
+    tmp_path: pathlib.Path, mark: femr.datasets.PatientTransform, expected: str
+) -> None:
+    patients = create_patients(tmp_path)
+
+    stats_dict: Dict[str, Dict[str, int]] = {}
+    transformed_patients = patients.transform(
+        os.path.join(tmp_path, "transformed_patients"), [ReverseEvents(), mark], stats_dict=stats_dict
+    )
+
+    # The events are only sorted before a transform that needs them in order, but always end up sorted
+    with transformed_patients.reader() as reader:
+        for patient in reader:
+            assert [(event.start, event.concept_id, event.value) for event in patient.events] == [
+                (event.start, event.concept_id, expected) for event in dummy_events
+            ]
+
+    assert stats_dict == {"ReverseEvents()": {"lost_events": 0}, str(mark): {"lost_events": 0}}
+
+
+def _get_modification_times(path: str) -> Dict[str, int]:
+    return {child: os.stat(os.path.join(path, child)).st_mtime_ns for child in os.listdir(path)}
+
+
+def test_checkpoints(tmp_path: pathlib.Path) -> None:
+    events = create_events(tmp_path)
+
+    patients_path = os.path.join(tmp_path, "patients")
+    patients = events.to_patient_collection(patients_path, num_threads=3, checkpoint=True)
+    patient_files = _get_modification_times(patients_path)
+    assert len(patient_files) == 3
+
+    # Only the missing patient file is written again
+    os.remove(os.path.join(patients_path, "1" + femr.datasets.fileio.ROW_GROUP_EXTENSION))
+    events.to_patient_collection(patients_path, num_threads=3, checkpoint=True)
+    new_patient_files = _get_modification_times(patients_path)
+    assert new_patient_files.keys() == patient_files.keys()
+    assert [name for name in patient_files if new_patient_files[name] != patient_files[name]] == [
+        "1" + femr.datasets.fileio.ROW_GROUP_EXTENSION
+    ]
+
+    transformed_path = os.path.join(tmp_path, "transformed_patients")
+
+    def transform(
+        transforms: List[femr.datasets.PatientTransform],
+    ) -> Tuple[Dict[str, int], Dict[str, Dict[str, int]]]:
+        stats_dict: Dict[str, Dict[str, int]] = {}
+        patients.transform(transformed_path, transforms, num_threads=2, stats_dict=stats_dict, checkpoint=True)
+        return _get_modification_times(transformed_path), stats_dict
+
+    transformed_files, stats = transform([ReverseEvents(), MarkSortedEvents()])
+    assert len(transformed_files) == 3
+
+    # Nothing is transformed again if nothing changed, and the statistics of the previous run are kept
+    assert transform([ReverseEvents(), MarkSortedEvents()]) == (transformed_files, stats)
+
+    # Changing the transforms invalidates every file
+    new_transformed_files, _ = transform([ReverseEvents(), MarkEvents()])
+    assert len(new_transformed_files) == 3
+    assert not new_transformed_files.keys() & transformed_files.keys()
+
+    with femr.datasets.PatientCollection(transformed_path).reader() as reader:
+        all_patients = list(reader)
+    assert sorted(p.patient_id for p in all_patients) == sorted(range(10, 25))
+    assert all(event.value == "unsorted" for p in all_patients for event in p.events)
+
+
+metadata_events = [
+    femr.datasets.RawEvent(
+        start=datetime.datetime(1995, 1, 3),
+        concept_id=0,
+        value=float(34),
+        visit_id=5,
+        end=datetime.datetime(1995, 1, 4, 10, 30),
+        omop_table="measurement",
+        unit="mg",
+    ),
+    femr.datasets.RawEvent(
+        start=datetime.datetime(2010, 1, 3),
+        concept_id=1,
+        value="test_value",
+        visit_id="not_an_int",
+        clarity_table="foo",
+    ),
+    femr.datasets.RawEvent(start=datetime.datetime(2010, 1, 5), concept_id=2, omop_table="condition_occurrence"),
+]
+
+
+def test_standard_metadata(tmp_path: pathlib.Path) -> None:
+    events = femr.datasets.EventCollection(os.path.join(tmp_path, "events"))
+    with contextlib.closing(events.create_writer()) as writer:
+        for event in metadata_events:
+            writer.add_event(10, event)
+
+    with events.reader() as reader:
+        assert [event for _, event in reader] == metadata_events
+
+    # Standard fields with the expected types are stored as columns instead of being pickled
+    (event_file,) = os.listdir(os.path.join(tmp_path, "events"))
+    with io.TextIOWrapper(
+        zstandard.ZstdDecompressor().stream_reader(open(os.path.join(tmp_path, "events", event_file), "rb"))
+    ) as f:
+        rows = list(csv.DictReader(f))
+
+    assert rows[0]["visit_id"] == "5"
+    assert rows[0]["unit"] == "mg"
+    assert rows[0]["metadata"] == ""
+    assert rows[1]["visit_id"] == ""
+    assert rows[1]["metadata"] != ""
+
+    path_to_ontology = os.path.join(tmp_path, "ontology")
+    create_ontology(path_to_ontology, DUMMY_CONCEPTS)
+
+    patients = events.to_patient_collection(os.path.join(tmp_path, "patients"))
+    path_to_database = os.path.join(tmp_path, "target")
+    patients.to_patient_database(path_to_database, path_to_ontology, num_threads=2).close()
+
+    with femr.datasets.PatientDatabase(path_to_database) as database:
+        first, second, third = database[10].events
+
+        assert first.visit_id == 5
+        assert first.end == datetime.datetime(1995, 1, 4, 10, 30)
+        assert first.omop_table == "measurement"
+        assert first.unit == "mg"
+
+        assert second.visit_id == "not_an_int"
+        assert second.clarity_table == "foo"
+        assert second.end is None
+
+        assert third.visit_id is None
+        assert third.omop_table == "condition_occurrence"
+
+
+def test_export_to_parquet(tmp_path: pathlib.Path) -> None:
+    pq = pytest.importorskip("pyarrow.parquet")
+
+    events = femr.datasets.EventCollection(os.path.join(tmp_path, "events"))
+    with contextlib.closing(events.create_writer()) as writer:
+        for patient_id in (10, 11, 12):
+            for event in metadata_events:
+                writer.add_event(patient_id, event)
+
+    path_to_ontology = os.path.join(tmp_path, "ontology")
+    create_ontology(path_to_ontology, DUMMY_CONCEPTS)
+
+    patients = events.to_patient_collection(os.path.join(tmp_path, "patients"))
+    path_to_database = os.path.join(tmp_path, "target")
+    path_to_export = os.path.join(tmp_path, "export")
+
+    with patients.to_patient_database(path_to_database, path_to_ontology) as database:
+        paths = femr.datasets.export_to_parquet(database, path_to_export, num_threads=2, patients_per_file=2)
+
+    assert len(paths) == 2
+    table = pq.read_table(path_to_export).to_pylist()
+    assert sorted(row["patient_id"] for row in table) == [10, 10, 10, 11, 11, 11, 12, 12, 12]
+
+    first, second, third = sorted((row for row in table if row["patient_id"] == 11), key=lambda row: row["start"])
+    assert first["start"] == datetime.datetime(1995, 1, 3)
+    assert first["code"] == "dummy/zero"
+    assert first["numeric_value"] == 34
+    assert first["text_value"] is None
+    assert first["visit_id"] == 5
+    assert first["end"] == datetime.datetime(1995, 1, 4, 10, 30)
+    assert first["omop_table"] == "measurement"
+    assert first["unit"] == "mg"
+
+    assert second["numeric_value"] is None
+    assert second["text_value"] == "test_value"
+    assert second["visit_id"] is None
+    assert second["end"] is None
+
+    assert third["code"] == "dummy/two"
+    assert third["text_value"] is None
+    assert third["omop_table"] == "condition_occurrence"
+    assert third["unit"] is None
+
+
+def _create_shard(tmp_path: pathlib.Path, name: str, patient_ids: List[int], path_to_ontology: str) -> str:
+    events = femr.datasets.EventCollection(os.path.join(tmp_path, name, "events"))
+    with contextlib.closing(events.create_writer()) as writer:
+        for patient_id in patient_ids:
+            for event in dummy_events:
+                writer.add_event(patient_id, event)
+            writer.add_event(patient_id, femr.datasets.RawEvent(start=datetime.datetime(2011, 1, 1), concept_id=3))
+
+    patients = events.to_patient_collection(os.path.join(tmp_path, name, "patients"))
+    path_to_database = os.path.join(tmp_path, name, "database")
+    patients.to_patient_database(path_to_database, path_to_ontology).close()
+    return path_to_database
+
+
+def test_sharded_database(tmp_path: pathlib.Path) -> None:
+    path_to_ontology = os.path.join(tmp_path, "ontology")
+    create_ontology(path_to_ontology, DUMMY_CONCEPTS)
+
+    paths = [
+        _create_shard(tmp_path, "shard_a", [3, 1, 5], path_to_ontology),
+        _create_shard(tmp_path, "shard_b", [2, 4], path_to_ontology),
+    ]
+
+    with femr.datasets.ShardedPatientDatabase(paths) as database:
+        assert len(database) == 5
+        assert sorted(database) == [1, 2, 3, 4, 5]
+        assert 4 in database
+        assert 6 not in database
+        assert database.get_shard_index(4) == 1
+        assert [e.code for e in database[4].events] == [
+            "dummy/zero",
+            "dummy/one",
+            "dummy/two",
+            "dummy/three",
+        ]
+
+        with pytest.raises(IndexError):
+            database[6]
+
+        ontology = database.get_ontology()
+        codes = ontology.get_codes()
+        for shard_index, shard in enumerate(database.shards):
+            shard_codes = shard.get_ontology().get_codes()
+            remap = ontology.get_code_remap(shard_index)
+            assert [codes[i] for i in remap] == list(shard_codes)
+
+        tasks = database.split_patient_ids([1, 2, 3, 4, 5], 4)
+        assert sorted(pid for _, pids in tasks for pid in pids) == [1, 2, 3, 4, 5]
+        for path, pids in tasks:
+            assert all(paths[database.get_shard_index(pid)] == path for pid in pids)
+
+    with pytest.raises(ValueError):
+        femr.datasets.ShardedPatientDatabase([paths[0], paths[0]])
+
+
+def test_patient_overlay(tmp_path: pathlib.Path) -> None:
+    path_to_ontology = os.path.join(tmp_path, "ontology")
+    create_ontology(path_to_ontology, DUMMY_CONCEPTS)
+
+    path_to_database = _create_shard(tmp_path, "base", [1, 2, 3], path_to_ontology)
+    base_id = femr.datasets.PatientDatabase(path_to_database).database_id()
+
+    events = femr.datasets.EventCollection(os.path.join(tmp_path, "update", "events"))
+    with contextlib.closing(events.create_writer()) as writer:
+        for patient_id in [2, 4]:
+            writer.add_event(patient_id, femr.datasets.RawEvent(start=datetime.datetime(2012, 1, 1), concept_id=2))
+    patients = events.to_patient_collection(os.path.join(tmp_path, "update", "patients"))
+
+    with femr.datasets.add_patient_overlay(path_to_database, patients, path_to_ontology) as database:
+        assert isinstance(database, femr.datasets.OverlayPatientDatabase)
+        assert sorted(database) == [1, 2, 3, 4]
+        assert database.get_layer_index(2) == 0
+        assert database.get_layer_index(1) == 1
+        assert [e.code for e in database[2].events] == ["dummy/two"]
+        assert len(database[1].events) == 4
+        assert database.database_id() != base_id
+        overlay_id = database.database_id()
+
+    with femr.datasets.delete_patients(path_to_database, [3, 4]) as database:
+        assert sorted(database) == [1, 2]
+        assert 3 not in database
+        assert database.database_id() not in (base_id, overlay_id)
+
+    # Native consumers do not resolve overlays, but can tell they are reading a stale view
+    with femr.datasets.PatientDatabase(path_to_database) as native_database:
+        assert sorted(native_database) == [1, 2, 3]
+        assert len(native_database[2].events) == 4
+        assert native_database.database_id() not in (base_id, overlay_id)
+
+    with femr.datasets.open_patient_database(path_to_database) as database:
+        assert isinstance(database, femr.datasets.OverlayPatientDatabase)
+        assert database.get_overlaid_patient_ids().tolist() == [2]
+        expected = {
+            patient_id: [(e.start, e.code, e.value) for e in database[patient_id].events] for patient_id in database
+        }
+
+    path_to_compacted = os.path.join(tmp_path, "compacted")
+    with femr.datasets.compact_patient_database(path_to_database, path_to_compacted, path_to_ontology) as compacted:
+        assert isinstance(compacted, femr.datasets.OverlayPatientDatabase)
+        assert len(compacted.overlays) == 1
+        assert sorted(compacted.base) == [1]
+        assert {
+            patient_id: [(e.start, e.code, e.value) for e in compacted[patient_id].events] for patient_id in compacted
+        } == expected
+
+    path_to_flattened = os.path.join(tmp_path, "flattened")
+    flattened = femr.datasets.compact_patient_database(
+        path_to_database, path_to_flattened, path_to_ontology, flatten=True
+    )
+    assert isinstance(flattened, femr.datasets.PatientDatabase)
+    assert {
+        patient_id: [(e.start, e.code, e.value) for e in flattened[patient_id].events] for patient_id in flattened
+    } == expected
@@ -1,11 +1,24 @@
 from __future__ import annotations
 
+import contextlib
 import datetime
+import os
+import pathlib
+import random
+from typing import Any, Dict
+
+import pytest
 
 import femr
+import femr.datasets
+from femr.etl_pipelines.mimic import _get_mimic_transformations
+from femr.etl_pipelines.sickkids import _get_sk_transformations
+from femr.etl_pipelines.stanford import _get_stanford_transformations
 from femr.extractors.omop import OMOP_BIRTH
-from femr.transforms import delta_encode, remove_nones
+from femr.transforms import DeltaEncode, RemoveNones, delta_encode, remove_nones
+from femr.transforms.sickkids import replace_categorical_measurement_results
 from femr.transforms.stanford import (
+    MovePreBirth,
     move_billing_codes,
     move_pre_birth,
     move_to_day_end,
@@ -356,3 +369,113 @@ def test_move_billing_codes() -> None:
     )
 
     assert move_billing_codes(patient) == expected
+
+
+def test_replace_categorical_measurement_results() -> None:
+    patient = femr.datasets.RawPatient(
+        patient_id=123,
+        events=[
+            femr.datasets.RawEvent(
+                start=datetime.datetime(1999, 7, 2), concept_id=1234, value=9999999, omop_table="measurement"
+            ),
+            femr.datasets.RawEvent(start=datetime.datetime(1999, 7, 2), concept_id=1234, value=9999999),
+        ],
+    )
+
+    expected = femr.datasets.RawPatient(
+        patient_id=123,
+        events=[
+            femr.datasets.RawEvent(start=datetime.datetime(1999, 7, 2), concept_id=1234, omop_table="measurement"),
+            femr.datasets.RawEvent(start=datetime.datetime(1999, 7, 2), concept_id=1234, value=9999999),
+        ],
+    )
+
+    assert replace_categorical_measurement_results(patient) == expected
+
+
+def _create_random_patients(path: str) -> femr.datasets.PatientCollection:
+    rng = random.Random(1234)
+
+    os.mkdir(path)
+    with contextlib.closing(femr.datasets.fileio.PatientWriter(path)) as writer:
+        for patient_id in range(100):
+            if patient_id % 20 == 1:
+                birth = datetime.datetime(1, 1, 1)
+            else:
+                birth = datetime.datetime(1990, 1, 1) + datetime.timedelta(
+                    days=rng.randrange(1000), hours=rng.randrange(2)
+                )
+
+            events = []
+            if patient_id % 20 != 2:
+                events.append(femr.datasets.RawEvent(start=birth, concept_id=OMOP_BIRTH, omop_table="person"))
+            if birth.year != 1:
+                events.append(
+                    femr.datasets.RawEvent(start=birth - datetime.timedelta(days=rng.randrange(60)), concept_id=6)
+                )
+
+            for visit_id in range(patient_id * 10, patient_id * 10 + 3):
+                visit_start = birth + datetime.timedelta(days=rng.randrange(0 if birth.year == 1 else -29, 365))
+                visit_end = visit_start + datetime.timedelta(hours=rng.randrange(-2, 48))
+                events.append(
+                    femr.datasets.RawEvent(
+                        start=visit_start,
+                        concept_id=5,
+                        visit_id=visit_id,
+                        end=visit_end,
+                        omop_table="visit_occurrence",
+                        clarity_table="shc_pat_enc",
+                    )
+                )
+                for _ in range(rng.randrange(10)):
+                    events.append(
+                        femr.datasets.RawEvent(
+                            start=visit_start + datetime.timedelta(hours=rng.choice([0, 0, 3, 24])),
+                            concept_id=rng.randrange(10, 14),
+                            value=rng.choice([None, 1.0, 2.0, 9999999.0, "a"]),
+                            visit_id=rng.choice([visit_id, visit_id, None]),
+                            omop_table=rng.choice(["condition_occurrence", "measurement"]),
+                            unit=rng.choice([None, "mg"]),
+                            clarity_table=rng.choice(["shc_pat_enc_dx", "lpch_arpb_transactions", None]),
+                        )
+                    )
+
+            patient = femr.datasets.RawPatient(patient_id=patient_id, events=events)
+            patient.resort()
+            writer.add_patient(patient)
+
+    return femr.datasets.PatientCollection(path)
+
+
+def _remove_measurements(patient: femr.datasets.RawPatient) -> femr.datasets.RawPatient:
+    patient.events = [event for event in patient.events if event.omop_table != "measurement"]
+    return patient
+
+
+@pytest.mark.parametrize("pipeline", ["stanford", "mimic", "sickkids", "mixed"])
+def test_native_transforms(tmp_path: pathlib.Path, pipeline: str) -> None:
+    patients = _create_random_patients(os.path.join(tmp_path, "patients"))
+
+    if pipeline == "stanford":
+        transforms = _get_stanford_transformations({10: 11, 12: 5})
+    elif pipeline == "mimic":
+        transforms = _get_mimic_transformations()
+    elif pipeline == "sickkids":
+        transforms = _get_sk_transformations()
+    else:
+        transforms = [MovePreBirth(), _remove_measurements, RemoveNones(), DeltaEncode(skip_omop_table="person")]
+
+    # Native transforms are only applied natively to row group files, so the CSV format uses the Python versions
+    results: Dict[str, Any] = {}
+    for file_format in femr.datasets.fileio.FILE_FORMATS:
+        stats_dict: Dict[str, Dict[str, int]] = {}
+        transformed = femr.datasets.PatientCollection(patients.path, file_format).transform(
+            os.path.join(tmp_path, file_format), transforms, num_threads=2, stats_dict=stats_dict
+        )
+        assert not any(child.startswith(".") for child in os.listdir(transformed.path))
+
+        with transformed.reader() as reader:
+            results[file_format] = (sorted(((p.patient_id, p.events) for p in reader), key=lambda a: a[0]), stats_dict)
+
+    assert results["rowgroups"] == results["csv"]
+    assert len(results["rowgroups"][0]) > 50